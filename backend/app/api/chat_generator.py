@@ -1,5 +1,5 @@
 import asyncio
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Header, HTTPException, Response
 from typing import Optional, Any, Dict, List, Set
 import logging
 import time
@@ -10,6 +10,8 @@ from app.models.schemas import (
     ChatGenerationResponse,
     CanvasSaveRequest,
     CanvasSaveResponse,
+    CanvasPatchRequest,
+    CanvasPatchResponse,
     CanvasSessionResponse,
     CanvasSessionData,
     CanvasSessionDeleteResponse,
@@ -17,11 +19,17 @@ from app.models.schemas import (
     Edge
 )
 from app.services.chat_generator import create_chat_generator_service, ARCHITECTURE_TEMPLATES
-from app.services.session_manager import get_session_manager
+from app.services.session_manager import SessionVersionConflict, get_session_manager
 from app.services.model_presets import get_model_presets_service
+from app.services.provider_health import get_provider_health
+from app.services.graph_ops import GraphOpApplier, GraphOpError
+from app.services.stream_json_parser import IncrementalJSONArrayParser
 from fastapi.responses import StreamingResponse
-import json
-from app.services.ai_vision import create_vision_service
+from app.services.ai_vision import create_vision_service, settle_response_cache
+from app.core.config import settings
+from app.core.serialization import json_dumps
+from app.services.concurrency_governor import queue_status_text
+from app.services.hedged_failover import HedgeExhaustedError, config_label, hedge_delay_for, run_hedged
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -117,77 +125,22 @@ def _is_finite_number(value: Any) -> bool:
     return isinstance(value, (int, float)) and not isinstance(value, bool)
 
 
-def _extract_array_objects(payload: str, array_key: str) -> List[Dict[str, Any]]:
-    """
-    Incrementally extract complete JSON objects from an array key in a partial JSON buffer.
-    Example: array_key="nodes" extracts objects from `"nodes": [ {...}, {...} ]`.
-    """
-    key_token = f"\"{array_key}\""
-    key_pos = payload.find(key_token)
-    if key_pos < 0:
-        return []
-
-    colon_pos = payload.find(":", key_pos + len(key_token))
-    if colon_pos < 0:
-        return []
-
-    array_start = payload.find("[", colon_pos)
-    if array_start < 0:
-        return []
+_PARTIAL_ARRAY_KEYS = ("layers", "items", "components", "services", "nodes", "edges")
 
-    results: List[Dict[str, Any]] = []
-    in_string = False
-    escaped = False
-    array_depth = 0
-    object_depth = 0
-    object_start = -1
-
-    for idx in range(array_start, len(payload)):
-        char = payload[idx]
-
-        if in_string:
-            if escaped:
-                escaped = False
-            elif char == "\\":
-                escaped = True
-            elif char == "\"":
-                in_string = False
-            continue
-
-        if char == "\"":
-            in_string = True
-            continue
-
-        if char == "[":
-            array_depth += 1
-            continue
-
-        if char == "]":
-            array_depth -= 1
-            if array_depth <= 0 and object_depth == 0:
-                break
-            continue
 
-        if char == "{":
-            if array_depth >= 1:
-                if object_depth == 0:
-                    object_start = idx
-                object_depth += 1
+def _apply_stream_ops(op_applier: GraphOpApplier, op_events: List[Any]) -> List[str]:
+    """应用流式解析出的操作，每条生成一个 [OP] / [OP_REJECTED] 事件"""
+    events: List[str] = []
+    for op_event in op_events:
+        try:
+            applied = op_applier.apply(op_event.value)
+        except GraphOpError as op_error:
+            events.append(
+                f"data: [OP_REJECTED] {json_dumps({'index': op_event.index, 'op': op_event.value, 'reason': str(op_error)})}\n\n"
+            )
             continue
-
-        if char == "}" and object_depth > 0:
-            object_depth -= 1
-            if object_depth == 0 and object_start != -1:
-                snippet = payload[object_start:idx + 1]
-                try:
-                    parsed = json.loads(snippet)
-                    if isinstance(parsed, dict):
-                        results.append(parsed)
-                except json.JSONDecodeError:
-                    pass
-                object_start = -1
-
-    return results
+        events.append(f"data: [OP] {json_dumps(dict(applied, index=op_event.index))}\n\n")
+    return events
 
 
 def _node_stream_identity(node_payload: Dict[str, Any]) -> str:
@@ -317,7 +270,30 @@ def _build_stream_config_candidates(
             candidates.extend(failover_fn(primary_config=primary, max_candidates=3))
         except Exception as error:
             logger.warning("[STREAM] Failed to load failover configs: %s", error)
-    return candidates
+    return get_provider_health().order_candidates(candidates, keep_primary=True)
+
+
+async def _open_first_token_stream(vision_service, prompt: str, first_token_timeout: float) -> tuple:
+    """打开 provider 流并等待首 token；失败或被取消时关闭流"""
+    stream_iterator = vision_service.generate_with_stream(prompt).__aiter__()
+    try:
+        first_token = await asyncio.wait_for(stream_iterator.__anext__(), timeout=first_token_timeout)
+    except StopAsyncIteration as empty_stream:
+        raise ValueError("Empty stream output") from empty_stream
+    except BaseException:
+        await _close_stream_quietly(stream_iterator)
+        raise
+    return stream_iterator, first_token
+
+
+async def _close_stream_quietly(stream_iterator) -> None:
+    aclose = getattr(stream_iterator, "aclose", None)
+    if aclose is None:
+        return
+    try:
+        await aclose()
+    except Exception as close_error:
+        logger.debug("[STREAM] Failed to close abandoned stream: %s", close_error)
 
 
 def _normalize_partial_edge(edge_payload: Dict[str, Any], fallback_index: int) -> Optional[Dict[str, Any]]:
@@ -786,6 +762,23 @@ async def generate_flowchart_stream(request: ChatGenerationRequest):
             prompt_request = request.model_copy(update={"diagram_type": effective_diagram_type})
             prompt = service._build_generation_prompt(prompt_request)
 
+            # 操作模式：模型只输出 {"ops": [...]}，每条操作闭合时校验、应用并推送 [OP]
+            op_applier: Optional[GraphOpApplier] = None
+            base_version: Optional[int] = None
+            if request.incremental_mode and request.session_id and request.incremental_output == "ops":
+                canvas = service._load_incremental_canvas(request.session_id)
+                if canvas:
+                    existing_nodes, existing_edges, base_version = canvas
+                    prompt, graph_codec = service._prepare_incremental_prompt(
+                        prompt_request, existing_nodes, existing_edges
+                    )
+                    # 故障切换时沿用同一份工作副本，重复的操作会被拒绝而不是重复应用
+                    op_applier = service._create_op_applier(existing_nodes, existing_edges, graph_codec)
+                    yield (
+                        "data: [START] incremental ops mode "
+                        f"(session nodes={len(existing_nodes)}, edges={len(existing_edges)})\n\n"
+                    )
+
             config_candidates = _build_stream_config_candidates(
                 provider=selected_provider,
                 api_key=request.api_key,
@@ -811,7 +804,9 @@ async def generate_flowchart_stream(request: ChatGenerationRequest):
             heartbeat_seconds = 6.0
             first_token_timeout_seconds = 18.0
 
-            for attempt_index, config in enumerate(config_candidates, start=1):
+            remaining_candidates = list(enumerate(config_candidates, start=1))
+            while remaining_candidates:
+                attempt_index, config = remaining_candidates.pop(0)
                 attempt_provider = config.get("provider") or selected_provider
                 attempt_model = config.get("model_name") or ""
                 selected_provider = attempt_provider
@@ -831,6 +826,7 @@ async def generate_flowchart_stream(request: ChatGenerationRequest):
                     )
                 except Exception as init_error:
                     status_code, error_code = _classify_upstream_error(init_error)
+                    get_provider_health().record_failure(config, status_code, error_code)
                     attempt_errors.append(
                         {
                             "provider": attempt_provider,
@@ -841,7 +837,7 @@ async def generate_flowchart_stream(request: ChatGenerationRequest):
                         }
                     )
                     logger.error("[STREAM] Failed to initialize streaming client: %s", init_error, exc_info=True)
-                    if attempt_index < len(config_candidates):
+                    if remaining_candidates:
                         yield (
                             "data: [WARN] "
                             f"attempt={attempt_index} init_failed ({status_code}:{error_code}), failover to next configuration\n\n"
@@ -849,9 +845,15 @@ async def generate_flowchart_stream(request: ChatGenerationRequest):
                         continue
                     break
 
+                queue_status = queue_status_text(vision_service)
+                if queue_status:
+                    yield f"data: [START] attempt={attempt_index}/{len(config_candidates)} {queue_status}\n\n"
+
                 accumulated = ""
                 chars_since_parse = 0
                 last_heartbeat = time.monotonic()
+                partial_parser = IncrementalJSONArrayParser(("ops",) if op_applier else _PARTIAL_ARRAY_KEYS)
+                completed_objects = []
                 token_batch = ""
                 token_batch_chars = 160
                 token_batch_interval_seconds = 0.2
@@ -882,6 +884,7 @@ async def generate_flowchart_stream(request: ChatGenerationRequest):
                     nonlocal architecture_layer_order
                     nonlocal architecture_layer_nodes
                     nonlocal token_batch
+                    nonlocal completed_objects
 
                     events: List[str] = []
                     if not text:
@@ -917,7 +920,7 @@ async def generate_flowchart_stream(request: ChatGenerationRequest):
 
                     def emit_partial_node(node_payload: Dict[str, Any]) -> None:
                         events.append(
-                            f"data: [PARTIAL_NODE] {json.dumps(node_payload, ensure_ascii=False)}\n\n"
+                            f"data: [PARTIAL_NODE] {json_dumps(node_payload)}\n\n"
                         )
 
                     accumulated += text
@@ -927,10 +930,20 @@ async def generate_flowchart_stream(request: ChatGenerationRequest):
                     else:
                         events.extend(flush_token_batch(force=False))
                     chars_since_parse += len(text)
+                    # Parser keeps lexer state across tokens; each object is reported once when it closes.
+                    completed_objects.extend(partial_parser.feed(text))
 
                     should_parse_partials = ("}" in text) or (chars_since_parse >= parse_interval_chars)
                     if should_parse_partials:
                         chars_since_parse = 0
+                        pending_objects = completed_objects
+                        completed_objects = []
+
+                        def objects_for(*keys: str) -> List[Any]:
+                            return [item for item in pending_objects if item.key in keys]
+
+                        if op_applier is not None:
+                            events.extend(_apply_stream_ops(op_applier, objects_for("ops")))
 
                         if effective_diagram_type == "architecture":
                             arch_type = request.architecture_type or "layered"
@@ -939,7 +952,9 @@ async def generate_flowchart_stream(request: ChatGenerationRequest):
                                 ARCHITECTURE_TEMPLATES["layered"],
                             )
                             arch_default_columns = int(arch_template.get("default_columns", 4))
-                            for layer_idx, raw_layer in enumerate(_extract_array_objects(accumulated, "layers")):
+                            for layer_event in objects_for("layers"):
+                                layer_idx = layer_event.index
+                                raw_layer = layer_event.value
                                 layer_name = str(raw_layer.get("name") or f"layer-{layer_idx + 1}").strip()
                                 layer_key = _normalize_alias_token(layer_name) or f"layer-{layer_idx + 1}"
                                 if layer_key not in seen_partial_layer_keys:
@@ -953,7 +968,7 @@ async def generate_flowchart_stream(request: ChatGenerationRequest):
                                         "columns": layer_layout.get("columns"),
                                     }
                                     events.append(
-                                        f"data: [PARTIAL_LAYER] {json.dumps(layer_event, ensure_ascii=False)}\n\n"
+                                        f"data: [PARTIAL_LAYER] {json_dumps(layer_event)}\n\n"
                                     )
                                 arch_partial_nodes = _build_architecture_partial_nodes(
                                     layer_payload=raw_layer,
@@ -971,24 +986,23 @@ async def generate_flowchart_stream(request: ChatGenerationRequest):
 
                             # Atomic parsing fallback: emit nodes from items/components objects
                             # before a full layer object is closed.
-                            item_object_keys = ("items", "components", "services")
-                            for item_key in item_object_keys:
-                                for raw_item in _extract_array_objects(accumulated, item_key):
-                                    atomic_node = _build_architecture_item_partial_node(
-                                        item_payload=raw_item,
-                                        fallback_index=partial_nodes_sent,
-                                        architecture_type=arch_type,
-                                    )
-                                    if not atomic_node:
-                                        continue
-                                    identity = _node_stream_identity(atomic_node)
-                                    if identity in seen_partial_node_keys:
-                                        continue
-                                    seen_partial_node_keys.add(identity)
-                                    register_partial_node(atomic_node)
-                                    emit_partial_node(atomic_node)
-
-                        for raw_node in _extract_array_objects(accumulated, "nodes"):
+                            for item_event in objects_for("items", "components", "services"):
+                                atomic_node = _build_architecture_item_partial_node(
+                                    item_payload=item_event.value,
+                                    fallback_index=partial_nodes_sent,
+                                    architecture_type=arch_type,
+                                )
+                                if not atomic_node:
+                                    continue
+                                identity = _node_stream_identity(atomic_node)
+                                if identity in seen_partial_node_keys:
+                                    continue
+                                seen_partial_node_keys.add(identity)
+                                register_partial_node(atomic_node)
+                                emit_partial_node(atomic_node)
+
+                        for node_event in objects_for("nodes"):
+                            raw_node = node_event.value
                             identity = _node_stream_identity(raw_node)
                             if identity in seen_partial_node_keys:
                                 continue
@@ -1001,7 +1015,8 @@ async def generate_flowchart_stream(request: ChatGenerationRequest):
                             register_partial_node(partial_node)
                             emit_partial_node(partial_node)
 
-                        for raw_edge in _extract_array_objects(accumulated, "edges"):
+                        for edge_event in objects_for("edges"):
+                            raw_edge = edge_event.value
                             identity = _edge_stream_identity(raw_edge)
                             if identity in seen_partial_edge_keys:
                                 continue
@@ -1018,7 +1033,7 @@ async def generate_flowchart_stream(request: ChatGenerationRequest):
                             seen_partial_edge_keys.add(identity)
                             partial_edges_sent += 1
                             events.append(
-                                f"data: [PARTIAL_EDGE] {json.dumps(partial_edge, ensure_ascii=False)}\n\n"
+                                f"data: [PARTIAL_EDGE] {json_dumps(partial_edge)}\n\n"
                             )
 
                         # Architecture streaming fallback:
@@ -1088,7 +1103,7 @@ async def generate_flowchart_stream(request: ChatGenerationRequest):
                                     )
                                     partial_edges_sent += 1
                                     events.append(
-                                        f"data: [PARTIAL_EDGE] {json.dumps(preview_edge, ensure_ascii=False)}\n\n"
+                                        f"data: [PARTIAL_EDGE] {json_dumps(preview_edge)}\n\n"
                                     )
 
                     now = time.monotonic()
@@ -1110,14 +1125,99 @@ async def generate_flowchart_stream(request: ChatGenerationRequest):
                         vision_service.provider,
                         vision_service.model_name,
                     )
-                    stream_iterator = vision_service.generate_with_stream(prompt).__aiter__()
+                    # 对冲：当前候选迟迟没有首 token 时，并行启动后续候选，先出首 token 者胜出
+                    race = [(attempt_index, config, vision_service)]
+                    race.extend((index, candidate, None) for index, candidate in remaining_candidates)
+                    race_started: Set[int] = set()
+                    race_events: List[str] = []
+
+                    async def open_race_stream(position: int, item) -> tuple:
+                        race_index, race_config, race_service = item
+                        race_started.add(race_index)
+                        if race_service is None:
+                            race_service = create_vision_service(
+                                provider=race_config.get("provider") or selected_provider,
+                                api_key=race_config.get("api_key"),
+                                base_url=race_config.get("base_url"),
+                                model_name=race_config.get("model_name"),
+                            )
+                        get_provider_health().begin_attempt(race_config)
+                        opened_at = time.perf_counter()
+                        race_iterator, race_first_token = await _open_first_token_stream(
+                            race_service, prompt, first_token_timeout_seconds
+                        )
+                        get_provider_health().record_success(
+                            race_config, first_token_seconds=time.perf_counter() - opened_at
+                        )
+                        return race_service, race_iterator, race_first_token
+
+                    def record_race_error(position: int, item, race_error: Exception) -> None:
+                        status_code, error_code = _classify_upstream_error(race_error)
+                        get_provider_health().record_failure(item[1], status_code, error_code)
+                        attempt_errors.append(
+                            {
+                                "provider": item[1].get("provider") or selected_provider,
+                                "model_name": item[1].get("model_name") or "",
+                                "status_code": status_code,
+                                "error_code": error_code,
+                                "detail": str(race_error),
+                            }
+                        )
+                        logger.warning("[STREAM] Attempt %s failed before first token: %s", item[0], race_error)
+                        race_events.append(
+                            "data: [WARN] "
+                            f"attempt={item[0]} stream_failed ({status_code}:{error_code}), failover to next configuration\n\n"
+                        )
+
+                    def announce_hedge(position: int, item) -> None:
+                        race_events.append(
+                            "data: [CALL] no first token yet, hedging with provider "
+                            f"{item[1].get('provider') or selected_provider}/{item[1].get('model_name') or '-'}...\n\n"
+                        )
+
+                    race_error: Optional[Exception] = None
                     try:
-                        first_token = await asyncio.wait_for(
-                            stream_iterator.__anext__(),
-                            timeout=first_token_timeout_seconds,
+                        winner_position, (vision_service, stream_iterator, first_token) = await run_hedged(
+                            race,
+                            open_race_stream,
+                            hedge_delay=hedge_delay_for(streaming=True),
+                            label=lambda item: config_label(item[1]),
+                            max_parallel=settings.HEDGE_MAX_PARALLEL,
+                            on_error=record_race_error,
+                            on_hedge=announce_hedge,
+                            discard=lambda opened: _close_stream_quietly(opened[1]),
+                        )
+                    except Exception as error:
+                        race_error = error
+
+                    # 参与过竞速的候选不再串行重试
+                    remaining_candidates = [
+                        (index, candidate) for index, candidate in remaining_candidates
+                        if index not in race_started
+                    ]
+                    for event in race_events:
+                        yield event
+                    if race_error is not None:
+                        raise race_error
+
+                    if winner_position > 0:
+                        attempt_index, config = race[winner_position][0], race[winner_position][1]
+                        attempt_provider = config.get("provider") or selected_provider
+                        attempt_model = config.get("model_name") or ""
+                        selected_provider = attempt_provider
+                        logger.warning(
+                            "[STREAM] Attempt %s (%s/%s) produced the first token after failover/hedge",
+                            attempt_index,
+                            attempt_provider,
+                            attempt_model,
+                        )
+
+                    queue_wait = getattr(vision_service, "last_queue_wait", 0.0) or 0.0
+                    if queue_wait >= 0.05:
+                        yield (
+                            f"data: [START] attempt={attempt_index}/{len(config_candidates)} "
+                            f"dequeued queue_wait={queue_wait:.2f}s\n\n"
                         )
-                    except StopAsyncIteration as empty_stream:
-                        raise ValueError("Empty stream output") from empty_stream
 
                     for event in build_events_from_token(first_token):
                         yield event
@@ -1132,17 +1232,20 @@ async def generate_flowchart_stream(request: ChatGenerationRequest):
                     for event in flush_token_batch(force=True):
                         yield event
                     status_code, error_code = _classify_upstream_error(stream_error)
-                    attempt_errors.append(
-                        {
-                            "provider": attempt_provider,
-                            "model_name": attempt_model,
-                            "status_code": status_code,
-                            "error_code": error_code,
-                            "detail": str(stream_error),
-                        }
-                    )
+                    # 首 token 之前的失败已在对冲回调中逐个记录
+                    if not isinstance(stream_error, HedgeExhaustedError):
+                        get_provider_health().record_failure(config, status_code, error_code)
+                        attempt_errors.append(
+                            {
+                                "provider": attempt_provider,
+                                "model_name": attempt_model,
+                                "status_code": status_code,
+                                "error_code": error_code,
+                                "detail": str(stream_error),
+                            }
+                        )
                     logger.error("[STREAM] Streaming interrupted: %s", stream_error, exc_info=True)
-                    if attempt_index < len(config_candidates):
+                    if remaining_candidates:
                         yield (
                             "data: [WARN] "
                             f"attempt={attempt_index} stream_failed ({status_code}:{error_code}), failover to next configuration\n\n"
@@ -1155,6 +1258,38 @@ async def generate_flowchart_stream(request: ChatGenerationRequest):
                             raise ValueError("Empty stream output")
 
                         ai_data = service._safe_json(accumulated)
+                        if op_applier is not None:
+                            if not isinstance(ai_data.get("ops"), list):
+                                raise ValueError("AI response has no ops array")
+                            for event in _apply_stream_ops(
+                                op_applier, [item for item in completed_objects if item.key == "ops"]
+                            ):
+                                yield event
+                            settle_response_cache(vision_service, accepted=True)
+                            try:
+                                session_id, saved_nodes, saved_edges = service._save_generated_canvas(
+                                    request.session_id, op_applier.nodes, op_applier.edges, base_version, op_applier
+                                )
+                            except SessionVersionConflict as conflict:
+                                # 生成期间会话被其他写入更新且无法重放：不覆盖，也不切换到下一个配置
+                                logger.warning("[STREAM] Ops result rejected: %s", conflict)
+                                yield f"data: [ERROR] {conflict}\n\n"
+                                return
+                            yield (
+                                f"data: [RESULT] nodes={len(saved_nodes)}, edges={len(saved_edges)}, "
+                                f"ops_applied={len(op_applier.applied)}, ops_rejected={len(op_applier.rejected)}, "
+                                f"session_id={session_id}, version={get_session_manager().get_session_version(session_id)}\n\n"
+                            )
+                            yield "data: [END] done\n\n"
+                            logger.info(
+                                "[STREAM] Completed ops mode. applied=%s rejected=%s provider=%s model=%s",
+                                len(op_applier.applied),
+                                len(op_applier.rejected),
+                                attempt_provider,
+                                attempt_model,
+                            )
+                            return
+
                         if effective_diagram_type == "architecture":
                             arch_type = request.architecture_type or "layered"
                             nodes, edges, mermaid_code = service._normalize_architecture_graph(ai_data, arch_type)
@@ -1169,6 +1304,7 @@ async def generate_flowchart_stream(request: ChatGenerationRequest):
                             len(nodes),
                             len(edges),
                         )
+                        settle_response_cache(vision_service, accepted=True)
 
                         layout_data = {
                             "nodes": [n.model_dump() if hasattr(n, "model_dump") else n for n in nodes],
@@ -1176,7 +1312,7 @@ async def generate_flowchart_stream(request: ChatGenerationRequest):
                             "diagram_type": effective_diagram_type,
                             "mermaid_code": mermaid_code,
                         }
-                        yield f"data: [LAYOUT_DATA] {json.dumps(layout_data, ensure_ascii=False)}\n\n"
+                        yield f"data: [LAYOUT_DATA] {json_dumps(layout_data)}\n\n"
                         yield f"data: [RESULT] nodes={len(nodes)}, edges={len(edges)}\n\n"
 
                         # Compatibility fallback for old clients.
@@ -1203,7 +1339,9 @@ async def generate_flowchart_stream(request: ChatGenerationRequest):
                         return
                     except Exception as parse_error:
                         parse_failed = True
+                        settle_response_cache(vision_service, accepted=False)
                         status_code, error_code = _classify_upstream_error(parse_error)
+                        get_provider_health().record_failure(config, status_code, error_code)
                         attempt_errors.append(
                             {
                                 "provider": attempt_provider,
@@ -1215,7 +1353,7 @@ async def generate_flowchart_stream(request: ChatGenerationRequest):
                         )
                         logger.warning("[STREAM] Parse failed after stream: %s", parse_error, exc_info=True)
 
-                if attempt_index < len(config_candidates):
+                if remaining_candidates:
                     reason = "parse_failed" if parse_failed else "stream_failed"
                     yield (
                         "data: [WARN] "
@@ -1240,7 +1378,7 @@ async def generate_flowchart_stream(request: ChatGenerationRequest):
                         "diagram_type": effective_diagram_type,
                         "mermaid_code": result.mermaid_code,
                     }
-                    yield f"data: [LAYOUT_DATA] {json.dumps(layout_data, ensure_ascii=False)}\n\n"
+                    yield f"data: [LAYOUT_DATA] {json_dumps(layout_data)}\n\n"
                     yield f"data: [RESULT] nodes={len(result.nodes)}, edges={len(result.edges)}\n\n"
 
                     if partial_nodes_sent == 0 and partial_edges_sent == 0:
@@ -1299,8 +1437,26 @@ async def generate_flowchart_stream(request: ChatGenerationRequest):
 # Canvas Session Management (澧為噺鐢熸垚浼氳瘽绠＄悊)
 # ============================================================
 
+def _session_etag(version: Optional[int]) -> str:
+    """会话版本号对应的强 ETag"""
+    return f'"{version or 1}"'
+
+
+def _parse_if_match(if_match: str) -> Optional[int]:
+    """解析 If-Match（"3" / W/"3" / 3）为版本号，"*" 返回 None（不校验版本）"""
+    value = if_match.strip()
+    if value == "*":
+        return None
+    if value.startswith("W/"):
+        value = value[2:]
+    try:
+        return int(value.strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid If-Match header: {if_match}")
+
+
 @router.post("/chat-generator/session/save", response_model=CanvasSaveResponse)
-async def save_canvas_session(request: CanvasSaveRequest):
+async def save_canvas_session(request: CanvasSaveRequest, response: Response):
     """
     淇濆瓨褰撳墠鐢诲竷鍒颁細璇?
 
@@ -1327,12 +1483,15 @@ async def save_canvas_session(request: CanvasSaveRequest):
 
         logger.info(f"Canvas session saved: {session_id}")
 
+        version = session_manager.get_session_version(session_id)
+        response.headers["ETag"] = _session_etag(version)
         return CanvasSaveResponse(
             success=True,
             session_id=session_id,
             message="Canvas session saved successfully",
             node_count=len(request.nodes),
-            edge_count=len(request.edges)
+            edge_count=len(request.edges),
+            version=version
         )
 
     except ValueError as ve:
@@ -1348,8 +1507,69 @@ async def save_canvas_session(request: CanvasSaveRequest):
         )
 
 
+@router.patch("/chat-generator/session/{session_id}", response_model=CanvasPatchResponse)
+async def patch_canvas_session(
+    session_id: str,
+    request: CanvasPatchRequest,
+    response: Response,
+    if_match: Optional[str] = Header(default=None)
+):
+    """
+    以编辑操作增量更新会话（乐观并发）
+
+    基准版本取自 If-Match 头（GET / save / PATCH 响应中的 ETag），没有时使用 request.base_version；
+    两者都没有时返回 428。版本不一致返回 409（响应 ETag 为当前版本），操作无效返回 422，整个补丁不生效。
+
+    Args:
+        session_id: 会话 ID
+        request: 包含 ops（见 app.services.canvas_patch）与可选的 base_version
+
+    Returns:
+        CanvasPatchResponse: 新版本号与节点 / 边数量，ETag 头为新版本
+    """
+    if if_match is not None:
+        expected_version = _parse_if_match(if_match)
+    elif request.base_version is not None:
+        expected_version = request.base_version
+    else:
+        raise HTTPException(status_code=428, detail="If-Match header or base_version is required")
+
+    try:
+        session_data = get_session_manager().patch_session(session_id, request.ops, expected_version)
+    except SessionVersionConflict as conflict:
+        logger.warning(f"Rejected stale patch: {conflict}")
+        raise HTTPException(
+            status_code=409,
+            detail=str(conflict),
+            headers={"ETag": _session_etag(conflict.current_version)}
+        )
+    except GraphOpError as op_error:
+        raise HTTPException(status_code=422, detail=str(op_error))
+    except ValueError as ve:
+        # 会话过大
+        logger.error(f"Failed to patch session: {ve}")
+        raise HTTPException(status_code=413, detail=str(ve))
+    except Exception as e:
+        logger.error(f"Failed to patch canvas session: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Failed to patch session: {str(e)}")
+
+    if session_data is None:
+        raise HTTPException(status_code=404, detail=f"Session not found or expired: {session_id}")
+
+    response.headers["ETag"] = _session_etag(session_data["version"])
+    return CanvasPatchResponse(
+        success=True,
+        session_id=session_id,
+        version=session_data["version"],
+        applied=len(request.ops),
+        node_count=session_data["node_count"],
+        edge_count=session_data["edge_count"],
+        message="Canvas session patched successfully"
+    )
+
+
 @router.get("/chat-generator/session/{session_id}", response_model=CanvasSessionResponse)
-async def get_canvas_session(session_id: str):
+async def get_canvas_session(session_id: str, response: Response):
     """
     鑾峰彇浼氳瘽鏁版嵁
 
@@ -1363,18 +1583,19 @@ async def get_canvas_session(session_id: str):
         logger.info(f"Retrieving canvas session: {session_id}")
 
         session_manager = get_session_manager()
-        session_data = session_manager.get_session(session_id)
+        loaded = session_manager.get_session_graph(session_id)
 
-        if not session_data:
+        if not loaded:
             logger.warning(f"Session not found or expired: {session_id}")
             raise HTTPException(
                 status_code=404,
                 detail=f"Session not found or expired: {session_id}"
             )
 
-        # 杞崲涓哄搷搴旀牸寮?
-        nodes = [Node(**n) for n in session_data["nodes"]]
-        edges = [Edge(**e) for e in session_data["edges"]]
+        # 会话缓存的已校验模型（版本未变时不重新校验）
+        session_data, graph = loaded
+        nodes = graph.nodes
+        edges = graph.edges
 
         session_response = CanvasSessionData(
             nodes=nodes,
@@ -1382,7 +1603,8 @@ async def get_canvas_session(session_id: str):
             node_count=session_data["node_count"],
             edge_count=session_data["edge_count"],
             timestamp=session_data["timestamp"].isoformat(),
-            created_at=session_data["created_at"].isoformat()
+            created_at=session_data["created_at"].isoformat(),
+            version=session_data.get("version")
         )
 
         logger.info(
@@ -1390,6 +1612,8 @@ async def get_canvas_session(session_id: str):
             f"({session_data['node_count']} nodes, {session_data['edge_count']} edges)"
         )
 
+        response.headers["ETag"] = _session_etag(session_data.get("version"))
+
         return CanvasSessionResponse(
             success=True,
             session=session_response
@@ -3,13 +3,16 @@ from fastapi import APIRouter, HTTPException
 from fastapi.responses import StreamingResponse
 from typing import Any, Dict, List, Optional, Set
 import logging
-import json
 import time
 
+from app.core.serialization import json_dumps
 from app.models.schemas import ExcalidrawGenerateRequest, ExcalidrawGenerateResponse
 from app.services.excalidraw_generator import create_excalidraw_service
-from app.services.ai_vision import create_vision_service
+from app.services.ai_vision import create_vision_service, settle_response_cache
+from app.services.concurrency_governor import queue_status_text
 from app.services.model_presets import get_model_presets_service
+from app.services.provider_health import get_provider_health
+from app.services.stream_json_parser import IncrementalJSONArrayParser
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -30,75 +33,6 @@ def _is_finite_number(value: Any) -> bool:
     return isinstance(value, (int, float)) and not isinstance(value, bool)
 
 
-def _extract_array_objects(payload: str, array_key: str) -> List[Dict[str, Any]]:
-    key_token = f"\"{array_key}\""
-    key_pos = payload.find(key_token)
-    if key_pos < 0:
-        return []
-
-    colon_pos = payload.find(":", key_pos + len(key_token))
-    if colon_pos < 0:
-        return []
-
-    array_start = payload.find("[", colon_pos)
-    if array_start < 0:
-        return []
-
-    results: List[Dict[str, Any]] = []
-    in_string = False
-    escaped = False
-    array_depth = 0
-    object_depth = 0
-    object_start = -1
-
-    for idx in range(array_start, len(payload)):
-        char = payload[idx]
-
-        if in_string:
-            if escaped:
-                escaped = False
-            elif char == "\\":
-                escaped = True
-            elif char == "\"":
-                in_string = False
-            continue
-
-        if char == "\"":
-            in_string = True
-            continue
-
-        if char == "[":
-            array_depth += 1
-            continue
-
-        if char == "]":
-            array_depth -= 1
-            if array_depth <= 0 and object_depth == 0:
-                break
-            continue
-
-        if char == "{":
-            if array_depth >= 1:
-                if object_depth == 0:
-                    object_start = idx
-                object_depth += 1
-            continue
-
-        if char == "}" and object_depth > 0:
-            object_depth -= 1
-            if object_depth == 0 and object_start != -1:
-                snippet = payload[object_start:idx + 1]
-                try:
-                    parsed = json.loads(snippet)
-                    if isinstance(parsed, dict):
-                        results.append(parsed)
-                except json.JSONDecodeError:
-                    pass
-                object_start = -1
-
-    return results
-
-
 def _element_stream_identity(element_payload: Dict[str, Any]) -> str:
     element_id = str(element_payload.get("id") or "").strip()
     if element_id:
@@ -222,7 +156,7 @@ def _build_config_candidates(request: ExcalidrawGenerateRequest) -> List[Dict[st
 
     candidates = [primary]
     candidates.extend(presets_service.get_failover_configs(primary_config=primary, max_candidates=3))
-    return candidates
+    return get_provider_health().order_candidates(candidates, keep_primary=True)
 
 
 def _is_fallback_scene_message(message: str) -> bool:
@@ -252,6 +186,7 @@ async def generate_excalidraw_scene(request: ExcalidrawGenerateRequest):
                 provider,
                 model_name,
             )
+            started_at = time.perf_counter()
             scene = await service.generate_scene(
                 prompt=request.prompt,
                 style=request.style,
@@ -274,6 +209,8 @@ async def generate_excalidraw_scene(request: ExcalidrawGenerateRequest):
                 logger.warning("[EXCALIDRAW] Attempt %s returned fallback scene, trying next config", index)
                 continue
 
+            get_provider_health().record_success(config, latency_seconds=time.perf_counter() - started_at)
+
             return ExcalidrawGenerateResponse(
                 scene=scene,
                 success=True,
@@ -281,6 +218,7 @@ async def generate_excalidraw_scene(request: ExcalidrawGenerateRequest):
             )
         except Exception as error:
             status_code, error_code = _classify_upstream_error(error)
+            get_provider_health().record_failure(config, status_code, error_code)
             attempt_errors.append({
                 "provider": provider,
                 "model_name": model_name,
@@ -347,6 +285,7 @@ async def generate_excalidraw_scene_stream(request: ExcalidrawGenerateRequest):
         for attempt_index, config in enumerate(config_candidates, start=1):
             provider = config.get("provider")
             model_name = config.get("model_name")
+            vision_service = None
             try:
                 yield f"data: [START] attempt={attempt_index}/{len(config_candidates)} provider={provider} model={model_name}\n\n"
                 yield "data: [CALL] Generating Excalidraw scene...\n\n"
@@ -357,6 +296,10 @@ async def generate_excalidraw_scene_stream(request: ExcalidrawGenerateRequest):
                     base_url=config.get("base_url"),
                     model_name=model_name,
                 )
+                get_provider_health().begin_attempt(config)
+                queue_status = queue_status_text(vision_service)
+                if queue_status:
+                    yield f"data: [START] attempt={attempt_index}/{len(config_candidates)} {queue_status}\n\n"
                 prompt = service._build_prompt(
                     request.prompt,
                     request.style,
@@ -365,8 +308,7 @@ async def generate_excalidraw_scene_stream(request: ExcalidrawGenerateRequest):
                 )
 
                 accumulated = ""
-                chars_since_parse = 0
-                parse_interval_chars = 120
+                partial_parser = IncrementalJSONArrayParser(("elements",))
                 heartbeat_seconds = 8.0
                 last_heartbeat = time.monotonic()
                 seen_partial_keys: Set[str] = set()
@@ -397,16 +339,21 @@ async def generate_excalidraw_scene_stream(request: ExcalidrawGenerateRequest):
                 except StopAsyncIteration as empty_stream:
                     raise ValueError("Empty stream output") from empty_stream
 
+                queue_wait = getattr(vision_service, "last_queue_wait", 0.0) or 0.0
+                if queue_wait >= 0.05:
+                    yield (
+                        f"data: [START] attempt={attempt_index}/{len(config_candidates)} "
+                        f"dequeued queue_wait={queue_wait:.2f}s\n\n"
+                    )
+
                 async def process_token(token: str):
                     nonlocal accumulated
-                    nonlocal chars_since_parse
                     nonlocal last_heartbeat
                     nonlocal partial_elements_sent
                     nonlocal token_batch
                     if not token:
                         return
                     accumulated += token
-                    chars_since_parse += len(token)
                     token_batch += token
                     if "\n" in token:
                         async for event in flush_token_batch(force=True):
@@ -415,21 +362,20 @@ async def generate_excalidraw_scene_stream(request: ExcalidrawGenerateRequest):
                         async for event in flush_token_batch(force=False):
                             yield event
 
-                    should_parse_partials = ("}" in token) or (chars_since_parse >= parse_interval_chars)
-                    if should_parse_partials:
-                        chars_since_parse = 0
-                        for raw_element in _extract_array_objects(accumulated, "elements"):
-                            identity = _element_stream_identity(raw_element)
-                            if identity in seen_partial_keys:
-                                continue
-                            partial_element = _normalize_partial_element(raw_element, partial_elements_sent)
-                            if not partial_element:
-                                continue
-                            seen_partial_keys.add(identity)
-                            partial_elements_sent += 1
-                            yield (
-                                f"data: [PARTIAL_ELEMENT] {json.dumps(partial_element, ensure_ascii=False)}\n\n"
-                            )
+                    # Incremental parser: only the new token is scanned, each element is reported once.
+                    for element_event in partial_parser.feed(token):
+                        raw_element = element_event.value
+                        identity = _element_stream_identity(raw_element)
+                        if identity in seen_partial_keys:
+                            continue
+                        partial_element = _normalize_partial_element(raw_element, partial_elements_sent)
+                        if not partial_element:
+                            continue
+                        seen_partial_keys.add(identity)
+                        partial_elements_sent += 1
+                        yield (
+                            f"data: [PARTIAL_ELEMENT] {json_dumps(partial_element)}\n\n"
+                        )
 
                     now = time.monotonic()
                     if now - last_heartbeat >= heartbeat_seconds:
@@ -451,6 +397,10 @@ async def generate_excalidraw_scene_stream(request: ExcalidrawGenerateRequest):
                 scene = service._validate_scene(ai_data, request.width or 1200, request.height or 800)
                 message = scene.appState.get("message", "") if isinstance(scene.appState, dict) else ""
                 is_fallback_scene = _is_fallback_scene_message(message)
+                if is_fallback_scene:
+                    settle_response_cache(vision_service, accepted=False)
+                else:
+                    settle_response_cache(vision_service, accepted=True)
 
                 if is_fallback_scene and attempt_index < len(config_candidates):
                     yield (
@@ -464,16 +414,20 @@ async def generate_excalidraw_scene_stream(request: ExcalidrawGenerateRequest):
                     }
                     continue
 
+                if not is_fallback_scene:
+                    get_provider_health().record_success(config)
                 response_data = {
                     "scene": scene.model_dump(),
                     "success": not is_fallback_scene,
                     "message": message or f"Scene generated via {provider}/{model_name}",
                 }
-                yield f"data: [RESULT] {json.dumps(response_data, ensure_ascii=False)}\n\n"
+                yield f"data: [RESULT] {json_dumps(response_data)}\n\n"
                 yield "data: [END] done\n\n"
                 return
             except Exception as error:
+                settle_response_cache(vision_service, accepted=False)
                 status_code, error_code = _classify_upstream_error(error)
+                get_provider_health().record_failure(config, status_code, error_code)
                 attempt_errors.append({
                     "provider": provider,
                     "model_name": model_name,
@@ -493,7 +447,7 @@ async def generate_excalidraw_scene_stream(request: ExcalidrawGenerateRequest):
                 f"{fallback_response.get('message', 'Fallback scene returned')}. "
                 "All configured providers returned fallback output."
             )
-            yield f"data: [RESULT] {json.dumps(fallback_response, ensure_ascii=False)}\n\n"
+            yield f"data: [RESULT] {json_dumps(fallback_response)}\n\n"
             yield "data: [END] done\n\n"
             return
 
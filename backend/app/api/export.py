@@ -23,6 +23,7 @@ from app.models.schemas import (
     RefineSectionRequest,
     ImprovementSuggestions,
 )
+from app.core.serialization import json_dumps
 from app.services.ppt_exporter import create_ppt_exporter
 from app.services.slidev_exporter import create_slidev_exporter
 from app.services.ai_vision import create_vision_service
@@ -248,7 +249,7 @@ async def generate_script_stream(
             try:
                 # Phase 1: 发送开始事件
                 start_data = {'type': 'GENERATION_START', 'data': {'message': 'AI正在创作演讲稿...'}}
-                yield f"data: {json.dumps(start_data, ensure_ascii=False)}\n\n"
+                yield f"data: {json_dumps(start_data)}\n\n"
                 logger.info("[SCRIPT-STREAM] Sent GENERATION_START event")
 
                 # 获取有效配置
@@ -262,7 +263,7 @@ async def generate_script_stream(
 
                 if not config:
                     error_data = {'type': 'ERROR', 'data': {'message': 'No AI configuration found. Please configure AI model in settings.'}}
-                    yield f"data: {json.dumps(error_data, ensure_ascii=False)}\n\n"
+                    yield f"data: {json_dumps(error_data)}\n\n"
                     return
 
                 # Create AI service for streaming
@@ -336,7 +337,7 @@ async def generate_script_stream(
                         accumulated += text
                         # 立即yield - 不要任何延迟
                         token_data = {'type': 'TOKEN', 'data': {'token': text}}
-                        yield f"data: {json.dumps(token_data, ensure_ascii=False)}\n\n"
+                        yield f"data: {json_dumps(token_data)}\n\n"
 
                     # 完成后发送COMPLETE事件
                     logger.info(f"[SCRIPT-STREAM] Streaming completed, total length: {len(accumulated)}")
@@ -358,13 +359,13 @@ async def generate_script_stream(
                             'estimated_seconds': int(len(accumulated) / 2.5)
                         }
                     }
-                    yield f"data: {json.dumps(complete_data, ensure_ascii=False)}\n\n"
+                    yield f"data: {json_dumps(complete_data)}\n\n"
                 else:
                     # 降级到非流式
                     logger.info(f"[SCRIPT-STREAM] Provider {provider} doesn't support streaming, using non-streaming")
                     result = await ai_service.generate_speech_script(request.nodes, request.edges, request.duration)
                     token_data = {'type': 'TOKEN', 'data': {'token': result}}
-                    yield f"data: {json.dumps(token_data, ensure_ascii=False)}\n\n"
+                    yield f"data: {json_dumps(token_data)}\n\n"
                     sections = {"intro": result[:len(result)//3], "body": result[len(result)//3:len(result)*2//3], "conclusion": result[len(result)*2//3:]}
                     complete_data = {
                         'type': 'COMPLETE',
@@ -379,16 +380,15 @@ async def generate_script_stream(
                             'estimated_seconds': int(len(result) / 2.5)
                         }
                     }
-                    yield f"data: {json.dumps(complete_data, ensure_ascii=False)}\n\n"
+                    yield f"data: {json_dumps(complete_data)}\n\n"
 
             except Exception as e:
                 logger.error(f"[SCRIPT-STREAM] Stream generation error: {e}", exc_info=True)
-                error_event = json.dumps(
+                error_event = json_dumps(
                     {
                         "type": "ERROR",
                         "data": {"error": str(e)}
-                    },
-                    ensure_ascii=False
+                    }
                 )
                 yield f"data: {error_event}\n\n"
 
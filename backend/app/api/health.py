@@ -1,6 +1,16 @@
 from fastapi import APIRouter
 import logging
 
+from app.services.client_pool import get_client_registry
+from app.services.concurrency_governor import get_concurrency_governor
+from app.services.hedged_failover import get_hedge_stats
+from app.services.image_preprocessor import get_image_preprocessor
+from app.services.provider_health import get_provider_health
+from app.services.response_cache import get_response_cache
+from app.services.session_manager import get_session_manager
+from app.services.single_flight import get_single_flight
+from app.services.vision_result_cache import get_vision_result_cache
+
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
@@ -15,3 +25,29 @@ async def health_check():
         "service": "SmartArchitect AI",
         "phase": "Phase 1 MVP",
     }
+
+
+@router.get("/health/metrics")
+async def runtime_metrics():
+    """运行时指标（LLM 响应缓存命中率、SDK 客户端池、图片预处理、视觉结果缓存、对冲 failover、provider 并发排队、单飞合并、画布会话内存层与后台写盘等）"""
+    return {
+        "llm_cache": get_response_cache().get_stats(),
+        "client_pool": get_client_registry().get_stats(),
+        "image_preprocess": get_image_preprocessor().get_stats(),
+        "vision_cache": get_vision_result_cache().get_stats(),
+        "hedging": get_hedge_stats().get_stats(),
+        "concurrency": get_concurrency_governor().get_stats(),
+        "single_flight": get_single_flight().get_stats(),
+        "sessions": get_session_manager().get_session_stats(),
+        "session_persist": get_session_manager().get_persistence_stats(),
+    }
+
+
+@router.get("/health/providers")
+async def provider_health():
+    """候选配置的熔断状态与健康分（按健康分从高到低，不包含 api_key）"""
+    registry = get_provider_health()
+    return {
+        "enabled": registry.enabled,
+        "providers": registry.get_states(),
+    }
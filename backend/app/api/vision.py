@@ -13,8 +13,12 @@ from app.models.schemas import (
     Position,
     NodeData
 )
-from app.services.ai_vision import create_vision_service
+from app.core.serialization import json_dumps
+from app.services.ai_vision import create_vision_service, settle_response_cache
+from app.services.json_recovery import JSONRecoveryError, describe_repairs, recover_json
 from app.services.model_presets import get_model_presets_service
+from app.services.stream_json_parser import IncrementalJSONArrayParser
+from app.services.vision_result_cache import lookup_vision_result, store_vision_result
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -640,13 +644,12 @@ async def analyze_flowchart_screenshot_stream_v2(request: VisionToReactFlowReque
     - error: Error occurred
     """
     from fastapi.responses import StreamingResponse
-    import json
     import base64
 
     async def generate():
         try:
             # Initial event
-            yield f"data: {json.dumps({'type': 'init', 'message': '开始分析流程图...'})}\n\n"
+            yield f"data: {json_dumps({'type': 'init', 'message': '开始分析流程图...'})}\n\n"
 
             # Extract base64 data
             image_data_str = request.image_data
@@ -658,21 +661,21 @@ async def analyze_flowchart_screenshot_stream_v2(request: VisionToReactFlowReque
                 file_size = len(image_data)
                 logger.info(f"[FLOWCHART STREAM] Decoded image: {file_size} bytes")
             except Exception as e:
-                yield f"data: {json.dumps({'type': 'error', 'message': f'图片解码失败: {str(e)}'})}\n\n"
+                yield f"data: {json_dumps({'type': 'error', 'message': f'图片解码失败: {str(e)}'})}\n\n"
                 return
 
             # Validate file size
             MAX_SIZE = 10 * 1024 * 1024
             if file_size > MAX_SIZE:
-                yield f"data: {json.dumps({'type': 'error', 'message': f'文件过大: {file_size / 1024 / 1024:.2f}MB (最大 10MB)'})}\n\n"
+                yield f"data: {json_dumps({'type': 'error', 'message': f'文件过大: {file_size / 1024 / 1024:.2f}MB (最大 10MB)'})}\n\n"
                 return
 
             if file_size == 0:
-                yield f"data: {json.dumps({'type': 'error', 'message': '文件为空'})}\n\n"
+                yield f"data: {json_dumps({'type': 'error', 'message': '文件为空'})}\n\n"
                 return
 
             # Get configuration
-            yield f"data: {json.dumps({'type': 'progress', 'message': '正在配置 AI 模型...'})}\n\n"
+            yield f"data: {json_dumps({'type': 'progress', 'message': '正在配置 AI 模型...'})}\n\n"
 
             presets_service = get_model_presets_service()
             config = presets_service.get_active_config(
@@ -683,12 +686,12 @@ async def analyze_flowchart_screenshot_stream_v2(request: VisionToReactFlowReque
             )
 
             if not config:
-                yield f"data: {json.dumps({'type': 'error', 'message': '未找到 AI 配置，请先在设置中配置 AI 模型'})}\n\n"
+                yield f"data: {json_dumps({'type': 'error', 'message': '未找到 AI 配置，请先在设置中配置 AI 模型'})}\n\n"
                 return
 
             # Create vision service
             provider_name = config["provider"]
-            yield f"data: {json.dumps({'type': 'progress', 'message': f'正在初始化 {provider_name} 服务...'})}\n\n"
+            yield f"data: {json_dumps({'type': 'progress', 'message': f'正在初始化 {provider_name} 服务...'})}\n\n"
 
             try:
                 vision_service = create_vision_service(
@@ -698,23 +701,23 @@ async def analyze_flowchart_screenshot_stream_v2(request: VisionToReactFlowReque
                     model_name=config.get("model_name")
                 )
             except Exception as e:
-                yield f"data: {json.dumps({'type': 'error', 'message': f'初始化 AI 服务失败: {str(e)}'})}\n\n"
+                yield f"data: {json_dumps({'type': 'error', 'message': f'初始化 AI 服务失败: {str(e)}'})}\n\n"
                 return
 
             # Analysis progress messages
-            yield f"data: {json.dumps({'type': 'progress', 'message': '🔍 正在分析图片结构...'})}\n\n"
+            yield f"data: {json_dumps({'type': 'progress', 'message': '🔍 正在分析图片结构...'})}\n\n"
             await asyncio.sleep(0.1)
 
-            yield f"data: {json.dumps({'type': 'progress', 'message': '📊 正在识别节点形状（开始/结束/任务/判断）...'})}\n\n"
+            yield f"data: {json_dumps({'type': 'progress', 'message': '📊 正在识别节点形状（开始/结束/任务/判断）...'})}\n\n"
             await asyncio.sleep(0.1)
 
-            yield f"data: {json.dumps({'type': 'progress', 'message': '✏️ 正在提取文本标签...'})}\n\n"
+            yield f"data: {json_dumps({'type': 'progress', 'message': '✏️ 正在提取文本标签...'})}\n\n"
             await asyncio.sleep(0.1)
 
-            yield f"data: {json.dumps({'type': 'progress', 'message': '🔗 正在识别连线关系...'})}\n\n"
+            yield f"data: {json_dumps({'type': 'progress', 'message': '🔗 正在识别连线关系...'})}\n\n"
             await asyncio.sleep(0.1)
 
-            yield f"data: {json.dumps({'type': 'progress', 'message': '⚡ 正在生成 Mermaid 代码...'})}\n\n"
+            yield f"data: {json_dumps({'type': 'progress', 'message': '⚡ 正在生成 Mermaid 代码...'})}\n\n"
 
             # Perform actual analysis with keep-alive progress events to avoid idle timeouts.
             try:
@@ -733,14 +736,14 @@ async def analyze_flowchart_screenshot_stream_v2(request: VisionToReactFlowReque
                     elapsed_wait += heartbeat_interval
                     if analysis_task.done():
                         break
-                    yield f"data: {json.dumps({'type': 'progress', 'message': f'⏳ AI 正在深度识别流程图（已用时 {elapsed_wait}s）...'})}\n\n"
+                    yield f"data: {json_dumps({'type': 'progress', 'message': f'⏳ AI 正在深度识别流程图（已用时 {elapsed_wait}s）...'})}\n\n"
 
                 result = await analysis_task
 
                 logger.info(f"[FLOWCHART STREAM] Analysis complete: {len(result.nodes)} nodes, {len(result.edges)} edges")
 
                 # ✅ Apply collision detection (use aggressive mode to ensure no overlaps)
-                yield f"data: {json.dumps({'type': 'progress', 'message': '🔧 正在修正节点间距...'})}\n\n"
+                yield f"data: {json_dumps({'type': 'progress', 'message': '🔧 正在修正节点间距...'})}\n\n"
                 result.nodes = _fix_node_overlaps(result.nodes, gentle_mode=False)
                 logger.info(f"[FLOWCHART STREAM] Collision detection complete")
 
@@ -773,18 +776,18 @@ async def analyze_flowchart_screenshot_stream_v2(request: VisionToReactFlowReque
                 }
 
                 # Send completion event with full result
-                yield f"data: {json.dumps({'type': 'complete', 'message': f'✅ 识别完成！共 {len(result.nodes)} 个节点，{len(result.edges)} 条连线', 'result': result_dict})}\n\n"
+                yield f"data: {json_dumps({'type': 'complete', 'message': f'✅ 识别完成！共 {len(result.nodes)} 个节点，{len(result.edges)} 条连线', 'result': result_dict})}\n\n"
 
             except ValueError as e:
                 logger.error(f"[FLOWCHART STREAM] Parsing error: {e}")
-                yield f"data: {json.dumps({'type': 'error', 'message': f'AI 响应解析失败: {str(e)}'})}\n\n"
+                yield f"data: {json_dumps({'type': 'error', 'message': f'AI 响应解析失败: {str(e)}'})}\n\n"
             except Exception as e:
                 logger.error(f"[FLOWCHART STREAM] Analysis failed: {e}", exc_info=True)
-                yield f"data: {json.dumps({'type': 'error', 'message': f'分析失败: {str(e)}'})}\n\n"
+                yield f"data: {json_dumps({'type': 'error', 'message': f'分析失败: {str(e)}'})}\n\n"
 
         except Exception as e:
             logger.error(f"[FLOWCHART STREAM] Unexpected error: {e}", exc_info=True)
-            yield f"data: {json.dumps({'type': 'error', 'message': f'处理失败: {str(e)}'})}\n\n"
+            yield f"data: {json_dumps({'type': 'error', 'message': f'处理失败: {str(e)}'})}\n\n"
 
     return StreamingResponse(generate(), media_type="text/event-stream")
 
@@ -840,9 +843,6 @@ async def generate_excalidraw_from_image(request: VisionToExcalidrawRequest):
     }
     ```
     """
-    import json
-    import re
-
     try:
         # 获取有效配置
         presets_service = get_model_presets_service()
@@ -1002,6 +1002,21 @@ Additional instructions: {request.prompt or 'None'}
         import base64
         image_bytes = base64.b64decode(image_data)
 
+        # 近似重复的截图（另存/缩放/裁边）直接复用已生成的场景
+        cache_slot, cached_scene = await lookup_vision_result(
+            "excalidraw",
+            image_bytes,
+            config["provider"],
+            config.get("model_name"),
+            config.get("base_url"),
+            prompt=request.prompt or "",
+            width=request.width,
+            height=request.height,
+        )
+        if cached_scene is not None:
+            logger.info(f"[Excalidraw] Vision cache hit: {len(cached_scene.get('elements', []))} elements")
+            return VisionToExcalidrawResponse(success=True, scene=cached_scene)
+
         # Call AI vision service
         # Prefer streaming collection for OpenAI-compatible providers to avoid
         # long one-shot stalls (common with large multimodal JSON outputs).
@@ -1040,42 +1055,28 @@ Additional instructions: {request.prompt or 'None'}
 
         logger.info(f"Raw AI response received (length: {len(raw_response)})")
 
-        # Extract JSON from response
-        json_pattern = r'```json\s*(.*?)\s*```'
-        match = re.search(json_pattern, raw_response, re.DOTALL)
-
-        if match:
-            json_str = match.group(1)
-        else:
-            # Try to find JSON object directly
-            json_obj_pattern = r'\{.*\}'
-            match = re.search(json_obj_pattern, raw_response, re.DOTALL)
-            if match:
-                json_str = match.group(0)
-            else:
-                return VisionToExcalidrawResponse(
-                    success=False,
-                    message="Failed to extract JSON from AI response",
-                    raw_response=raw_response[:500]
-                )
-
-        # Parse JSON
+        # Extract JSON from response (prose / code fences / truncation tolerated)
         try:
-            scene_data = json.loads(json_str)
-        except json.JSONDecodeError as e:
+            recovered = recover_json(raw_response)
+        except JSONRecoveryError as e:
             logger.error(f"JSON parse error: {e}")
+            settle_response_cache(vision_service, accepted=False)
             return VisionToExcalidrawResponse(
                 success=False,
-                message=f"Invalid JSON: {str(e)}",
-                raw_response=json_str[:500]
+                message="Failed to extract JSON from AI response",
+                raw_response=raw_response[:500]
             )
+        if recovered.repaired:
+            logger.warning(f"JSON repaired: {describe_repairs(recovered.repairs)}")
+        scene_data = recovered.value
 
         # Validate structure
         if "elements" not in scene_data:
+            settle_response_cache(vision_service, accepted=False)
             return VisionToExcalidrawResponse(
                 success=False,
                 message="Response missing 'elements' field",
-                raw_response=json_str[:500]
+                raw_response=raw_response[:500]
             )
 
         # Ensure appState exists
@@ -1181,6 +1182,9 @@ Additional instructions: {request.prompt or 'None'}
 
         logger.info(f"Successfully generated Excalidraw scene with {len(scene_data['elements'])} elements (normalized)")
 
+        settle_response_cache(vision_service, accepted=True)
+        await store_vision_result(cache_slot, scene_data)
+
         return VisionToExcalidrawResponse(
             success=True,
             scene=scene_data
@@ -1201,8 +1205,6 @@ async def generate_excalidraw_from_image_stream(request: VisionToExcalidrawReque
     Uses multimodal streaming APIs to yield elements as they are generated in real-time.
     """
     from fastapi.responses import StreamingResponse
-    import json
-    import re
     import random
     import time
 
@@ -1266,57 +1268,9 @@ async def generate_excalidraw_from_image_stream(request: VisionToExcalidrawReque
 
         return element
 
-    def try_parse_incremental_elements(json_buffer: str, parsed_ids: set) -> list:
-        """
-        🔥 Incrementally parse JSON buffer to extract completed elements.
-        Returns list of newly completed elements (not previously parsed).
-        """
-        # Try to extract elements array even from incomplete JSON
-        # Pattern: "elements": [ {...}, {...}, ... ]
-        elements_pattern = r'"elements"\s*:\s*\[\s*(.*?)(?:\]|$)'
-        match = re.search(elements_pattern, json_buffer, re.DOTALL)
-
-        if not match:
-            return []
-
-        elements_str = match.group(1)
-
-        # Find all complete element objects (balanced braces)
-        new_elements = []
-        brace_count = 0
-        start_idx = -1
-        i = 0
-
-        while i < len(elements_str):
-            char = elements_str[i]
-
-            if char == '{':
-                if brace_count == 0:
-                    start_idx = i
-                brace_count += 1
-            elif char == '}':
-                brace_count -= 1
-                if brace_count == 0 and start_idx != -1:
-                    # Found a complete element
-                    element_str = elements_str[start_idx:i+1]
-                    try:
-                        element = json.loads(element_str)
-                        # Only return if not already parsed
-                        element_id = element.get("id", "")
-                        if element_id and element_id not in parsed_ids:
-                            new_elements.append(element)
-                            parsed_ids.add(element_id)
-                    except json.JSONDecodeError:
-                        pass  # Incomplete element, wait for more tokens
-                    start_idx = -1
-
-            i += 1
-
-        return new_elements
-
     async def generate():
         try:
-            yield f"data: {json.dumps({'type': 'init', 'message': 'Starting real-time Excalidraw generation...'})}\n\n"
+            yield f"data: {json_dumps({'type': 'init', 'message': 'Starting real-time Excalidraw generation...'})}\n\n"
 
             # 获取有效配置
             presets_service = get_model_presets_service()
@@ -1328,7 +1282,7 @@ async def generate_excalidraw_from_image_stream(request: VisionToExcalidrawReque
             )
 
             if not config:
-                yield f"data: {json.dumps({'type': 'error', 'message': 'No AI configuration found. Please configure AI model in settings.'})}\n\n"
+                yield f"data: {json_dumps({'type': 'error', 'message': 'No AI configuration found. Please configure AI model in settings.'})}\n\n"
                 return
 
             # Create vision service
@@ -1339,7 +1293,7 @@ async def generate_excalidraw_from_image_stream(request: VisionToExcalidrawReque
                 model_name=config.get("model_name")
             )
 
-            yield f"data: {json.dumps({'type': 'progress', 'message': 'Analyzing image...'})}\n\n"
+            yield f"data: {json_dumps({'type': 'progress', 'message': 'Analyzing image...'})}\n\n"
 
             # Build prompt
             excalidraw_prompt = f"""
@@ -1473,36 +1427,46 @@ Additional instructions: {request.prompt or 'None'}
             import base64
             image_bytes = base64.b64decode(image_data)
 
+            cache_slot, cached_scene = await lookup_vision_result(
+                "excalidraw",
+                image_bytes,
+                config["provider"],
+                config.get("model_name"),
+                config.get("base_url"),
+                prompt=request.prompt or "",
+                width=request.width,
+                height=request.height,
+            )
+            if cached_scene is not None:
+                cached_elements = cached_scene.get("elements", [])
+                for cached_element in cached_elements:
+                    yield f"data: {json_dumps({'type': 'element', 'element': cached_element})}\n\n"
+                yield f"data: {json_dumps({'type': 'complete', 'message': f'Generated {len(cached_elements)} elements (cached result)'})}\n\n"
+                logger.info(f"[REAL STREAM] Vision cache hit: replayed {len(cached_elements)} elements")
+                return
+
             # 🔥 Use real streaming with multimodal API
-            yield f"data: {json.dumps({'type': 'progress', 'message': 'Starting real-time generation...'})}\n\n"
+            yield f"data: {json_dumps({'type': 'progress', 'message': 'Starting real-time generation...'})}\n\n"
 
-            json_buffer = ""
+            element_parser = IncrementalJSONArrayParser(("elements",))
             parsed_ids = set()  # Track which elements we've already sent
             timestamp = int(time.time() * 1000)
             element_count = 0
             arrow_count = 0  # Track connection count
             shape_count = 0  # Track shape count
             emitted_elements: List[Dict[str, Any]] = []
-            chars_since_parse = 0
             last_element_ts = time.monotonic()
 
             # Stream tokens in real-time
             async for token in vision_service.generate_with_vision_stream(image_bytes, excalidraw_prompt):
-                json_buffer += token
-                chars_since_parse += len(token)
-
-                # Performance guard:
-                # avoid O(n^2) full-buffer scans on every tiny token.
-                should_parse_now = ("}" in token) or (chars_since_parse >= 256)
-                if not should_parse_now:
-                    continue
-                chars_since_parse = 0
+                # Incremental parser keeps lexer state across tokens (no full-buffer rescans)
+                for element_event in element_parser.feed(token):
+                    element = element_event.value
+                    element_id = element.get("id", "")
+                    if not element_id or element_id in parsed_ids:
+                        continue
+                    parsed_ids.add(element_id)
 
-                # Try to parse new complete elements from the buffer
-                new_elements = try_parse_incremental_elements(json_buffer, parsed_ids)
-
-                # Yield each new element immediately
-                for element in new_elements:
                     normalized = normalize_element(element, timestamp)
                     element_count += 1
                     emitted_elements.append(normalized)
@@ -1518,7 +1482,7 @@ Additional instructions: {request.prompt or 'None'}
                     elif element_type in ["rectangle", "ellipse", "diamond"]:
                         shape_count += 1
 
-                    yield f"data: {json.dumps({'type': 'element', 'element': normalized})}\n\n"
+                    yield f"data: {json_dumps({'type': 'element', 'element': normalized})}\n\n"
                     logger.info(f"[REAL STREAM] Yielded element {element_count}: {element.get('id')} (type: {element_type})")
 
                 # Stall guard: if model keeps streaming tokens but no new complete
@@ -1531,25 +1495,6 @@ Additional instructions: {request.prompt or 'None'}
                     )
                     break
 
-            # Final parse pass after stream ends to catch trailing complete elements.
-            final_elements = try_parse_incremental_elements(json_buffer, parsed_ids)
-            for element in final_elements:
-                normalized = normalize_element(element, timestamp)
-                element_count += 1
-                emitted_elements.append(normalized)
-
-                element_type = element.get("type")
-                if element_type in ["arrow", "line"]:
-                    arrow_count += 1
-                elif element_type in ["rectangle", "ellipse", "diamond"]:
-                    shape_count += 1
-
-                yield f"data: {json.dumps({'type': 'element', 'element': normalized})}\n\n"
-                logger.info(
-                    f"[REAL STREAM] Yielded final-pass element {element_count}: "
-                    f"{element.get('id')} (type: {element_type})"
-                )
-
             # Quality guard for streaming mode: ensure at least baseline connectors exist.
             if arrow_count == 0 and shape_count > 1:
                 auto_scene = {
@@ -1562,7 +1507,7 @@ Additional instructions: {request.prompt or 'None'}
                     for auto_element in auto_scene["elements"][-auto_added:]:
                         element_count += 1
                         arrow_count += 1
-                        yield f"data: {json.dumps({'type': 'element', 'element': auto_element})}\n\n"
+                        yield f"data: {json_dumps({'type': 'element', 'element': auto_element})}\n\n"
                     logger.warning(
                         "[REAL STREAM] No connectors from AI output; auto-inferred %s arrows",
                         auto_added,
@@ -1576,12 +1521,22 @@ Additional instructions: {request.prompt or 'None'}
                 logger.warning(f"⚠️ No arrows/lines detected for {shape_count} shapes - possible AI recognition issue")
                 completion_message += " - ⚠️ No connections detected"
 
-            yield f"data: {json.dumps({'type': 'complete', 'message': completion_message})}\n\n"
+            if emitted_elements:
+                settle_response_cache(vision_service, accepted=True)
+                await store_vision_result(cache_slot, {
+                    "elements": emitted_elements,
+                    "appState": {"viewBackgroundColor": "#ffffff"},
+                    "files": {},
+                })
+            else:
+                settle_response_cache(vision_service, accepted=False)
+
+            yield f"data: {json_dumps({'type': 'complete', 'message': completion_message})}\n\n"
             logger.info(f"[REAL STREAM] Completed with {element_count} elements ({shape_count} shapes, {arrow_count} connections)")
 
         except Exception as e:
             logger.error(f"Excalidraw real streaming failed: {e}", exc_info=True)
-            yield f"data: {json.dumps({'type': 'error', 'message': f'Generation failed: {str(e)}'})}\n\n"
+            yield f"data: {json_dumps({'type': 'error', 'message': f'Generation failed: {str(e)}'})}\n\n"
 
     return StreamingResponse(generate(), media_type="text/event-stream")
 
@@ -1590,13 +1545,12 @@ Additional instructions: {request.prompt or 'None'}
 async def test_stream():
     """Simple test streaming endpoint"""
     from fastapi.responses import StreamingResponse
-    import json
     import asyncio
 
     async def generate():
-        yield f"data: {json.dumps({'test': 'hello'})}\n\n"
+        yield f"data: {json_dumps({'test': 'hello'})}\n\n"
         await asyncio.sleep(0.1)
-        yield f"data: {json.dumps({'test': 'world'})}\n\n"
+        yield f"data: {json_dumps({'test': 'world'})}\n\n"
 
     return StreamingResponse(generate(), media_type="text/event-stream")
 
@@ -1608,14 +1562,13 @@ async def generate_excalidraw_stream_mock():
     Streams 5 test elements progressively.
     """
     from fastapi.responses import StreamingResponse
-    import json
     import random
     import asyncio
     import time
 
     async def generate():
         try:
-            yield f"data: {json.dumps({'type': 'init', 'message': 'Starting mock generation...'})}\n\n"
+            yield f"data: {json_dumps({'type': 'init', 'message': 'Starting mock generation...'})}\n\n"
             await asyncio.sleep(0.1)
 
             # Mock elements
@@ -1629,7 +1582,7 @@ async def generate_excalidraw_stream_mock():
 
             appState = {"viewBackgroundColor": "#ffffff"}
 
-            yield f"data: {json.dumps({'type': 'start_streaming', 'total': len(elements), 'appState': appState})}\n\n"
+            yield f"data: {json_dumps({'type': 'start_streaming', 'total': len(elements), 'appState': appState})}\n\n"
             await asyncio.sleep(0.1)
 
             timestamp = int(time.time() * 1000)
@@ -1652,14 +1605,14 @@ async def generate_excalidraw_stream_mock():
                     element["endBinding"] = None
                     element["endArrowhead"] = "arrow"
 
-                yield f"data: {json.dumps({'type': 'element', 'element': element, 'index': idx, 'total': len(elements)})}\n\n"
+                yield f"data: {json_dumps({'type': 'element', 'element': element, 'index': idx, 'total': len(elements)})}\n\n"
                 await asyncio.sleep(0.3)  # 300ms delay per element for visual effect
 
-            yield f"data: {json.dumps({'type': 'complete', 'message': 'Mock generation complete'})}\n\n"
+            yield f"data: {json_dumps({'type': 'complete', 'message': 'Mock generation complete'})}\n\n"
 
         except Exception as e:
             logger.error(f"Mock streaming failed: {e}", exc_info=True)
-            yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
+            yield f"data: {json_dumps({'type': 'error', 'message': str(e)})}\n\n"
 
     return StreamingResponse(generate(), media_type="text/event-stream")
 
@@ -1694,8 +1647,6 @@ async def generate_reactflow_from_image(request: VisionToReactFlowRequest):
     - container: Generic containers
     - default: Default nodes
     """
-    import json
-    import re
     from app.models.schemas import Node, Edge, Position, NodeData
 
     try:
@@ -1829,6 +1780,18 @@ For a 2-row layout:
         import base64
         image_bytes = base64.b64decode(image_data)
 
+        cache_slot, cached_diagram = await lookup_vision_result(
+            "reactflow",
+            image_bytes,
+            config["provider"],
+            config.get("model_name"),
+            config.get("base_url"),
+            prompt=request.prompt or "",
+        )
+        if cached_diagram is not None:
+            logger.info(f"Vision cache hit: {len(cached_diagram['nodes'])} nodes, {len(cached_diagram['edges'])} edges")
+            return VisionToReactFlowResponse(success=True, **cached_diagram)
+
         # Call AI vision service
         raw_response = await vision_service.generate_with_vision(
             image_data=image_bytes,
@@ -1837,42 +1800,28 @@ For a 2-row layout:
 
         logger.info(f"Raw AI response received (length: {len(raw_response)})")
 
-        # Extract JSON from response
-        json_pattern = r'```json\s*(.*?)\s*```'
-        match = re.search(json_pattern, raw_response, re.DOTALL)
-
-        if match:
-            json_str = match.group(1)
-        else:
-            # Try to find JSON object directly
-            json_obj_pattern = r'\{.*\}'
-            match = re.search(json_obj_pattern, raw_response, re.DOTALL)
-            if match:
-                json_str = match.group(0)
-            else:
-                return VisionToReactFlowResponse(
-                    success=False,
-                    message="Failed to extract JSON from AI response",
-                    raw_response=raw_response[:500]
-                )
-
-        # Parse JSON
+        # Extract JSON from response (prose / code fences / truncation tolerated)
         try:
-            diagram_data = json.loads(json_str)
-        except json.JSONDecodeError as e:
+            recovered = recover_json(raw_response)
+        except JSONRecoveryError as e:
             logger.error(f"JSON parse error: {e}")
+            settle_response_cache(vision_service, accepted=False)
             return VisionToReactFlowResponse(
                 success=False,
-                message=f"Invalid JSON: {str(e)}",
-                raw_response=json_str[:500]
+                message="Failed to extract JSON from AI response",
+                raw_response=raw_response[:500]
             )
+        if recovered.repaired:
+            logger.warning(f"JSON repaired: {describe_repairs(recovered.repairs)}")
+        diagram_data = recovered.value
 
         # Validate structure
         if "nodes" not in diagram_data or "edges" not in diagram_data:
+            settle_response_cache(vision_service, accepted=False)
             return VisionToReactFlowResponse(
                 success=False,
                 message="Response missing 'nodes' or 'edges' field",
-                raw_response=json_str[:500]
+                raw_response=raw_response[:500]
             )
 
         # Normalize model-provided node shapes to schema-supported values.
@@ -1927,10 +1876,11 @@ For a 2-row layout:
             edges = [Edge(**edge_data) for edge_data in diagram_data["edges"]]
         except Exception as e:
             logger.error(f"Data validation error: {e}")
+            settle_response_cache(vision_service, accepted=False)
             return VisionToReactFlowResponse(
                 success=False,
                 message=f"Invalid node/edge data: {str(e)}",
-                raw_response=json_str[:500]
+                raw_response=raw_response[:500]
             )
 
         # ✅ Apply collision detection (use aggressive mode to ensure no overlaps)
@@ -1938,11 +1888,14 @@ For a 2-row layout:
 
         logger.info(f"Successfully generated React Flow diagram: {len(nodes)} nodes, {len(edges)} edges (collision-fixed)")
 
-        return VisionToReactFlowResponse(
-            success=True,
-            nodes=[n.dict() for n in nodes],
-            edges=[e.dict() for e in edges]
-        )
+        diagram = {
+            "nodes": [n.dict() for n in nodes],
+            "edges": [e.dict() for e in edges],
+        }
+        settle_response_cache(vision_service, accepted=True)
+        await store_vision_result(cache_slot, diagram)
+
+        return VisionToReactFlowResponse(success=True, **diagram)
 
     except Exception as e:
         logger.error(f"React Flow generation failed: {e}", exc_info=True)
@@ -1,5 +1,5 @@
 from pydantic_settings import BaseSettings
-from typing import List
+from typing import List, Optional
 import os
 
 
@@ -37,6 +37,97 @@ class Settings(BaseSettings):
     CUSTOM_BASE_URL: str = os.getenv("CUSTOM_BASE_URL", "https://www.right.codes/codex/v1")
     CUSTOM_MODEL_NAME: str = os.getenv("CUSTOM_MODEL_NAME", "gpt-5.2")
 
+    # Provider Client Pool (shared SDK clients keyed by config signature)
+    CLIENT_POOL_MAX_SIZE: int = 32               # 最多缓存的 SDK 客户端数量
+    CLIENT_POOL_IDLE_SECONDS: float = 600.0      # 空闲超过该时长的客户端被关闭
+    CLIENT_POOL_MAX_CONNECTIONS: int = 64        # 每个客户端的最大连接数
+    CLIENT_POOL_MAX_KEEPALIVE: int = 16          # 每个客户端保持的 keep-alive 连接数
+    CLIENT_POOL_KEEPALIVE_SECONDS: float = 90.0  # keep-alive 连接过期时间
+
+    # LLM Response Cache (content-addressed, memory LRU + on-disk tier)
+    LLM_CACHE_ENABLED: bool = True
+    LLM_CACHE_TTL_SECONDS: float = 86400.0                # 缓存有效期，<=0 表示永不过期
+    LLM_CACHE_MEMORY_ENTRIES: int = 256                   # 内存层最多缓存的响应数
+    LLM_CACHE_DISK_PATH: str = "data/llm_cache"           # 磁盘层目录（留空则只用内存）
+    LLM_CACHE_DISK_MAX_BYTES: int = 256 * 1024 * 1024     # 磁盘层总大小上限
+    LLM_CACHE_REPLAY_CHUNK_CHARS: int = 256               # 命中时按流式回放的分片大小
+    # 按入口关闭缓存（逗号分隔）：text, vision, stream, vision_stream
+    LLM_CACHE_DISABLED_ENDPOINTS_STR: str = ""
+
+    # Vision Image Preprocessing (downscale + re-encode before upload)
+    IMAGE_PREPROCESS_ENABLED: bool = True
+    IMAGE_MAX_EDGE_CLAUDE: int = 1568       # Claude 超过 1568px 会在服务端缩小
+    IMAGE_MAX_EDGE_OPENAI: int = 2048       # OpenAI high detail 先缩放到 2048 以内
+    IMAGE_MAX_EDGE_GEMINI: int = 3072
+    IMAGE_MAX_EDGE_SILICONFLOW: int = 2048
+    IMAGE_JPEG_QUALITY: int = 85
+
+    # Vision Result Cache (perceptual hash, near-duplicate screenshots)
+    VISION_CACHE_ENABLED: bool = True
+    VISION_CACHE_MAX_DISTANCE: int = 0                # 近似匹配的 dHash 汉明距离阈值（0-64），0 表示只按字节精确命中
+    VISION_CACHE_MAX_ENTRIES: int = 512               # 最多缓存的识别结果数
+    VISION_CACHE_TTL_SECONDS: float = 7 * 86400.0     # 结果有效期，<=0 表示永不过期
+    VISION_CACHE_DISK_PATH: str = "data/vision_cache" # 持久化目录（留空则只用内存）
+
+    # Hedged Failover (start the next candidate in parallel when the current one stalls)
+    HEDGE_ENABLED: bool = True
+    HEDGE_FIRST_TOKEN_DELAY_SECONDS: float = 6.0      # 流式：多久没有首 token 就并行启动下一个候选
+    HEDGE_RESPONSE_DELAY_SECONDS: float = 45.0        # 非流式：多久没有完整响应就并行启动下一个候选
+    HEDGE_MAX_PARALLEL: int = 2                       # 单个请求同时在途的尝试数
+    HEDGE_MAX_INFLIGHT: int = 4                       # 全进程同时在途的对冲请求数上限
+
+    # Provider Circuit Breaker & Health Score (reorders failover candidates)
+    CIRCUIT_BREAKER_ENABLED: bool = True
+    CIRCUIT_FAILURE_THRESHOLD: int = 3                # 连续失败多少次后熔断
+    CIRCUIT_OPEN_SECONDS: float = 30.0                # 熔断冷却时间，之后进入 half_open 放行一个探测请求
+    CIRCUIT_MAX_OPEN_SECONDS: float = 300.0           # 探测连续失败时冷却时间翻倍的上限
+    HEALTH_EWMA_ALPHA: float = 0.3                    # 错误率 / 延迟 EWMA 的平滑系数
+    HEALTH_LATENCY_REFERENCE_SECONDS: float = 20.0    # 非流式完整响应的参考延迟
+    HEALTH_TTFT_REFERENCE_SECONDS: float = 5.0        # 流式首 token 的参考延迟
+
+    # Provider Concurrency Governor (per-config slots, bounded queue, AIMD on 429)
+    PROVIDER_CONCURRENCY_ENABLED: bool = True
+    PROVIDER_CONCURRENCY_INITIAL: Optional[int] = None  # 每个配置初始的并发上限，留空时从 MAX 起步，只在上游 429 时收缩
+    PROVIDER_CONCURRENCY_MIN: int = 1
+    PROVIDER_CONCURRENCY_MAX: int = 16
+    PROVIDER_QUEUE_MAX_SIZE: int = 32                 # 每个配置最多排队的请求数，超出直接 failover
+    PROVIDER_QUEUE_TIMEOUT_SECONDS: float = 300.0     # 排队超过该时长放弃并 failover（流式请求占用名额可达 240-300 秒）
+    PROVIDER_AIMD_DECREASE_FACTOR: float = 0.5        # 上游 429 时并发上限乘以该系数
+    PROVIDER_RETRY_AFTER_MAX_SECONDS: float = 60.0    # Retry-After 冷却时间上限
+
+    # Single-flight Coalescing (identical concurrent generations share one upstream call)
+    SINGLE_FLIGHT_ENABLED: bool = True
+
+    # Incremental Generation Scoping (only the relevant k-hop subgraph goes into the prompt)
+    INCREMENTAL_SCOPE_ENABLED: bool = True
+    INCREMENTAL_SCOPE_MIN_NODES: int = 40             # 画布节点数超过该值才裁剪
+    INCREMENTAL_SCOPE_HOPS: int = 2                   # 相关节点向外扩展的跳数
+    INCREMENTAL_SCOPE_MAX_NODES: int = 40             # Prompt 中子图的节点数上限
+
+    # Canvas Session Write-behind Persistence (background, coalesced, atomic)
+    SESSION_WRITE_BEHIND_ENABLED: bool = True
+    SESSION_PERSIST_FLUSH_INTERVAL_SECONDS: float = 0.5   # 合并窗口：首次更新到落盘的等待时间
+    SESSION_PERSIST_MAX_DIRTY: int = 256                  # 待落盘会话数上限（超出时立即刷盘并背压）
+
+    # Canvas Session Memory Tier (byte-bounded LRU that evicts to disk, periodic TTL sweep)
+    SESSION_CACHE_MAX_SESSIONS: int = 1000                # 内存中保留的会话数上限
+    SESSION_CACHE_MAX_BYTES: int = 256 * 1024 * 1024      # 内存中会话的估算总字节数上限
+    SESSION_SWEEP_INTERVAL_SECONDS: float = 60            # 过期会话清理周期
+    SESSION_SWEEP_BATCH_SIZE: int = 200                   # 每批最多清理的会话数
+
+    # Canvas Session Store (file: one JSON per session; sqlite: WAL database shared by all workers)
+    SESSION_STORE_BACKEND: str = "file"
+    SESSION_SQLITE_PATH: str = "data/canvas_sessions.db"  # 多 worker 指向同一个文件
+
+    # Canvas Session Snapshot Format (binary: columnar + compressed; json: legacy full model_dump)
+    SESSION_SNAPSHOT_FORMAT: str = "binary"
+    SESSION_SNAPSHOT_COMPRESSION: str = "zstd"            # zstd / zlib / none（未安装 zstandard 时回退 zlib）
+
+    @property
+    def LLM_CACHE_DISABLED_ENDPOINTS(self) -> List[str]:
+        """Parse disabled cache endpoints from comma-separated string"""
+        return [name.strip() for name in self.LLM_CACHE_DISABLED_ENDPOINTS_STR.split(",") if name.strip()]
+
     class Config:
         env_file = ".env"
         case_sensitive = True
@@ -0,0 +1,142 @@
+"""
+JSON 序列化层 (Fast JSON Serialization)
+
+热路径上的 JSON 编解码：每个 [PARTIAL_NODE] / [PARTIAL_ELEMENT] SSE 帧、会话大小检查与持久化、
+RAG fallback 索引、演讲稿草稿、模型预设文件。stdlib json 在大画布（数千节点）与长会话下占用明显 CPU。
+
+设计：
+- 安装了 orjson 时优先使用，其次 msgspec，都没有时回退到 stdlib json（均为可选依赖）
+- 不同后端之间输出一致（与安装了哪个可选依赖无关）：
+  * 紧凑模式：separators=(",", ":")、不转义非 ASCII
+  * indent=True：与 json.dumps(obj, ensure_ascii=False, indent=2) 布局一致（持久化文件可读、diff 友好）
+  * 唯一差异是小数指数写法（orjson 为 1e-7，stdlib 为 1e-07），数值相同
+- SSE 帧的线上格式因此有变化：以前是 json.dumps 默认分隔符（", " / ": "），
+  /api/vision 的帧还会把非 ASCII 转义为 \\uXXXX；现在统一为紧凑、UTF-8 原样输出。
+  JSON.parse 得到的值不变，但与旧版本不是字节一致，按原始文本匹配帧内容的客户端需要调整
+- datetime 等非原生类型统一交给 default 处理（默认 str），与旧的 json.dumps(default=str) 语义一致
+- 快速后端无法编码的值（超 64 位整数、非字符串键、NaN 等）自动回退 stdlib，保证不因后端不同而报错
+"""
+
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Any, Callable, Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+if orjson is not None:
+    BACKEND = "orjson"
+elif msgspec is not None:
+    BACKEND = "msgspec"
+else:
+    BACKEND = "json"
+
+_ORJSON_OPTIONS = (
+    orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+    if orjson is not None
+    else 0
+)
+
+
+def json_dumps_bytes(obj: Any, *, indent: bool = False, default: Optional[Callable[[Any], Any]] = None) -> bytes:
+    """
+    编码为 UTF-8 JSON 字节
+
+    Args:
+        obj: 待编码对象
+        indent: True 时按 2 空格缩进（与 stdlib indent=2 输出一致）
+        default: 非原生类型的转换函数，为 None 时遇到非原生类型抛出 TypeError
+
+    Returns:
+        UTF-8 编码的 JSON
+    """
+    if orjson is not None:
+        try:
+            options = _ORJSON_OPTIONS | (orjson.OPT_INDENT_2 if indent else 0)
+            return orjson.dumps(obj, default=default, option=options)
+        except (TypeError, orjson.JSONEncodeError):
+            pass
+    elif msgspec is not None:
+        try:
+            encoded = msgspec.json.encode(obj, enc_hook=default)
+            return msgspec.json.format(encoded, indent=2) if indent else encoded
+        except (TypeError, OverflowError, msgspec.EncodeError):
+            pass
+    return _stdlib_dumps(obj, indent, default).encode("utf-8")
+
+
+def json_dumps(obj: Any, *, indent: bool = False, default: Optional[Callable[[Any], Any]] = None) -> str:
+    """编码为 JSON 字符串（参数同 json_dumps_bytes）"""
+    if BACKEND == "json":
+        return _stdlib_dumps(obj, indent, default)
+    return json_dumps_bytes(obj, indent=indent, default=default).decode("utf-8")
+
+
+def json_loads(data: Union[str, bytes, bytearray, memoryview]) -> Any:
+    """解码 JSON（str 或 UTF-8 字节）"""
+    if orjson is not None:
+        return orjson.loads(data)
+    if msgspec is not None:
+        return msgspec.json.decode(data)
+    return json.loads(data)
+
+
+def json_size(obj: Any, default: Optional[Callable[[Any], Any]] = str) -> int:
+    """对象编码后的字节数（用于大小限制检查，不产生中间 str）"""
+    return len(json_dumps_bytes(obj, default=default))
+
+
+def write_json_file(path: Union[str, Path], obj: Any, *, indent: bool = True,
+                    default: Optional[Callable[[Any], Any]] = None) -> int:
+    """
+    原子写入 JSON 文件（UTF-8，默认 2 空格缩进）
+
+    先写同目录下的临时文件再 os.replace，写入中途崩溃不会留下半个文件。
+
+    Returns:
+        写入的字节数
+    """
+    return write_bytes_file(path, json_dumps_bytes(obj, indent=indent, default=default))
+
+
+def write_bytes_file(path: Union[str, Path], data: bytes) -> int:
+    """
+    原子写入二进制文件（临时文件 + os.replace）
+
+    Returns:
+        写入的字节数
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return len(data)
+
+
+def read_json_file(path: Union[str, Path]) -> Any:
+    """读取 JSON 文件（兼容带 BOM 的 UTF-8 文件）"""
+    data = Path(path).read_bytes()
+    if data.startswith(b"\xef\xbb\xbf"):
+        data = data[3:]
+    return json_loads(data)
+
+
+# ==================== 私有方法 ====================
+
+def _stdlib_dumps(obj: Any, indent: bool, default: Optional[Callable[[Any], Any]]) -> str:
+    if indent:
+        return json.dumps(obj, ensure_ascii=False, indent=2, default=default)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=default)
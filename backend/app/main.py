@@ -1,3 +1,5 @@
+import asyncio
+from contextlib import asynccontextmanager, suppress
 from typing import Any
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
@@ -7,14 +9,36 @@ from app.core.config import settings
 from app.core.logging import setup_logging
 from app.middleware.logging_middleware import LoggerMiddleware
 from app.api import health, mermaid, models, vision, prompter, export, rag, chat_generator, excalidraw
+from app.services.response_cache import get_response_cache
+from app.services.session_manager import migrate_session_snapshots, run_session_sweeper, shutdown_session_manager
 
 # 初始化日志系统（在创建 FastAPI app 之前）
 setup_logging()
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 开始服务前把旧 JSON 会话文件转换为二进制快照
+    await asyncio.to_thread(migrate_session_snapshots)
+    # 定期清理过期的画布会话
+    sweeper = asyncio.create_task(
+        run_session_sweeper(settings.SESSION_SWEEP_INTERVAL_SECONDS, settings.SESSION_SWEEP_BATCH_SIZE)
+    )
+    yield
+    sweeper.cancel()
+    with suppress(asyncio.CancelledError):
+        await sweeper
+    # 关闭时把后台写盘队列中的画布会话刷到文件
+    await asyncio.to_thread(shutdown_session_manager)
+    # 以及尚未写入磁盘的 LLM 响应缓存条目
+    await asyncio.to_thread(get_response_cache().flush, 5.0)
+
+
 app = FastAPI(
     title="SmartArchitect AI API",
     description="AI-powered architecture design platform backend",
     version="0.5.0",
+    lifespan=lifespan,
 )
 
 # 添加日志中间件（必须在 CORS 之前，确保捕获所有请求）
@@ -1,5 +1,5 @@
 from pydantic import AliasChoices, BaseModel, ConfigDict, Field
-from typing import List, Optional, Literal
+from typing import Any, Dict, List, Optional, Literal
 
 
 # React Flow 节点和边的数据模型
@@ -311,6 +311,19 @@ class ChatGenerationRequest(BaseModel):
     # 🆕 增量生成参数
     incremental_mode: Optional[bool] = False  # 是否启用增量模式
     session_id: Optional[str] = None  # 会话 ID（用于获取现有画板）
+    incremental_output: Optional[Literal["graph", "ops"]] = "graph"  # 增量输出格式：完整图 / 图操作列表
+    response_mode: Optional[Literal["full", "delta"]] = "full"  # 增量模式下只返回相对会话快照的变化
+    base_version: Optional[int] = None  # 客户端持有的会话版本，delta 模式下必须与会话一致
+
+
+# Graph delta (added / modified / removed against a session snapshot)
+class GraphDelta(BaseModel):
+    added_nodes: List[Node] = Field(default_factory=list)
+    modified_nodes: List[Node] = Field(default_factory=list)
+    removed_node_ids: List[str] = Field(default_factory=list)
+    added_edges: List[Edge] = Field(default_factory=list)
+    modified_edges: List[Edge] = Field(default_factory=list)
+    removed_edge_ids: List[str] = Field(default_factory=list)
 
 
 # Chat generation response
@@ -321,6 +334,9 @@ class ChatGenerationResponse(BaseModel):
     success: bool = True
     message: Optional[str] = None
     session_id: Optional[str] = None  # 🆕 返回会话 ID（供前端后续使用）
+    session_version: Optional[int] = None  # 保存后的会话版本
+    base_version: Optional[int] = None  # delta 所基于的会话版本（全量返回时为 None）
+    delta: Optional[GraphDelta] = None  # delta 模式且版本匹配时返回，此时 nodes / edges 为空
 
 
 # ============================================================
@@ -341,6 +357,24 @@ class CanvasSaveResponse(BaseModel):
     message: Optional[str] = None
     node_count: int
     edge_count: int
+    version: Optional[int] = None
+
+
+# Canvas session patch request (ops applied against a session version, see app.services.canvas_patch)
+class CanvasPatchRequest(BaseModel):
+    ops: List[Dict[str, Any]]
+    base_version: Optional[int] = None  # 可选，未带 If-Match 头时使用
+
+
+# Canvas session patch response
+class CanvasPatchResponse(BaseModel):
+    success: bool = True
+    session_id: str
+    version: int
+    applied: int
+    node_count: int
+    edge_count: int
+    message: Optional[str] = None
 
 
 # Canvas session data
@@ -351,6 +385,7 @@ class CanvasSessionData(BaseModel):
     edge_count: int
     timestamp: str
     created_at: str
+    version: Optional[int] = None
 
 
 # Canvas session get response
@@ -1,8 +1,8 @@
 ﻿import asyncio
-import base64
+import hashlib
 import json
-import re
-from typing import Optional, Dict, Any, List
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any, List, Tuple
 import logging
 
 # AI SDK imports
@@ -12,16 +12,33 @@ except ImportError:
     genai = None
 
 try:
-    from openai import OpenAI
+    from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
 except ImportError:
     OpenAI = None
+    AsyncOpenAI = None
+    DefaultHttpxClient = None
+    DefaultAsyncHttpxClient = None
 
 try:
-    from anthropic import Anthropic
+    from anthropic import Anthropic, AsyncAnthropic
+    from anthropic import DefaultHttpxClient as AnthropicHttpxClient
+    from anthropic import DefaultAsyncHttpxClient as AnthropicAsyncHttpxClient
 except ImportError:
     Anthropic = None
+    AsyncAnthropic = None
+    AnthropicHttpxClient = None
+    AnthropicAsyncHttpxClient = None
 
 from app.core.config import settings
+from app.services.client_pool import build_http_client_kwargs, get_client_registry
+from app.services.concurrency_governor import get_concurrency_governor, run_blocking
+from app.services.image_preprocessor import PreparedImage, get_image_preprocessor
+from app.services.json_recovery import JSONRecoveryError, describe_repairs, recover_json
+from app.services.model_presets import ModelPresetsService
+from app.services.provider_health import config_key_label
+from app.services.response_cache import LLMResponseCache, get_response_cache, is_cache_enabled
+from app.services.single_flight import get_single_flight
+from app.services.vision_result_cache import lookup_vision_result, store_vision_result
 from app.models.schemas import (
     ImageAnalysisResponse,
     Node,
@@ -35,6 +52,12 @@ from app.models.schemas import (
 
 logger = logging.getLogger(__name__)
 
+# 所有生成入口共用的采样参数（参与响应缓存键计算）
+_CACHE_SAMPLING_PARAMS = {"temperature": 0.2, "max_tokens": 16384}
+
+# 因输出长度上限被截断的结束原因（OpenAI / Anthropic / Gemini），截断的输出不写入响应缓存
+_TRUNCATED_FINISH_REASONS = {"length", "max_tokens", "MAX_TOKENS"}
+
 
 class AIVisionService:
     """AI Vision 多模态图片分析服务"""
@@ -62,10 +85,36 @@ class AIVisionService:
         self.request_timeout = 60.0  # Increased from 8 to 60 seconds to handle slow AI responses
         # Allow fast fallback when running with placeholder keys (e.g., tests)
         self.mock_mode = api_key == "invalid"
+        # 最近一次获取上游并发名额时的排队情况（SSE 展示用）
+        self.last_queue_wait = 0.0
+        self.last_queue_depth = 0
+        # 响应缓存：完整输出先暂存，调用方解析 / 校验通过后 commit_response_cache() 才写入
+        self._staged_cache_writes: Dict[str, Tuple[str, str]] = {}
+        self._served_cache_keys: List[str] = []
+        self._output_truncated = False
         self._init_client()
 
+    def _config_signature(self) -> tuple:
+        """
+        当前实例的配置签名
+
+        按构造时传入的运行时配置（未经环境变量 / 默认模型补全）计算，与
+        ModelPresetsService._preset_runtime_config 的签名一致，预设更新 / 删除时才能失效对应客户端。
+        环境变量回退与默认值在进程内不变，同一签名构造出的客户端参数相同。
+        """
+        return ModelPresetsService._config_signature({
+            "provider": self.provider,
+            "api_key": self.custom_api_key,
+            "base_url": self.custom_base_url,
+            "model_name": self.custom_model_name,
+        })
+
+    def _pooled_client(self, kind: str, factory, loop=None):
+        """从进程级注册表获取共享 SDK 客户端（复用连接池与 TLS 会话；异步客户端传入所属事件循环）"""
+        return get_client_registry().get_or_create(kind, self._config_signature(), factory, loop=loop)
+
     def _init_client(self):
-        """初始化 AI 客户端"""
+        """初始化 AI 客户端（OpenAI/Anthropic 客户端从共享注册表获取）"""
         try:
             if self.provider == "gemini":
                 if not genai:
@@ -74,6 +123,7 @@ class AIVisionService:
                 api_key = self.custom_api_key or settings.GEMINI_API_KEY
                 if not api_key:
                     raise ValueError("GEMINI_API_KEY not configured. Please set in UI or .env file")
+                # genai.configure 是全局状态，底层 gRPC 通道由 SDK 自行复用，这里不入池
                 genai.configure(api_key=api_key)
                 self.client = genai.GenerativeModel("gemini-2.0-flash-exp")
                 logger.info("Gemini client initialized")
@@ -85,10 +135,14 @@ class AIVisionService:
                 api_key = self.custom_api_key or settings.OPENAI_API_KEY
                 if not api_key:
                     raise ValueError("OPENAI_API_KEY not configured. Please set in UI or .env file")
-                self.client = OpenAI(
-                    api_key=api_key,
-                    timeout=120.0,  # 2 minutes timeout
-                    max_retries=2   # Limit retries
+                self.client = self._pooled_client(
+                    "openai",
+                    lambda: OpenAI(
+                        api_key=api_key,
+                        timeout=120.0,  # 2 minutes timeout
+                        max_retries=2,  # Limit retries
+                        http_client=DefaultHttpxClient(**build_http_client_kwargs()),
+                    ),
                 )
                 logger.info("OpenAI client initialized")
 
@@ -99,7 +153,13 @@ class AIVisionService:
                 api_key = self.custom_api_key or settings.ANTHROPIC_API_KEY
                 if not api_key:
                     raise ValueError("ANTHROPIC_API_KEY not configured. Please set in UI or .env file")
-                self.client = Anthropic(api_key=api_key)
+                self.client = self._pooled_client(
+                    "anthropic",
+                    lambda: Anthropic(
+                        api_key=api_key,
+                        http_client=AnthropicHttpxClient(**build_http_client_kwargs()),
+                    ),
+                )
                 logger.info("Claude client initialized")
 
             elif self.provider == "siliconflow":
@@ -109,11 +169,15 @@ class AIVisionService:
                 if not api_key:
                     raise ValueError("SILICONFLOW_API_KEY not configured. Please set in UI or .env file")
                 base_url = self.custom_base_url or settings.SILICONFLOW_BASE_URL
-                self.client = OpenAI(
-                    api_key=api_key,
-                    base_url=base_url,
-                    timeout=240.0,  # 增加到 240 秒匹配 flowchart_timeout
-                    max_retries=0   # 禁用重试（视觉模型处理慢，重试会导致超时）
+                self.client = self._pooled_client(
+                    "openai",
+                    lambda: OpenAI(
+                        api_key=api_key,
+                        base_url=base_url,
+                        timeout=240.0,  # 增加到 240 秒匹配 flowchart_timeout
+                        max_retries=0,  # 禁用重试（视觉模型处理慢，重试会导致超时）
+                        http_client=DefaultHttpxClient(**build_http_client_kwargs()),
+                    ),
                 )
                 logger.info(f"SiliconFlow client initialized with base_url: {base_url}")
 
@@ -134,27 +198,23 @@ class AIVisionService:
                     if not Anthropic:
                         raise ImportError("anthropic not installed")
 
-                    # Anthropic SDK 会自动添加 /v1 路径，所以需要去掉 base_url 中的 /v1
-                    clean_base_url = self.custom_base_url.rstrip('/')
-                    if clean_base_url.endswith('/v1'):
-                        clean_base_url = clean_base_url[:-3]
-
-                    self.client = Anthropic(
-                        api_key=self.custom_api_key,
-                        base_url=clean_base_url
-                    )
-                    logger.info(f"Custom Claude provider initialized with base_url: {clean_base_url} (original: {self.custom_base_url})")
+                    self.client = self._get_custom_anthropic_client()
+                    logger.info(f"Custom Claude provider initialized with base_url: {self._anthropic_base_url()} (original: {self.custom_base_url})")
                 else:
                     # 使用 OpenAI SDK 处理 OpenAI 兼容的 API
                     if not OpenAI:
                         raise ImportError("openai not installed")
-                    self.client = OpenAI(
-                        api_key=self.custom_api_key,
-                        base_url=self.custom_base_url,
-                        # Vision requests can be large; allow a longer single attempt,
-                        # but avoid retry storms that amplify latency to >300s.
-                        timeout=180.0,
-                        max_retries=0
+                    self.client = self._pooled_client(
+                        "openai",
+                        lambda: OpenAI(
+                            api_key=self.custom_api_key,
+                            base_url=self.custom_base_url,
+                            # Vision requests can be large; allow a longer single attempt,
+                            # but avoid retry storms that amplify latency to >300s.
+                            timeout=180.0,
+                            max_retries=0,
+                            http_client=DefaultHttpxClient(**build_http_client_kwargs()),
+                        ),
                     )
                     logger.info(f"Custom provider initialized with base_url: {self.custom_base_url}")
 
@@ -165,6 +225,25 @@ class AIVisionService:
             logger.error(f"Failed to initialize {self.provider} client: {e}")
             raise
 
+    def _anthropic_base_url(self) -> str:
+        """Anthropic SDK 会自动添加 /v1 路径，所以需要去掉 base_url 中的 /v1"""
+        clean_base_url = (self.custom_base_url or "").rstrip('/')
+        if clean_base_url.endswith('/v1'):
+            clean_base_url = clean_base_url[:-3]
+        return clean_base_url
+
+    def _get_custom_anthropic_client(self):
+        """获取自定义 Claude 代理的共享 Anthropic 客户端"""
+        clean_base_url = self._anthropic_base_url()
+        return self._pooled_client(
+            "anthropic",
+            lambda: Anthropic(
+                api_key=self.custom_api_key,
+                base_url=clean_base_url,
+                http_client=AnthropicHttpxClient(**build_http_client_kwargs()),
+            ),
+        )
+
     def _build_analysis_prompt(self, analyze_bottlenecks: bool = True) -> str:
         """构建针对架构图优化的 Prompt"""
         base_prompt = """
@@ -733,22 +812,33 @@ Step 9: If any validation fails: FIX before output, then re-validate
         analyze_bottlenecks: bool = True
     ) -> ImageAnalysisResponse:
         """分析架构图片"""
+        slot, cached = await self._lookup_vision_result(
+            "architecture", image_data, analyze_bottlenecks=analyze_bottlenecks
+        )
+        if cached is not None:
+            return cached
+
         prompt = self._build_analysis_prompt(analyze_bottlenecks)
 
         try:
-            if self.provider == "gemini":
-                result = await self._analyze_with_gemini(image_data, prompt)
-            elif self.provider == "openai":
-                result = await self._analyze_with_openai(image_data, prompt)
-            elif self.provider == "claude":
-                result = await self._analyze_with_claude(image_data, prompt)
-            elif self.provider == "siliconflow":
-                result = await self._analyze_with_siliconflow(image_data, prompt)
-            elif self.provider == "custom":
-                result = await self._analyze_with_custom(image_data, prompt)
-            else:
-                raise ValueError(f"Unsupported provider: {self.provider}")
+            async def _dispatch():
+                async with self._provider_slot():
+                    if self.provider == "gemini":
+                        return await self._analyze_with_gemini(image_data, prompt)
+                    elif self.provider == "openai":
+                        return await self._analyze_with_openai(image_data, prompt)
+                    elif self.provider == "claude":
+                        return await self._analyze_with_claude(image_data, prompt)
+                    elif self.provider == "siliconflow":
+                        return await self._analyze_with_siliconflow(image_data, prompt)
+                    elif self.provider == "custom":
+                        return await self._analyze_with_custom(image_data, prompt)
+                    else:
+                        raise ValueError(f"Unsupported provider: {self.provider}")
 
+            result = await get_single_flight().do(self._flight_key("architecture", prompt, image_data), _dispatch)
+
+            await store_vision_result(slot, result.model_dump(mode="json"))
             return result
 
         except Exception as e:
@@ -774,6 +864,13 @@ Step 9: If any validation fails: FIX before output, then re-validate
         Returns:
             ImageAnalysisResponse: 包含 nodes, edges, mermaid_code, warnings
         """
+        slot, cached = await self._lookup_vision_result(
+            "flowchart", image_data, preserve_layout=preserve_layout, fast_mode=fast_mode
+        )
+        if cached is not None:
+            logger.info(f"[FLOWCHART] Vision cache hit: {len(cached.nodes)} nodes, {len(cached.edges)} edges")
+            return cached
+
         prompt = self._build_flowchart_prompt(preserve_layout, fast_mode)
 
         # 根据 fast_mode 设置 max_tokens（足够大以避免JSON截断）
@@ -788,23 +885,31 @@ Step 9: If any validation fails: FIX before output, then re-validate
         try:
             logger.info(f"[FLOWCHART] Starting analysis with {self.provider}, preserve_layout={preserve_layout}, fast_mode={fast_mode}, max_tokens={max_tokens}, timeout={self._flowchart_timeout}s, detail={self._image_detail}")
 
-            if self.provider == "gemini":
-                result = await self._analyze_with_gemini(image_data, prompt, max_tokens)
-            elif self.provider == "openai":
-                result = await self._analyze_with_openai(image_data, prompt, max_tokens)
-            elif self.provider == "claude":
-                result = await self._analyze_with_claude(image_data, prompt, max_tokens)
-            elif self.provider == "siliconflow":
-                result = await self._analyze_with_siliconflow(image_data, prompt, max_tokens)
-            elif self.provider == "custom":
-                result = await self._analyze_with_custom(image_data, prompt, max_tokens)
-            else:
-                raise ValueError(f"Unsupported provider: {self.provider}")
+            async def _dispatch():
+                async with self._provider_slot():
+                    if self.provider == "gemini":
+                        return await self._analyze_with_gemini(image_data, prompt, max_tokens)
+                    elif self.provider == "openai":
+                        return await self._analyze_with_openai(image_data, prompt, max_tokens)
+                    elif self.provider == "claude":
+                        return await self._analyze_with_claude(image_data, prompt, max_tokens)
+                    elif self.provider == "siliconflow":
+                        return await self._analyze_with_siliconflow(image_data, prompt, max_tokens)
+                    elif self.provider == "custom":
+                        return await self._analyze_with_custom(image_data, prompt, max_tokens)
+                    else:
+                        raise ValueError(f"Unsupported provider: {self.provider}")
+
+            flight_key = self._flight_key(
+                "flowchart", prompt, image_data, max_tokens=max_tokens, detail=self._image_detail
+            )
+            result = await get_single_flight().do(flight_key, _dispatch)
 
             logger.info(f"[FLOWCHART] Analysis completed: {len(result.nodes)} nodes, {len(result.edges)} edges")
 
             # warnings 和 analysis 已经在 JSON 中，_build_response 会处理
 
+            await store_vision_result(slot, result.model_dump(mode="json"))
             return result
 
         except Exception as e:
@@ -814,13 +919,14 @@ Step 9: If any validation fails: FIX before output, then re-validate
     async def _analyze_with_gemini(self, image_data: bytes, prompt: str, max_tokens: int = 4096) -> ImageAnalysisResponse:
         """使用 Gemini 分析"""
         try:
-            logger.info(f"[GEMINI] Starting analysis, image size: {len(image_data)} bytes, max_tokens: {max_tokens}")
+            image = await self._prepare_image(image_data)
+            logger.info(f"[GEMINI] Starting analysis, image size: {len(image.data)} bytes, max_tokens: {max_tokens}")
 
             # Gemini 支持直接传 bytes
             image_parts = [
                 {
-                    "mime_type": "image/jpeg",
-                    "data": image_data
+                    "mime_type": image.media_type,
+                    "data": image.data
                 }
             ]
 
@@ -853,10 +959,10 @@ Step 9: If any validation fails: FIX before output, then re-validate
         """使用 OpenAI GPT-4 Vision 分析"""
         try:
             logger.info(f"[OPENAI] Starting vision analysis, max_tokens: {max_tokens}")
-            image_b64 = base64.b64encode(image_data).decode("utf-8")
+            image = await self._prepare_image(image_data)
 
-            # 使用 asyncio.to_thread 包装同步调用
-            response = await asyncio.to_thread(
+            # 使用 run_blocking 包装同步调用（被取消时名额保留到线程返回）
+            response = await run_blocking(
                 self.client.chat.completions.create,
                 model="gpt-4-vision-preview",
                 messages=[
@@ -867,7 +973,7 @@ Step 9: If any validation fails: FIX before output, then re-validate
                             {
                                 "type": "image_url",
                                 "image_url": {
-                                    "url": f"data:image/jpeg;base64,{image_b64}"
+                                    "url": image.data_url
                                 }
                             }
                         ]
@@ -892,10 +998,10 @@ Step 9: If any validation fails: FIX before output, then re-validate
         """使用 Claude 3.5 Sonnet 分析"""
         try:
             logger.info(f"[CLAUDE] Starting vision analysis, max_tokens: {max_tokens}")
-            image_b64 = base64.b64encode(image_data).decode("utf-8")
+            image = await self._prepare_image(image_data)
 
-            # 使用 asyncio.to_thread 包装同步调用
-            response = await asyncio.to_thread(
+            # 使用 run_blocking 包装同步调用（被取消时名额保留到线程返回）
+            response = await run_blocking(
                 self.client.messages.create,
                 model="claude-3-5-sonnet-20241022",
                 max_tokens=max_tokens,
@@ -909,8 +1015,8 @@ Step 9: If any validation fails: FIX before output, then re-validate
                                 "type": "image",
                                 "source": {
                                     "type": "base64",
-                                    "media_type": "image/jpeg",
-                                    "data": image_b64
+                                    "media_type": image.media_type,
+                                    "data": image.b64
                                 }
                             }
                         ]
@@ -938,11 +1044,11 @@ Step 9: If any validation fails: FIX before output, then re-validate
             detail = getattr(self, '_image_detail', 'high')
 
             logger.info(f"[SILICONFLOW] Starting vision analysis with model: {self.model_name}, max_tokens: {max_tokens}, timeout: {timeout}s, detail: {detail}")
-            image_b64 = base64.b64encode(image_data).decode("utf-8")
+            image = await self._prepare_image(image_data)
 
-            # 使用 asyncio.to_thread 包装同步调用，并增加超时时间
+            # 使用 run_blocking 包装同步调用（被取消时名额保留到线程返回），并增加超时时间
             response = await asyncio.wait_for(
-                asyncio.to_thread(
+                run_blocking(
                     self.client.chat.completions.create,
                     model=self.model_name,  # 例如: Qwen/Qwen3-VL-32B-Thinking
                     messages=[
@@ -953,7 +1059,7 @@ Step 9: If any validation fails: FIX before output, then re-validate
                                 {
                                     "type": "image_url",
                                     "image_url": {
-                                        "url": f"data:image/jpeg;base64,{image_b64}",
+                                        "url": image.data_url,
                                         "detail": detail  # 关键参数：low=快速，high=高质量
                                     }
                                 }
@@ -985,7 +1091,8 @@ Step 9: If any validation fails: FIX before output, then re-validate
         """使用自定义 provider 分析（支持 OpenAI 和 Claude 格式）"""
         try:
             logger.info(f"[CUSTOM] Starting vision analysis, max_tokens: {max_tokens}")
-            image_b64 = base64.b64encode(image_data).decode("utf-8")
+            image = await self._prepare_image(image_data)
+            image_b64 = image.b64
 
             # 使用自定义模型名称，默认为 gpt-4-vision-preview
             model = self.custom_model_name or "gpt-4-vision-preview"
@@ -999,20 +1106,7 @@ Step 9: If any validation fails: FIX before output, then re-validate
                 # Claude API 使用 Anthropic 格式
                 logger.info("[CUSTOM] Detected Claude model, using Anthropic image format")
 
-                # 检测图片类型
-                import imghdr
-                media_type = imghdr.what(None, h=image_data)
-                if media_type == "jpeg":
-                    media_type = "image/jpeg"
-                elif media_type == "png":
-                    media_type = "image/png"
-                elif media_type == "webp":
-                    media_type = "image/webp"
-                elif media_type == "gif":
-                    media_type = "image/gif"
-                else:
-                    media_type = "image/jpeg"  # 默认 JPEG
-
+                media_type = image.media_type
                 logger.info(f"[CUSTOM] Image media type: {media_type}")
 
                 # 检测是否是 ikuncode.cc
@@ -1086,7 +1180,7 @@ Step 9: If any validation fails: FIX before output, then re-validate
                 else:
                     # linkflow.run 等: 使用 Anthropic SDK
                     logger.info("[CUSTOM] Using Anthropic SDK")
-                    response = await asyncio.to_thread(
+                    response = await run_blocking(
                         self.client.messages.create,
                         model=model,
                         messages=[
@@ -1111,7 +1205,7 @@ Step 9: If any validation fails: FIX before output, then re-validate
             else:
                 # OpenAI 格式（默认）
                 logger.info("[CUSTOM] Using OpenAI image_url format")
-                response = await asyncio.to_thread(
+                response = await run_blocking(
                     self.client.chat.completions.create,
                     model=model,
                     messages=[
@@ -1122,7 +1216,7 @@ Step 9: If any validation fails: FIX before output, then re-validate
                                 {
                                     "type": "image_url",
                                     "image_url": {
-                                        "url": f"data:image/jpeg;base64,{image_b64}"
+                                        "url": image.data_url
                                     }
                                 }
                             ]
@@ -1238,115 +1332,20 @@ Step 9: If any validation fails: FIX before output, then re-validate
             raise
 
     def _extract_json_from_response(self, text: str, is_truncated: bool = False) -> Dict[str, Any]:
-        """Extract JSON from AI response with aggressive cleaning and multiple fallback strategies."""
-
-        def _repair_truncated_json(raw: str) -> str:
-            """尝试修复被截断的JSON"""
-            # 移除markdown代码块标记
-            cleaned = re.sub(r"```(?:json)?", "", raw).strip()
-
-            # 提取JSON边界
-            start = cleaned.find("{")
-            if start != -1:
-                cleaned = cleaned[start:]
-
-            # 检查并修复截断的字符串
-            # 如果最后一个字符不是闭合的，尝试补全
-            if cleaned and not cleaned.endswith("}"):
-                # 查找最后一个完整的结构
-                # 尝试找到最后一个完整的数组或对象
-
-                # 统计未闭合的括号
-                open_brackets = cleaned.count("[") - cleaned.count("]")
-                open_braces = cleaned.count("{") - cleaned.count("}")
-                open_quotes = cleaned.count('"') - cleaned.count('\\"')
-
-                # 如果有未闭合的引号，先闭合它
-                if open_quotes % 2 != 0:
-                    cleaned += '"'
-
-                # 闭合未闭合的数组
-                cleaned += "]" * open_brackets
-
-                # 闭合未闭合的对象
-                cleaned += "}" * open_braces
-
-                logger.info(f"[JSON REPAIR] Fixed {open_quotes % 2} quotes, {open_brackets} brackets, {open_braces} braces")
-
-            return cleaned
-
-        def _sanitize_json(raw: str) -> str:
-            """Aggressive JSON sanitization with multiple repair strategies."""
-            # Strip markdown code blocks
-            cleaned = re.sub(r"```(?:json)?", "", raw)
-
-            # Extract JSON boundaries
-            start = cleaned.find("{")
-            end = cleaned.rfind("}")
-            if start != -1 and end != -1 and end > start:
-                cleaned = cleaned[start:end + 1]
-
-            # Fix common JSON issues
-            cleaned = re.sub(r",\s*([}\]])", r"\1", cleaned)  # Remove trailing commas
-            cleaned = re.sub(r"'", '"', cleaned)  # Single quotes to double quotes
-            cleaned = re.sub(r'(\w+):', r'"\1":', cleaned)  # Unquoted keys (basic fix)
-            cleaned = cleaned.replace("\n", " ")  # Remove newlines
-
-            return cleaned
-
-        # Strategy 0: If truncated, try to repair first
-        if is_truncated:
-            try:
-                logger.info("[JSON REPAIR] Attempting to repair truncated JSON")
-                repaired = _repair_truncated_json(text)
-                result = json.loads(repaired)
-                logger.info("[JSON REPAIR] Successfully parsed repaired truncated JSON")
-                return result
-            except json.JSONDecodeError as e:
-                logger.warning(f"[JSON REPAIR] Failed to parse repaired JSON: {e}")
-                # Continue to other strategies
-
-        # Strategy 1: Try direct JSON parse of full text
-        try:
-            return json.loads(text)
-        except json.JSONDecodeError:
-            pass
-
-        # Strategy 2: Extract from ```json...``` blocks
-        try:
-            json_match = re.search(r'```json\s*(\{.*?\})\s*```', text, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group(1))
-        except json.JSONDecodeError:
-            pass
-
-        # Strategy 3: Extract from ```...``` blocks
+        """Extract JSON from AI response with a single-pass tolerant parser (prose, code fences, truncation)."""
         try:
-            code_match = re.search(r'```\s*(\{.*?\})\s*```', text, re.DOTALL)
-            if code_match:
-                return json.loads(code_match.group(1))
-        except json.JSONDecodeError:
-            pass
-
-        # Strategy 4: Find JSON object boundaries
-        try:
-            json_match = re.search(r'\{.*\}', text, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group(0))
-        except json.JSONDecodeError:
-            pass
-
-        # Strategy 5: Aggressive sanitization
-        try:
-            sanitized = _sanitize_json(text)
-            logger.warning(f"Using sanitized JSON (original failed): {sanitized[:200]}...")
-            return json.loads(sanitized)
-        except json.JSONDecodeError as e:
-            logger.error(f"All JSON parse strategies failed: {e}")
+            recovered = recover_json(text)
+        except JSONRecoveryError as e:
+            logger.error(f"JSON recovery failed: {e}")
             logger.error(f"Raw response (first 500 chars): {text[:500]}")
             logger.error(f"Raw response (last 500 chars): {text[-500:]}")
             raise ValueError(f"Invalid JSON response from AI after all repair attempts: {str(e)}")
 
+        if recovered.repaired:
+            log = logger.info if is_truncated else logger.warning
+            log(f"[JSON REPAIR] Recovered JSON (truncated={is_truncated}): {describe_repairs(recovered.repairs)}")
+        return recovered.value
+
     def _build_response(self, result_json: Dict[str, Any]) -> ImageAnalysisResponse:
         """构建响应对象"""
         try:
@@ -1444,18 +1443,32 @@ Step 9: If any validation fails: FIX before output, then re-validate
         try:
             logger.info(f"[VISION GEN] Generating with {self.provider}")
 
-            if self.provider == "gemini":
-                return await self._generate_with_gemini_vision(image_data, prompt)
-            elif self.provider == "openai":
-                return await self._generate_with_openai_vision(image_data, prompt)
-            elif self.provider == "claude":
-                return await self._generate_with_claude_vision(image_data, prompt)
-            elif self.provider == "siliconflow":
-                return await self._generate_with_siliconflow_vision(image_data, prompt)
-            elif self.provider == "custom":
-                return await self._generate_with_custom_vision(image_data, prompt)
-            else:
-                raise ValueError(f"Unsupported provider: {self.provider}")
+            cache_key = self._response_cache_key("vision", prompt, image_data)
+            cached = await self._cache_lookup(cache_key)
+            if cached is not None:
+                logger.info("[VISION GEN] Response cache hit")
+                return cached
+
+            async def _dispatch():
+                self._output_truncated = False
+                async with self._provider_slot():
+                    if self.provider == "gemini":
+                        result = await self._generate_with_gemini_vision(image_data, prompt)
+                    elif self.provider == "openai":
+                        result = await self._generate_with_openai_vision(image_data, prompt)
+                    elif self.provider == "claude":
+                        result = await self._generate_with_claude_vision(image_data, prompt)
+                    elif self.provider == "siliconflow":
+                        result = await self._generate_with_siliconflow_vision(image_data, prompt)
+                    elif self.provider == "custom":
+                        result = await self._generate_with_custom_vision(image_data, prompt)
+                    else:
+                        raise ValueError(f"Unsupported provider: {self.provider}")
+                if cache_key and isinstance(result, str):
+                    self._stage_cache_write(cache_key, result, "vision")
+                return result
+
+            return await get_single_flight().do(self._flight_key("vision", prompt, image_data), _dispatch)
 
         except Exception as e:
             logger.error(f"Vision generation failed: {e}", exc_info=True)
@@ -1463,18 +1476,16 @@ Step 9: If any validation fails: FIX before output, then re-validate
 
     async def _generate_with_gemini_vision(self, image_data: bytes, prompt: str) -> str:
         """Gemini vision generation"""
-        import PIL.Image
-        import io
-
-        image = PIL.Image.open(io.BytesIO(image_data))
-        response = self.client.generate_content([prompt, image])
+        image = await self._prepare_image(image_data)
+        response = self.client.generate_content(
+            [prompt, {"mime_type": image.media_type, "data": image.data}]
+        )
+        self._note_response_finish(response)
         return response.text
 
     async def _generate_with_openai_vision(self, image_data: bytes, prompt: str) -> str:
         """OpenAI vision generation"""
-        import base64
-
-        base64_image = base64.b64encode(image_data).decode()
+        image = await self._prepare_image(image_data)
 
         response = self.client.chat.completions.create(
             model=self.model_name,
@@ -1484,7 +1495,7 @@ Step 9: If any validation fails: FIX before output, then re-validate
                     {"type": "text", "text": prompt},
                     {
                         "type": "image_url",
-                        "image_url": {"url": f"data:image/png;base64,{base64_image}"}
+                        "image_url": {"url": image.data_url}
                     }
                 ]
             }],
@@ -1492,13 +1503,12 @@ Step 9: If any validation fails: FIX before output, then re-validate
             temperature=0.2
         )
 
+        self._note_response_finish(response)
         return response.choices[0].message.content
 
     async def _generate_with_claude_vision(self, image_data: bytes, prompt: str) -> str:
         """Claude vision generation"""
-        import base64
-
-        base64_image = base64.b64encode(image_data).decode()
+        image = await self._prepare_image(image_data)
 
         response = self.client.messages.create(
             model=self.model_name,
@@ -1511,21 +1521,20 @@ Step 9: If any validation fails: FIX before output, then re-validate
                         "type": "image",
                         "source": {
                             "type": "base64",
-                            "media_type": "image/png",
-                            "data": base64_image
+                            "media_type": image.media_type,
+                            "data": image.b64
                         }
                     }
                 ]
             }]
         )
 
+        self._note_response_finish(response)
         return response.content[0].text
 
     async def _generate_with_siliconflow_vision(self, image_data: bytes, prompt: str) -> str:
         """SiliconFlow vision generation"""
-        import base64
-
-        base64_image = base64.b64encode(image_data).decode()
+        image = await self._prepare_image(image_data)
 
         response = self.client.chat.completions.create(
             model=self.model_name,
@@ -1535,7 +1544,7 @@ Step 9: If any validation fails: FIX before output, then re-validate
                     {"type": "text", "text": prompt},
                     {
                         "type": "image_url",
-                        "image_url": {"url": f"data:image/png;base64,{base64_image}"}
+                        "image_url": {"url": image.data_url}
                     }
                 ]
             }],
@@ -1543,13 +1552,12 @@ Step 9: If any validation fails: FIX before output, then re-validate
             temperature=0.2
         )
 
+        self._note_response_finish(response)
         return response.choices[0].message.content
 
     async def _generate_with_custom_vision(self, image_data: bytes, prompt: str) -> str:
         """Custom provider vision generation (auto-detect Claude vs OpenAI format)"""
-        import base64
-
-        base64_image = base64.b64encode(image_data).decode()
+        image = await self._prepare_image(image_data)
 
         # Check if this is a Claude-native endpoint (linkflow, anthropic)
         is_claude_format = (
@@ -1559,18 +1567,8 @@ Step 9: If any validation fails: FIX before output, then re-validate
         )
 
         if is_claude_format:
-            # Use Anthropic's native API format
-            from anthropic import Anthropic
-
-            # Remove /v1 suffix from base_url if present (Anthropic SDK adds it automatically)
-            anthropic_base_url = self.custom_base_url.rstrip("/")
-            if anthropic_base_url.endswith("/v1"):
-                anthropic_base_url = anthropic_base_url[:-3]
-
-            client = Anthropic(
-                api_key=self.custom_api_key,
-                base_url=anthropic_base_url
-            )
+            # Use Anthropic's native API format (shared client, base_url without /v1)
+            client = self._get_custom_anthropic_client()
 
             response = client.messages.create(
                 model=self.model_name,
@@ -1583,14 +1581,15 @@ Step 9: If any validation fails: FIX before output, then re-validate
                             "type": "image",
                             "source": {
                                 "type": "base64",
-                                "media_type": "image/png",
-                                "data": base64_image
+                                "media_type": image.media_type,
+                                "data": image.b64
                             }
                         }
                     ]
                 }]
             )
 
+            self._note_response_finish(response)
             return response.content[0].text
         else:
             # Use OpenAI-compatible format
@@ -1602,7 +1601,7 @@ Step 9: If any validation fails: FIX before output, then re-validate
                         {"type": "text", "text": prompt},
                         {
                             "type": "image_url",
-                            "image_url": {"url": f"data:image/png;base64,{base64_image}"}
+                            "image_url": {"url": image.data_url}
                         }
                     ]
                 }],
@@ -1610,165 +1609,422 @@ Step 9: If any validation fails: FIX before output, then re-validate
                 temperature=0.2
             )
 
+            self._note_response_finish(response)
             return response.choices[0].message.content
 
+    # ========== Response Cache ==========
+
+    def commit_response_cache(self) -> int:
+        """
+        调用方解析 / 校验输出成功后调用：把本实例暂存的完整输出写入响应缓存
+
+        生成入口只暂存输出（截断的输出不暂存），不直接写缓存，
+        避免解析失败或归一化失败的结果被缓存后，用户重试时回放同一个坏结果。
+
+        Returns:
+            写入的条目数
+        """
+        staged, self._staged_cache_writes = self._staged_cache_writes, {}
+        self._served_cache_keys = []
+        cache = get_response_cache()
+        for key, (text, endpoint) in staged.items():
+            cache.put(key, text, endpoint)
+        return len(staged)
+
+    def reject_response_cache(self) -> int:
+        """
+        调用方解析 / 校验输出失败时调用：丢弃暂存的输出，并删除本实例命中过的缓存条目
+
+        Returns:
+            删除的缓存条目数
+        """
+        self._staged_cache_writes = {}
+        served, self._served_cache_keys = self._served_cache_keys, []
+        cache = get_response_cache()
+        return sum(1 for key in served if cache.invalidate(key))
+
+    async def _cache_lookup(self, cache_key: Optional[str]) -> Optional[str]:
+        """读取响应缓存，命中的键记录下来（调用方校验失败时 reject_response_cache 删除）"""
+        if not cache_key:
+            return None
+        # 内存层未命中时会回落到读磁盘文件，放到线程池执行，不阻塞事件循环
+        cached = await asyncio.to_thread(get_response_cache().get, cache_key)
+        if cached is not None:
+            self._served_cache_keys.append(cache_key)
+        return cached
+
+    def _stage_cache_write(self, cache_key: str, text: str, endpoint: str):
+        """暂存一次完整输出，等待调用方 commit_response_cache()；截断的输出直接丢弃"""
+        if self._output_truncated:
+            logger.info(f"[CACHE] Skipping truncated {endpoint} output ({len(text)} chars)")
+            return
+        if text:
+            self._staged_cache_writes[cache_key] = (text, endpoint)
+
+    def _note_finish_reason(self, reason: Any):
+        """记录上游结束原因：因输出长度上限截断时标记本次输出不可缓存"""
+        if reason is None:
+            return
+        if str(getattr(reason, "name", reason)) in _TRUNCATED_FINISH_REASONS:
+            self._output_truncated = True
+
+    def _note_response_finish(self, response: Any):
+        """从 SDK 响应对象中提取结束原因（OpenAI choices / Anthropic stop_reason / Gemini candidates）"""
+        choices = getattr(response, "choices", None)
+        if isinstance(choices, list) and choices:
+            self._note_finish_reason(getattr(choices[0], "finish_reason", None))
+            return
+        stop_reason = getattr(response, "stop_reason", None)
+        if stop_reason is not None:
+            self._note_finish_reason(stop_reason)
+            return
+        candidates = getattr(response, "candidates", None)
+        if isinstance(candidates, (list, tuple)) and candidates:
+            self._note_finish_reason(getattr(candidates[0], "finish_reason", None))
+
+    def _credential_fingerprint(self) -> str:
+        """调用凭据的摘要：共用 provider / model / base_url 的不同租户不能读到彼此的缓存"""
+        api_key = (self.custom_api_key or "").strip()
+        return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16] if api_key else ""
+
+    def _response_cache_key(
+        self,
+        endpoint: str,
+        prompt: str,
+        image_data: Optional[bytes] = None,
+        provider: Optional[str] = None,
+    ) -> Optional[str]:
+        """计算响应缓存键（provider 为实际分发的 provider）；mock 模式或该入口关闭缓存时返回 None"""
+        if self.mock_mode or not is_cache_enabled(endpoint):
+            return None
+        return self._flight_key(endpoint, prompt, image_data, provider)
+
+    def _flight_key(
+        self,
+        endpoint: str,
+        prompt: str,
+        image_data: Optional[bytes] = None,
+        provider: Optional[str] = None,
+        **variant,
+    ) -> Optional[str]:
+        """单飞合并键（与响应缓存键同构，但不受缓存开关影响）；mock 模式返回 None"""
+        if self.mock_mode:
+            return None
+        return LLMResponseCache.make_key(
+            endpoint,
+            provider or self.provider,
+            self.model_name,
+            prompt,
+            base_url=self.custom_base_url,
+            image_data=image_data,
+            params={**_CACHE_SAMPLING_PARAMS, **variant},
+            credential=self._credential_fingerprint(),
+        )
+
+    async def _lookup_vision_result(self, endpoint: str, image_data: bytes, **variant):
+        """
+        查询感知哈希结果缓存（近似重复的截图直接复用已识别的结果）
+
+        Returns:
+            (slot, ImageAnalysisResponse | None)；mock 模式下不使用缓存
+        """
+        if self.mock_mode:
+            return None, None
+        slot, cached = await lookup_vision_result(
+            endpoint,
+            image_data,
+            self.provider,
+            self.model_name,
+            self.custom_base_url,
+            **variant,
+        )
+        if cached is None:
+            return slot, None
+        try:
+            return slot, ImageAnalysisResponse.model_validate(cached)
+        except Exception as e:
+            logger.warning(f"Ignoring invalid vision cache entry for {endpoint}: {e}")
+            return slot, None
+
+    async def _cached_stream(self, endpoint: str, prompt: str, image_data: Optional[bytes], stream):
+        """
+        流式入口的缓存包装：命中时分片回放，未命中时边转发边收集，完整结束后写入缓存
+
+        未命中时整个上游流占用一个并发名额，流结束或消费方提前退出时归还；
+        相同请求并发时由单飞合并共享同一个上游流。
+
+        完整结束且未被截断的输出只暂存，调用方解析 / 校验通过后 commit_response_cache() 才写入；
+        消费方提前退出或上游异常时不暂存，避免缓存半截输出。
+        """
+        cache_key = self._response_cache_key(endpoint, prompt, image_data)
+        cached = await self._cache_lookup(cache_key)
+        if cached is not None:
+            await stream.aclose()
+            logger.info(f"[STREAM] Response cache hit ({endpoint}), replaying {len(cached)} chars")
+            chunk_chars = max(1, settings.LLM_CACHE_REPLAY_CHUNK_CHARS)
+            for start in range(0, len(cached), chunk_chars):
+                yield cached[start:start + chunk_chars]
+                await asyncio.sleep(0)
+            return
+
+        async def upstream():
+            collected: List[str] = []
+            self._output_truncated = False
+            async with self._provider_slot():
+                async for token in stream:
+                    collected.append(token)
+                    yield token
+            if cache_key:
+                self._stage_cache_write(cache_key, "".join(collected), endpoint)
+
+        # 相同请求同时在途时共享同一个上游流，后加入者先回放已输出的前缀
+        async for token in get_single_flight().stream(self._flight_key(endpoint, prompt, image_data), upstream):
+            yield token
+
+    async def analyze_text(self, prompt: str, provider: Optional[str] = None) -> dict:
+        """
+        纯文本提示统一入口（按 provider 分发到 _analyze_with_*_text，带响应缓存）
+
+        Args:
+            prompt: 文本提示词
+            provider: 分发使用的 provider，默认为当前实例的 provider
+
+        Returns:
+            模型输出解析得到的 JSON 字典
+        """
+        provider = provider or self.provider
+        cache_key = self._response_cache_key("text", prompt, provider=provider)
+        cached = await self._cache_lookup(cache_key)
+        if cached is not None:
+            logger.info("[TEXT] Response cache hit")
+            return json.loads(cached)
+
+        async def _dispatch():
+            self._output_truncated = False
+            async with self._provider_slot():
+                if provider == "gemini":
+                    result = await self._analyze_with_gemini_text(prompt)
+                elif provider == "openai":
+                    result = await self._analyze_with_openai_text(prompt)
+                elif provider == "claude":
+                    result = await self._analyze_with_claude_text(prompt)
+                elif provider == "siliconflow":
+                    result = await self._analyze_with_siliconflow_text(prompt)
+                else:
+                    result = await self._analyze_with_custom_text(prompt)
+            if cache_key and result:
+                self._stage_cache_write(cache_key, json.dumps(result, ensure_ascii=False), "text")
+            return result
+
+        return await get_single_flight().do(self._flight_key("text", prompt, provider=provider), _dispatch)
+
+    # ========== Provider Concurrency ==========
+
+    def concurrency_label(self) -> str:
+        """并发治理 / 健康统计使用的配置标签"""
+        return config_key_label({
+            "provider": self.provider,
+            "api_key": self.custom_api_key,
+            "base_url": self.custom_base_url,
+            "model_name": self.model_name,
+        })
+
+    @asynccontextmanager
+    async def _provider_slot(self):
+        """占用当前配置的上游并发名额（排满时排队，上游 429 时自动收缩并发上限）"""
+        async with get_concurrency_governor().slot(self.concurrency_label()) as ticket:
+            self.last_queue_wait = ticket.wait_seconds
+            self.last_queue_depth = ticket.queue_depth
+            yield ticket
+
     # ========== Unified Streaming Methods (for SSE streaming to frontend) ==========
 
+    def _get_async_openai_client(self):
+        """获取当前配置对应的共享 AsyncOpenAI 客户端（流式输出使用）"""
+        if not AsyncOpenAI:
+            raise ImportError("openai not installed")
+
+        if self.provider == "openai":
+            api_key = self.custom_api_key or settings.OPENAI_API_KEY
+            base_url, timeout, max_retries = None, 120.0, 2
+        elif self.provider == "siliconflow":
+            api_key = self.custom_api_key or settings.SILICONFLOW_API_KEY
+            base_url = self.custom_base_url or settings.SILICONFLOW_BASE_URL
+            timeout, max_retries = 240.0, 0
+        else:
+            api_key, base_url = self.custom_api_key, self.custom_base_url
+            timeout, max_retries = 180.0, 0
+
+        return self._pooled_client(
+            "openai-async",
+            lambda: AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                timeout=timeout,
+                max_retries=max_retries,
+                http_client=DefaultAsyncHttpxClient(**build_http_client_kwargs()),
+            ),
+            loop=asyncio.get_running_loop(),
+        )
+
+    def _get_async_anthropic_client(self):
+        """获取当前配置对应的共享 AsyncAnthropic 客户端（流式输出使用）"""
+        if not AsyncAnthropic:
+            raise ImportError("anthropic not installed")
+
+        if self.provider == "custom":
+            api_key, sdk_base_url = self.custom_api_key, self._anthropic_base_url()
+        else:
+            api_key, sdk_base_url = self.custom_api_key or settings.ANTHROPIC_API_KEY, None
+
+        return self._pooled_client(
+            "anthropic-async",
+            lambda: AsyncAnthropic(
+                api_key=api_key,
+                base_url=sdk_base_url,
+                http_client=AnthropicAsyncHttpxClient(**build_http_client_kwargs()),
+            ),
+            loop=asyncio.get_running_loop(),
+        )
+
+    def _get_async_raw_http_client(self):
+        """获取 raw HTTP Claude 代理（ikuncode.cc）使用的共享 httpx.AsyncClient"""
+        import httpx
+
+        return self._pooled_client(
+            "httpx-async",
+            lambda: httpx.AsyncClient(timeout=300.0, **build_http_client_kwargs()),
+            loop=asyncio.get_running_loop(),
+        )
+
+    def _uses_raw_http_claude(self) -> bool:
+        """ikuncode.cc 会拦截 SDK 的 User-Agent，需要走 raw HTTP"""
+        return bool(
+            self.provider == "custom"
+            and self.custom_base_url
+            and "ikuncode.cc" in self.custom_base_url.lower()
+        )
+
+    def _image_profile(self) -> str:
+        """图片预处理档位（决定最长边上限）"""
+        if self.provider in ("claude", "gemini", "siliconflow"):
+            return self.provider
+        if self.provider == "custom" and "claude" in (self.model_name or "").lower():
+            return "claude"
+        return "openai"
+
+    async def _prepare_image(self, image_data: bytes) -> PreparedImage:
+        """缩放/重编码图片（线程池中执行，结果按内容哈希缓存，failover 重试直接复用）"""
+        return await asyncio.to_thread(get_image_preprocessor().prepare, image_data, self._image_profile())
+
+    async def _stream_openai_compatible(self, content, log_tag: str):
+        """OpenAI 兼容接口的原生异步流式输出（openai / siliconflow / custom）"""
+        client = self._get_async_openai_client()
+        logger.info(f"{log_tag} Initiating {self.provider} stream with model={self.model_name}")
+        stream = await client.chat.completions.create(
+            model=self.model_name,
+            messages=[{"role": "user", "content": content}],
+            stream=True,
+            temperature=0.2,
+            max_tokens=16384,  # Increased to 16K for complete Excalidraw JSON generation
+        )
+        try:
+            async for chunk in stream:
+                if not getattr(chunk, "choices", None):
+                    continue
+                self._note_finish_reason(getattr(chunk.choices[0], "finish_reason", None))
+                delta = chunk.choices[0].delta.content if chunk.choices[0].delta else None
+                if delta:
+                    yield delta
+            logger.info(f"{log_tag} {self.provider} stream completed")
+        finally:
+            # 消费方提前退出（客户端断开/超时切换）时立即释放上游连接
+            await stream.close()
+
+    async def _stream_claude_sdk(self, content, log_tag: str):
+        """Anthropic SDK 原生异步流式输出（官方 Claude 及 linkflow.run 等代理）"""
+        client = self._get_async_anthropic_client()
+        logger.info(f"{log_tag} Initiating Claude stream with model={self.model_name}")
+        async with client.messages.stream(
+            model=self.model_name,
+            max_tokens=16384,  # Increased to 16K for complete Excalidraw JSON generation
+            temperature=0.2,
+            messages=[{"role": "user", "content": content}],
+        ) as stream:
+            async for text in stream.text_stream:
+                yield text
+            self._note_response_finish(getattr(stream, "current_message_snapshot", None))
+        logger.info(f"{log_tag} Claude stream completed")
+
+    async def _stream_claude_raw_http(self, content, log_tag: str):
+        """raw HTTP 方式请求 Claude Messages SSE 接口（避免 ikuncode.cc 的 User-Agent 拦截）"""
+        client = self._get_async_raw_http_client()
+        url = f"{self._anthropic_base_url()}/v1/messages"
+        logger.info(f"{log_tag} Initiating raw HTTP Claude stream to {url}")
+
+        async with client.stream(
+            "POST",
+            url,
+            headers={
+                "anthropic-version": "2023-06-01",
+                "x-api-key": self.custom_api_key,
+                "content-type": "application/json",
+            },
+            json={
+                "model": self.model_name,
+                "max_tokens": 16384,
+                "temperature": 0.2,
+                "messages": [{"role": "user", "content": content}],
+                "stream": True,
+            },
+        ) as response:
+            if response.is_error:
+                await response.aread()
+                response.raise_for_status()
+
+            current_event = None
+            async for line in response.aiter_lines():
+                line = line.strip()
+                if line.startswith("event: "):
+                    current_event = line[7:]
+                elif line.startswith("data: ") and current_event == "content_block_delta":
+                    data = json.loads(line[6:])
+                    text = data.get("delta", {}).get("text", "")
+                    if text:
+                        yield text
+                elif line.startswith("data: ") and current_event == "message_delta":
+                    self._note_finish_reason(json.loads(line[6:]).get("delta", {}).get("stop_reason"))
+
+        logger.info(f"{log_tag} Raw HTTP Claude stream completed")
+
     async def generate_with_stream(self, prompt: str):
         """
         Unified streaming generation entry point supporting all providers.
         Yields text tokens as they are generated by the LLM.
 
+        所有 provider 均使用原生异步 SDK / httpx.AsyncClient，流式过程不占用线程池。
+        命中响应缓存时按分片回放，SSE 消费方无需区分。
+
         Returns: AsyncGenerator[str, None]
         """
-        import queue
-        import threading
+        async for token in self._cached_stream("stream", prompt, None, self._stream_text(prompt)):
+            yield token
 
+    async def _stream_text(self, prompt: str):
+        """纯文本流式生成（不经过缓存）"""
         try:
-            if self.provider == "openai":
-                # OpenAI native streaming - use queue for real-time streaming
-                logger.info(f"[STREAM] OpenAI streaming with model: {self.model_name}")
-                q = queue.Queue()
-
-                def _openai_stream():
-                    try:
-                        logger.info(f"[STREAM] Initiating OpenAI stream with model={self.model_name}")
-                        stream = self.client.chat.completions.create(
-                            model=self.model_name,
-                            messages=[{"role": "user", "content": prompt}],
-                            stream=True,
-                            temperature=0.2,
-                            max_tokens=16384,  # Increased to 16K for complete Excalidraw JSON generation
-                        )
-                        logger.info("[STREAM] OpenAI stream created, starting iteration")
-                        for chunk in stream:
-                            delta = chunk.choices[0].delta.content
-                            if delta:
-                                q.put(("data", delta))
-                        logger.info("[STREAM] OpenAI stream completed successfully")
-                        q.put(("done", None))
-                    except Exception as e:
-                        logger.error(f"[STREAM] Exception in _openai_stream: {e}", exc_info=True)
-                        q.put(("error", e))
-
-                loop = asyncio.get_event_loop()
-                # Start streaming in background thread
-                loop.run_in_executor(None, _openai_stream)
-
-                while True:
-                    msg_type, data = await loop.run_in_executor(None, q.get)
-                    if msg_type == "error":
-                        raise data
-                    elif msg_type == "done":
-                        break
-                    else:
-                        yield data
-
-            elif self.provider == "claude" or (
+            is_claude_model = self.provider == "claude" or (
                 self.provider == "custom" and "claude" in (self.model_name or "").lower()
-            ):
-                # Claude streaming with context manager (supports custom Claude endpoints)
-                logger.info(f"[STREAM] Claude streaming with model: {self.model_name} (provider={self.provider})")
-
-                # Detect ikuncode.cc specifically to avoid User-Agent blocking
-                use_ikuncode_raw_http = (
-                    self.provider == "custom" and
-                    self.custom_base_url and
-                    "ikuncode.cc" in self.custom_base_url.lower()
-                )
-
-                q = queue.Queue()
+            )
 
-                if use_ikuncode_raw_http:
-                    # Use raw HTTP for ikuncode.cc to avoid User-Agent blocking
-                    logger.info(f"[STREAM] Using raw HTTP for ikuncode.cc: {self.custom_base_url}")
-
-                    def _claude_stream_raw_http():
-                        try:
-                            import httpx
-                            import json
-
-                            # Clean base_url to avoid /v1/v1/messages duplication
-                            clean_base_url = self.custom_base_url.rstrip('/')
-                            if clean_base_url.endswith('/v1'):
-                                clean_base_url = clean_base_url[:-3]
-
-                            logger.info(f"[STREAM] Initiating raw HTTP Claude stream to {clean_base_url}/v1/messages")
-
-                            with httpx.Client(timeout=300.0) as client:
-                                with client.stream(
-                                    "POST",
-                                    f"{clean_base_url}/v1/messages",
-                                    headers={
-                                        "anthropic-version": "2023-06-01",
-                                        "x-api-key": self.custom_api_key,
-                                        "content-type": "application/json",
-                                    },
-                                    json={
-                                        "model": self.model_name,
-                                        "max_tokens": 16384,
-                                        "temperature": 0.2,
-                                        "messages": [{"role": "user", "content": prompt}],
-                                        "stream": True,
-                                    },
-                                ) as response:
-                                    current_event = None
-                                    buffer = ""
-
-                                    for chunk in response.iter_bytes():
-                                        buffer += chunk.decode('utf-8')
-
-                                        while '\n' in buffer:
-                                            line, buffer = buffer.split('\n', 1)
-                                            line = line.strip()
-
-                                            if line.startswith("event: "):
-                                                current_event = line[7:]
-                                            elif line.startswith("data: "):
-                                                data = json.loads(line[6:])
-                                                if current_event == "content_block_delta":
-                                                    text = data.get("delta", {}).get("text", "")
-                                                    if text:
-                                                        q.put(("data", text))
-
-                            logger.info("[STREAM] Raw HTTP Claude stream completed successfully")
-                            q.put(("done", None))
-                        except Exception as e:
-                            logger.error(f"[STREAM] Exception in _claude_stream_raw_http: {e}", exc_info=True)
-                            q.put(("error", e))
-
-                    loop = asyncio.get_event_loop()
-                    loop.run_in_executor(None, _claude_stream_raw_http)
+            if is_claude_model:
+                logger.info(f"[STREAM] Claude streaming with model: {self.model_name} (provider={self.provider})")
+                if self._uses_raw_http_claude():
+                    stream = self._stream_claude_raw_http(prompt, "[STREAM]")
                 else:
-                    # Use standard Anthropic SDK for other providers (linkflow.run, etc.)
-                    def _claude_stream():
-                        try:
-                            logger.info(f"[STREAM] Initiating Claude stream with model={self.model_name}")
-                            with self.client.messages.stream(
-                                model=self.model_name,
-                                max_tokens=16384,  # Increased to 16K for complete Excalidraw JSON generation
-                                temperature=0.2,
-                                messages=[{"role": "user", "content": prompt}],
-                            ) as stream:
-                                for text in stream.text_stream:
-                                    q.put(("data", text))
-                            logger.info("[STREAM] Claude stream completed successfully")
-                            q.put(("done", None))
-                        except Exception as e:
-                            logger.error(f"[STREAM] Exception in _claude_stream: {e}", exc_info=True)
-                            q.put(("error", e))
-
-                    loop = asyncio.get_event_loop()
-                    loop.run_in_executor(None, _claude_stream)
-
-                while True:
-                    msg_type, data = await loop.run_in_executor(None, q.get)
-                    if msg_type == "error":
-                        raise data
-                    elif msg_type == "done":
-                        break
-                    else:
-                        yield data
+                    stream = self._stream_claude_sdk(prompt, "[STREAM]")
+                async for text in stream:
+                    yield text
 
             elif self.provider == "gemini":
                 # Gemini native async streaming
@@ -1778,48 +2034,14 @@ Step 9: If any validation fails: FIX before output, then re-validate
                     stream=True,
                 )
                 async for chunk in response:
+                    self._note_response_finish(chunk)
                     if chunk.text:
                         yield chunk.text
 
-            elif self.provider == "siliconflow" or self.provider == "custom":
-                # SiliconFlow/Custom (OpenAI-compatible) - use queue for real-time streaming
+            elif self.provider in ("openai", "siliconflow", "custom"):
                 logger.info(f"[STREAM] {self.provider} streaming with model: {self.model_name}")
-                q = queue.Queue()
-
-                def _compatible_stream():
-                    try:
-                        logger.info(f"[STREAM] Initiating {self.provider} stream")
-                        stream = self.client.chat.completions.create(
-                            model=self.model_name,
-                            messages=[{"role": "user", "content": prompt}],
-                            stream=True,
-                            max_tokens=16384,
-                            temperature=0.2,
-                        )
-                        logger.info(f"[STREAM] {self.provider} stream created, iterating chunks")
-                        for chunk in stream:
-                            if not getattr(chunk, "choices", None) or not chunk.choices:
-                                continue
-                            delta = chunk.choices[0].delta.content if chunk.choices[0].delta else None
-                            if delta:
-                                q.put(("data", delta))
-                        logger.info(f"[STREAM] {self.provider} stream completed")
-                        q.put(("done", None))
-                    except Exception as e:
-                        logger.error(f"[STREAM] Exception in {self.provider}_stream: {e}", exc_info=True)
-                        q.put(("error", e))
-
-                loop = asyncio.get_event_loop()
-                loop.run_in_executor(None, _compatible_stream)
-
-                while True:
-                    msg_type, data = await loop.run_in_executor(None, q.get)
-                    if msg_type == "error":
-                        raise data
-                    elif msg_type == "done":
-                        break
-                    else:
-                        yield data
+                async for delta in self._stream_openai_compatible(prompt, "[STREAM]"):
+                    yield delta
 
             else:
                 raise ValueError(f"Streaming not supported for provider: {self.provider}")
@@ -1834,239 +2056,59 @@ Step 9: If any validation fails: FIX before output, then re-validate
         Uses multimodal streaming APIs (Claude/GPT-4 Vision support streaming).
         Yields tokens as they are generated.
         """
-        import queue
-        import threading
+        stream = self._stream_vision(image_data, prompt)
+        async for token in self._cached_stream("vision_stream", prompt, image_data, stream):
+            yield token
 
+    async def _stream_vision(self, image_data: bytes, prompt: str):
+        """图片 + 文本流式生成（不经过缓存）"""
         try:
             # 检查是否是 Claude 模型（官方或 custom）
             is_claude_model = (
                 self.provider == "claude" or
                 (self.provider == "custom" and "claude" in self.model_name.lower())
             )
+            image = await self._prepare_image(image_data)
 
             if is_claude_model:
                 # Claude Vision streaming with multimodal content
                 logger.info(f"[VISION-STREAM] Claude streaming with model: {self.model_name}")
-
-                # 检测是否是 ikuncode.cc
-                use_ikuncode_raw_http = (
-                    self.provider == "custom" and
-                    self.custom_base_url and
-                    "ikuncode.cc" in self.custom_base_url.lower()
-                )
-
-                q = queue.Queue()
-
-                if use_ikuncode_raw_http:
-                    # ikuncode.cc: 使用 raw HTTP streaming
-                    def _claude_vision_stream_raw_http():
-                        try:
-                            import base64
-                            import httpx
-                            import json
-
-                            # Detect image format
-                            image_b64 = base64.b64encode(image_data).decode('utf-8')
-
-                            # Determine media type from image bytes
-                            media_type = "image/jpeg"
-                            if image_data.startswith(b'\x89PNG'):
-                                media_type = "image/png"
-                            elif image_data.startswith(b'GIF'):
-                                media_type = "image/gif"
-                            elif image_data.startswith(b'\xff\xd8\xff'):
-                                media_type = "image/jpeg"
-                            elif image_data.startswith(b'RIFF') and b'WEBP' in image_data[:20]:
-                                media_type = "image/webp"
-
-                            # Build multimodal content
-                            content = [
-                                {
-                                    "type": "image",
-                                    "source": {
-                                        "type": "base64",
-                                        "media_type": media_type,
-                                        "data": image_b64,
-                                    },
-                                },
-                                {
-                                    "type": "text",
-                                    "text": prompt,
-                                }
-                            ]
-
-                            # 清理 base_url
-                            clean_base_url = self.custom_base_url.rstrip('/')
-                            if clean_base_url.endswith('/v1'):
-                                clean_base_url = clean_base_url[:-3]
-
-                            logger.info(f"[VISION-STREAM] Using raw HTTP for ikuncode.cc: {clean_base_url}/v1/messages")
-
-                            with httpx.Client(timeout=300.0) as client:
-                                with client.stream(
-                                    "POST",
-                                    f"{clean_base_url}/v1/messages",
-                                    headers={
-                                        "anthropic-version": "2023-06-01",
-                                        "x-api-key": self.custom_api_key,
-                                        "content-type": "application/json",
-                                    },
-                                    json={
-                                        "model": self.model_name,
-                                        "max_tokens": 16384,
-                                        "temperature": 0.2,
-                                        "messages": [{"role": "user", "content": content}],
-                                        "stream": True,
-                                    },
-                                ) as response:
-                                    current_event = None
-                                    buffer = ""
-
-                                    for chunk in response.iter_bytes():
-                                        buffer += chunk.decode('utf-8')
-
-                                        while '\n' in buffer:
-                                            line, buffer = buffer.split('\n', 1)
-                                            line = line.strip()
-
-                                            if line.startswith("event: "):
-                                                current_event = line[7:]
-                                            elif line.startswith("data: "):
-                                                data = json.loads(line[6:])
-                                                if current_event == "content_block_delta":
-                                                    text = data.get("delta", {}).get("text", "")
-                                                    if text:
-                                                        q.put(("data", text))
-
-                            logger.info("[VISION-STREAM] Raw HTTP Claude stream completed")
-                            q.put(("done", None))
-                        except Exception as e:
-                            logger.error(f"[VISION-STREAM] Exception in raw HTTP: {e}", exc_info=True)
-                            q.put(("error", e))
-
-                    loop = asyncio.get_event_loop()
-                    loop.run_in_executor(None, _claude_vision_stream_raw_http)
+                content = [
+                    {
+                        "type": "image",
+                        "source": {
+                            "type": "base64",
+                            "media_type": image.media_type,
+                            "data": image.b64,
+                        },
+                    },
+                    {
+                        "type": "text",
+                        "text": prompt,
+                    }
+                ]
+                if self._uses_raw_http_claude():
+                    stream = self._stream_claude_raw_http(content, "[VISION-STREAM]")
                 else:
-                    # linkflow.run 等: 使用 Anthropic SDK
-                    def _claude_vision_stream():
-                        try:
-                            import base64
-                            # Detect image format
-                            image_b64 = base64.b64encode(image_data).decode('utf-8')
-
-                            # Determine media type from image bytes
-                            media_type = "image/jpeg"
-                            if image_data.startswith(b'\x89PNG'):
-                                media_type = "image/png"
-                            elif image_data.startswith(b'GIF'):
-                                media_type = "image/gif"
-                            elif image_data.startswith(b'\xff\xd8\xff'):
-                                media_type = "image/jpeg"
-                            elif image_data.startswith(b'RIFF') and b'WEBP' in image_data[:20]:
-                                media_type = "image/webp"
-
-                            # Build multimodal content
-                            content = [
-                                {
-                                    "type": "image",
-                                    "source": {
-                                        "type": "base64",
-                                        "media_type": media_type,
-                                        "data": image_b64,
-                                    },
-                                },
-                                {
-                                    "type": "text",
-                                    "text": prompt,
-                                }
-                            ]
-
-                            logger.info(f"[VISION-STREAM] Starting Claude vision stream with SDK")
-                            with self.client.messages.stream(
-                                model=self.model_name,
-                                max_tokens=16384,
-                                temperature=0.2,
-                                messages=[{"role": "user", "content": content}],
-                            ) as stream:
-                                for text in stream.text_stream:
-                                    q.put(("data", text))
-                            logger.info("[VISION-STREAM] Claude stream completed")
-                            q.put(("done", None))
-                        except Exception as e:
-                            logger.error(f"[VISION-STREAM] Exception: {e}", exc_info=True)
-                            q.put(("error", e))
-
-                    loop = asyncio.get_event_loop()
-                    loop.run_in_executor(None, _claude_vision_stream)
-
-                while True:
-                    msg_type, data = await loop.run_in_executor(None, q.get)
-                    if msg_type == "error":
-                        raise data
-                    elif msg_type == "done":
-                        break
-                    else:
-                        yield data
+                    stream = self._stream_claude_sdk(content, "[VISION-STREAM]")
+                async for text in stream:
+                    yield text
 
             elif self.provider == "openai" or self.provider == "custom":
                 # OpenAI GPT-4 Vision streaming
                 logger.info(f"[VISION-STREAM] OpenAI streaming with model: {self.model_name}")
-                q = queue.Queue()
-
-                def _openai_vision_stream():
-                    try:
-                        import base64
-                        image_b64 = base64.b64encode(image_data).decode('utf-8')
-
-                        # Detect format
-                        if image_data.startswith(b'\x89PNG'):
-                            data_url = f"data:image/png;base64,{image_b64}"
-                        elif image_data.startswith(b'\xff\xd8\xff'):
-                            data_url = f"data:image/jpeg;base64,{image_b64}"
-                        else:
-                            data_url = f"data:image/jpeg;base64,{image_b64}"
-
-                        content = [
-                            {
-                                "type": "image_url",
-                                "image_url": {"url": data_url}
-                            },
-                            {
-                                "type": "text",
-                                "text": prompt
-                            }
-                        ]
-
-                        logger.info("[VISION-STREAM] Starting OpenAI vision stream")
-                        stream = self.client.chat.completions.create(
-                            model=self.model_name,
-                            messages=[{"role": "user", "content": content}],
-                            stream=True,
-                            temperature=0.2,
-                            max_tokens=16384,
-                        )
-
-                        for chunk in stream:
-                            delta = chunk.choices[0].delta.content
-                            if delta:
-                                q.put(("data", delta))
-                        logger.info("[VISION-STREAM] OpenAI stream completed")
-                        q.put(("done", None))
-                    except Exception as e:
-                        logger.error(f"[VISION-STREAM] Exception: {e}", exc_info=True)
-                        q.put(("error", e))
-
-                loop = asyncio.get_event_loop()
-                loop.run_in_executor(None, _openai_vision_stream)
-
-                while True:
-                    msg_type, data = await loop.run_in_executor(None, q.get)
-                    if msg_type == "error":
-                        raise data
-                    elif msg_type == "done":
-                        break
-                    else:
-                        yield data
+                content = [
+                    {
+                        "type": "image_url",
+                        "image_url": {"url": image.data_url}
+                    },
+                    {
+                        "type": "text",
+                        "text": prompt
+                    }
+                ]
+                async for delta in self._stream_openai_compatible(content, "[VISION-STREAM]"):
+                    yield delta
 
             else:
                 raise ValueError(f"Streaming vision not supported for provider: {self.provider}")
@@ -2091,6 +2133,7 @@ Step 9: If any validation fails: FIX before output, then re-validate
             )
 
             logger.info(f"[GEMINI TEXT] Response received")
+            self._note_response_finish(response)
             result_json = self._extract_json_from_response(response.text)
             logger.info(f"[GEMINI TEXT] JSON extracted successfully")
 
@@ -2117,6 +2160,7 @@ Step 9: If any validation fails: FIX before output, then re-validate
                 temperature=0.2
             )
 
+            self._note_response_finish(response)
             result_json = self._extract_json_from_response(
                 response.choices[0].message.content
             )
@@ -2145,6 +2189,7 @@ Step 9: If any validation fails: FIX before output, then re-validate
                 ]
             )
 
+            self._note_response_finish(response)
             result_json = self._extract_json_from_response(
                 response.content[0].text
             )
@@ -2169,7 +2214,7 @@ Step 9: If any validation fails: FIX before output, then re-validate
 
             # SiliconFlow SDK 调用是同步的，包一层线程 + 超时，避免请求长时间挂起
             response = await asyncio.wait_for(
-                asyncio.to_thread(
+                run_blocking(
                     self.client.chat.completions.create,
                     model=self.model_name,
                     messages=[{"role": "user", "content": prompt}],
@@ -2185,6 +2230,7 @@ Step 9: If any validation fails: FIX before output, then re-validate
             )
 
             # 当 response_format 为 json_object 时，content 应已是 JSON 对象
+            self._note_response_finish(response)
             content = response.choices[0].message.content
             if isinstance(content, dict):
                 result_json = content
@@ -2223,7 +2269,7 @@ Step 9: If any validation fails: FIX before output, then re-validate
                     text_acc.append(piece)
                 return "".join(text_acc)
 
-            full_text = await asyncio.wait_for(asyncio.to_thread(_stream), timeout=self.request_timeout)
+            full_text = await asyncio.wait_for(run_blocking(_stream), timeout=self.request_timeout)
             logger.info("[SILICONFLOW STREAM] Collected length=%s", len(full_text))
             if not full_text.strip():
                 raise ValueError("Empty stream output")
@@ -2283,6 +2329,7 @@ Step 9: If any validation fails: FIX before output, then re-validate
                         raise ValueError(f"Claude API request failed: {response.status_code} - {error_text}")
 
                     result = response.json()
+                    self._note_finish_reason(result.get("stop_reason"))
                     content = result['content'][0]['text']
                     logger.info(f"[CUSTOM TEXT] Claude response received, length: {len(content)}")
 
@@ -2301,6 +2348,8 @@ Step 9: If any validation fails: FIX before output, then re-validate
                     temperature=0.2
                 )
 
+                self._note_response_finish(response)
+
                 # Handle different response formats
                 content = None
                 if hasattr(response, 'choices') and response.choices:
@@ -2394,7 +2443,7 @@ Step 9: If any validation fails: FIX before output, then re-validate
                 return response.text.strip()
 
             if self.provider == "openai":
-                response = await asyncio.to_thread(
+                response = await run_blocking(
                     self.client.chat.completions.create,
                     model=self.model_name,
                     messages=[{"role": "user", "content": prompt}],
@@ -2404,7 +2453,7 @@ Step 9: If any validation fails: FIX before output, then re-validate
                 return response.choices[0].message.content.strip()
 
             if self.provider == "siliconflow":
-                response = await asyncio.to_thread(
+                response = await run_blocking(
                     self.client.chat.completions.create,
                     model=self.model_name,
                     messages=[{"role": "user", "content": prompt}],
@@ -2415,7 +2464,7 @@ Step 9: If any validation fails: FIX before output, then re-validate
                 return response.choices[0].message.content.strip()
 
             if self.provider == "claude":
-                response = await asyncio.to_thread(
+                response = await run_blocking(
                     self.client.messages.create,
                     model=self.model_name,
                     max_tokens=2000,
@@ -2425,7 +2474,7 @@ Step 9: If any validation fails: FIX before output, then re-validate
                 return response.content[0].text.strip()
 
             # custom provider (OpenAI-compatible)
-            response = await asyncio.to_thread(
+            response = await run_blocking(
                 self.client.chat.completions.create,
                 model=self.model_name,
                 messages=[{"role": "user", "content": prompt}],
@@ -2436,7 +2485,11 @@ Step 9: If any validation fails: FIX before output, then re-validate
             return response.choices[0].message.content.strip()
 
         try:
-            script = await asyncio.wait_for(_generate_with_provider(), timeout=self.request_timeout)
+            async def _governed_generate():
+                async with self._provider_slot():
+                    return await _generate_with_provider()
+
+            script = await asyncio.wait_for(_governed_generate(), timeout=self.request_timeout)
             logger.info(f"Generated {duration} speech script ({len(script)} characters)")
             return script
 
@@ -2502,31 +2555,33 @@ Step 9: If any validation fails: FIX before output, then re-validate
             if self.provider in ["openai", "siliconflow", "custom"]:
                 logger.info(f"Starting streaming speech script generation with {self.provider}")
 
-                # 直接创建stream并同步迭代（参考chat_generator的实现）
-                stream = self.client.chat.completions.create(
-                    model=self.model_name,
-                    messages=[{"role": "user", "content": prompt}],
-                    temperature=0.7,
-                    max_tokens=4000,
-                    stream=True,
-                )
+                async with self._provider_slot():
+                    # 直接创建stream并同步迭代（参考chat_generator的实现）
+                    stream = self.client.chat.completions.create(
+                        model=self.model_name,
+                        messages=[{"role": "user", "content": prompt}],
+                        temperature=0.7,
+                        max_tokens=4000,
+                        stream=True,
+                    )
 
-                # 同步迭代stream chunks
-                for chunk in stream:
-                    if chunk.choices and chunk.choices[0].delta.content:
-                        yield chunk.choices[0].delta.content
+                    # 同步迭代stream chunks
+                    for chunk in stream:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            yield chunk.choices[0].delta.content
 
             elif self.provider == "claude":
                 logger.info("Starting streaming speech script generation with Claude")
                 # Claude uses async streaming API
-                async with self.client.messages.stream(
-                    model=self.model_name,
-                    max_tokens=4000,
-                    temperature=0.7,
-                    messages=[{"role": "user", "content": prompt}]
-                ) as stream:
-                    async for text in stream.text_stream:
-                        yield text
+                async with self._provider_slot():
+                    async with self.client.messages.stream(
+                        model=self.model_name,
+                        max_tokens=4000,
+                        temperature=0.7,
+                        messages=[{"role": "user", "content": prompt}]
+                    ) as stream:
+                        async for text in stream.text_stream:
+                            yield text
 
             else:
                 # Fallback to non-streaming for other providers (like Gemini)
@@ -2556,3 +2611,14 @@ def create_vision_service(
         base_url=base_url,
         model_name=model_name
     )
+
+
+def settle_response_cache(vision_service: Any, accepted: bool) -> int:
+    """
+    调用方解析 / 校验完生成结果后调用
+
+    accepted=True 时写入暂存的完整输出（commit_response_cache），否则丢弃并删除本次命中的缓存条目
+    （reject_response_cache）。vision_service 为 None 或不带响应缓存的替身时什么也不做。
+    """
+    settle = getattr(vision_service, "commit_response_cache" if accepted else "reject_response_cache", None)
+    return settle() if callable(settle) else 0
@@ -0,0 +1,213 @@
+"""
+画布会话补丁 (Canvas Session Patch)
+
+/chat-generator/session/save 每次都上传完整的 nodes / edges，服务端对整张画布重新校验、重新序列化，
+保存流量与 CPU 随画布大小增长。补丁接口只提交编辑操作：
+    [
+      {"op": "add_node", "node": {"id": "cache-1", "type": "cache", "position": {...}, "data": {...}}},
+      {"op": "update_node", "id": "api-1", "position": {"x": 320, "y": 80}},
+      {"op": "update_node", "id": "api-1", "data": {"label": "API Gateway"}},
+      {"op": "remove_node", "id": "legacy-1"},
+      {"op": "add_edge", "edge": {"id": "e9", "source": "api-1", "target": "cache-1"}},
+      {"op": "update_edge", "id": "e9", "label": "read"},
+      {"op": "remove_edge", "id": "e3"}
+    ]
+
+设计：
+- CanvasIndex 缓存会话画布的 id → 列表下标、节点 → 关联边，按 id 定位是 O(1)
+- CanvasPatch 在节点 / 边列表的浅拷贝上应用操作：只校验（Node / Edge 模型）与计算大小变化
+  被改动的元素，代价与操作数成正比；被改动的元素替换为新字典，旧版本的快照保持不变
+- update_node / update_edge 为浅合并，position / data 按字段合并
+- remove_node 同时删除关联的边；删除在补丁末尾一次性压缩列表
+- 补丁是原子的：任一操作失败抛出 GraphOpError（注明操作下标），调用方丢弃本次结果与索引
+"""
+
+from typing import Any, Dict, List, Set
+
+from app.core.serialization import json_size
+from app.models.schemas import Edge, Node
+from app.services.graph_ops import GraphOpError
+
+PATCH_OPS = ("add_node", "update_node", "remove_node", "add_edge", "update_edge", "remove_edge")
+
+
+class CanvasIndex:
+    """会话画布的 id 索引（节点 / 边在列表中的下标、节点关联的边）"""
+
+    def __init__(self, nodes: List[Dict[str, Any]], edges: List[Dict[str, Any]]):
+        self.node_pos: Dict[str, int] = {}
+        self.edge_pos: Dict[str, int] = {}
+        self.node_edges: Dict[str, Set[str]] = {}
+        self.reindex_nodes(nodes)
+        self.reindex_edges(edges)
+        for edge in edges:
+            self.link(edge)
+
+    def reindex_nodes(self, nodes: List[Dict[str, Any]]):
+        self.node_pos = {node["id"]: position for position, node in enumerate(nodes)}
+
+    def reindex_edges(self, edges: List[Dict[str, Any]]):
+        self.edge_pos = {edge["id"]: position for position, edge in enumerate(edges)}
+
+    def link(self, edge: Dict[str, Any]):
+        for node_id in (edge["source"], edge["target"]):
+            self.node_edges.setdefault(node_id, set()).add(edge["id"])
+
+    def unlink(self, edge: Dict[str, Any]):
+        for node_id in (edge["source"], edge["target"]):
+            linked = self.node_edges.get(node_id)
+            if linked is not None:
+                linked.discard(edge["id"])
+                if not linked:
+                    del self.node_edges[node_id]
+
+
+class CanvasPatch:
+    """在会话画布上应用一次补丁（原子，代价与操作数成正比）"""
+
+    def __init__(self, nodes: List[Dict[str, Any]], edges: List[Dict[str, Any]], index: CanvasIndex):
+        """
+        Args:
+            nodes: 会话当前的节点字典列表（不会被修改）
+            edges: 会话当前的边字典列表（不会被修改）
+            index: 与 nodes / edges 对应的索引（会被原地更新）
+        """
+        self.nodes = list(nodes)
+        self.edges = list(edges)
+        self.size_delta = 0          # 编码后字节数的变化（用于会话大小检查）
+        self._index = index
+        self._removed_nodes: Set[str] = set()
+        self._removed_edges: Set[str] = set()
+
+    def apply_all(self, ops: List[Any]) -> int:
+        """
+        按顺序应用全部操作
+
+        Returns:
+            应用的操作数
+
+        Raises:
+            GraphOpError: 某个操作无效（此时整个补丁作废，索引可能已部分更新）
+        """
+        if not isinstance(ops, list):
+            raise GraphOpError("ops must be an array")
+        for position, op in enumerate(ops):
+            try:
+                self._apply(op)
+            except GraphOpError as e:
+                raise GraphOpError(f"op {position}: {e}")
+
+        # 删除在末尾一次性压缩列表并重建下标
+        if self._removed_nodes:
+            self.nodes = [node for node in self.nodes if node["id"] not in self._removed_nodes]
+            self._index.reindex_nodes(self.nodes)
+        if self._removed_edges:
+            self.edges = [edge for edge in self.edges if edge["id"] not in self._removed_edges]
+            self._index.reindex_edges(self.edges)
+        return len(ops)
+
+    # ==================== 私有方法 ====================
+
+    def _apply(self, op: Any):
+        if not isinstance(op, dict):
+            raise GraphOpError("operation must be an object")
+        handler = {
+            "add_node": self._add_node,
+            "update_node": self._update_node,
+            "remove_node": self._remove_node,
+            "add_edge": self._add_edge,
+            "update_edge": self._update_edge,
+            "remove_edge": self._remove_edge,
+        }.get(op.get("op"))
+        if handler is None:
+            raise GraphOpError(f"unsupported op {op.get('op')!r} (expected one of {', '.join(PATCH_OPS)})")
+        handler(op)
+
+    def _node_position(self, node_id: Any) -> int:
+        position = self._index.node_pos.get(node_id) if isinstance(node_id, str) else None
+        if position is None or node_id in self._removed_nodes:
+            raise GraphOpError(f"unknown node {node_id!r}")
+        return position
+
+    def _edge_position(self, edge_id: Any) -> int:
+        position = self._index.edge_pos.get(edge_id) if isinstance(edge_id, str) else None
+        if position is None or edge_id in self._removed_edges:
+            raise GraphOpError(f"unknown edge {edge_id!r}")
+        return position
+
+    def _add_node(self, op: Dict[str, Any]):
+        node = _validate(Node, op.get("node"), "node")
+        if node["id"] in self._index.node_pos:
+            raise GraphOpError(f"node {node['id']!r} already exists")
+        self._index.node_pos[node["id"]] = len(self.nodes)
+        self.nodes.append(node)
+        self.size_delta += _size(node)
+
+    def _update_node(self, op: Dict[str, Any]):
+        position = self._node_position(op.get("id"))
+        current = self.nodes[position]
+        merged = dict(current)
+        for key in ("position", "data"):
+            if isinstance(op.get(key), dict):
+                merged[key] = {**current[key], **op[key]}
+        if "type" in op:
+            merged["type"] = op["type"]
+        node = _validate(Node, merged, "node")
+        self.nodes[position] = node
+        self.size_delta += _size(node) - _size(current)
+
+    def _remove_node(self, op: Dict[str, Any]):
+        position = self._node_position(op.get("id"))
+        node = self.nodes[position]
+        for edge_id in list(self._index.node_edges.get(node["id"], ())):
+            if edge_id not in self._removed_edges:
+                self._drop_edge(self._index.edge_pos[edge_id])
+        self._removed_nodes.add(node["id"])
+        self.size_delta -= _size(node)
+
+    def _add_edge(self, op: Dict[str, Any]):
+        edge = _validate(Edge, op.get("edge"), "edge")
+        if edge["id"] in self._index.edge_pos:
+            raise GraphOpError(f"edge {edge['id']!r} already exists")
+        self._node_position(edge["source"])
+        self._node_position(edge["target"])
+        self._index.edge_pos[edge["id"]] = len(self.edges)
+        self._index.link(edge)
+        self.edges.append(edge)
+        self.size_delta += _size(edge)
+
+    def _update_edge(self, op: Dict[str, Any]):
+        position = self._edge_position(op.get("id"))
+        current = self.edges[position]
+        merged = {**current, **{key: value for key, value in op.items() if key not in ("op", "id")}}
+        edge = _validate(Edge, merged, "edge")
+        self._node_position(edge["source"])
+        self._node_position(edge["target"])
+        self._index.unlink(current)
+        self._index.link(edge)
+        self.edges[position] = edge
+        self.size_delta += _size(edge) - _size(current)
+
+    def _remove_edge(self, op: Dict[str, Any]):
+        self._drop_edge(self._edge_position(op.get("id")))
+
+    def _drop_edge(self, position: int):
+        edge = self.edges[position]
+        self._index.unlink(edge)
+        self._removed_edges.add(edge["id"])
+        self.size_delta -= _size(edge)
+
+
+# ==================== 私有方法 ====================
+
+def _validate(model, payload: Any, kind: str) -> Dict[str, Any]:
+    if not isinstance(payload, dict):
+        raise GraphOpError(f"{kind} must be an object")
+    try:
+        return model(**payload).model_dump()
+    except (TypeError, ValueError) as e:
+        raise GraphOpError(f"invalid {kind} {payload.get('id')!r}: {e}")
+
+
+def _size(item: Dict[str, Any]) -> int:
+    return json_size(item)
@@ -17,12 +17,21 @@ from app.models.schemas import (
     Position,
     NodeData,
 )
-from app.services.ai_vision import create_vision_service
+from app.core.config import settings
+from app.services.ai_vision import create_vision_service, settle_response_cache
+from app.services.hedged_failover import HedgeExhaustedError, config_label, hedge_delay_for, run_hedged
+from app.services.graph_codec import GraphCodec, k_hop_subgraph
+from app.services.graph_ops import GraphOpApplier, diff_graph
+from app.services.json_recovery import describe_repairs, recover_json
 from app.services.model_presets import get_model_presets_service
-from app.services.session_manager import get_session_manager
+from app.services.provider_health import get_provider_health
+from app.services.session_manager import SessionVersionConflict, get_session_manager
 
 logger = logging.getLogger(__name__)
 
+# 保存生成结果时会话已被其他写入更新：操作模式在最新画布上重放的最多次数
+_SESSION_SAVE_ATTEMPTS = 3
+
 
 # Architecture type templates configuration
 ARCHITECTURE_TEMPLATES = {
@@ -590,18 +599,8 @@ Generate a well-laid-out flowchart. Focus on clarity and visual balance. Return
         return system_prompt
 
     async def _call_ai_text_generation(self, vision_service, prompt: str, provider: str) -> dict:
-        """Call AI provider (placeholder)."""
-        if provider == "gemini":
-            response = await vision_service._analyze_with_gemini_text(prompt)
-        elif provider == "openai":
-            response = await vision_service._analyze_with_openai_text(prompt)
-        elif provider == "claude":
-            response = await vision_service._analyze_with_claude_text(prompt)
-        elif provider == "siliconflow":
-            response = await vision_service._analyze_with_siliconflow_text(prompt)
-        else:
-            response = await vision_service._analyze_with_custom_text(prompt)
-        return response
+        """Call AI provider (dispatch + response cache live in AIVisionService.analyze_text)."""
+        return await vision_service.analyze_text(prompt, provider)
 
     @staticmethod
     def _classify_provider_error(error: Exception) -> tuple[int, str]:
@@ -616,11 +615,6 @@ Generate a well-laid-out flowchart. Focus on clarity and visual balance. Return
             return 503, "upstream_unavailable"
         return 500, "provider_error"
 
-    @classmethod
-    def _is_retryable_provider_error(cls, error: Exception) -> bool:
-        status_code, _ = cls._classify_provider_error(error)
-        return status_code in {429, 503, 504}
-
     def _bpmn_colors(self):
         return {
             "start": "#16a34a",
@@ -636,18 +630,11 @@ Generate a well-laid-out flowchart. Focus on clarity and visual balance. Return
         if isinstance(payload, dict):
             return payload
         if isinstance(payload, str):
-            # Clean markdown code blocks (```json ... ``` or ``` ... ```)
-            cleaned = payload.strip()
-            if cleaned.startswith("```"):
-                # Remove opening ```json or ```
-                lines = cleaned.split("\n")
-                if lines[0].startswith("```"):
-                    lines = lines[1:]
-                # Remove closing ```
-                if lines and lines[-1].strip() == "```":
-                    lines = lines[:-1]
-                cleaned = "\n".join(lines)
-            return json.loads(cleaned)
+            # 单遍容错解析：跳过说明文字 / 代码块，修复逗号与截断；无法恢复时抛出 JSONRecoveryError
+            recovered = recover_json(payload)
+            if recovered.repaired:
+                logger.info(f"[CHAT-GEN] JSON repaired: {describe_repairs(recovered.repairs)}")
+            return recovered.value
         if hasattr(payload, "model_dump"):  # pydantic models
             return payload.model_dump()
         return json.loads(json.dumps(payload, default=str))
@@ -1440,13 +1427,220 @@ Generate a well-laid-out flowchart. Focus on clarity and visual balance. Return
 
         return "\n".join(lines)
 
+    def _load_incremental_canvas(self, session_id: str) -> Optional[Tuple[List[Node], List[Edge], int]]:
+        """从会话加载现有画布及其版本号，会话不存在或已过期时返回 None（调用方回退为全量生成）"""
+        logger.info(f"[INCREMENTAL] Incremental mode enabled, loading session: {session_id}")
+        loaded = get_session_manager().get_session_graph(session_id)
+        if not loaded:
+            logger.warning(
+                f"[INCREMENTAL] Session {session_id} not found or expired, falling back to full generation"
+            )
+            return None
+
+        # 会话缓存的已校验模型（只读共享，合并时写时复制）
+        session_data, graph = loaded
+        existing_nodes = list(graph.nodes)
+        existing_edges = list(graph.edges)
+        logger.info(f"[INCREMENTAL] Loaded {len(existing_nodes)} nodes, {len(existing_edges)} edges")
+        return existing_nodes, existing_edges, session_data.get("version", 1)
+
+    def _prepare_incremental_prompt(
+        self,
+        request: ChatGenerationRequest,
+        existing_nodes: List[Node],
+        existing_edges: List[Edge],
+    ) -> Tuple[str, GraphCodec]:
+        """裁剪相关子图并构建增量 Prompt，返回 (prompt, 用于还原短 id 的 codec)"""
+        scoped_nodes, scoped_edges, omitted_summary = self._scope_incremental_graph(
+            request.user_input, existing_nodes, existing_edges
+        )
+        graph_codec = GraphCodec(scoped_nodes, scoped_edges)
+        prompt = self._build_incremental_prompt(
+            request, existing_nodes, existing_edges, graph_codec, omitted_summary
+        )
+        return prompt, graph_codec
+
+    def _create_op_applier(
+        self,
+        existing_nodes: List[Node],
+        existing_edges: List[Edge],
+        codec: Optional[GraphCodec] = None,
+    ) -> GraphOpApplier:
+        """操作模式下的画布工作副本，新节点按 _ensure_positions 的规则归一化"""
+        return GraphOpApplier(
+            existing_nodes,
+            existing_edges,
+            codec=codec,
+            node_normalizer=lambda payload: self._ensure_positions([payload])[0],
+        )
+
+    def _save_generated_canvas(
+        self,
+        session_id: Optional[str],
+        nodes: List[Node],
+        edges: List[Edge],
+        base_version: Optional[int],
+        op_applier: Optional[GraphOpApplier] = None,
+    ) -> Tuple[str, List[Node], List[Edge]]:
+        """
+        保存生成结果，以生成前加载画布时的版本为条件（与 PATCH 相同的比较后写入）
+
+        生成期间会话可能已被 PATCH 或其他生成更新：操作模式在最新画布上重放操作后重试，
+        全量合并结果无法安全重放，直接抛出 SessionVersionConflict，不覆盖对方的修改。
+
+        Returns:
+            (会话 ID, 实际保存的节点, 实际保存的边)
+        """
+        session_manager = get_session_manager()
+        for attempt in range(_SESSION_SAVE_ATTEMPTS):
+            try:
+                session_id = session_manager.create_or_update_session(
+                    session_id=session_id,
+                    nodes=nodes,
+                    edges=edges,
+                    expected_version=base_version,
+                )
+                return session_id, nodes, edges
+            except SessionVersionConflict as conflict:
+                if op_applier is None or attempt == _SESSION_SAVE_ATTEMPTS - 1:
+                    raise
+                canvas = self._load_incremental_canvas(session_id)
+                if canvas is None:
+                    raise
+                logger.warning(f"[INCREMENTAL] {conflict}; replaying {len(op_applier.applied)} ops on the latest canvas")
+                fresh_nodes, fresh_edges, base_version = canvas
+                op_applier = op_applier.rebase(fresh_nodes, fresh_edges)
+                nodes, edges = op_applier.nodes, op_applier.edges
+
+    def _build_delta_response(
+        self,
+        request: ChatGenerationRequest,
+        base_nodes: List[Node],
+        base_edges: List[Edge],
+        nodes: List[Node],
+        edges: List[Edge],
+        base_version: Optional[int],
+        session_version: Optional[int],
+    ) -> Optional[ChatGenerationResponse]:
+        """
+        delta 模式响应：只返回相对会话快照的变化
+
+        客户端的 base_version 必须等于加载的快照版本，且本次保存恰好是下一个版本
+        （期间没有其他写入），否则返回 None，由调用方回退为全量响应。
+        """
+        if base_version is None or session_version is None:
+            return None
+        if request.base_version != base_version or session_version != base_version + 1:
+            logger.info(
+                "[INCREMENTAL] Delta unavailable: client base=%s, snapshot=%s, saved=%s",
+                request.base_version,
+                base_version,
+                session_version,
+            )
+            return None
+
+        delta = diff_graph(base_nodes, base_edges, nodes, edges)
+        logger.info(
+            "[INCREMENTAL] Delta v%s -> v%s: +%s/~%s/-%s nodes, +%s/~%s/-%s edges",
+            base_version,
+            session_version,
+            len(delta.added_nodes),
+            len(delta.modified_nodes),
+            len(delta.removed_node_ids),
+            len(delta.added_edges),
+            len(delta.modified_edges),
+            len(delta.removed_edge_ids),
+        )
+        return ChatGenerationResponse(
+            nodes=[],
+            edges=[],
+            mermaid_code="",
+            success=True,
+            session_version=session_version,
+            base_version=base_version,
+            delta=delta,
+        )
+
+    def _scope_incremental_graph(
+        self,
+        user_input: str,
+        existing_nodes: List[Node],
+        existing_edges: List[Edge],
+    ) -> Tuple[List[Node], List[Edge], str]:
+        """
+        大画布只保留与请求相关的子图：label 关键词命中请求的节点及其 k 跳邻居
+
+        Returns:
+            (子图节点, 子图边, 其余部分的一行摘要)；未裁剪时摘要为空
+        """
+        if not settings.INCREMENTAL_SCOPE_ENABLED or len(existing_nodes) <= settings.INCREMENTAL_SCOPE_MIN_NODES:
+            return existing_nodes, existing_edges, ""
+
+        request_keywords = self._extract_semantic_keywords(user_input)
+        request_text = (user_input or "").lower()
+        scores: Dict[str, int] = {}
+        for node in existing_nodes:
+            # 英文按整词匹配；中文没有分词，按子串匹配（"订单服务" 命中 "给订单服务加缓存"）
+            score = sum(
+                1 for keyword in self._extract_semantic_keywords(node.data.label)
+                if keyword in request_keywords or (not keyword.isascii() and keyword in request_text)
+            )
+            if score:
+                scores[node.id] = score
+
+        if not scores:
+            logger.info("[INCREMENTAL] No canvas node matches the request; sending the full canvas")
+            return existing_nodes, existing_edges, ""
+
+        seed_ids = sorted(scores, key=lambda node_id: -scores[node_id])
+        scoped_nodes, scoped_edges = k_hop_subgraph(
+            existing_nodes,
+            existing_edges,
+            seed_ids,
+            hops=settings.INCREMENTAL_SCOPE_HOPS,
+            max_nodes=settings.INCREMENTAL_SCOPE_MAX_NODES,
+        )
+
+        scoped_ids = {node.id for node in scoped_nodes}
+        omitted_types: Dict[str, int] = {}
+        for node in existing_nodes:
+            if node.id not in scoped_ids:
+                node_type = node.type or "default"
+                omitted_types[node_type] = omitted_types.get(node_type, 0) + 1
+        type_summary = ", ".join(
+            f"{node_type}: {count}" for node_type, count in sorted(omitted_types.items(), key=lambda item: -item[1])
+        )
+        summary = (
+            f"Not shown (unchanged, keep as is): {len(existing_nodes) - len(scoped_nodes)} more nodes "
+            f"({type_summary}) and {len(existing_edges) - len(scoped_edges)} more edges."
+        )
+        logger.info(
+            "[INCREMENTAL] Scoped canvas to %s/%s nodes (%s seeds, %s hops)",
+            len(scoped_nodes),
+            len(existing_nodes),
+            len(seed_ids),
+            settings.INCREMENTAL_SCOPE_HOPS,
+        )
+        return scoped_nodes, scoped_edges, summary
+
     def _build_incremental_prompt(
         self,
         request: ChatGenerationRequest,
         existing_nodes: List[Node],
-        existing_edges: List[Edge]
+        existing_edges: List[Edge],
+        codec: Optional[GraphCodec] = None,
+        omitted_summary: str = "",
     ) -> str:
-        existing_ids = [n.id for n in existing_nodes]
+        """
+        现有画布以紧凑编码嵌入（短 id / 量化坐标 / 类型字典 / 邻接表），模型输出经 codec.restore_ids 还原
+
+        codec 可以只覆盖相关子图（见 _scope_incremental_graph），其余部分由 omitted_summary 一行带过；
+        坐标范围与统计仍按完整画布计算。
+        """
+        codec = codec or GraphCodec(existing_nodes, existing_edges)
+        graph_block = codec.encode()
+        if omitted_summary:
+            graph_block = f"{graph_block}\n{omitted_summary}"
         max_x = max((n.position.x for n in existing_nodes), default=0)
         max_y = max((n.position.y for n in existing_nodes), default=0)
         min_y = min((n.position.y for n in existing_nodes), default=0)
@@ -1454,33 +1648,36 @@ Generate a well-laid-out flowchart. Focus on clarity and visual balance. Return
         edge_count = len(existing_edges)
         timestamp = int(time.time())
 
-        node_type_summary: Dict[str, int] = {}
-        for node in existing_nodes:
-            node_type = node.type or "default"
-            node_type_summary[node_type] = node_type_summary.get(node_type, 0) + 1
-
-        type_lines = "\n".join([f"- {k}: {v}" for k, v in sorted(node_type_summary.items())])
-        existing_json = json.dumps(
-            {
-                "nodes": [n.model_dump() for n in existing_nodes],
-                "edges": [e.model_dump() for e in existing_edges],
-            },
-            ensure_ascii=False,
-            indent=2,
-        )
+        if request.incremental_output == "ops":
+            output_instructions = (
+                "Return only valid JSON of the form {\"ops\": [...]} listing the changes, in order. "
+                "Do not repeat unchanged nodes or edges. Allowed ops:\n"
+                "{\"op\": \"add_node\", \"id\", \"type\", \"label\", \"x\", \"y\", \"shape\"}\n"
+                "{\"op\": \"add_edge\", \"source\", \"target\", \"label\"}\n"
+                "{\"op\": \"update_label\", \"id\", \"label\"}\n"
+                "{\"op\": \"remove_edge\", \"source\", \"target\"}\n"
+                "Add a node before any edge that references it; use full type names."
+            )
+        else:
+            output_instructions = (
+                "Return only valid JSON with full nodes and edges arrays "
+                "(nodes as {id, type, position: {x, y}, data: {label, shape}} with full type names)."
+            )
 
         return (
             f"You are an expert systems architect doing incremental updates.\n"
             f"Keep all existing nodes/edges unchanged and add only new content.\n"
-            f"Existing node IDs: {', '.join(existing_ids[:15])}{'...' if len(existing_ids) > 15 else ''}\n"
-            f"Existing bounds: x=[0,{max_x}], y=[{min_y},{max_y}]\n"
-            f"New nodes should be placed at x >= {max_x + 280}.\n"
-            f"Current graph stats: nodes={node_count}, edges={edge_count}\n"
-            f"Node types:\n{type_lines}\n\n"
-            f"Current graph JSON:\n{existing_json}\n\n"
+            f"Existing bounds: x=[0,{max_x:.0f}], y=[{min_y:.0f},{max_y:.0f}]\n"
+            f"New nodes should be placed at x >= {max_x + 280:.0f}.\n"
+            f"Current graph stats: nodes={node_count}, edges={edge_count}\n\n"
+            f"Current graph (compact encoding: type codes declared in 'types', "
+            f"one node per line as id|type|label|x,y|shape, edges as an adjacency list "
+            f"source>target:label; quoted labels are JSON strings):\n"
+            f"{graph_block}\n\n"
             f"User request: {request.user_input}\n"
+            f"Refer to existing nodes by their short ids (n1, n2, ...).\n"
             f"New node IDs must follow <type>-{timestamp}-<n>.\n"
-            f"Return only valid JSON with full nodes and edges arrays."
+            f"{output_instructions}"
         )
 
     def _extract_semantic_keywords(self, label: str) -> set:
@@ -1531,20 +1728,21 @@ Generate a well-laid-out flowchart. Focus on clarity and visual balance. Return
             if node_id not in ai_map:
                 ai_nodes.append(node)
 
-        ai_map = {n.id: n for n in ai_nodes}
-        for node_id, original in original_map.items():
-            if node_id not in ai_map:
+        # 现有节点是会话缓存中共享的只读模型：不原地修改，模型返回的同 id 节点替换为带会话字段的副本
+        for idx, current in enumerate(ai_nodes):
+            original = original_map.get(current.id)
+            if original is None or current is original:
                 continue
-            current = ai_map[node_id]
-            current.type = original.type
-            current.data.label = original.data.label
-            current.position = original.position
+            # 紧凑编码不含 iconType / color 等样式字段，现有节点的 data 以会话为准
+            ai_nodes[idx] = current.model_copy(
+                update={"type": original.type, "data": original.data, "position": original.position}
+            )
 
         seen_ids = set()
         deduped = []
         for idx, node in enumerate(ai_nodes):
             if node.id in seen_ids:
-                node.id = f"{node.id}-dup-{idx}"
+                node = node.model_copy(update={"id": f"{node.id}-dup-{idx}"})
             seen_ids.add(node.id)
             deduped.append(node)
 
@@ -1559,8 +1757,10 @@ Generate a well-laid-out flowchart. Focus on clarity and visual balance. Return
                     (node.position.y - other.position.y) ** 2
                 )
                 if distance < overlap_threshold:
-                    node.position.x += 260
-                    node.position.y += 30
+                    node = node.model_copy(update={
+                        "position": Position(x=node.position.x + 260, y=node.position.y + 30)
+                    })
+                    nodes[i] = node
         return nodes
 
     def _merge_edges(self, original_edges: List[Edge], ai_edges: List[Edge]) -> List[Edge]:
@@ -1623,6 +1823,8 @@ Generate a well-laid-out flowchart. Focus on clarity and visual balance. Return
             config_candidates.extend(
                 presets_service.get_failover_configs(primary_config=config, max_candidates=3)
             )
+            provider_health = get_provider_health()
+            config_candidates = provider_health.order_candidates(config_candidates, keep_primary=True)
             logger.info(
                 "[CHAT-GEN] Config candidates prepared: %s",
                 [
@@ -1633,31 +1835,23 @@ Generate a well-laid-out flowchart. Focus on clarity and visual balance. Return
             # 棣冨晭 婢х偤鍣洪悽鐔稿灇濡€崇础閿涙碍閺屻儱鑻熼懢宄板絿閻滅増婀侀弸鑸电€?
             existing_nodes = []
             existing_edges = []
+            base_version: Optional[int] = None
             session_id = request.session_id
 
             if request.incremental_mode and request.session_id:
-                logger.info(f"[INCREMENTAL] Incremental mode enabled, loading session: {request.session_id}")
-                session_manager = get_session_manager()
-                session_data = session_manager.get_session(request.session_id)
-
-                if session_data:
-                    existing_nodes = [Node(**n) for n in session_data["nodes"]]
-                    existing_edges = [Edge(**e) for e in session_data["edges"]]
-                    logger.info(
-                        f"[INCREMENTAL] Loaded {len(existing_nodes)} nodes, {len(existing_edges)} edges"
-                    )
+                canvas = self._load_incremental_canvas(request.session_id)
+                if canvas:
+                    existing_nodes, existing_edges, base_version = canvas
                 else:
-                    logger.warning(
-                        f"[INCREMENTAL] Session {request.session_id} not found or expired, "
-                        "falling back to full generation"
-                    )
                     request.incremental_mode = False
 
             # 閺嬪嫬缂?Prompt閿涘牆闁插繑鍨ㄩ崗銊︽煀閿?
             prompt_request = request.model_copy(update={"diagram_type": effective_diagram_type})
+            graph_codec: Optional[GraphCodec] = None
+            ops_mode = bool(request.incremental_mode and existing_nodes and request.incremental_output == "ops")
             if request.incremental_mode and existing_nodes:
-                logger.info("[INCREMENTAL] Building incremental prompt")
-                prompt = self._build_incremental_prompt(prompt_request, existing_nodes, existing_edges)
+                logger.info("[INCREMENTAL] Building incremental prompt (output=%s)", request.incremental_output)
+                prompt, graph_codec = self._prepare_incremental_prompt(prompt_request, existing_nodes, existing_edges)
             else:
                 prompt = self._build_generation_prompt(prompt_request)
 
@@ -1666,58 +1860,81 @@ Generate a well-laid-out flowchart. Focus on clarity and visual balance. Return
 
             ai_raw: Any = None
             attempt_errors: List[Dict[str, Any]] = []
+            attempt_services: Dict[int, Any] = {}
+            winning_service = None
 
-            for attempt_index, attempt_config in enumerate(config_candidates, start=1):
+            async def run_attempt(attempt_index: int, attempt_config: Dict[str, Any]) -> Any:
                 attempt_provider = attempt_config.get("provider") or selected_provider
-                attempt_model = attempt_config.get("model_name") or ""
-                attempt_base = attempt_config.get("base_url") or ""
-                try:
-                    logger.info(
-                        "[CHAT-GEN] Attempt %s/%s via provider=%s model=%s base=%s",
-                        attempt_index,
-                        len(config_candidates),
-                        attempt_provider,
-                        attempt_model,
-                        attempt_base or "-",
-                    )
-                    vision_service = create_vision_service(
-                        provider=attempt_provider,
-                        api_key=attempt_config.get("api_key"),
-                        base_url=attempt_config.get("base_url"),
-                        model_name=attempt_config.get("model_name"),
-                    )
-                    ai_raw = await self._call_ai_text_generation(vision_service, prompt, attempt_provider)
-                    selected_provider = attempt_provider
-                    config = attempt_config
-                    if attempt_index > 1:
-                        logger.warning(
-                            "[CHAT-GEN] Provider failover succeeded on attempt %s (%s/%s)",
-                            attempt_index,
-                            attempt_provider,
-                            attempt_model,
-                        )
-                    break
-                except Exception as provider_error:
-                    status_code, error_code = self._classify_provider_error(provider_error)
-                    attempt_errors.append({
-                        "provider": attempt_provider,
-                        "model_name": attempt_model,
-                        "status_code": status_code,
-                        "error_code": error_code,
-                        "detail": str(provider_error),
-                    })
+                logger.info(
+                    "[CHAT-GEN] Attempt %s/%s via provider=%s model=%s base=%s",
+                    attempt_index + 1,
+                    len(config_candidates),
+                    attempt_provider,
+                    attempt_config.get("model_name") or "",
+                    attempt_config.get("base_url") or "-",
+                )
+                vision_service = create_vision_service(
+                    provider=attempt_provider,
+                    api_key=attempt_config.get("api_key"),
+                    base_url=attempt_config.get("base_url"),
+                    model_name=attempt_config.get("model_name"),
+                )
+                attempt_services[attempt_index] = vision_service
+                provider_health.begin_attempt(attempt_config)
+                started_at = time.perf_counter()
+                raw = await self._call_ai_text_generation(vision_service, prompt, attempt_provider)
+                # 无效输出视为失败，交给下一个候选（对冲时也不会采用无效结果），也不写入响应缓存
+                parsed = self._safe_json(raw)
+                invalid_reason = None
+                if not parsed:
+                    invalid_reason = "AI response is empty or not a JSON object"
+                elif ops_mode and not isinstance(parsed.get("ops"), list):
+                    invalid_reason = "AI response has no ops array"
+                if invalid_reason:
+                    settle_response_cache(vision_service, accepted=False)
+                    raise ValueError(invalid_reason)
+                provider_health.record_success(attempt_config, latency_seconds=time.perf_counter() - started_at)
+                return raw
+
+            def record_attempt_error(attempt_index: int, attempt_config: Dict[str, Any], provider_error: Exception):
+                status_code, error_code = self._classify_provider_error(provider_error)
+                provider_health.record_failure(attempt_config, status_code, error_code)
+                attempt_errors.append({
+                    "provider": attempt_config.get("provider") or selected_provider,
+                    "model_name": attempt_config.get("model_name") or "",
+                    "status_code": status_code,
+                    "error_code": error_code,
+                    "detail": str(provider_error),
+                })
+                logger.warning(
+                    "[CHAT-GEN] Attempt %s failed (%s/%s): %s",
+                    attempt_index + 1,
+                    status_code,
+                    error_code,
+                    provider_error,
+                )
+
+            try:
+                winner_index, ai_raw = await run_hedged(
+                    config_candidates,
+                    run_attempt,
+                    hedge_delay=hedge_delay_for(streaming=False),
+                    label=config_label,
+                    max_parallel=settings.HEDGE_MAX_PARALLEL,
+                    on_error=record_attempt_error,
+                )
+                config = config_candidates[winner_index]
+                selected_provider = config.get("provider") or selected_provider
+                winning_service = attempt_services.get(winner_index)
+                if winner_index > 0:
                     logger.warning(
-                        "[CHAT-GEN] Attempt %s failed (%s/%s): %s",
-                        attempt_index,
-                        status_code,
-                        error_code,
-                        provider_error,
+                        "[CHAT-GEN] Provider failover succeeded on attempt %s (%s/%s)",
+                        winner_index + 1,
+                        selected_provider,
+                        config.get("model_name") or "",
                     )
-                    if (
-                        attempt_index < len(config_candidates)
-                        and self._is_retryable_provider_error(provider_error)
-                    ):
-                        continue
+            except HedgeExhaustedError:
+                ai_raw = None
 
             if ai_raw is None:
                 status_priority = [429, 401, 503, 504, 500]
@@ -1743,8 +1960,22 @@ Generate a well-laid-out flowchart. Focus on clarity and visual balance. Return
             logger.info(f"[CHAT-GEN] AI raw response type: {type(ai_raw)}, keys: {list(ai_raw.keys()) if isinstance(ai_raw, dict) else 'N/A'}")
             ai_data = self._safe_json(ai_raw)
             logger.info(f"[CHAT-GEN] Parsed AI data keys: {list(ai_data.keys())}")
+            if graph_codec is not None and not ops_mode:
+                ai_data = graph_codec.restore_ids(ai_data)
 
-            if effective_diagram_type == "architecture":
+            op_applier: Optional[GraphOpApplier] = None
+            if ops_mode:
+                op_applier = self._create_op_applier(existing_nodes, existing_edges, graph_codec)
+                applied_ops, rejected_ops = op_applier.apply_all(ai_data.get("ops") or [])
+                logger.info(
+                    "[INCREMENTAL] Applied %s ops (%s rejected): %s",
+                    len(applied_ops),
+                    len(rejected_ops),
+                    [item["reason"] for item in rejected_ops][:5],
+                )
+                nodes, edges = op_applier.nodes, op_applier.edges
+                mermaid_code = graph_to_mermaid(nodes, edges)
+            elif effective_diagram_type == "architecture":
                 # Pass architecture_type to normalization
                 arch_type = request.architecture_type or "layered"
                 nodes, edges, mermaid_code = self._normalize_architecture_graph(ai_data, arch_type)
@@ -1760,10 +1991,11 @@ Generate a well-laid-out flowchart. Focus on clarity and visual balance. Return
             logger.info(f"[CHAT-GEN] After normalization: {len(nodes)} nodes, {len(edges)} edges")
 
             # 棣冨晭 婢х偤鍣哄Ο鈥崇础妤犲矁鐦夐崪灞芥値楠?
-            if request.incremental_mode and existing_nodes:
+            if request.incremental_mode and existing_nodes and not ops_mode:
                 logger.info("[INCREMENTAL] Validating and merging incremental results")
-                nodes = self._validate_incremental_result(existing_nodes, nodes)
-                edges = self._merge_edges(existing_edges, edges)
+                nodes = self._validate_incremental_result(existing_nodes, [Node(**n) for n in nodes])
+                edges = self._merge_edges(existing_edges, [Edge(**e) for e in edges])
+                mermaid_code = graph_to_mermaid(nodes, edges)
                 logger.info(
                     f"[INCREMENTAL] After merge: {len(nodes)} nodes (+{len(nodes) - len(existing_nodes)} new), "
                     f"{len(edges)} edges (+{len(edges) - len(existing_edges)} new)"
@@ -1774,7 +2006,10 @@ Generate a well-laid-out flowchart. Focus on clarity and visual balance. Return
                     "[CHAT-GEN] AI response missing nodes; raw keys: %s",
                     list(ai_data.keys()),
                 )
+                settle_response_cache(winning_service, accepted=False)
                 raise ValueError("AI response missing nodes; please retry with clearer input.")
+            # 解析 / 归一化均通过后才写入响应缓存
+            settle_response_cache(winning_service, accepted=True)
 
             # If AI result is completely empty, use template mock as last resort
             # Changed from < 3 nodes to == 0 nodes to be less aggressive
@@ -1809,14 +2044,31 @@ Generate a well-laid-out flowchart. Focus on clarity and visual balance. Return
             )
 
             # 棣冨晭 閺囧瓨鏌婃导姘崇樈閿涘牆闁插繑膩瀵繑鍨ㄦ＃鏍ㄦ穱婵嗙摠閿?
+            session_version: Optional[int] = None
             if request.incremental_mode or session_id:
-                session_manager = get_session_manager()
-                session_id = session_manager.create_or_update_session(
-                    session_id=session_id,
-                    nodes=nodes,
-                    edges=edges
+                nodes = [n if isinstance(n, Node) else Node(**n) for n in nodes]
+                edges = [e if isinstance(e, Edge) else Edge(**e) for e in edges]
+                try:
+                    saved = self._save_generated_canvas(session_id, nodes, edges, base_version, op_applier)
+                except SessionVersionConflict as conflict:
+                    logger.warning(f"[SESSION] Generation result rejected: {conflict}")
+                    raise HTTPException(status_code=409, detail=str(conflict))
+                if saved[1] is not nodes:
+                    # 操作已在最新画布上重放
+                    mermaid_code = graph_to_mermaid(saved[1], saved[2])
+                session_id, nodes, edges = saved
+                session_version = get_session_manager().get_session_version(session_id)
+                logger.info(f"[SESSION] Updated session: {session_id} (version={session_version})")
+
+            if request.response_mode == "delta":
+                delta_response = self._build_delta_response(
+                    request, existing_nodes, existing_edges, nodes, edges, base_version, session_version
                 )
-                logger.info(f"[SESSION] Updated session: {session_id}")
+                if delta_response is not None:
+                    delta_response.session_id = session_id
+                    delta_response.message = message
+                    return delta_response
+                message = f"{message} (full graph: base_version does not match the session)"
 
             return ChatGenerationResponse(
                 nodes=nodes,
@@ -1824,7 +2076,8 @@ Generate a well-laid-out flowchart. Focus on clarity and visual balance. Return
                 mermaid_code=mermaid_code,
                 success=True,
                 message=message,
-                session_id=session_id  # 棣冨晭 鏉╂柨娲?session_id
+                session_id=session_id,  # 棣冨晭 鏉╂柨娲?session_id
+                session_version=session_version
             )
 
         except HTTPException:
@@ -0,0 +1,273 @@
+"""
+Provider 客户端连接池 (Provider Client Registry)
+
+进程级共享的 OpenAI / Anthropic SDK 客户端注册表（含异步客户端），按
+ModelPresetsService._config_signature 元组（provider, api_key, base_url, model_name）
+复用长连接客户端，避免每个请求、每次 failover 都重新建立连接池和 TLS 握手。
+异步客户端（AsyncOpenAI / AsyncAnthropic / httpx.AsyncClient）绑定事件循环：
+调用方传入 loop，注册表按事件循环隔离（WeakKeyDictionary 为每个循环分配序号，
+循环被回收后不会与新循环的 id 冲突），关闭时把 aclose() 调度回所属循环执行。
+
+设计：
+- 空闲淘汰 / clear() 直接关闭客户端
+- 容量淘汰 / invalidate() 的客户端可能仍被进行中的请求持有：先移入 retired 列表，
+  自最后一次使用起空闲超过 idle_seconds 后再关闭（不会打断进行中的流式请求）
+- 异步客户端的关闭协程通过 run_coroutine_threadsafe 调度到所属事件循环；
+  只有循环已关闭（或已被回收）时才丢弃协程，由对象回收释放连接
+"""
+
+import asyncio
+import inspect
+import itertools
+import logging
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ProviderClientRegistry:
+    """线程安全的 SDK 客户端注册表（LRU + 空闲淘汰）"""
+
+    def __init__(
+        self,
+        max_size: int = 32,
+        idle_seconds: float = 600.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        初始化注册表
+
+        Args:
+            max_size: 最多缓存的客户端数量，超出后淘汰最久未使用的
+            idle_seconds: 空闲超过该时长的客户端会被关闭并移除
+            clock: 单调时钟（测试时可注入假时钟）
+        """
+        self._max_size = max(1, max_size)
+        self._idle_seconds = idle_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        # {(kind, signature, loop_token): {"client": ..., "last_used": float, "loop": weakref | None}}
+        self._entries: "OrderedDict[Tuple[str, tuple, int], Dict[str, Any]]" = OrderedDict()
+        # 已移出注册表、等待空闲超时后关闭的客户端（容量淘汰 / invalidate）
+        self._retired: List[Dict[str, Any]] = []
+        # 事件循环 → 序号（0 表示同步客户端）；循环被回收后条目自动消失，序号不会复用
+        self._loop_tokens: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, int]" = weakref.WeakKeyDictionary()
+        self._token_counter = itertools.count(1)
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get_or_create(
+        self,
+        kind: str,
+        signature: tuple,
+        factory: Callable[[], Any],
+        loop: Optional[asyncio.AbstractEventLoop] = None,
+    ) -> Any:
+        """
+        获取（或创建）指定签名的客户端
+
+        Args:
+            kind: 客户端类别（如 "openai"、"anthropic"），同一签名可能需要多种客户端
+            signature: 配置签名元组
+            factory: 缓存未命中时调用的构造函数
+            loop: 异步客户端所属的事件循环（同步客户端为 None）
+
+        Returns:
+            共享的客户端实例
+        """
+        now = self._clock()
+        evicted = []
+
+        with self._lock:
+            key = (kind, signature, self._loop_token_locked(loop))
+            evicted.extend(self._evict_idle_locked(now))
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry["last_used"] = now
+                self._entries.move_to_end(key)
+                self._hits += 1
+                client = entry["client"]
+            else:
+                client = None
+
+        if client is not None:
+            self._close_all(evicted)
+            return client
+
+        # 在锁外构造，避免慢速初始化阻塞其它请求
+        created = factory()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                # 并发构造时保留先入库的实例
+                evicted.append(self._new_entry(created, now, loop))
+                entry["last_used"] = now
+                self._entries.move_to_end(key)
+                self._hits += 1
+                client = entry["client"]
+            else:
+                self._entries[key] = self._new_entry(created, now, loop)
+                self._misses += 1
+                client = created
+                while len(self._entries) > self._max_size:
+                    # 容量淘汰的客户端可能仍被进行中的请求持有，先退役，空闲超时后再关闭
+                    self._retired.append(self._entries.popitem(last=False)[1])
+                    self._evictions += 1
+
+        self._close_all(evicted)
+        return client
+
+    def invalidate(self, signature: tuple) -> int:
+        """
+        移除某个配置签名下的所有客户端（预设更新/删除时调用）
+
+        Returns:
+            被移除的客户端数量
+        """
+        with self._lock:
+            keys = [key for key in self._entries if key[1] == signature]
+            removed = [self._entries.pop(key) for key in keys]
+            # 与容量淘汰相同：进行中的请求继续使用旧客户端，空闲超时后关闭；新请求拿到新配置的客户端
+            self._retired.extend(removed)
+
+        if removed:
+            logger.info(f"Invalidated {len(removed)} pooled client(s) for provider={signature[0] if signature else '-'}")
+        return len(removed)
+
+    def evict_idle(self) -> int:
+        """淘汰所有空闲超时的客户端"""
+        with self._lock:
+            evicted = self._evict_idle_locked(self._clock())
+        self._close_all(evicted)
+        return len(evicted)
+
+    def clear(self):
+        """关闭并清空所有客户端（包括退役中的客户端）"""
+        with self._lock:
+            entries = list(self._entries.values()) + self._retired
+            self._entries.clear()
+            self._retired = []
+        self._close_all(entries)
+
+    def get_stats(self) -> dict:
+        """获取连接池统计信息"""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "retired": len(self._retired),
+                "max_size": self._max_size,
+                "idle_seconds": self._idle_seconds,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+            }
+
+    # ==================== 私有方法 ====================
+
+    def _loop_token_locked(self, loop: Optional[asyncio.AbstractEventLoop]) -> int:
+        if loop is None:
+            return 0
+        token = self._loop_tokens.get(loop)
+        if token is None:
+            token = self._loop_tokens[loop] = next(self._token_counter)
+        return token
+
+    @staticmethod
+    def _new_entry(client: Any, now: float, loop: Optional[asyncio.AbstractEventLoop]) -> Dict[str, Any]:
+        return {"client": client, "last_used": now, "loop": weakref.ref(loop) if loop is not None else None}
+
+    def _evict_idle_locked(self, now: float) -> list:
+        if self._idle_seconds <= 0:
+            return []
+        expired = [
+            key for key, entry in self._entries.items()
+            if now - entry["last_used"] > self._idle_seconds
+        ]
+        evicted = []
+        for key in expired:
+            evicted.append(self._entries.pop(key))
+            self._evictions += 1
+
+        retired = []
+        for entry in self._retired:
+            if now - entry["last_used"] > self._idle_seconds:
+                evicted.append(entry)
+            else:
+                retired.append(entry)
+        self._retired = retired
+        return evicted
+
+    @staticmethod
+    def _close_all(entries: list):
+        for entry in entries:
+            client = entry["client"]
+            close = getattr(client, "aclose", None) or getattr(client, "close", None)
+            if not callable(close):
+                continue
+            try:
+                result = close()
+                if inspect.isawaitable(result):
+                    loop = entry["loop"]() if entry["loop"] is not None else None
+                    if loop is not None and not loop.is_closed():
+                        # 异步客户端必须在所属事件循环上关闭连接池
+                        asyncio.run_coroutine_threadsafe(result, loop)
+                    else:
+                        # 所属事件循环已结束，无法再 await，底层连接随对象回收释放
+                        result.close()
+            except Exception as e:
+                logger.debug(f"Failed to close pooled client: {e}")
+
+
+def build_http_client_kwargs() -> Dict[str, Any]:
+    """共享 SDK 客户端使用的 httpx 连接池参数（keep-alive + 有界连接数）"""
+    import httpx
+
+    return {
+        "limits": httpx.Limits(
+            max_connections=settings.CLIENT_POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.CLIENT_POOL_MAX_KEEPALIVE,
+            keepalive_expiry=settings.CLIENT_POOL_KEEPALIVE_SECONDS,
+        )
+    }
+
+
+# ==================== 全局实例 ====================
+
+_registry: Optional[ProviderClientRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_client_registry() -> ProviderClientRegistry:
+    """
+    获取全局客户端注册表（单例模式）
+
+    Returns:
+        ProviderClientRegistry 实例
+    """
+    global _registry
+
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = ProviderClientRegistry(
+                    max_size=settings.CLIENT_POOL_MAX_SIZE,
+                    idle_seconds=settings.CLIENT_POOL_IDLE_SECONDS,
+                )
+
+    return _registry
+
+
+def reset_client_registry():
+    """重置全局客户端注册表（主要用于测试）"""
+    global _registry
+    if _registry is not None:
+        _registry.clear()
+    _registry = None
@@ -0,0 +1,448 @@
+"""
+Provider 并发治理 (Per-Provider Concurrency Governor)
+
+原先对每个 provider/key 同时发起的上游请求没有任何上限：一波用户同时生成时，
+请求无限制地扇出到上游，触发 provider 限流后所有人一起失败。
+
+设计：
+- 每个候选配置（provider/model@base_url#key指纹）一个自适应并发上限，超出上限的请求进入 FIFO 等待队列
+- 队列有长度上限和等待超时；排满或等待超时时抛出 ProviderBusyError（按 429 分类，交给 failover）
+- 默认从 max_limit 起步：上游没有限流时不做本地节流，只在上游返回 429 后才收缩
+- AIMD 调整上限：上游返回 429 时乘性减小，之后成功时加性增长（约每个窗口 +1）恢复到 max_limit，
+  同一秒内的多个 429 只减一次；带 Retry-After 时在冷却结束前不再放行新请求
+- 排队超时默认与流式请求的上游超时（240-300 秒）同量级：名额在整个流期间被占用，
+  超时过短会让排队的请求在前面的流结束前就被拒绝
+- 缓存命中不占用名额；流式请求的名额在整个流结束（或消费方提前退出）时才释放
+- 线程中的阻塞 SDK 调用通过 run_blocking() 执行：调用方被取消（如对冲落败）时 HTTP 请求仍在进行，
+  所在 slot 的名额推迟到线程返回后再归还，而不是在取消时立即放行下一个请求
+- 队列深度、等待耗时按配置统计，供 SSE [START] 事件和 /api/health/metrics 使用
+
+asyncio 的 Future 绑定创建它的事件循环，测试里 TestClient 会在不同线程的事件循环中发请求，
+因此内部状态用 threading.Lock 保护，唤醒等待者时通过 call_soon_threadsafe 投递到其所属循环。
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ProviderBusyError(Exception):
+    """本地并发上限已满（队列已满或排队超时）"""
+
+
+@dataclass
+class QueueTicket:
+    """一次获取名额的结果"""
+
+    wait_seconds: float = 0.0
+    queue_depth: int = 0      # 进入队列时前面（含自己）的排队数，0 表示未排队
+    # 占用名额期间通过 run_blocking 启动的线程调用（取消后仍在运行的调用推迟归还名额）
+    blocking_calls: List[asyncio.Future] = field(default_factory=list)
+
+
+# 当前任务所占用的名额（run_blocking 据此登记线程调用）
+_active_ticket: ContextVar[Optional[QueueTicket]] = ContextVar("active_ticket", default=None)
+
+
+class _Waiter:
+    __slots__ = ("loop", "future", "granted")
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, future: asyncio.Future):
+        self.loop = loop
+        self.future = future
+        self.granted = False
+
+
+class _ConfigLimiter:
+    """单个配置的并发状态"""
+
+    def __init__(self, label: str, initial_limit: float):
+        self.label = label
+        self.limit = initial_limit
+        self.in_flight = 0
+        self.waiters: Deque[_Waiter] = deque()
+        self.cooldown_until = 0.0
+        self.last_decrease_at = float("-inf")
+        # 统计
+        self.acquired = 0
+        self.queued_total = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.rate_limited = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+
+def rate_limit_info(error: BaseException) -> Tuple[bool, Optional[float]]:
+    """
+    判断异常是否为上游限流，并解析 Retry-After
+
+    兼容 openai / anthropic SDK 的 APIStatusError、httpx.HTTPStatusError 以及只带错误文本的异常。
+
+    Returns:
+        (是否限流, Retry-After 秒数或 None)
+    """
+    if isinstance(error, ProviderBusyError):
+        # 本地排队失败不是上游限流，不参与 AIMD
+        return False, None
+
+    response = getattr(error, "response", None)
+    status_code = getattr(error, "status_code", None)
+    if status_code is None and response is not None:
+        status_code = getattr(response, "status_code", None)
+
+    text = str(error).lower()
+    limited = status_code == 429 or (
+        status_code is None
+        and ("429" in text or "rate limit" in text or "usage_limit" in text or "too many requests" in text)
+    )
+    if not limited:
+        return False, None
+
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return True, None
+    try:
+        retry_after_ms = headers.get("retry-after-ms")
+        if retry_after_ms:
+            return True, max(0.0, float(retry_after_ms) / 1000.0)
+        retry_after = headers.get("retry-after")
+        if not retry_after:
+            return True, None
+        try:
+            return True, max(0.0, float(retry_after))
+        except ValueError:
+            retry_at = parsedate_to_datetime(retry_after)
+            return True, max(0.0, retry_at.timestamp() - time.time())
+    except Exception:
+        return True, None
+
+
+class ConcurrencyGovernor:
+    """按配置限制同时在途的上游请求数"""
+
+    def __init__(
+        self,
+        initial_limit: Optional[int] = None,
+        min_limit: int = 1,
+        max_limit: int = 16,
+        max_queue: int = 32,
+        queue_timeout: float = 300.0,
+        decrease_factor: float = 0.5,
+        decrease_interval: float = 1.0,
+        max_retry_after: float = 60.0,
+        enabled: bool = True,
+    ):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        if initial_limit is None:
+            initial_limit = self.max_limit
+        self.initial_limit = min(self.max_limit, max(self.min_limit, initial_limit))
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = max(0.0, queue_timeout)
+        self.decrease_factor = min(0.95, max(0.1, decrease_factor))
+        self.decrease_interval = max(0.0, decrease_interval)
+        self.max_retry_after = max(0.0, max_retry_after)
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._limiters: Dict[str, _ConfigLimiter] = {}
+
+    async def acquire(self, label: str) -> QueueTicket:
+        """
+        获取一个并发名额（超出上限时排队等待）
+
+        Raises:
+            ProviderBusyError: 队列已满或排队超时
+        """
+        if not self.enabled:
+            return QueueTicket()
+
+        started_at = time.monotonic()
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            limiter = self._limiter(label)
+            if not limiter.waiters and self._can_start_locked(limiter, started_at):
+                limiter.in_flight += 1
+                limiter.acquired += 1
+                return QueueTicket()
+            if len(limiter.waiters) >= self.max_queue:
+                limiter.rejected += 1
+                raise ProviderBusyError(
+                    f"Local rate limit: {len(limiter.waiters)} requests already queued for {label}"
+                )
+            waiter = _Waiter(loop, loop.create_future())
+            limiter.waiters.append(waiter)
+            limiter.queued_total += 1
+            queue_depth = len(limiter.waiters)
+
+        logger.info("[GOVERNOR] %s saturated, queued at position %s", label, queue_depth)
+        deadline = started_at + self.queue_timeout
+        try:
+            while True:
+                now = time.monotonic()
+                with self._lock:
+                    if not waiter.granted:
+                        self._dispatch_locked(limiter, now)
+                    if waiter.granted:
+                        break
+                    if now >= deadline:
+                        limiter.timed_out += 1
+                        raise ProviderBusyError(
+                            f"Local rate limit: waited {now - started_at:.1f}s for a provider slot ({label})"
+                        )
+                    # Retry-After 冷却结束时需要有人重新派发名额
+                    wake_in = deadline - now
+                    if limiter.cooldown_until > now:
+                        wake_in = min(wake_in, limiter.cooldown_until - now)
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter.future), timeout=wake_in)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            with self._lock:
+                if waiter.granted:
+                    # 已分到名额但调用方放弃（取消 / 超时竞争），归还名额
+                    limiter.in_flight -= 1
+                    self._dispatch_locked(limiter, time.monotonic())
+                else:
+                    try:
+                        limiter.waiters.remove(waiter)
+                    except ValueError:
+                        pass
+            raise
+
+        wait_seconds = time.monotonic() - started_at
+        with self._lock:
+            limiter.acquired += 1
+            limiter.wait_total += wait_seconds
+            limiter.wait_max = max(limiter.wait_max, wait_seconds)
+        return QueueTicket(wait_seconds=wait_seconds, queue_depth=queue_depth)
+
+    def release(self, label: str, success: bool = True, rate_limited: bool = False,
+                retry_after: Optional[float] = None):
+        """
+        归还名额并按结果调整并发上限（AIMD）
+
+        Args:
+            label: 配置标签
+            success: 调用是否成功（成功时加性增长）
+            rate_limited: 上游是否返回 429（乘性减小）
+            retry_after: 上游给出的 Retry-After 秒数
+        """
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        with self._lock:
+            limiter = self._limiter(label)
+            limiter.in_flight = max(0, limiter.in_flight - 1)
+            if rate_limited:
+                limiter.rate_limited += 1
+                if now - limiter.last_decrease_at >= self.decrease_interval:
+                    previous = limiter.limit
+                    limiter.limit = max(float(self.min_limit), limiter.limit * self.decrease_factor)
+                    limiter.last_decrease_at = now
+                    logger.warning(
+                        "[GOVERNOR] %s rate limited, concurrency limit %.1f -> %.1f",
+                        label,
+                        previous,
+                        limiter.limit,
+                    )
+                if retry_after:
+                    limiter.cooldown_until = max(
+                        limiter.cooldown_until, now + min(retry_after, self.max_retry_after)
+                    )
+            elif success:
+                limiter.limit = min(float(self.max_limit), limiter.limit + 1.0 / max(limiter.limit, 1.0))
+            self._dispatch_locked(limiter, now)
+
+    @asynccontextmanager
+    async def slot(self, label: str):
+        """
+        占用一个名额执行上游调用，退出时按异常类型归还
+
+        用法:
+            async with governor.slot(label) as ticket:
+                ...
+        """
+        ticket = await self.acquire(label)
+        previous = _active_ticket.get()
+        _active_ticket.set(ticket)
+        try:
+            yield ticket
+        except Exception as error:
+            rate_limited, retry_after = rate_limit_info(error)
+            self.release(label, success=False, rate_limited=rate_limited, retry_after=retry_after)
+            raise
+        except BaseException:
+            # 取消 / 消费方提前关闭流：只归还名额，不调整上限；线程中的调用仍在进行时等它返回再归还
+            running = [future for future in ticket.blocking_calls if not future.done()]
+            if running:
+                asyncio.gather(*running, return_exceptions=True).add_done_callback(
+                    lambda _: self.release(label, success=False)
+                )
+            else:
+                self.release(label, success=False)
+            raise
+        else:
+            self.release(label, success=True)
+        finally:
+            # 不用 reset(token)：流式生成器可能在其他上下文中关闭
+            _active_ticket.set(previous)
+
+    def snapshot(self, label: str) -> dict:
+        """单个配置的当前并发状态（用于 SSE [START] 事件）"""
+        with self._lock:
+            limiter = self._limiters.get(label)
+            if limiter is None:
+                return {"limit": self.initial_limit, "in_flight": 0, "queued": 0, "cooldown_seconds": 0.0}
+            return {
+                "limit": int(limiter.limit),
+                "in_flight": limiter.in_flight,
+                "queued": len(limiter.waiters),
+                "cooldown_seconds": round(max(0.0, limiter.cooldown_until - time.monotonic()), 2),
+            }
+
+    def get_stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            configs = {}
+            for label, limiter in self._limiters.items():
+                waited = limiter.queued_total - limiter.rejected - limiter.timed_out
+                configs[label] = {
+                    "limit": round(limiter.limit, 2),
+                    "in_flight": limiter.in_flight,
+                    "queued": len(limiter.waiters),
+                    "acquired": limiter.acquired,
+                    "queued_total": limiter.queued_total,
+                    "rejected": limiter.rejected,
+                    "timed_out": limiter.timed_out,
+                    "rate_limited": limiter.rate_limited,
+                    "avg_wait_ms": round(limiter.wait_total / waited * 1000, 1) if waited > 0 else 0.0,
+                    "max_wait_ms": round(limiter.wait_max * 1000, 1),
+                    "cooldown_seconds": round(max(0.0, limiter.cooldown_until - now), 2),
+                }
+        return {
+            "enabled": self.enabled,
+            "initial_limit": self.initial_limit,
+            "max_queue": self.max_queue,
+            "queue_timeout_seconds": self.queue_timeout,
+            "configs": configs,
+        }
+
+    # ==================== 私有方法 ====================
+
+    def _limiter(self, label: str) -> _ConfigLimiter:
+        limiter = self._limiters.get(label)
+        if limiter is None:
+            limiter = _ConfigLimiter(label, float(self.initial_limit))
+            self._limiters[label] = limiter
+        return limiter
+
+    @staticmethod
+    def _can_start_locked(limiter: _ConfigLimiter, now: float) -> bool:
+        return now >= limiter.cooldown_until and limiter.in_flight < int(limiter.limit)
+
+    def _dispatch_locked(self, limiter: _ConfigLimiter, now: float):
+        """按 FIFO 顺序把空出来的名额分给排队者"""
+        while limiter.waiters and self._can_start_locked(limiter, now):
+            waiter = limiter.waiters.popleft()
+            waiter.granted = True
+            limiter.in_flight += 1
+            try:
+                waiter.loop.call_soon_threadsafe(_resolve_waiter, waiter.future)
+            except RuntimeError:
+                # 事件循环已关闭：调用方不会再来取名额
+                waiter.granted = False
+                limiter.in_flight -= 1
+
+
+async def run_blocking(func: Callable[..., Any], *args, **kwargs) -> Any:
+    """
+    在线程池中执行阻塞的上游调用（替代 asyncio.to_thread）
+
+    线程无法中断：调用方被取消时立即向上传播取消，但线程调用登记在当前名额上，
+    slot 退出时等它返回后才归还名额，上游仍在处理的请求始终计入并发数。
+    """
+    future = asyncio.ensure_future(asyncio.to_thread(func, *args, **kwargs))
+    # 取消后没有人等待结果：取走异常，避免 "exception was never retrieved"
+    future.add_done_callback(lambda done: done.cancelled() or done.exception())
+    ticket = _active_ticket.get()
+    if ticket is not None:
+        ticket.blocking_calls.append(future)
+    return await asyncio.shield(future)
+
+
+def _resolve_waiter(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+def queue_status_text(vision_service: Any) -> str:
+    """
+    SSE [START] 事件中展示的排队状态
+
+    当前配置已饱和（有人排队、名额占满或处于 Retry-After 冷却）时返回
+    "queued queue_depth=N in_flight=a/b"，否则返回空串
+    """
+    label_fn = getattr(vision_service, "concurrency_label", None)
+    if not callable(label_fn):
+        return ""
+    governor = get_concurrency_governor()
+    if not governor.enabled:
+        return ""
+    state = governor.snapshot(label_fn())
+    if not state["queued"] and state["in_flight"] < state["limit"] and not state["cooldown_seconds"]:
+        return ""
+    text = f"queued queue_depth={state['queued'] + 1} in_flight={state['in_flight']}/{state['limit']}"
+    if state["cooldown_seconds"]:
+        text += f" cooldown={state['cooldown_seconds']:.1f}s"
+    return text
+
+
+# ==================== 全局实例 ====================
+
+_governor: Optional[ConcurrencyGovernor] = None
+_governor_lock = threading.Lock()
+
+
+def get_concurrency_governor() -> ConcurrencyGovernor:
+    """
+    获取全局并发治理器（单例模式）
+
+    Returns:
+        ConcurrencyGovernor 实例
+    """
+    global _governor
+
+    if _governor is None:
+        with _governor_lock:
+            if _governor is None:
+                _governor = ConcurrencyGovernor(
+                    initial_limit=settings.PROVIDER_CONCURRENCY_INITIAL,
+                    min_limit=settings.PROVIDER_CONCURRENCY_MIN,
+                    max_limit=settings.PROVIDER_CONCURRENCY_MAX,
+                    max_queue=settings.PROVIDER_QUEUE_MAX_SIZE,
+                    queue_timeout=settings.PROVIDER_QUEUE_TIMEOUT_SECONDS,
+                    decrease_factor=settings.PROVIDER_AIMD_DECREASE_FACTOR,
+                    max_retry_after=settings.PROVIDER_RETRY_AFTER_MAX_SECONDS,
+                    enabled=settings.PROVIDER_CONCURRENCY_ENABLED,
+                )
+
+    return _governor
+
+
+def reset_concurrency_governor():
+    """重置全局并发治理器（主要用于测试）"""
+    global _governor
+    _governor = None
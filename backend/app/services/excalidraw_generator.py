@@ -5,87 +5,12 @@ import time
 from typing import Optional
 
 from app.models.schemas import ExcalidrawScene
-from app.services.ai_vision import create_vision_service
+from app.services.ai_vision import create_vision_service, settle_response_cache
+from app.services.json_recovery import JSONRecoveryError, describe_repairs, recover_json
 
 logger = logging.getLogger(__name__)
 
 
-def repair_json(json_str: str) -> str:
-    """
-    Repair incomplete JSON by tracking bracket/brace stack and closing open structures.
-    Based on FlowPilot's json-repair.ts implementation.
-
-    Args:
-        json_str: Potentially incomplete JSON string
-
-    Returns:
-        Repaired JSON string with closed brackets/braces
-    """
-    if not json_str:
-        return "{}"
-
-    trimmed = json_str.strip()
-    if trimmed.endswith("}"):
-        return trimmed  # Assume complete
-
-    # Track bracket/brace stack
-    stack = []
-    is_string = False
-    is_escaped = False
-
-    for char in trimmed:
-        if is_string:
-            if char == '"' and not is_escaped:
-                is_string = False
-            elif char == '\\':
-                is_escaped = not is_escaped
-            else:
-                is_escaped = False
-        else:
-            if char == '"':
-                is_string = True
-            elif char == '{':
-                stack.append('}')
-            elif char == '[':
-                stack.append(']')
-            elif char == '}':
-                if stack and stack[-1] == '}':
-                    stack.pop()
-            elif char == ']':
-                if stack and stack[-1] == ']':
-                    stack.pop()
-
-    # Build completion string
-    completion = ""
-    if is_string:
-        completion += '"'  # Close open string
-    while stack:
-        completion += stack.pop()
-
-    return trimmed + completion
-
-
-def safe_parse_partial_json(json_str: str) -> Optional[dict]:
-    """
-    Safely parse potentially incomplete JSON with automatic repair.
-
-    Args:
-        json_str: JSON string (may be incomplete)
-
-    Returns:
-        Parsed dict or None if unrepairable
-    """
-    try:
-        return json.loads(json_str)
-    except json.JSONDecodeError:
-        try:
-            repaired = repair_json(json_str)
-            return json.loads(repaired)
-        except Exception as e:
-            logger.debug(f"JSON repair failed: {e}")
-            return None
-
-
 class ExcalidrawGeneratorService:
     """Excalidraw scene generation via LLM with validation and mock fallback."""
 
@@ -204,15 +129,11 @@ Return ONLY the JSON structure above. Generate the full set of elements; do not
 
     def _safe_json(self, payload):
         """
-        Sanitize AI response into valid JSON dict with FlowPilot-inspired simple strategy.
+        Sanitize AI response into valid JSON dict.
 
-        Strategy:
-        1. Extract JSON from markdown code blocks or find { } boundaries
-        2. Try direct parsing
-        3. If failed, use simple bracket tracking repair (FlowPilot method)
-        4. If still failed, return None to trigger mock scene fallback
-
-        This simplified approach is more reliable than aggressive multi-strategy repair.
+        Uses the single-pass tolerant parser (skips prose / code fences, fixes trailing or
+        missing commas, closes truncated structures). Returns None when nothing is
+        recoverable so the caller falls back to the mock scene.
         """
         if payload is None:
             return None
@@ -222,59 +143,16 @@ Return ONLY the JSON structure above. Generate the full set of elements; do not
             return payload.model_dump()
 
         if isinstance(payload, str):
-            text = payload.strip()
-            import re
-
-            # Step 1: Extract from markdown code block if present
-            code_block_match = re.search(r'```(?:json)?\s*\n?([^`]*?)(?:```|$)', text, re.IGNORECASE | re.DOTALL)
-            if code_block_match:
-                text = code_block_match.group(1).strip()
-
-            # Step 2: Find JSON object boundaries { ... }
-            if not text.startswith("{"):
-                start_idx = text.find("{")
-                if start_idx >= 0:
-                    text = text[start_idx:]
-                else:
-                    logger.warning("No JSON object found in payload")
-                    return None
-
-            # Find last closing brace (simple heuristic)
-            if not text.endswith("}"):
-                end_idx = text.rfind("}")
-                if end_idx > 0:
-                    text = text[:end_idx+1]
-
-            # Step 3: Try direct parsing (fast path)
             try:
-                result = json.loads(text)
-                logger.debug("JSON parsed successfully without repair")
-                return result
-            except json.JSONDecodeError as e:
-                logger.info(f"JSON parse failed: {e}. Attempting simple repair...")
-
-            # Step 4: Use FlowPilot's simple bracket tracking repair
-            repaired_result = safe_parse_partial_json(text)
-            if repaired_result is not None:
-                logger.info("JSON repaired successfully with FlowPilot bracket tracking")
-                return repaired_result
-
-            # Step 5: One additional strategy - fix missing commas between array elements
-            # This is a common AI mistake: } { without comma
-            if "Expecting ',' delimiter" in str(e):
-                text_with_commas = re.sub(r'}\s+{', '}, {', text)
-                text_with_commas = re.sub(r'}\n\s*{', '},\n{', text_with_commas)
-
-                repaired_result = safe_parse_partial_json(text_with_commas)
-                if repaired_result is not None:
-                    logger.info("JSON repaired by fixing missing commas")
-                    return repaired_result
-
-            # Final fallback: Log and return None to trigger mock scene
-            logger.warning(f"All JSON repair strategies failed. Payload length: {len(payload)}")
-            logger.debug(f"First 300 chars: {payload[:300]}")
-            logger.debug(f"Last 300 chars: {payload[-300:]}")
-            return None
+                recovered = recover_json(payload)
+            except JSONRecoveryError as e:
+                logger.warning(f"JSON recovery failed: {e}. Payload length: {len(payload)}")
+                logger.debug(f"First 300 chars: {payload[:300]}")
+                logger.debug(f"Last 300 chars: {payload[-300:]}")
+                return None
+            if recovered.repaired:
+                logger.info(f"JSON repaired: {describe_repairs(recovered.repairs)}")
+            return recovered.value
 
         # Last resort for non-string types
         try:
@@ -568,6 +446,7 @@ Return ONLY the JSON structure above. Generate the full set of elements; do not
         model_name: Optional[str] = None,
     ) -> ExcalidrawScene:
         """Generate scene via LLM with fallback to mock (no upstream stack for callers)."""
+        vision_service = None
         try:
             vision_service = create_vision_service(
                 provider=provider,
@@ -587,24 +466,18 @@ Return ONLY the JSON structure above. Generate the full set of elements; do not
 
             system_prompt = self._build_prompt(prompt, style, width, height)
 
-            if provider == "gemini":
-                ai_raw = await vision_service._analyze_with_gemini_text(system_prompt)
-            elif provider == "openai":
-                ai_raw = await vision_service._analyze_with_openai_text(system_prompt)
-            elif provider == "claude":
-                ai_raw = await vision_service._analyze_with_claude_text(system_prompt)
-            elif provider == "siliconflow":
+            if provider == "siliconflow":
                 # Streaming was slow/unreliable in testing; prefer single non-stream call
                 try:
-                    ai_raw = await vision_service._analyze_with_siliconflow_text(system_prompt)
+                    ai_raw = await vision_service.analyze_text(system_prompt, provider)
                 except Exception:
                     # Fallback to a smaller, more JSON-stable model if provided model struggles
                     backup = "Qwen/Qwen2.5-14B-Instruct"
                     logger.warning("Primary SiliconFlow model failed; retrying with %s", backup)
                     vision_service.model_name = backup
-                    ai_raw = await vision_service._analyze_with_siliconflow_text(system_prompt)
+                    ai_raw = await vision_service.analyze_text(system_prompt, provider)
             else:
-                ai_raw = await vision_service._analyze_with_custom_text(system_prompt)
+                ai_raw = await vision_service.analyze_text(system_prompt, provider)
 
             ai_data = self._safe_json(ai_raw)
             scene = self._validate_scene(ai_data, width, height)
@@ -613,11 +486,15 @@ Return ONLY the JSON structure above. Generate the full set of elements; do not
             current_message = scene.appState.get("message", "")
             if "fallback" not in current_message.lower() and "mock" not in current_message.lower():
                 scene.appState["message"] = f"Generated via {provider}"
+                settle_response_cache(vision_service, accepted=True)
+            else:
+                settle_response_cache(vision_service, accepted=False)
 
             # Scene is guaranteed to have elements now (either AI or mock)
             return scene
         except Exception as e:
             logger.error(f"Excalidraw generation failed: {e}", exc_info=True)
+            settle_response_cache(vision_service, accepted=False)
             # Return mock scene with error message instead of propagating stack
             mock_scene = self._mock_scene()
             mock_scene.appState["message"] = f"Fallback mock: {str(e)[:120]}"
@@ -0,0 +1,309 @@
+"""
+紧凑图编码 (Compact Graph Codec)
+
+增量生成时需要把现有画布嵌入 Prompt。旧实现直接嵌入 json.dumps(model_dump(), indent=2)：
+每个节点都带完整的 position / data / 样式字段和缩进，Prompt 随画布线性膨胀（150 节点约 2 万 token），
+增量调用比从零生成还慢。
+
+编码格式（逐行，| 分隔字段，头部声明列与类型字典）：
+    types: s=service d=database c=cache
+    nodes: id|type|label|pos|shape
+    n1|s|Order Service|960,200|task
+    n2|d|MySQL|1220,200
+    edges: source>target[:label],...
+    n1>n2:SQL,n3
+
+设计：
+- 短 id：按节点顺序分配 n1..nN，Prompt 中只出现短 id；GraphCodec 保存映射，
+  restore_ids() 把模型输出里引用的短 id 还原为原 id
+- 坐标按 position_grid 像素取整（None 时整列省略），增量布局只需要粗略位置
+- 节点类型字典编码：按出现频次分配助记短码（service → s），在头部声明一次
+- 边按源节点合并为邻接表，边 id 不进入 Prompt（合并时按 source/target 去重）
+- iconType / color 等样式字段不进入 Prompt，合并时以会话中的原节点为准
+- 含分隔符的 label 以 JSON 字符串形式加引号；decode() 是 encode() 的逆运算（坐标为量化值）
+- k_hop_subgraph() 取种子节点的 k 跳邻域（无向），大画布只编码与请求相关的局部
+"""
+
+import json
+from collections import deque
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from app.models.schemas import Edge, Node
+
+# 默认坐标量化粒度（像素）
+DEFAULT_POSITION_GRID = 20
+
+_SHORT_ID_PREFIX = "n"
+_FIELD_SEPARATOR = "|"
+_UNSAFE_LABEL_CHARS = set('|,:>"\n\r')
+
+
+class GraphCodec:
+    """一张画布的紧凑编码（保存短 id ↔ 原 id、类型短码 ↔ 类型名的映射）"""
+
+    def __init__(self, nodes: List[Node], edges: List[Edge], position_grid: Optional[int] = DEFAULT_POSITION_GRID):
+        """
+        Args:
+            nodes: 现有节点
+            edges: 现有边
+            position_grid: 坐标量化粒度（像素），None 表示不输出坐标
+        """
+        self.nodes = nodes
+        self.edges = edges
+        self.position_grid = position_grid
+        self.short_ids: Dict[str, str] = {}
+        for node in nodes:
+            self.short_ids.setdefault(node.id, f"{_SHORT_ID_PREFIX}{len(self.short_ids) + 1}")
+        self.original_ids: Dict[str, str] = {short: original for original, short in self.short_ids.items()}
+        self.type_codes = _assign_type_codes(node.type or "default" for node in nodes)
+
+    def encode(self) -> str:
+        """编码为紧凑文本"""
+        columns = ["id", "type", "label"]
+        if self.position_grid:
+            columns.append("pos")
+        columns.append("shape")
+
+        lines = [
+            "types: " + " ".join(f"{code}={node_type}" for node_type, code in self.type_codes.items()),
+            "nodes: " + _FIELD_SEPARATOR.join(columns),
+        ]
+        for node in self.nodes:
+            fields = [
+                self.short_ids[node.id],
+                self.type_codes[node.type or "default"],
+                _quote(node.data.label or ""),
+            ]
+            if self.position_grid:
+                fields.append(f"{self._quantize(node.position.x)},{self._quantize(node.position.y)}")
+            fields.append(node.data.shape or "")
+            lines.append(_FIELD_SEPARATOR.join(fields).rstrip(_FIELD_SEPARATOR))
+
+        lines.append("edges: source>target[:label],...")
+        adjacency: Dict[str, List[str]] = {}
+        for edge in self.edges:
+            source = self.short_ids.get(edge.source, edge.source)
+            target = self.short_ids.get(edge.target, edge.target)
+            entry = f"{target}:{_quote(edge.label)}" if edge.label else target
+            adjacency.setdefault(source, []).append(entry)
+        for source, targets in adjacency.items():
+            lines.append(f"{source}>{','.join(targets)}")
+
+        return "\n".join(lines)
+
+    def decode(self, text: str) -> Tuple[List[Node], List[Edge]]:
+        """
+        解码紧凑文本（encode 的逆运算）
+
+        节点 / 边引用的短 id 还原为原 id；未知的短 id 原样保留。
+        坐标为量化后的值；未输出坐标时为 (0, 0)。边 id 按出现顺序生成为 e0..eN。
+        """
+        type_names: Dict[str, str] = {}
+        columns: List[str] = []
+        nodes: List[Node] = []
+        edges: List[Edge] = []
+        section = None
+
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            if line.startswith("types:"):
+                for item in line[len("types:"):].split():
+                    code, _, node_type = item.partition("=")
+                    type_names[code] = node_type
+                continue
+            if line.startswith("nodes:"):
+                columns = line[len("nodes:"):].strip().split(_FIELD_SEPARATOR)
+                section = "nodes"
+                continue
+            if line.startswith("edges:"):
+                section = "edges"
+                continue
+
+            if section == "nodes":
+                values = dict(zip(columns, _split(line, _FIELD_SEPARATOR)))
+                x, _, y = (values.get("pos") or "0,0").partition(",")
+                nodes.append(Node(
+                    id=self.original_ids.get(values["id"], values["id"]),
+                    type=type_names.get(values.get("type", ""), values.get("type") or "default"),
+                    position={"x": float(x or 0), "y": float(y or 0)},
+                    data={"label": _unquote(values.get("label", "")), "shape": values.get("shape") or None},
+                ))
+            elif section == "edges":
+                source, _, targets = line.partition(">")
+                for entry in _split(targets, ","):
+                    target, label = _split_label(entry)
+                    edges.append(Edge(
+                        id=f"e{len(edges)}",
+                        source=self.original_ids.get(source, source),
+                        target=self.original_ids.get(target, target),
+                        label=label,
+                    ))
+
+        return nodes, edges
+
+    def restore_ids(self, ai_data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        把模型输出（JSON 图）中引用的短 id 还原为原 id
+
+        只改写 nodes[].id 与 edges[].source / target；新节点的 id 不在映射中，原样保留。
+
+        Returns:
+            改写后的新字典（不修改入参）
+        """
+        restored = dict(ai_data)
+        if isinstance(ai_data.get("nodes"), list):
+            restored["nodes"] = [
+                dict(node, id=self.original_ids.get(node.get("id"), node.get("id")))
+                if isinstance(node, dict) and "id" in node else node
+                for node in ai_data["nodes"]
+            ]
+        if isinstance(ai_data.get("edges"), list):
+            edges = []
+            for edge in ai_data["edges"]:
+                if isinstance(edge, dict):
+                    edge = dict(edge)
+                    for key in ("source", "target"):
+                        if isinstance(edge.get(key), str):
+                            edge[key] = self.original_ids.get(edge[key], edge[key])
+                edges.append(edge)
+            restored["edges"] = edges
+        return restored
+
+    # ==================== 私有方法 ====================
+
+    def _quantize(self, value: float) -> int:
+        return int(round(value / self.position_grid)) * self.position_grid
+
+
+def encode_graph(
+    nodes: List[Node],
+    edges: List[Edge],
+    position_grid: Optional[int] = DEFAULT_POSITION_GRID,
+) -> Tuple[str, GraphCodec]:
+    """
+    编码画布
+
+    Returns:
+        (紧凑文本, GraphCodec)，后者用于还原模型输出中的短 id
+    """
+    codec = GraphCodec(nodes, edges, position_grid=position_grid)
+    return codec.encode(), codec
+
+
+def k_hop_subgraph(
+    nodes: List[Node],
+    edges: List[Edge],
+    seed_ids: List[str],
+    hops: int = 1,
+    max_nodes: Optional[int] = None,
+) -> Tuple[List[Node], List[Edge]]:
+    """
+    种子节点的 k 跳邻域（按无向图计算距离）
+
+    Args:
+        nodes: 全部节点
+        edges: 全部边
+        seed_ids: 种子节点 id（按优先级排序，超出 max_nodes 时先保留靠前的种子）
+        hops: 跳数
+        max_nodes: 子图节点数上限，按 BFS 顺序截断（None 表示不限）
+
+    Returns:
+        (子图节点, 两端都在子图内的边)，节点保持原画布顺序
+    """
+    neighbors: Dict[str, List[str]] = {}
+    for edge in edges:
+        neighbors.setdefault(edge.source, []).append(edge.target)
+        neighbors.setdefault(edge.target, []).append(edge.source)
+
+    known_ids = {node.id for node in nodes}
+    selected: Dict[str, int] = {}
+    queue = deque()
+    for seed_id in seed_ids:
+        if seed_id in known_ids and seed_id not in selected:
+            selected[seed_id] = 0
+            queue.append(seed_id)
+    if max_nodes is not None and len(selected) > max_nodes:
+        selected = dict(list(selected.items())[:max_nodes])
+        queue = deque(selected)
+
+    while queue and (max_nodes is None or len(selected) < max_nodes):
+        current = queue.popleft()
+        if selected[current] >= hops:
+            continue
+        for neighbor in neighbors.get(current, []):
+            if neighbor in known_ids and neighbor not in selected:
+                selected[neighbor] = selected[current] + 1
+                queue.append(neighbor)
+                if max_nodes is not None and len(selected) >= max_nodes:
+                    break
+
+    sub_nodes = [node for node in nodes if node.id in selected]
+    sub_edges = [edge for edge in edges if edge.source in selected and edge.target in selected]
+    return sub_nodes, sub_edges
+
+
+# ==================== 私有方法 ====================
+
+def _assign_type_codes(node_types: Iterable[str]) -> Dict[str, str]:
+    """按频次为类型分配助记短码：首字母 → 前缀 → 首字母 + 序号"""
+    counts: Dict[str, int] = {}
+    for node_type in node_types:
+        counts[node_type] = counts.get(node_type, 0) + 1
+
+    codes: Dict[str, str] = {}
+    used = set()
+    for node_type in sorted(counts, key=lambda t: (-counts[t], t)):
+        stem = "".join(ch for ch in node_type.lower() if ch.isalnum()) or "t"
+        candidates = [stem[:length] for length in range(1, len(stem) + 1)]
+        candidates.extend(f"{stem[0]}{index}" for index in range(2, len(counts) + 2))
+        code = next(candidate for candidate in candidates if candidate not in used)
+        used.add(code)
+        codes[node_type] = code
+    return codes
+
+
+def _quote(text: str) -> str:
+    if text and not _UNSAFE_LABEL_CHARS.intersection(text) and text == text.strip():
+        return text
+    return json.dumps(text, ensure_ascii=False)
+
+
+def _unquote(text: str) -> str:
+    if text.startswith('"'):
+        return json.loads(text)
+    return text
+
+
+def _split(text: str, separator: str) -> List[str]:
+    """按分隔符切分，跳过 JSON 引号字符串内部的分隔符"""
+    parts: List[str] = []
+    current: List[str] = []
+    in_string = False
+    escaped = False
+    for ch in text:
+        if in_string:
+            current.append(ch)
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+            current.append(ch)
+        elif ch == separator:
+            parts.append("".join(current))
+            current = []
+        else:
+            current.append(ch)
+    parts.append("".join(current))
+    return parts
+
+
+def _split_label(entry: str) -> Tuple[str, Optional[str]]:
+    target, separator, label = entry.partition(":")
+    if not separator:
+        return target, None
+    return target, _unquote(label)
@@ -0,0 +1,269 @@
+"""
+增量生成的图操作 (Graph Operations)
+
+增量模式下模型原本要重新输出完整的 nodes / edges 数组，输出 token（调用中最贵、最慢的部分）
+随画布线性增长。操作模式下模型只输出变化：
+    {"ops": [
+      {"op": "add_node", "id": "cache-1700000000-1", "type": "cache", "label": "Redis", "x": 1240, "y": 200},
+      {"op": "add_edge", "source": "n3", "target": "cache-1700000000-1", "label": "read"},
+      {"op": "update_label", "id": "n2", "label": "Order Service v2"},
+      {"op": "remove_edge", "source": "n1", "target": "n2"}
+    ]}
+
+设计：
+- GraphOpApplier 持有会话画布的工作副本，逐条校验并应用；Prompt 中的短 id 经 GraphCodec 还原
+  * 副本只复制列表：会话中的模型是共享只读对象，修改时替换为 model_copy（写时复制），
+    未修改的节点 / 边保持原对象，保存时会话管理器据此复用其序列化结果
+- 校验失败的操作抛出 GraphOpError 并记入 rejected，不影响其余操作
+  （流式接口据此逐条推送 [OP] / [OP_REJECTED]）
+- 只允许新增节点 / 边、修改 label、删除边：不删除节点，现有节点的位置与样式保持不变
+- add_node 缺少坐标时依次排在现有画布右侧；节点字段归一化由调用方传入的 node_normalizer 完成
+- rebase() 在最新画布上按原顺序重放已应用的操作：生成期间会话被其他写入更新时，
+  保存前据此合并而不是覆盖对方的修改
+- diff_graph() 计算两版画布之间的差异（按 id 对比，同一对象视为未修改），用于增量响应只返回变化部分
+"""
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.models.schemas import Edge, GraphDelta, Node
+from app.services.graph_codec import GraphCodec
+
+SUPPORTED_OPS = ("add_node", "add_edge", "update_label", "remove_edge")
+
+# 自动摆放新节点：现有画布右侧留出的间距与纵向步长
+_AUTO_PLACE_GAP_X = 280
+_AUTO_PLACE_STEP_Y = 140
+
+
+class GraphOpError(ValueError):
+    """图操作无法应用（格式错误或与当前画布冲突）"""
+
+
+class GraphOpApplier:
+    """在会话画布的工作副本上逐条应用图操作"""
+
+    def __init__(
+        self,
+        nodes: List[Node],
+        edges: List[Edge],
+        codec: Optional[GraphCodec] = None,
+        node_normalizer: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+    ):
+        """
+        Args:
+            nodes: 会话中的现有节点
+            edges: 会话中的现有边
+            codec: Prompt 使用的编码（用于还原短 id），为 None 时按原 id 解析
+            node_normalizer: 新节点字典的归一化函数（类型 / shape 白名单等）
+        """
+        self._nodes: Dict[str, Node] = {node.id: node for node in nodes}
+        self._edges: List[Edge] = list(edges)
+        self._codec = codec
+        self._node_normalizer = node_normalizer
+        self._next_x = max((node.position.x for node in nodes), default=0) + _AUTO_PLACE_GAP_X
+        self._next_y = min((node.position.y for node in nodes), default=0)
+        self.applied: List[Dict[str, Any]] = []
+        self.rejected: List[Dict[str, Any]] = []
+        self._applied_raw: List[Dict[str, Any]] = []
+
+    @property
+    def nodes(self) -> List[Node]:
+        return list(self._nodes.values())
+
+    @property
+    def edges(self) -> List[Edge]:
+        return list(self._edges)
+
+    def apply(self, raw_op: Any) -> Dict[str, Any]:
+        """
+        校验并应用一条操作
+
+        Returns:
+            已应用操作的规范形式（含新增节点 / 边的完整内容，id 为原 id）
+
+        Raises:
+            GraphOpError: 操作格式错误或与当前画布冲突（此时画布不变，操作记入 rejected）
+        """
+        try:
+            if not isinstance(raw_op, dict):
+                raise GraphOpError("operation must be an object")
+            op_name = raw_op.get("op")
+            handler = {
+                "add_node": self._add_node,
+                "add_edge": self._add_edge,
+                "update_label": self._update_label,
+                "remove_edge": self._remove_edge,
+            }.get(op_name)
+            if handler is None:
+                raise GraphOpError(f"unsupported op {op_name!r} (expected one of {', '.join(SUPPORTED_OPS)})")
+            applied = handler(raw_op)
+        except GraphOpError as e:
+            self.rejected.append({"op": raw_op, "reason": str(e)})
+            raise
+        self.applied.append(applied)
+        self._applied_raw.append(raw_op)
+        return applied
+
+    def apply_all(self, raw_ops: Any) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """
+        按顺序应用操作列表，跳过被拒绝的操作
+
+        Returns:
+            (本次已应用的操作, 本次被拒绝的操作及原因)
+        """
+        if not isinstance(raw_ops, list):
+            raise GraphOpError("ops must be an array")
+        applied_before, rejected_before = len(self.applied), len(self.rejected)
+        for raw_op in raw_ops:
+            try:
+                self.apply(raw_op)
+            except GraphOpError:
+                continue
+        return self.applied[applied_before:], self.rejected[rejected_before:]
+
+    def rebase(self, nodes: List[Node], edges: List[Edge]) -> "GraphOpApplier":
+        """
+        在新的画布上按原顺序重放已应用的操作
+
+        Args:
+            nodes: 会话中的最新节点
+            edges: 会话中的最新边
+
+        Returns:
+            新的 GraphOpApplier（与新画布冲突的操作记入其 rejected）
+        """
+        applier = GraphOpApplier(nodes, edges, codec=self._codec, node_normalizer=self._node_normalizer)
+        applier.apply_all(self._applied_raw)
+        return applier
+
+    # ==================== 私有方法 ====================
+
+    def _resolve_id(self, raw_id: Any) -> str:
+        if not isinstance(raw_id, str) or not raw_id.strip():
+            raise GraphOpError("missing node id")
+        node_id = raw_id.strip()
+        if self._codec is not None:
+            node_id = self._codec.original_ids.get(node_id, node_id)
+        return node_id
+
+    def _existing_node_id(self, raw_id: Any) -> str:
+        node_id = self._resolve_id(raw_id)
+        if node_id not in self._nodes:
+            raise GraphOpError(f"unknown node {raw_id!r}")
+        return node_id
+
+    def _add_node(self, raw_op: Dict[str, Any]) -> Dict[str, Any]:
+        node_id = self._resolve_id(raw_op.get("id"))
+        if node_id in self._nodes:
+            raise GraphOpError(f"node {node_id!r} already exists")
+
+        data = dict(raw_op["data"]) if isinstance(raw_op.get("data"), dict) else {}
+        label = raw_op.get("label") or data.get("label")
+        if not isinstance(label, str) or not label.strip():
+            raise GraphOpError(f"node {node_id!r} has no label")
+        data["label"] = label.strip()
+        if raw_op.get("shape") and "shape" not in data:
+            data["shape"] = raw_op["shape"]
+
+        position = raw_op.get("position") if isinstance(raw_op.get("position"), dict) else raw_op
+        x, y = position.get("x"), position.get("y")
+        if not isinstance(x, (int, float)) or not isinstance(y, (int, float)):
+            x, y = self._next_x, self._next_y
+            self._next_y += _AUTO_PLACE_STEP_Y
+
+        payload = {
+            "id": node_id,
+            "type": raw_op.get("node_type") or raw_op.get("type") or "default",
+            "position": {"x": float(x), "y": float(y)},
+            "data": data,
+        }
+        if self._node_normalizer is not None:
+            payload = self._node_normalizer(payload)
+        try:
+            node = Node(**payload)
+        except ValueError as e:
+            raise GraphOpError(f"invalid node {node_id!r}: {e}")
+
+        self._nodes[node_id] = node
+        return {"op": "add_node", "node": node.model_dump()}
+
+    def _add_edge(self, raw_op: Dict[str, Any]) -> Dict[str, Any]:
+        source = self._existing_node_id(raw_op.get("source"))
+        target = self._existing_node_id(raw_op.get("target"))
+        if source == target:
+            raise GraphOpError(f"self-loop on {source!r}")
+        if any(edge.source == source and edge.target == target for edge in self._edges):
+            raise GraphOpError(f"edge {source!r} -> {target!r} already exists")
+
+        existing_ids = {edge.id for edge in self._edges}
+        edge_id = raw_op.get("id") if isinstance(raw_op.get("id"), str) else ""
+        if not edge_id or edge_id in existing_ids:
+            index = len(self._edges)
+            while f"e{index}" in existing_ids:
+                index += 1
+            edge_id = f"e{index}"
+        label = raw_op.get("label")
+        edge = Edge(id=edge_id, source=source, target=target, label=label if isinstance(label, str) and label else None)
+
+        self._edges.append(edge)
+        return {"op": "add_edge", "edge": edge.model_dump()}
+
+    def _update_label(self, raw_op: Dict[str, Any]) -> Dict[str, Any]:
+        node_id = self._existing_node_id(raw_op.get("id"))
+        label = raw_op.get("label")
+        if not isinstance(label, str) or not label.strip():
+            raise GraphOpError(f"update_label on {node_id!r} has no label")
+
+        node = self._nodes[node_id]
+        self._nodes[node_id] = node.model_copy(update={"data": node.data.model_copy(update={"label": label.strip()})})
+        return {"op": "update_label", "id": node_id, "label": label.strip()}
+
+    def _remove_edge(self, raw_op: Dict[str, Any]) -> Dict[str, Any]:
+        if isinstance(raw_op.get("id"), str) and not raw_op.get("source"):
+            matches = [edge for edge in self._edges if edge.id == raw_op["id"]]
+        else:
+            source = self._existing_node_id(raw_op.get("source"))
+            target = self._existing_node_id(raw_op.get("target"))
+            matches = [edge for edge in self._edges if edge.source == source and edge.target == target]
+        if not matches:
+            raise GraphOpError("edge to remove does not exist")
+
+        removed = matches[0]
+        self._edges.remove(removed)
+        return {"op": "remove_edge", "id": removed.id, "source": removed.source, "target": removed.target}
+
+
+def diff_graph(
+    base_nodes: List[Node],
+    base_edges: List[Edge],
+    nodes: List[Node],
+    edges: List[Edge],
+) -> GraphDelta:
+    """
+    以 base 为快照计算画布差异（节点 / 边按 id 对应，同一对象视为未修改，否则按 model_dump 比较）
+
+    Returns:
+        GraphDelta，新增 / 修改项保持新画布中的顺序
+    """
+    base_node_map = {node.id: node for node in base_nodes}
+    base_edge_map = {edge.id: edge for edge in base_edges}
+    node_ids = {node.id for node in nodes}
+    edge_ids = {edge.id for edge in edges}
+
+    delta = GraphDelta(
+        removed_node_ids=[node_id for node_id in base_node_map if node_id not in node_ids],
+        removed_edge_ids=[edge_id for edge_id in base_edge_map if edge_id not in edge_ids],
+    )
+    for node in nodes:
+        base = base_node_map.get(node.id)
+        if base is None:
+            delta.added_nodes.append(node)
+        elif base is not node and base.model_dump() != node.model_dump():
+            delta.modified_nodes.append(node)
+    for edge in edges:
+        base = base_edge_map.get(edge.id)
+        if base is None:
+            delta.added_edges.append(edge)
+        elif base is not edge and base.model_dump() != edge.model_dump():
+            delta.modified_edges.append(edge)
+    return delta
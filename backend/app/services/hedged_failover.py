@@ -0,0 +1,256 @@
+"""
+对冲式 Failover (Hedged Failover)
+
+get_failover_configs 返回的候选配置原本严格串行尝试：主配置卡住时，
+要等满首 token 超时（18s）或客户端超时（60-240s）才会轮到备用配置。
+
+对冲模式：
+- 主配置在 hedge_delay 内没有结果（流式为首 token，非流式为完整响应），
+  并行启动下一个候选，谁先给出有效结果用谁，其余的取消
+- 候选报错时立即切换下一个（与原串行 failover 一致）
+- 全局限制同时在途的对冲请求数，避免故障时把请求量翻倍；名额不足时每个请求只计一次 hedges_capped
+- 落败的尝试被取消；线程中的阻塞调用无法中断，其上游并发名额由 run_blocking 保留到线程返回
+- 按 provider/model 统计胜负次数，供 /api/health/metrics 查看
+"""
+
+import asyncio
+import logging
+import threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple, TypeVar
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class HedgeExhaustedError(Exception):
+    """所有候选配置都失败"""
+
+    def __init__(self, errors: List[Tuple[int, Exception]]):
+        self.errors = errors
+        last = errors[-1][1] if errors else None
+        super().__init__(f"All {len(errors)} candidates failed. Last error: {last}")
+
+
+class HedgeStats:
+    """对冲统计：全局在途对冲数上限 + 按 provider/model 的胜负计数"""
+
+    def __init__(self, max_inflight_hedges: int = 4):
+        self._max_inflight = max(0, max_inflight_hedges)
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self._hedges_started = 0
+        self._hedges_capped = 0
+        self._hedge_wins = 0
+        # {label: {"attempts", "wins", "losses", "failures"}}
+        self._providers: Dict[str, Dict[str, int]] = {}
+
+    def try_acquire_hedge(self) -> bool:
+        """占用一个对冲名额，已达上限时返回 False"""
+        with self._lock:
+            if self._inflight >= self._max_inflight:
+                return False
+            self._inflight += 1
+            self._hedges_started += 1
+            return True
+
+    def record_hedge_capped(self):
+        """记录一个因名额不足而没能对冲的请求"""
+        with self._lock:
+            self._hedges_capped += 1
+
+    def release_hedge(self):
+        with self._lock:
+            self._inflight = max(0, self._inflight - 1)
+
+    def record(self, label: str, outcome: str):
+        """记录一次尝试结果：attempts / wins / losses（被取消）/ failures"""
+        with self._lock:
+            counters = self._providers.setdefault(
+                label, {"attempts": 0, "wins": 0, "losses": 0, "failures": 0}
+            )
+            counters[outcome] += 1
+
+    def record_hedge_win(self):
+        with self._lock:
+            self._hedge_wins += 1
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_inflight_hedges": self._max_inflight,
+                "inflight_hedges": self._inflight,
+                "hedges_started": self._hedges_started,
+                "hedges_capped": self._hedges_capped,
+                "hedge_wins": self._hedge_wins,
+                "providers": {label: dict(counters) for label, counters in self._providers.items()},
+            }
+
+
+def config_label(config: Dict[str, Any]) -> str:
+    """候选配置的统计标签（provider/model）"""
+    return f"{config.get('provider') or '-'}/{config.get('model_name') or '-'}"
+
+
+async def run_hedged(
+    candidates: Sequence[T],
+    attempt: Callable[[int, T], Awaitable[R]],
+    hedge_delay: Optional[float],
+    label: Callable[[T], str] = str,
+    max_parallel: int = 2,
+    on_error: Optional[Callable[[int, T, Exception], None]] = None,
+    on_hedge: Optional[Callable[[int, T], None]] = None,
+    discard: Optional[Callable[[R], Awaitable[None]]] = None,
+    stats: Optional["HedgeStats"] = None,
+) -> Tuple[int, R]:
+    """
+    按顺序尝试候选配置，超过 hedge_delay 仍无结果时并行启动下一个
+
+    Args:
+        candidates: 候选配置（按优先级排序）
+        attempt: 执行一次尝试的协程工厂，返回值即有效结果；结果无效时应抛异常
+        hedge_delay: 启动对冲前的等待秒数；None 或 <=0 表示纯串行 failover
+        label: 统计标签
+        max_parallel: 单个请求同时在途的尝试数上限
+        on_error: 某个候选失败时的回调（用于记录错误明细）
+        on_hedge: 启动对冲候选时的回调
+        discard: 同时完成但未被采用的结果的清理回调（如关闭流）
+        stats: 统计对象，默认使用全局实例
+
+    Returns:
+        (胜出候选的下标, 结果)
+
+    Raises:
+        HedgeExhaustedError: 所有候选都失败
+    """
+    stats = stats or get_hedge_stats()
+    hedging = bool(hedge_delay and hedge_delay > 0 and max_parallel > 1)
+    pending: Dict[asyncio.Task, Tuple[int, bool]] = {}
+    errors: List[Tuple[int, Exception]] = []
+    next_index = 0
+    capped = False
+
+    def launch(index: int, hedged: bool):
+        stats.record(label(candidates[index]), "attempts")
+        task = asyncio.ensure_future(attempt(index, candidates[index]))
+        pending[task] = (index, hedged)
+
+    async def cancel_pending():
+        for task in pending:
+            task.cancel()
+        for task, (index, hedged) in list(pending.items()):
+            try:
+                result = await task
+            except BaseException:
+                result = None
+            else:
+                if discard is not None:
+                    await discard(result)
+            if hedged:
+                stats.release_hedge()
+            stats.record(label(candidates[index]), "losses")
+        pending.clear()
+
+    try:
+        while pending or next_index < len(candidates):
+            if not pending:
+                # 串行 failover：上一个候选失败后立即尝试下一个
+                launch(next_index, hedged=False)
+                next_index += 1
+                continue
+
+            can_hedge = hedging and next_index < len(candidates) and len(pending) < max_parallel
+            done, _ = await asyncio.wait(
+                pending.keys(),
+                timeout=hedge_delay if can_hedge else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+
+            if not done:
+                if stats.try_acquire_hedge():
+                    logger.info(
+                        "[HEDGE] No result after %.1fs, hedging with candidate %s (%s)",
+                        hedge_delay,
+                        next_index + 1,
+                        label(candidates[next_index]),
+                    )
+                    if on_hedge is not None:
+                        on_hedge(next_index, candidates[next_index])
+                    launch(next_index, hedged=True)
+                    next_index += 1
+                elif not capped:
+                    # 名额不足时每轮等待都会重试，同一个请求只计一次
+                    capped = True
+                    stats.record_hedge_capped()
+                continue
+
+            winner: Optional[Tuple[int, bool, Any]] = None
+            for task in sorted(done, key=lambda item: pending[item][0]):
+                index, hedged = pending.pop(task)
+                if hedged:
+                    stats.release_hedge()
+                error = task.exception()
+                if error is not None:
+                    stats.record(label(candidates[index]), "failures")
+                    errors.append((index, error))
+                    if on_error is not None:
+                        on_error(index, candidates[index], error)
+                    continue
+                if winner is None:
+                    winner = (index, hedged, task.result())
+                else:
+                    stats.record(label(candidates[index]), "losses")
+                    if discard is not None:
+                        await discard(task.result())
+
+            if winner is not None:
+                index, hedged, result = winner
+                await cancel_pending()
+                stats.record(label(candidates[index]), "wins")
+                if hedged:
+                    stats.record_hedge_win()
+                return index, result
+    finally:
+        if pending:
+            await cancel_pending()
+
+    raise HedgeExhaustedError(errors)
+
+
+# ==================== 全局实例 ====================
+
+_stats: Optional[HedgeStats] = None
+_stats_lock = threading.Lock()
+
+
+def get_hedge_stats() -> HedgeStats:
+    """
+    获取全局对冲统计（单例模式）
+
+    Returns:
+        HedgeStats 实例
+    """
+    global _stats
+
+    if _stats is None:
+        with _stats_lock:
+            if _stats is None:
+                _stats = HedgeStats(max_inflight_hedges=settings.HEDGE_MAX_INFLIGHT)
+
+    return _stats
+
+
+def reset_hedge_stats():
+    """重置全局对冲统计（主要用于测试）"""
+    global _stats
+    _stats = None
+
+
+def hedge_delay_for(streaming: bool) -> Optional[float]:
+    """读取对冲延迟配置；关闭对冲时返回 None"""
+    if not settings.HEDGE_ENABLED:
+        return None
+    return settings.HEDGE_FIRST_TOKEN_DELAY_SECONDS if streaming else settings.HEDGE_RESPONSE_DELAY_SECONDS
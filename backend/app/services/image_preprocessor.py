@@ -0,0 +1,272 @@
+"""
+视觉请求图片预处理 (Image Preprocessor)
+
+上传的截图可能高达 10MB，原样 base64 后发给模型既拖慢上传，也浪费 provider 侧的图片 token。
+预处理流程：
+1. 识别真实格式（不再硬编码 image/jpeg）
+2. 按 provider 限制最长边（超过模型内部分辨率的像素只会被服务端再次缩小）
+3. 应用 EXIF 方向后重新编码（图表类截图用调色板 PNG，照片类用 JPEG，取较小者），同时去除元数据
+4. base64 只计算一次，并按内容哈希缓存，failover 的多次尝试复用同一份载荷
+"""
+
+import base64
+import hashlib
+import io
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+
+from app.core.config import settings
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+    ImageOps = None
+
+logger = logging.getLogger(__name__)
+
+# 颜色数不超过该值的图片按"图表类"处理（截图通常只有几千种颜色，照片则远多于此）
+_FLAT_GRAPHIC_MAX_COLORS = 8192
+
+_EXIF_ORIENTATION_TAG = 0x0112
+
+
+def detect_image_media_type(image_data: bytes) -> str:
+    """根据文件头识别图片 MIME 类型（无法识别时按 JPEG 处理）"""
+    if image_data.startswith(b'\x89PNG'):
+        return "image/png"
+    if image_data.startswith(b'GIF'):
+        return "image/gif"
+    if image_data.startswith(b'RIFF') and b'WEBP' in image_data[:20]:
+        return "image/webp"
+    return "image/jpeg"
+
+
+@dataclass
+class PreparedImage:
+    """预处理后的图片载荷"""
+    data: bytes
+    media_type: str
+    width: int = 0
+    height: int = 0
+    original_size: int = 0
+    original_media_type: str = ""
+    resized: bool = False
+    _b64: Optional[str] = field(default=None, repr=False)
+
+    @property
+    def b64(self) -> str:
+        """base64 编码（首次访问时计算，之后复用）"""
+        if self._b64 is None:
+            self._b64 = base64.b64encode(self.data).decode("utf-8")
+        return self._b64
+
+    @property
+    def data_url(self) -> str:
+        return f"data:{self.media_type};base64,{self.b64}"
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.original_size - len(self.data)
+
+
+class ImagePreprocessor:
+    """按 provider 档位缩放/重编码图片，并缓存最近的处理结果"""
+
+    def __init__(
+        self,
+        max_edges: Optional[Dict[str, int]] = None,
+        jpeg_quality: int = 85,
+        cache_size: int = 16,
+        enabled: bool = True,
+    ):
+        """
+        初始化预处理器
+
+        Args:
+            max_edges: 各档位（claude/openai/gemini/siliconflow）的最长边上限，<=0 表示不限制
+            jpeg_quality: JPEG 重编码质量
+            cache_size: 最近处理结果的缓存条数（同一请求 failover 时复用）
+            enabled: 关闭时只识别格式，原样透传
+        """
+        self._max_edges = dict(max_edges or {})
+        self._jpeg_quality = jpeg_quality
+        self._cache_size = max(1, cache_size)
+        self._enabled = enabled and Image is not None
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[Tuple[str, int, int], PreparedImage]" = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._bytes_saved = 0
+
+    def max_edge_for(self, profile: str) -> int:
+        return int(self._max_edges.get(profile, 0) or 0)
+
+    def prepare(self, image_data: bytes, profile: str = "openai") -> PreparedImage:
+        """
+        预处理图片（CPU 密集，异步代码中应通过 asyncio.to_thread 调用）
+
+        Args:
+            image_data: 原始图片字节
+            profile: provider 档位，决定最长边上限
+
+        Returns:
+            PreparedImage；无法解码时原样透传
+        """
+        max_edge = self.max_edge_for(profile)
+        key = (hashlib.sha256(image_data).hexdigest(), max_edge, self._jpeg_quality)
+
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self._hits += 1
+                return cached
+
+        prepared = self._process(image_data, max_edge)
+
+        with self._lock:
+            self._misses += 1
+            self._bytes_saved += max(0, prepared.bytes_saved)
+            self._cache[key] = prepared
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+        if prepared.bytes_saved > 0:
+            logger.info(
+                f"[IMAGE] {profile}: {prepared.original_media_type} {prepared.original_size} bytes -> "
+                f"{prepared.media_type} {len(prepared.data)} bytes ({prepared.width}x{prepared.height})"
+            )
+        return prepared
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self._enabled,
+                "cached": len(self._cache),
+                "hits": self._hits,
+                "misses": self._misses,
+                "bytes_saved": self._bytes_saved,
+            }
+
+    # ==================== 私有方法 ====================
+
+    def _passthrough(self, image_data: bytes, width: int = 0, height: int = 0) -> PreparedImage:
+        media_type = detect_image_media_type(image_data)
+        return PreparedImage(
+            data=image_data,
+            media_type=media_type,
+            width=width,
+            height=height,
+            original_size=len(image_data),
+            original_media_type=media_type,
+        )
+
+    def _process(self, image_data: bytes, max_edge: int) -> PreparedImage:
+        if not self._enabled:
+            return self._passthrough(image_data)
+
+        try:
+            image = Image.open(io.BytesIO(image_data))
+            image.load()
+        except Exception as e:
+            logger.warning(f"[IMAGE] Cannot decode image ({len(image_data)} bytes), sending as-is: {e}")
+            return self._passthrough(image_data)
+
+        original_media_type = Image.MIME.get(image.format or "", detect_image_media_type(image_data))
+        has_metadata = "exif" in image.info
+        if has_metadata and image.getexif().get(_EXIF_ORIENTATION_TAG, 1) != 1:
+            # 拍照上传的截图可能带 EXIF 方向，去除元数据前先应用
+            image = ImageOps.exif_transpose(image)
+
+        # 在缩放前判断：缩放插值会引入大量抗锯齿中间色
+        is_flat_graphic = image.getcolors(_FLAT_GRAPHIC_MAX_COLORS) is not None
+
+        resized = False
+        if max_edge > 0 and max(image.size) > max_edge:
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+            resized = True
+
+        candidates = self._encode_candidates(image, is_flat_graphic)
+        media_type, data = min(candidates, key=lambda item: len(item[1]))
+
+        # 未缩放、无元数据且重编码没有变小时保留原文件（仅限模型普遍支持的格式）
+        if (
+            not resized
+            and not has_metadata
+            and len(data) >= len(image_data)
+            and original_media_type in ("image/png", "image/jpeg")
+        ):
+            return self._passthrough(image_data, *image.size)
+
+        return PreparedImage(
+            data=data,
+            media_type=media_type,
+            width=image.size[0],
+            height=image.size[1],
+            original_size=len(image_data),
+            original_media_type=original_media_type,
+            resized=resized,
+        )
+
+    def _encode_candidates(self, image, is_flat_graphic: bool) -> list:
+        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+            # 透明背景铺白底，避免 JPEG 把透明区域变成黑色
+            rgba = image.convert("RGBA")
+            rgb = Image.new("RGB", rgba.size, (255, 255, 255))
+            rgb.paste(rgba, mask=rgba.split()[-1])
+        else:
+            rgb = image.convert("RGB")
+
+        candidates = []
+        jpeg_buffer = io.BytesIO()
+        rgb.save(jpeg_buffer, format="JPEG", quality=self._jpeg_quality, optimize=True)
+        candidates.append(("image/jpeg", jpeg_buffer.getvalue()))
+
+        if is_flat_graphic:
+            # 流程图/架构图多为纯色块 + 文字：256 色调色板 PNG 远小于 JPEG，且文字边缘不糊
+            png_buffer = io.BytesIO()
+            rgb.quantize(256, method=Image.Quantize.FASTOCTREE).save(png_buffer, format="PNG", compress_level=6)
+            candidates.append(("image/png", png_buffer.getvalue()))
+        return candidates
+
+
+# ==================== 全局实例 ====================
+
+_preprocessor: Optional[ImagePreprocessor] = None
+_preprocessor_lock = threading.Lock()
+
+
+def get_image_preprocessor() -> ImagePreprocessor:
+    """
+    获取全局图片预处理器（单例模式）
+
+    Returns:
+        ImagePreprocessor 实例
+    """
+    global _preprocessor
+
+    if _preprocessor is None:
+        with _preprocessor_lock:
+            if _preprocessor is None:
+                _preprocessor = ImagePreprocessor(
+                    max_edges={
+                        "claude": settings.IMAGE_MAX_EDGE_CLAUDE,
+                        "openai": settings.IMAGE_MAX_EDGE_OPENAI,
+                        "gemini": settings.IMAGE_MAX_EDGE_GEMINI,
+                        "siliconflow": settings.IMAGE_MAX_EDGE_SILICONFLOW,
+                    },
+                    jpeg_quality=settings.IMAGE_JPEG_QUALITY,
+                    enabled=settings.IMAGE_PREPROCESS_ENABLED,
+                )
+
+    return _preprocessor
+
+
+def reset_image_preprocessor():
+    """重置全局图片预处理器（主要用于测试）"""
+    global _preprocessor
+    _preprocessor = None
@@ -0,0 +1,565 @@
+"""
+容错 JSON 恢复解析器 (Tolerant JSON Recovery Parser)
+
+LLM 返回的 JSON 常见问题：前后夹带说明文字、包在 ```json 代码块里、尾随逗号、
+对象之间漏逗号、max_tokens 截断导致字符串/容器未闭合。旧实现按“多策略级联”处理：
+整段 json.loads → 代码块正则 → 贪婪 \\{.*\\} 正则 → 全局替换单引号 / `word:` 后再 loads，
+长输出下要做多次全量解析，且全局替换会破坏合法内容（如 label 中的 "It's" 或 "http:"）。
+
+设计：
+- 快速路径：定位首个 "{" 后用 json.JSONDecoder.raw_decode 解析（C 实现，合法输出只扫描一次）
+- 慢速路径：单遍扫描的容错解析器，按结构位置修复，不改写字符串内容；
+  遇到对象 / 数组 / 字符串值时先尝试 raw_decode 整块解析，只有出错的容器才逐字符处理
+  （整块解析连续失败时自动停用，避免每层容器都重复扫描；双引号字符串用 C 实现的 scanstring）：
+  * 尾随逗号、重复逗号、缺失逗号 / 冒号
+  * 单引号字符串、未加引号的键、Python 字面量（True / False / None）、// 与 /* */ 注释
+  * 截断：闭合未结束的字符串与容器，丢弃不完整的键值对 / 字面量
+  * 顶层对象结束后的说明文字、代码块结束标记直接忽略
+- 首个 "{" 可能只是说明文字里的花括号（如 "Format {nodes, edges}:"）或示例对象：首个候选需要结构修复、
+  结果为空、出现缺失冒号（散文特征）或不含图结构键（nodes / edges / ops / elements）时，
+  对其后每个顶层 "{" 依次解析（raw_decode 失败时同样走容错解析，截断的真实输出也能恢复）；
+  优先含图结构键的候选，其次跨度最大的；已接受候选内部的 "{" 直接跳过，嵌套对象不会被提升为根；
+  都不可用时抛出 JSONRecoveryError，不把说明文字“恢复”成空对象或垃圾键值
+- 返回值附带 repairs（修复类型 → 次数），调用方可记录日志或统计
+"""
+
+import json
+import re
+from json.decoder import scanstring
+from typing import Any, Dict, List, NamedTuple, Optional
+
+_FENCE_START = re.compile(r"```[ \t]*(?:json|JSON)?[ \t]*\r?\n?")
+_WHITESPACE = re.compile(r"\s*")
+_STRING_SPECIAL = {
+    '"': re.compile(r'["\\\x00-\x1f]'),
+    "'": re.compile(r"['\\\x00-\x1f]"),
+}
+_NUMBER = re.compile(r"-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?")
+_IDENTIFIER = re.compile(r"[A-Za-z_$][\w$\-]*")
+_LITERALS = {
+    "true": (True, None),
+    "false": (False, None),
+    "null": (None, None),
+    "True": (True, "python_literal"),
+    "False": (False, "python_literal"),
+    "None": (None, "python_literal"),
+}
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t", "'": "'"}
+_VALUE_START = set('"\'{[-0123456789tfnTFN')
+_DECODER = json.JSONDecoder(strict=False)
+# 整块解析失败次数超过成功次数该值后停用（如每个对象都有尾随逗号时）
+_FAST_PATH_SLACK = 8
+# 只涉及对象前后文本的修复；其余修复说明首个候选本身不是合法 JSON
+_LOCATION_REPAIRS = frozenset({"code_fence", "leading_text", "trailing_text"})
+# 说明文字被当成对象解析时的典型特征（LLM 输出的 JSON 几乎不会漏掉冒号）
+_PROSE_REPAIRS = frozenset({"missing_colon"})
+# 图结构输出的顶层键：多个候选时优先含这些键的对象
+_PREFERRED_KEYS = frozenset({"nodes", "edges", "ops", "elements"})
+
+# 解析状态
+_EXPECT_VALUE = 0
+_EXPECT_KEY = 1
+_EXPECT_COLON = 2
+_EXPECT_SEPARATOR = 3
+
+
+class JSONRecoveryError(ValueError):
+    """无法从文本中恢复出 JSON 对象"""
+
+
+class RecoveredJSON(NamedTuple):
+    """恢复结果"""
+    value: Dict[str, Any]
+    repairs: Dict[str, int]     # 修复类型 → 次数；为空表示原文即合法 JSON
+    start: int                  # 对象在原文中的起始偏移
+
+    @property
+    def repaired(self) -> bool:
+        return bool(self.repairs)
+
+
+class _Truncated(Exception):
+    """内部信号：到达文本末尾或代码块结束标记"""
+
+
+def recover_json(text: str) -> RecoveredJSON:
+    """
+    从 LLM 输出中恢复 JSON 对象
+
+    Args:
+        text: 原始输出（可含说明文字、代码块、截断内容）
+
+    Returns:
+        RecoveredJSON(value, repairs, start)
+
+    Raises:
+        JSONRecoveryError: 文本中没有可恢复的 JSON 对象
+    """
+    if not isinstance(text, str):
+        raise JSONRecoveryError(f"Expected str, got {type(text).__name__}")
+
+    start, prefix_repairs = _locate_object(text)
+    if start < 0:
+        raise JSONRecoveryError("No JSON object found in response")
+
+    value, end, repairs = _parse_candidate(text, start)
+    for name, count in prefix_repairs.items():
+        repairs[name] = repairs.get(name, 0) + count
+
+    usable = _is_usable(value, repairs)
+    clean = usable and _LOCATION_REPAIRS.issuperset(repairs)
+    if clean and _PREFERRED_KEYS.intersection(value):
+        return RecoveredJSON(value, repairs, start)
+
+    # 首个候选可能只是说明文字里的 "{" 或示例对象：依次尝试其后的顶层候选
+    first = (start, end, value, repairs) if usable else None
+    candidate = _best_candidate(text, end if usable else start + 1, first, require_preferred=clean)
+    if candidate is None:
+        raise JSONRecoveryError("No JSON object found in response")
+    position, value, repairs = candidate
+    if position != start:
+        repairs["leading_text"] = 1
+    return RecoveredJSON(value, repairs, position)
+
+
+def loads_tolerant(text: str) -> Dict[str, Any]:
+    """recover_json 的便捷形式：只返回解析结果"""
+    return recover_json(text).value
+
+
+def describe_repairs(repairs: Dict[str, int]) -> str:
+    """把修复统计格式化为日志友好的字符串，如 "trailing_comma=2, closed_containers=3" """
+    return ", ".join(f"{name}={count}" for name, count in repairs.items())
+
+
+# ==================== 私有方法 ====================
+
+def _locate_object(text: str):
+    """优先取 ```json 代码块内的首个 "{"，否则取全文首个 "{" """
+    repairs: Dict[str, int] = {}
+    fence = _FENCE_START.search(text)
+    if fence is not None:
+        position = text.find("{", fence.end())
+        if position >= 0:
+            repairs["code_fence"] = 1
+            if text[:fence.start()].strip():
+                repairs["leading_text"] = 1
+            return position, repairs
+
+    position = text.find("{")
+    if position > 0 and text[:position].strip():
+        repairs["leading_text"] = 1
+    return position, repairs
+
+
+def _parse_candidate(text: str, start: int):
+    """
+    解析 start 处的对象：先 raw_decode，失败再用容错解析器
+
+    Returns:
+        (对象或 None, 结束偏移, 修复统计)
+    """
+    try:
+        value, end = _DECODER.raw_decode(text, start)
+    except json.JSONDecodeError:
+        parser = _TolerantParser(text, start)
+        try:
+            value = parser.parse()
+        except JSONRecoveryError:
+            value = None
+        return value, parser.pos, parser.repairs
+
+    repairs = {}
+    if text[end:].strip(" \t\r\n`"):
+        repairs["trailing_text"] = 1
+    return value, end, repairs
+
+
+def _is_usable(value: Any, repairs: Dict[str, int]) -> bool:
+    """非空对象且没有散文特征"""
+    return isinstance(value, dict) and bool(value) and not _PROSE_REPAIRS.intersection(repairs)
+
+
+def _best_candidate(text: str, position: int, best: Optional[tuple], require_preferred: bool = False):
+    """
+    从 position 起逐个解析顶层 "{"，返回最佳候选
+
+    排序：含图结构键优先，其次跨度最大。被拒绝的候选（散文）只前进一个字符，
+    已接受的候选跳到其结束位置，内部的嵌套对象不再作为候选。
+
+    Args:
+        best: 首个候选 (起始偏移, 结束偏移, 对象, 修复统计)，不可用时为 None
+        require_preferred: 只接受含图结构键的候选（首个候选本身已是合法 JSON 时）
+
+    Returns:
+        (起始偏移, 对象, 修复统计)；没有可用候选时为 None
+    """
+    def rank(start, end, value):
+        return bool(_PREFERRED_KEYS.intersection(value)), end - start
+
+    best_rank = rank(*best[:3]) if best is not None else None
+    while True:
+        position = text.find("{", position)
+        if position < 0:
+            return best and (best[0], best[2], best[3])
+        value, end, repairs = _parse_candidate(text, position)
+        if not _is_usable(value, repairs):
+            position += 1
+            continue
+        candidate_rank = rank(position, end, value)
+        if (not require_preferred or candidate_rank[0]) and (best_rank is None or candidate_rank > best_rank):
+            best, best_rank = (position, end, value, repairs), candidate_rank
+        # 对象内部的 "{" 只会得到嵌套对象，直接跳过
+        position = max(end, position + 1)
+
+
+class _TolerantParser:
+    """单遍容错解析器（显式栈，不递归）"""
+
+    def __init__(self, text: str, start: int):
+        self.text = text
+        self.pos = start
+        self.length = len(text)
+        self.repairs: Dict[str, int] = {}
+        # 截断发生在字符串内部时记录：(是否为键, 已到达的内容)
+        self._partial: Optional[tuple] = None
+        self._fast_hits = 0
+        self._fast_misses = 0
+
+    def note(self, repair: str, count: int = 1):
+        self.repairs[repair] = self.repairs.get(repair, 0) + count
+
+    def parse(self) -> Dict[str, Any]:
+        text = self.text
+        # 栈元素：[容器, 是否对象, 待赋值的键]
+        stack: List[list] = []
+        root: Optional[Any] = None
+        state = _EXPECT_VALUE
+
+        try:
+            while True:
+                char = self._next_significant()
+                if char == "`":
+                    raise _Truncated()
+
+                if state == _EXPECT_SEPARATOR:
+                    frame = stack[-1]
+                    if char == ",":
+                        self.pos += 1
+                        state = _EXPECT_KEY if frame[1] else _EXPECT_VALUE
+                    elif char in "}]":
+                        if self._close(stack, char):
+                            finished = stack.pop()[0]
+                            if not stack:
+                                root = finished
+                                break
+                            self._attach(stack[-1], finished)
+                    elif char in _VALUE_START or (frame[1] and _IDENTIFIER.match(text, self.pos)):
+                        # 两个值之间漏了逗号：`} {` / `"a" "b"`
+                        self.note("missing_comma")
+                        state = _EXPECT_KEY if frame[1] else _EXPECT_VALUE
+                    else:
+                        self.note("unexpected_char")
+                        self.pos += 1
+                    continue
+
+                if state == _EXPECT_KEY:
+                    frame = stack[-1]
+                    if char in "\"'":
+                        frame[2] = self._string(char, is_key=True)
+                        state = _EXPECT_COLON
+                    elif char == "}":
+                        self.pos += 1
+                        if frame[0]:
+                            self.note("trailing_comma")
+                        finished = stack.pop()[0]
+                        if not stack:
+                            root = finished
+                            break
+                        self._attach(stack[-1], finished)
+                        state = _EXPECT_SEPARATOR
+                    elif char == ",":
+                        # 尾随逗号（后面紧跟 "}" 时在下一轮处理）或重复逗号
+                        self.pos += 1
+                        self.note("extra_comma")
+                    elif char == "]":
+                        if self._close(stack, char):
+                            finished = stack.pop()[0]
+                            if not stack:
+                                root = finished
+                                break
+                            self._attach(stack[-1], finished)
+                            state = _EXPECT_SEPARATOR
+                    else:
+                        match = _IDENTIFIER.match(text, self.pos)
+                        if match:
+                            self.pos = match.end()
+                            frame[2] = match.group(0)
+                            self.note("unquoted_key")
+                            state = _EXPECT_COLON
+                        else:
+                            self.note("unexpected_char")
+                            self.pos += 1
+                    continue
+
+                if state == _EXPECT_COLON:
+                    if char == ":":
+                        self.pos += 1
+                    else:
+                        self.note("missing_colon")
+                    state = _EXPECT_VALUE
+                    continue
+
+                # _EXPECT_VALUE
+                if stack and char in "{[" and self._fast_misses <= self._fast_hits + _FAST_PATH_SLACK:
+                    # 先按合法 JSON 整块解析该值（C 实现），失败再进入容错处理
+                    try:
+                        value, self.pos = _DECODER.raw_decode(text, self.pos)
+                    except json.JSONDecodeError:
+                        self._fast_misses += 1
+                    else:
+                        self._fast_hits += 1
+                        self._attach(stack[-1], value)
+                        state = _EXPECT_SEPARATOR
+                        continue
+                if char == "{":
+                    self.pos += 1
+                    stack.append([{}, True, None])
+                    state = _EXPECT_KEY
+                    continue
+                if char == "[":
+                    self.pos += 1
+                    stack.append([[], False, None])
+                    continue
+                if not stack:
+                    # 顶层只接受对象
+                    raise JSONRecoveryError("No JSON object found in response")
+                if char in "}]":
+                    frame = stack[-1]
+                    if frame[1]:
+                        # `{"a": }`：丢弃没有值的键
+                        frame[2] = None
+                        self.note("dropped_incomplete_member")
+                    elif char == "]" and frame[0]:
+                        self.note("trailing_comma")
+                    state = _EXPECT_SEPARATOR
+                    continue
+                if char == ",":
+                    self.pos += 1
+                    self.note("extra_comma")
+                    if stack[-1][1]:
+                        stack[-1][2] = None
+                        self.note("dropped_incomplete_member")
+                        state = _EXPECT_KEY
+                    continue
+
+                if char in "\"'":
+                    value = self._string(char, is_key=False)
+                else:
+                    value = self._scalar()
+                    if value is _SKIP:
+                        continue
+                self._attach(stack[-1], value)
+                state = _EXPECT_SEPARATOR
+
+        except _Truncated:
+            root = self._close_truncated(stack, state)
+
+        if self.pos < self.length and text[self.pos:].strip(" \t\r\n`"):
+            self.note("trailing_text")
+        if not isinstance(root, dict):
+            raise JSONRecoveryError("No JSON object found in response")
+        return root
+
+    # ---------- 词法 ----------
+
+    def _next_significant(self) -> str:
+        """跳过空白与注释，返回下一个有效字符；到达末尾时抛出 _Truncated"""
+        text = self.text
+        while True:
+            self.pos = _WHITESPACE.match(text, self.pos).end()
+            if self.pos >= self.length:
+                raise _Truncated()
+            char = text[self.pos]
+            if char == "/" and text.startswith("//", self.pos):
+                newline = text.find("\n", self.pos)
+                self.pos = self.length if newline < 0 else newline + 1
+                self.note("comment")
+                continue
+            if char == "/" and text.startswith("/*", self.pos):
+                end = text.find("*/", self.pos + 2)
+                self.pos = self.length if end < 0 else end + 2
+                self.note("comment")
+                continue
+            return char
+
+    def _string(self, quote: str, is_key: bool) -> str:
+        text = self.text
+        if quote == '"':
+            try:
+                value, self.pos = scanstring(text, self.pos + 1, False)
+                return value
+            except ValueError:
+                # 未闭合（截断）或非法转义：逐段处理
+                pass
+        special = _STRING_SPECIAL[quote]
+        if quote == "'":
+            self.note("single_quotes")
+        self.pos += 1
+        parts: List[str] = []
+        while True:
+            match = special.search(text, self.pos)
+            if match is None:
+                parts.append(text[self.pos:])
+                self.pos = self.length
+                self._truncated_string(parts, is_key)
+            index = match.start()
+            parts.append(text[self.pos:index])
+            char = text[index]
+            if char == quote:
+                self.pos = index + 1
+                return "".join(parts)
+            if char == "\\":
+                self.pos = index + 1
+                parts.append(self._escape(parts, is_key))
+                continue
+            # 字符串内的原始控制字符（换行 / 制表符）按原样保留
+            parts.append(char)
+            self.pos = index + 1
+            self.note("control_character")
+
+    def _escape(self, parts: List[str], is_key: bool) -> str:
+        text = self.text
+        if self.pos >= self.length:
+            self._truncated_string(parts, is_key)
+        char = text[self.pos]
+        if char == "u":
+            digits = text[self.pos + 1:self.pos + 5]
+            if len(digits) < 4 and self.pos + 5 > self.length:
+                self.pos = self.length
+                self._truncated_string(parts, is_key)
+            try:
+                code = int(digits, 16)
+            except ValueError:
+                self.note("invalid_escape")
+                self.pos += 1
+                return "\\u"
+            self.pos += 5
+            if 0xD800 <= code < 0xDC00 and text.startswith("\\u", self.pos):
+                try:
+                    low = int(text[self.pos + 2:self.pos + 6], 16)
+                except ValueError:
+                    low = 0
+                if 0xDC00 <= low < 0xE000:
+                    self.pos += 6
+                    return chr(0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00))
+            return chr(code)
+        self.pos += 1
+        if char in _ESCAPES:
+            return _ESCAPES[char]
+        # 非法转义（如 Windows 路径 C:\data）按原文保留反斜杠
+        self.note("invalid_escape")
+        return "\\" + char
+
+    def _truncated_string(self, parts: List[str], is_key: bool):
+        """字符串在末尾被截断：值保留已到达的内容，键直接丢弃"""
+        self.note("closed_string")
+        self._partial = (is_key, "".join(parts))
+        raise _Truncated()
+
+    def _scalar(self) -> Any:
+        """数字或字面量；末尾被截断的字面量返回 _SKIP 并由截断处理丢弃"""
+        text = self.text
+        match = _NUMBER.match(text, self.pos)
+        if match:
+            self.pos = match.end()
+            if self.pos >= self.length:
+                # 数字可能被截断（如 "12" 实际是 "125"），仍保留已到达的部分
+                self.note("truncated_number")
+            literal = match.group(0)
+            if "." in literal or "e" in literal or "E" in literal:
+                return float(literal)
+            return int(literal)
+
+        match = _IDENTIFIER.match(text, self.pos)
+        if match:
+            word = match.group(0)
+            if word in _LITERALS:
+                self.pos = match.end()
+                value, repair = _LITERALS[word]
+                if repair:
+                    self.note(repair)
+                return value
+            if match.end() >= self.length and any(literal.startswith(word) for literal in _LITERALS):
+                self.pos = self.length
+                self.note("dropped_incomplete_value")
+                raise _Truncated()
+            # 未加引号的字符串值：按字符串保留
+            self.pos = match.end()
+            self.note("unquoted_value")
+            return word
+
+        if text[self.pos] == "-" and self.pos + 1 >= self.length:
+            self.pos = self.length
+            self.note("dropped_incomplete_value")
+            raise _Truncated()
+        self.note("unexpected_char")
+        self.pos += 1
+        return _SKIP
+
+    # ---------- 结构 ----------
+
+    @staticmethod
+    def _attach(frame: list, value: Any):
+        if frame[1]:
+            if frame[2] is not None:
+                frame[0][frame[2]] = value
+            frame[2] = None
+        else:
+            frame[0].append(value)
+
+    def _close(self, stack: List[list], closer: str) -> bool:
+        """
+        处理闭合符；返回 True 表示栈顶容器应弹出
+
+        闭合符与栈顶不匹配时（如 `[1, 2}`），若更深层有匹配容器则先补齐中间的闭合符，
+        否则忽略该字符
+        """
+        self.pos += 1
+        expected_object = closer == "}"
+        if stack[-1][1] == expected_object:
+            return True
+        for depth in range(len(stack) - 2, -1, -1):
+            if stack[depth][1] == expected_object:
+                while len(stack) - 1 > depth:
+                    finished = stack.pop()[0]
+                    self._attach(stack[-1], finished)
+                    self.note("closed_containers")
+                return True
+        self.note("unexpected_char")
+        return False
+
+    def _close_truncated(self, stack: List[list], state: int) -> Any:
+        """文本结束：补齐截断的字符串 / 键值对与所有未闭合容器"""
+        if not stack:
+            raise JSONRecoveryError("No JSON object found in response")
+
+        frame = stack[-1]
+        if self._partial is not None and not self._partial[0]:
+            self._attach(frame, self._partial[1])
+        elif (frame[1] and frame[2] is not None) or self._partial is not None:
+            frame[2] = None
+            self.note("dropped_incomplete_member")
+
+        self.note("closed_containers", len(stack))
+        while len(stack) > 1:
+            finished = stack.pop()[0]
+            self._attach(stack[-1], finished)
+        return stack[0][0]
+
+
+class _Skip:
+    __slots__ = ()
+
+
+_SKIP = _Skip()
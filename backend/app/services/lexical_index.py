@@ -0,0 +1,204 @@
+"""
+词法倒排索引 (BM25 Inverted Index)
+
+RAG fallback 模式（没有 chromadb / sentence-transformers 时）原本每次查询都遍历全部分块：
+逐块正则分词、构建 Counter、计算余弦 + 覆盖率，再对全部结果排序，查询代价与语料总字符数成正比，
+几千个分块后知识库就不可用了。
+
+设计：
+- 上传时增量建索引：每个分块只分词一次，记录词频与文档长度；
+  postings 为 词 → (槽位列表, 词频列表)，只追加（槽位递增），大语料下比 dict 套 dict 建索引快数倍
+- BM25 打分（k1=1.2, b=0.75）：只遍历查询词的 postings，不接触不含查询词的分块；
+  idf 使用按词维护的存活文档数；postings 覆盖大部分文档时改用稠密数组累加分数
+- heapq.nlargest 取 top-k，不对全部命中结果排序；同分时先加入的分块在前（与旧实现的稳定排序一致）
+- remove() 只把槽位标记为已删除并更新文档数 / 总长度，查询时跳过；
+  已删除槽位超过一半时压缩（重排槽位、过滤 postings），删除的均摊代价为 O(该分块的词数)
+- 分词与旧实现一致：英文单词 / 数字按词，中文按单字（中英混合查询）
+"""
+
+import heapq
+import math
+import re
+from typing import Any, Dict, List, Tuple
+
+_TOKEN_PATTERN = re.compile(r"[a-zA-Z0-9_]+|[\u4e00-\u9fff]")
+
+# 已删除槽位的占位条目
+_REMOVED = object()
+
+# 需要扫描的 postings 数 × 该值 ≥ 槽位数时改用稠密数组累加分数
+_DENSE_RATIO = 8
+
+
+def tokenize(text: str) -> List[str]:
+    """分词：小写英文单词 / 数字 + 单个中文字符"""
+    if not text:
+        return []
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """BM25 倒排索引（增量添加 / 删除，只在查询词的 postings 上打分）"""
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings: Dict[str, Tuple[List[int], List[int]]] = {}  # 词 → (槽位列表, 词频列表)
+        self._doc_freq: Dict[str, int] = {}        # 词 → 包含该词的存活文档数
+        self._lengths: List[int] = []              # 槽位 → 文档长度（词数）
+        self._terms: List[Tuple[str, ...]] = []    # 槽位 → 去重词表（删除时更新 doc_freq）
+        self._items: List[Any] = []                # 槽位 → 调用方的条目，已删除为 _REMOVED
+        self._slots: Dict[str, int] = {}           # key → 槽位
+        self._removed = 0
+        self._total_length = 0
+        self._posting_count = 0
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._slots
+
+    def add(self, key: str, text: str, item: Any = None):
+        """
+        添加一个文档（同 key 已存在时先删除）
+
+        Args:
+            key: 文档唯一标识（如 chunk_id）
+            text: 文档文本
+            item: 查询时随分数返回的条目，默认为 key
+        """
+        if key in self._slots:
+            self.remove(key)
+
+        tokens = tokenize(text)
+        frequencies: Dict[str, int] = {}
+        for token in tokens:
+            frequencies[token] = frequencies.get(token, 0) + 1
+
+        slot = len(self._items)
+        postings = self._postings
+        doc_freq = self._doc_freq
+        for token, frequency in frequencies.items():
+            entry = postings.get(token)
+            if entry is None:
+                entry = postings[token] = ([], [])
+            entry[0].append(slot)
+            entry[1].append(frequency)
+            doc_freq[token] = doc_freq.get(token, 0) + 1
+
+        self._slots[key] = slot
+        self._lengths.append(len(tokens))
+        self._terms.append(tuple(frequencies))
+        self._items.append(key if item is None else item)
+        self._total_length += len(tokens)
+        self._posting_count += len(frequencies)
+
+    def remove(self, key: str) -> bool:
+        """删除一个文档，返回是否存在"""
+        slot = self._slots.pop(key, None)
+        if slot is None:
+            return False
+        for token in self._terms[slot]:
+            self._doc_freq[token] -= 1
+        self._items[slot] = _REMOVED
+        self._total_length -= self._lengths[slot]
+        self._posting_count -= len(self._terms[slot])
+        self._removed += 1
+        if self._removed * 2 > len(self._items):
+            self._compact()
+        return True
+
+    def search(self, query: str, top_k: int = 5) -> List[Tuple[float, Any]]:
+        """
+        BM25 检索
+
+        Returns:
+            [(分数, 条目)]，按分数降序，只包含至少命中一个查询词的文档
+        """
+        if top_k <= 0 or not self._slots:
+            return []
+        query_terms = set(tokenize(query))
+        if not query_terms:
+            return []
+
+        doc_count = len(self._slots)
+        avg_length = self._total_length / doc_count or 1.0
+        k1 = self.k1
+        length_norm = k1 * self.b / avg_length
+        base_norm = k1 * (1 - self.b)
+        items = self._items
+
+        weighted = []
+        for term in query_terms:
+            doc_freq = self._doc_freq.get(term, 0)
+            if doc_freq > 0:
+                idf = math.log(1 + (doc_count - doc_freq + 0.5) / (doc_freq + 0.5))
+                weighted.append((idf * (k1 + 1), self._postings[term]))
+        if not weighted:
+            return []
+
+        scanned = sum(len(slots) for _, (slots, _) in weighted)
+        if scanned * _DENSE_RATIO >= len(items):
+            # 查询词覆盖大部分文档（常见词 / 中文单字）：按槽位下标累加，比 dict 累加快约一倍
+            norms = [base_norm + length_norm * length for length in self._lengths]
+            dense = [0.0] * len(items)
+            for weight, (slots, frequencies) in weighted:
+                for slot, frequency in zip(slots, frequencies):
+                    dense[slot] += weight * frequency / (frequency + norms[slot])
+            candidates = (
+                (score, -slot) for slot, score in enumerate(dense)
+                if score > 0 and items[slot] is not _REMOVED
+            )
+        else:
+            lengths = self._lengths
+            sparse: Dict[int, float] = {}
+            for weight, (slots, frequencies) in weighted:
+                for slot, frequency in zip(slots, frequencies):
+                    sparse[slot] = sparse.get(slot, 0.0) + weight * frequency / (
+                        frequency + base_norm + length_norm * lengths[slot]
+                    )
+            candidates = ((score, -slot) for slot, score in sparse.items() if items[slot] is not _REMOVED)
+
+        # 同分时槽位小（先加入）的在前
+        return [(score, items[-negative_slot]) for score, negative_slot in heapq.nlargest(top_k, candidates)]
+
+    def get_stats(self) -> Dict[str, Any]:
+        doc_count = len(self._slots)
+        return {
+            "documents": doc_count,
+            "terms": sum(1 for count in self._doc_freq.values() if count > 0),
+            "postings": self._posting_count,
+            "removed_slots": self._removed,
+            "avg_length": self._total_length / doc_count if doc_count else 0.0,
+        }
+
+    # ==================== 私有方法 ====================
+
+    def _compact(self):
+        """丢弃已删除的槽位：存活槽位按原顺序重新编号，postings 只保留存活项"""
+        remap: Dict[int, int] = {}
+        lengths: List[int] = []
+        terms: List[Tuple[str, ...]] = []
+        items: List[Any] = []
+        for slot, item in enumerate(self._items):
+            if item is _REMOVED:
+                continue
+            remap[slot] = len(items)
+            lengths.append(self._lengths[slot])
+            terms.append(self._terms[slot])
+            items.append(item)
+
+        postings: Dict[str, Tuple[List[int], List[int]]] = {}
+        for term, (slots, frequencies) in self._postings.items():
+            kept = [(remap[slot], frequency) for slot, frequency in zip(slots, frequencies) if slot in remap]
+            if kept:
+                postings[term] = ([slot for slot, _ in kept], [frequency for _, frequency in kept])
+
+        self._postings = postings
+        self._doc_freq = {term: len(entry[0]) for term, entry in postings.items()}
+        self._lengths = lengths
+        self._terms = terms
+        self._items = items
+        self._slots = {key: remap[slot] for key, slot in self._slots.items()}
+        self._removed = 0
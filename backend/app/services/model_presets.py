@@ -5,13 +5,15 @@
 解决频繁替换 API Key 体验差的问题。
 """
 
-import json
 import os
 from typing import List, Optional, Dict, Any
 from datetime import datetime
 import logging
 
+from app.core.serialization import read_json_file, write_json_file
 from app.models.schemas import ModelPreset, ModelPresetCreate, ModelPresetUpdate
+from app.services.client_pool import get_client_registry
+from app.services.provider_health import get_provider_health
 
 logger = logging.getLogger(__name__)
 
@@ -43,12 +45,11 @@ class ModelPresetsService:
         """从 JSON 文件加载预设配置"""
         if os.path.exists(self.config_file):
             try:
-                with open(self.config_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    for preset_data in data.get("presets", []):
-                        normalized = self._normalize_preset_data(preset_data)
-                        preset = ModelPreset(**normalized)
-                        self.presets[preset.id] = preset
+                data = read_json_file(self.config_file)
+                for preset_data in data.get("presets", []):
+                    normalized = self._normalize_preset_data(preset_data)
+                    preset = ModelPreset(**normalized)
+                    self.presets[preset.id] = preset
                 logger.info(f"Loaded {len(self.presets)} model presets from {self.config_file}")
             except Exception as e:
                 logger.error(f"Failed to load presets from {self.config_file}: {e}")
@@ -84,8 +85,7 @@ class ModelPresetsService:
                 "last_updated": datetime.now().isoformat()
             }
 
-            with open(self.config_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            write_json_file(self.config_file, data)
 
             logger.info(f"Saved {len(self.presets)} presets to {self.config_file}")
         except Exception as e:
@@ -195,6 +195,9 @@ class ModelPresetsService:
             for p in self.presets.values():
                 p.is_default = False
 
+        # 记录旧签名，更新后失效对应的共享客户端
+        old_signature = self._config_signature(self._preset_runtime_config(preset))
+
         # 更新字段
         if update_data.name is not None:
             preset.name = update_data.name
@@ -211,6 +214,9 @@ class ModelPresetsService:
 
         self._save_presets()
 
+        if self._config_signature(self._preset_runtime_config(preset)) != old_signature:
+            get_client_registry().invalidate(old_signature)
+
         logger.info(f"Updated preset: {preset.name} ({preset_id})")
         return preset
 
@@ -224,9 +230,11 @@ class ModelPresetsService:
             是否成功删除
         """
         if preset_id in self.presets:
-            preset_name = self.presets[preset_id].name
+            preset = self.presets[preset_id]
+            preset_name = preset.name
             del self.presets[preset_id]
             self._save_presets()
+            get_client_registry().invalidate(self._config_signature(self._preset_runtime_config(preset)))
             logger.info(f"Deleted preset: {preset_name} ({preset_id})")
             return True
         return False
@@ -359,18 +367,22 @@ class ModelPresetsService:
             (config.get("model_name") or "").strip(),
         )
 
+    @staticmethod
+    def _preset_runtime_config(preset: ModelPreset) -> Dict[str, Any]:
+        return {
+            "provider": preset.provider or DEFAULT_PROVIDER,
+            "api_key": preset.api_key,
+            "base_url": preset.base_url or None,
+            "model_name": preset.model_name or None,
+        }
+
     def list_full_runtime_configs(self) -> List[Dict[str, Any]]:
         """Return full runtime configs (including keys) for routing/failover."""
         configs: List[Dict[str, Any]] = []
         for preset in self.presets.values():
             if not preset.api_key:
                 continue
-            configs.append({
-                "provider": preset.provider or DEFAULT_PROVIDER,
-                "api_key": preset.api_key,
-                "base_url": preset.base_url or None,
-                "model_name": preset.model_name or None,
-            })
+            configs.append(self._preset_runtime_config(preset))
         return configs
 
     def get_failover_configs(
@@ -381,6 +393,8 @@ class ModelPresetsService:
         """
         Build alternate configs for automatic failover.
         The primary config is excluded from returned candidates.
+        Candidates are ordered by provider health (circuit state, then score)
+        before truncation, so a tripped preset does not take a slot.
         """
         if max_candidates <= 0:
             return []
@@ -395,10 +409,9 @@ class ModelPresetsService:
                 continue
             seen.add(sig)
             candidates.append(config)
-            if len(candidates) >= max_candidates:
-                break
 
-        return candidates
+        candidates = get_provider_health().order_candidates(candidates)
+        return candidates[:max_candidates]
 
 
 # 全局单例实例
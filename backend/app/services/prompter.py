@@ -12,7 +12,7 @@ from app.models.schemas import (
     Edge,
     ImageAnalysisResponse
 )
-from app.services.ai_vision import create_vision_service
+from app.services.ai_vision import create_vision_service, settle_response_cache
 from app.services.model_presets import get_model_presets_service
 from app.core.config import settings
 
@@ -123,6 +123,7 @@ Do NOT include any explanatory text outside the JSON. The response must be parse
         logger.debug(f"Prompter full prompt:\n{full_prompt}")
 
         # 5. 获取有效配置并调用 AI Vision Service
+        vision_service = None
         try:
             # 获取有效配置
             presets_service = get_model_presets_service()
@@ -157,16 +158,20 @@ Do NOT include any explanatory text outside the JSON. The response must be parse
                 provider
             )
 
-            return PromptExecutionResponse(
+            response = PromptExecutionResponse(
                 nodes=result["nodes"],
                 edges=result["edges"],
                 mermaid_code=result.get("mermaid_code", ""),
                 ai_explanation=result.get("ai_explanation", "Architecture transformed successfully"),
                 success=True
             )
+            # 输出通过校验后才写入响应缓存
+            settle_response_cache(vision_service, accepted=True)
+            return response
 
         except Exception as e:
             logger.error(f"Prompter execution failed: {e}", exc_info=True)
+            settle_response_cache(vision_service, accepted=False)
             return PromptExecutionResponse(
                 nodes=request.nodes,
                 edges=request.edges,
@@ -210,20 +215,9 @@ Do NOT include any explanatory text outside the JSON. The response must be parse
         prompt: str,
         provider: str
     ) -> dict:
-        """调用 AI 服务处理文本提示词"""
-
-        if provider == "gemini":
-            response = await vision_service._analyze_with_gemini_text(prompt)
-        elif provider == "openai":
-            response = await vision_service._analyze_with_openai_text(prompt)
-        elif provider == "claude":
-            response = await vision_service._analyze_with_claude_text(prompt)
-        elif provider == "siliconflow":
-            response = await vision_service._analyze_with_siliconflow_text(prompt)
-        else:
-            response = await vision_service._analyze_with_custom_text(prompt)
-
-        return response
+        """调用 AI 服务处理文本提示词（按 provider 分发并走响应缓存）"""
+
+        return await vision_service.analyze_text(prompt, provider)
 
 
 # Helper function to create service instance
@@ -0,0 +1,386 @@
+"""
+Provider 熔断与健康评分 (Provider Circuit Breaker & Health Score)
+
+get_failover_configs 原本按预设遍历顺序返回候选：某个 provider 持续返回 429/503 时，
+每个请求仍然先打到它，直到有人手动修改预设。
+
+设计：
+- 每个候选配置（provider + base_url + model + key 指纹）一个熔断器：
+  closed → 连续失败达到阈值 → open（冷却期内排到最后）
+  → 冷却结束 half_open（放行一个探测请求）→ 成功 closed / 失败重新 open（冷却时间翻倍）
+- 失败类型复用 _classify_provider_error / _classify_upstream_error 的分类结果：
+  429 / 5xx / 超时计入失败，401 直接熔断（换 key 之前不会自己恢复），其余 4xx 视为请求问题不计入
+- 健康分 = (1 - EWMA 错误率) × 延迟因子 × 首 token 因子，
+  延迟因子 = ref / (ref + EWMA 延迟)，没有样本时按 ref 估计（因子 0.5）
+- order_candidates 按 (熔断状态, 健康分档位) 稳定排序：分数差距很小时保留预设顺序，
+  用户选择的主配置不会因为几百毫秒的差异被挤到后面；keep_primary=True 时首个候选（用户选择的主配置）
+  只在熔断或探测已在途时让位，其余情况下只对后面的故障切换候选按健康度排序
+- 排序只读取状态，不占用 half_open 的探测名额；调用真正开始时 begin_attempt() 才占用，
+  主配置健康时排在后面、实际没被尝试的备用配置不会把探测名额白白占住一个冷却期
+- 时钟可注入，便于在单元测试中模拟冷却时间
+"""
+
+import hashlib
+import logging
+import math
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+# 直接熔断的错误码：不会在短时间内自行恢复
+_TRIP_IMMEDIATELY_CODES = {"authentication_failed"}
+
+
+def is_breaker_failure(status_code: int) -> bool:
+    """分类后的错误是否计入熔断（provider 侧故障）"""
+    return status_code in {401, 429} or status_code >= 500
+
+
+class CircuitBreaker:
+    """单个候选配置的熔断器（closed / open / half_open）"""
+
+    def __init__(
+        self,
+        failure_threshold: int = 3,
+        open_seconds: float = 30.0,
+        max_open_seconds: float = 300.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = max(1, failure_threshold)
+        self.open_seconds = max(0.0, open_seconds)
+        self.max_open_seconds = max(self.open_seconds, max_open_seconds)
+        self._clock = clock
+        self._state = STATE_CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._cooldown = self.open_seconds
+        self._probe_started_at: Optional[float] = None
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        """当前状态（open 冷却结束后自动进入 half_open）"""
+        if self._state == STATE_OPEN and self._clock() - self._opened_at >= self._cooldown:
+            self._state = STATE_HALF_OPEN
+            self._probe_started_at = None
+        return self._state
+
+    def allow_request(self) -> bool:
+        """
+        是否放行请求
+
+        half_open 状态只放行一个探测请求（放行即占用探测名额）；
+        探测迟迟没有结果（超过一个冷却期）时允许重新探测
+        """
+        state = self.state
+        if state == STATE_CLOSED:
+            return True
+        if state == STATE_OPEN or self.probe_in_flight():
+            return False
+        self._probe_started_at = self._clock()
+        return True
+
+    def probe_in_flight(self) -> bool:
+        """half_open 状态下是否已有探测请求在途（只读，不占用名额）"""
+        return (
+            self.state == STATE_HALF_OPEN
+            and self._probe_started_at is not None
+            and self._clock() - self._probe_started_at < self._cooldown
+        )
+
+    def record_success(self):
+        self._state = STATE_CLOSED
+        self._consecutive_failures = 0
+        self._cooldown = self.open_seconds
+        self._probe_started_at = None
+
+    def record_failure(self, trip: bool = False):
+        self._consecutive_failures += 1
+        state = self.state
+        if state == STATE_HALF_OPEN:
+            # 探测失败：重新熔断，冷却时间翻倍
+            self._open(min(self._cooldown * 2, self.max_open_seconds))
+        elif state == STATE_CLOSED and (trip or self._consecutive_failures >= self.failure_threshold):
+            self._open(self.open_seconds)
+
+    def retry_after(self) -> float:
+        """距离进入 half_open 还剩多少秒"""
+        if self.state != STATE_OPEN:
+            return 0.0
+        return max(0.0, self._cooldown - (self._clock() - self._opened_at))
+
+    def _open(self, cooldown: float):
+        self._state = STATE_OPEN
+        self._opened_at = self._clock()
+        self._cooldown = cooldown
+        self._probe_started_at = None
+        self.trips += 1
+
+
+class ProviderHealth:
+    """单个候选配置的熔断器 + 滚动健康指标"""
+
+    def __init__(self, label: str, breaker: CircuitBreaker):
+        self.label = label
+        self.breaker = breaker
+        self.successes = 0
+        self.failures = 0
+        self.error_rate: Optional[float] = None
+        self.latency: Optional[float] = None
+        self.first_token_latency: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+
+class ProviderHealthRegistry:
+    """按候选配置记录调用结果，并据此对 failover 候选排序"""
+
+    def __init__(
+        self,
+        failure_threshold: int = 3,
+        open_seconds: float = 30.0,
+        max_open_seconds: float = 300.0,
+        ewma_alpha: float = 0.3,
+        latency_reference: float = 20.0,
+        first_token_reference: float = 5.0,
+        score_bucket: float = 0.1,
+        enabled: bool = True,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.ewma_alpha = min(1.0, max(0.01, ewma_alpha))
+        self.latency_reference = max(0.001, latency_reference)
+        self.first_token_reference = max(0.001, first_token_reference)
+        self.score_bucket = max(0.0, score_bucket)
+        self.enabled = enabled
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[str, str, str, str], ProviderHealth] = {}
+
+    def record_success(
+        self,
+        config: Dict[str, Any],
+        latency_seconds: Optional[float] = None,
+        first_token_seconds: Optional[float] = None,
+    ):
+        """
+        记录一次成功调用
+
+        Args:
+            config: 候选配置
+            latency_seconds: 完整响应耗时（非流式）
+            first_token_seconds: 首 token 耗时（流式）
+        """
+        with self._lock:
+            entry = self._entry(config)
+            entry.successes += 1
+            entry.error_rate = self._ewma(entry.error_rate, 0.0)
+            if latency_seconds is not None:
+                entry.latency = self._ewma(entry.latency, latency_seconds)
+            if first_token_seconds is not None:
+                entry.first_token_latency = self._ewma(entry.first_token_latency, first_token_seconds)
+            entry.breaker.record_success()
+
+    def record_failure(self, config: Dict[str, Any], status_code: int, error_code: str = ""):
+        """
+        记录一次失败调用（status_code / error_code 来自错误分类函数）
+
+        非 provider 侧的错误（如 400 请求参数问题）不计入
+        """
+        if not is_breaker_failure(status_code):
+            return
+        with self._lock:
+            entry = self._entry(config)
+            entry.failures += 1
+            entry.error_rate = self._ewma(entry.error_rate, 1.0)
+            entry.last_error = f"{status_code}:{error_code}"
+            previous = entry.breaker.state
+            entry.breaker.record_failure(trip=error_code in _TRIP_IMMEDIATELY_CODES)
+            if entry.breaker.state == STATE_OPEN and previous != STATE_OPEN:
+                logger.warning(
+                    "[HEALTH] Circuit opened for %s after %s (cooldown %.0fs)",
+                    entry.label,
+                    entry.last_error,
+                    entry.breaker.retry_after(),
+                )
+
+    def allow_request(self, config: Dict[str, Any]) -> bool:
+        with self._lock:
+            return self._entry(config).breaker.allow_request()
+
+    def begin_attempt(self, config: Dict[str, Any]) -> bool:
+        """
+        对某个候选配置的调用真正开始时调用：half_open 配置在此占用探测名额
+
+        Returns:
+            是否放行；False 表示熔断中或探测已在途（排序已把它排到最后，调用方作为兜底仍可尝试）
+        """
+        if not self.enabled:
+            return True
+        return self.allow_request(config)
+
+    def score(self, config: Dict[str, Any]) -> float:
+        with self._lock:
+            return self._score(self._entry(config))
+
+    def order_candidates(self, configs: List[Dict[str, Any]], keep_primary: bool = False) -> List[Dict[str, Any]]:
+        """
+        按熔断状态与健康分对候选排序（稳定排序，不删除候选）
+
+        熔断中的配置排到最后而不是移除：所有候选都熔断时仍然有配置可用。
+        half_open 且探测已在途的配置同样排到后面；排序不占用探测名额（见 begin_attempt）
+
+        Args:
+            configs: 候选配置（按预设优先级）
+            keep_primary: configs[0] 是用户选择的主配置：可用时固定在第一位，不参与健康分排序
+        """
+        if not self.enabled or len(configs) < 2:
+            return list(configs)
+
+        with self._lock:
+            keyed = []
+            for position, config in enumerate(configs):
+                entry = self._entry(config)
+                available = entry.breaker.state != STATE_OPEN and not entry.breaker.probe_in_flight()
+                if keep_primary and position == 0 and available:
+                    keyed.append(((-1, 0, 0), config))
+                    continue
+                tier = 0 if available else 1
+                score = self._score(entry)
+                bucket = math.floor(score / self.score_bucket) if self.score_bucket else score
+                keyed.append(((tier, -bucket, position), config))
+
+        keyed.sort(key=lambda item: item[0])
+        ordered = [config for _, config in keyed]
+        if ordered[0] is not configs[0]:
+            logger.info(
+                "[HEALTH] Reordered candidates: %s",
+                [config_key_label(config) for config in ordered],
+            )
+        return ordered
+
+    def get_states(self) -> List[dict]:
+        """所有候选配置的熔断状态与健康指标（不包含 api_key）"""
+        with self._lock:
+            states = []
+            for entry in self._entries.values():
+                states.append({
+                    "config": entry.label,
+                    "state": entry.breaker.state,
+                    "score": round(self._score(entry), 4),
+                    "retry_after_seconds": round(entry.breaker.retry_after(), 2),
+                    "trips": entry.breaker.trips,
+                    "successes": entry.successes,
+                    "failures": entry.failures,
+                    "error_rate": None if entry.error_rate is None else round(entry.error_rate, 4),
+                    "latency_ewma_seconds": None if entry.latency is None else round(entry.latency, 3),
+                    "ttft_ewma_seconds": (
+                        None if entry.first_token_latency is None else round(entry.first_token_latency, 3)
+                    ),
+                    "last_error": entry.last_error,
+                })
+        states.sort(key=lambda item: item["score"], reverse=True)
+        return states
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    # ==================== 私有方法 ====================
+
+    def _entry(self, config: Dict[str, Any]) -> ProviderHealth:
+        key = _config_key(config)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = ProviderHealth(
+                label=config_key_label(config),
+                breaker=CircuitBreaker(
+                    failure_threshold=self.failure_threshold,
+                    open_seconds=self.open_seconds,
+                    max_open_seconds=self.max_open_seconds,
+                    clock=self._clock,
+                ),
+            )
+            self._entries[key] = entry
+        return entry
+
+    def _ewma(self, current: Optional[float], sample: float) -> float:
+        if current is None:
+            return sample
+        return self.ewma_alpha * sample + (1 - self.ewma_alpha) * current
+
+    def _score(self, entry: ProviderHealth) -> float:
+        success_rate = 1.0 - (entry.error_rate or 0.0)
+        latency = entry.latency if entry.latency is not None else self.latency_reference
+        ttft = entry.first_token_latency if entry.first_token_latency is not None else self.first_token_reference
+        latency_factor = self.latency_reference / (self.latency_reference + max(0.0, latency))
+        ttft_factor = self.first_token_reference / (self.first_token_reference + max(0.0, ttft))
+        return success_rate * latency_factor * ttft_factor
+
+
+def _config_key(config: Dict[str, Any]) -> Tuple[str, str, str, str]:
+    return (
+        (config.get("provider") or "").strip().lower(),
+        (config.get("base_url") or "").strip(),
+        (config.get("model_name") or "").strip(),
+        _key_fingerprint(config.get("api_key")),
+    )
+
+
+def _key_fingerprint(api_key: Optional[str]) -> str:
+    api_key = (api_key or "").strip()
+    if not api_key:
+        return "-"
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:8]
+
+
+def config_key_label(config: Dict[str, Any]) -> str:
+    """候选配置的展示标签：provider/model@base_url#key指纹"""
+    provider, base_url, model_name, fingerprint = _config_key(config)
+    return f"{provider or '-'}/{model_name or '-'}@{base_url or '-'}#{fingerprint}"
+
+
+# ==================== 全局实例 ====================
+
+_registry: Optional[ProviderHealthRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_provider_health() -> ProviderHealthRegistry:
+    """
+    获取全局 provider 健康注册表（单例模式）
+
+    Returns:
+        ProviderHealthRegistry 实例
+    """
+    global _registry
+
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = ProviderHealthRegistry(
+                    failure_threshold=settings.CIRCUIT_FAILURE_THRESHOLD,
+                    open_seconds=settings.CIRCUIT_OPEN_SECONDS,
+                    max_open_seconds=settings.CIRCUIT_MAX_OPEN_SECONDS,
+                    ewma_alpha=settings.HEALTH_EWMA_ALPHA,
+                    latency_reference=settings.HEALTH_LATENCY_REFERENCE_SECONDS,
+                    first_token_reference=settings.HEALTH_TTFT_REFERENCE_SECONDS,
+                    enabled=settings.CIRCUIT_BREAKER_ENABLED,
+                )
+
+    return _registry
+
+
+def reset_provider_health():
+    """重置全局 provider 健康注册表（主要用于测试）"""
+    global _registry
+    _registry = None
@@ -6,13 +6,12 @@ Primary mode:
 
 Fallback mode (when vector deps are unavailable):
 - lightweight lexical retrieval with persisted local index
+- BM25 over an in-memory inverted index (app.services.lexical_index), rebuilt on load
+  and updated incrementally on upload / delete
 """
 
-import json
 import logging
-import math
 import uuid
-from collections import Counter
 from datetime import datetime
 from pathlib import Path
 from typing import List
@@ -28,6 +27,7 @@ try:
 except ImportError:
     SentenceTransformer = None
 
+from app.core.serialization import read_json_file, write_json_file
 from app.models.schemas import (
     DocumentUploadResponse,
     DocumentSearchResponse,
@@ -35,6 +35,7 @@ from app.models.schemas import (
     DocumentMetadata,
 )
 from app.services.document_parser import create_document_parser, DocumentChunk as ParserChunk
+from app.services.lexical_index import BM25Index
 
 logger = logging.getLogger(__name__)
 
@@ -59,6 +60,7 @@ class RAGService:
 
         self._fallback_chunks: List[dict] = []
         self._fallback_documents: dict = {}
+        self._fallback_index = BM25Index()
 
         self.parser = create_document_parser()
 
@@ -95,7 +97,7 @@ class RAGService:
 
     def _init_fallback_mode(self):
         self.backend_mode = "fallback"
-        self.embedding_model_name = "lexical-tf-fallback-v1"
+        self.embedding_model_name = "lexical-bm25-fallback-v2"
         self.client = None
         self.collection = None
         self.embedder = None
@@ -106,14 +108,16 @@ class RAGService:
             if not self.fallback_index_path.exists():
                 self._fallback_chunks = []
                 self._fallback_documents = {}
+                self._rebuild_fallback_index()
                 return
 
-            data = json.loads(self.fallback_index_path.read_text(encoding="utf-8"))
+            data = read_json_file(self.fallback_index_path)
             self._fallback_chunks = data.get("chunks", [])
             documents = data.get("documents", [])
             self._fallback_documents = {
                 doc["document_id"]: doc for doc in documents if doc.get("document_id")
             }
+            self._rebuild_fallback_index()
             logger.info(
                 "Loaded fallback RAG index: %d docs, %d chunks",
                 len(self._fallback_documents),
@@ -123,6 +127,12 @@ class RAGService:
             logger.warning("Failed to load fallback RAG index, starting empty: %s", e)
             self._fallback_chunks = []
             self._fallback_documents = {}
+            self._rebuild_fallback_index()
+
+    def _rebuild_fallback_index(self):
+        self._fallback_index = BM25Index()
+        for chunk in self._fallback_chunks:
+            self._fallback_index.add(chunk.get("chunk_id", ""), chunk.get("content", ""), chunk)
 
     def _save_fallback_index(self):
         try:
@@ -132,49 +142,10 @@ class RAGService:
                 "chunks": self._fallback_chunks,
                 "updated_at": datetime.now().isoformat(),
             }
-            self.fallback_index_path.write_text(
-                json.dumps(payload, ensure_ascii=False, indent=2),
-                encoding="utf-8",
-            )
+            write_json_file(self.fallback_index_path, payload)
         except Exception as e:
             logger.warning("Failed to persist fallback RAG index: %s", e)
 
-    @staticmethod
-    def _tokenize(text: str) -> List[str]:
-        if not text:
-            return []
-        import re
-
-        # Keep English words/numbers and CJK chars for mixed-language queries
-        return re.findall(r"[a-zA-Z0-9_]+|[\u4e00-\u9fff]", text.lower())
-
-    @staticmethod
-    def _cosine_similarity(a: Counter, b: Counter) -> float:
-        if not a or not b:
-            return 0.0
-        intersection = set(a.keys()) & set(b.keys())
-        numerator = sum(a[t] * b[t] for t in intersection)
-        denom_a = math.sqrt(sum(v * v for v in a.values()))
-        denom_b = math.sqrt(sum(v * v for v in b.values()))
-        if denom_a == 0 or denom_b == 0:
-            return 0.0
-        return float(numerator / (denom_a * denom_b))
-
-    def _fallback_score(self, query: str, content: str) -> float:
-        q_tokens = self._tokenize(query)
-        d_tokens = self._tokenize(content)
-        if not q_tokens or not d_tokens:
-            return 0.0
-
-        q_counter = Counter(q_tokens)
-        d_counter = Counter(d_tokens)
-        cosine = self._cosine_similarity(q_counter, d_counter)
-
-        overlap = len(set(q_tokens) & set(d_tokens))
-        coverage = overlap / max(len(set(q_tokens)), 1)
-
-        return 0.7 * cosine + 0.3 * coverage
-
     async def upload_document(
         self, file_path: str, filename: str, file_type: str
     ) -> DocumentUploadResponse:
@@ -226,21 +197,21 @@ class RAGService:
 
                 for chunk in chunks:
                     chunk_id = f"{document_id}_{chunk.chunk_id}"
-                    self._fallback_chunks.append(
-                        {
-                            "chunk_id": chunk_id,
+                    fallback_chunk = {
+                        "chunk_id": chunk_id,
+                        "document_id": document_id,
+                        "content": chunk.content,
+                        "metadata": {
                             "document_id": document_id,
-                            "content": chunk.content,
-                            "metadata": {
-                                "document_id": document_id,
-                                "filename": filename,
-                                "file_type": file_type,
-                                "upload_date": upload_date,
-                                "chunk_index": chunk.metadata.get("chunk_index", 0),
-                                **chunk.metadata,
-                            },
-                        }
-                    )
+                            "filename": filename,
+                            "file_type": file_type,
+                            "upload_date": upload_date,
+                            "chunk_index": chunk.metadata.get("chunk_index", 0),
+                            **chunk.metadata,
+                        },
+                    }
+                    self._fallback_chunks.append(fallback_chunk)
+                    self._fallback_index.add(chunk_id, chunk.content, fallback_chunk)
 
                 self._save_fallback_index()
 
@@ -304,15 +275,7 @@ class RAGService:
                             )
                         )
             else:
-                ranked = []
-                for chunk in self._fallback_chunks:
-                    score = self._fallback_score(query, chunk.get("content", ""))
-                    if score <= 0:
-                        continue
-                    ranked.append((score, chunk))
-
-                ranked.sort(key=lambda x: x[0], reverse=True)
-                for score, chunk in ranked[:top_k]:
+                for score, chunk in self._fallback_index.search(query, top_k):
                     metadata_raw = chunk.get("metadata", {})
                     doc_id = metadata_raw.get("document_id")
                     doc_info = self._fallback_documents.get(doc_id, {})
@@ -348,12 +311,15 @@ class RAGService:
                 count = len(self._fallback_chunks)
                 collection_name = "fallback_index"
 
-            return {
+            stats = {
                 "total_chunks": count,
                 "collection_name": collection_name,
                 "embedding_model": self.embedding_model_name,
                 "mode": self.backend_mode,
             }
+            if self.backend_mode == "fallback":
+                stats["lexical_index"] = self._fallback_index.get_stats()
+            return stats
         except Exception as e:
             logger.error("Failed to get collection stats: %s", e)
             return {
@@ -403,9 +369,13 @@ class RAGService:
                     logger.warning("Document %s not found", document_id)
             else:
                 before = len(self._fallback_chunks)
-                self._fallback_chunks = [
-                    c for c in self._fallback_chunks if c.get("document_id") != document_id
-                ]
+                kept = []
+                for chunk in self._fallback_chunks:
+                    if chunk.get("document_id") == document_id:
+                        self._fallback_index.remove(chunk.get("chunk_id", ""))
+                    else:
+                        kept.append(chunk)
+                self._fallback_chunks = kept
                 self._fallback_documents.pop(document_id, None)
                 self._save_fallback_index()
                 deleted = before - len(self._fallback_chunks)
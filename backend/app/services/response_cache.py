@@ -0,0 +1,423 @@
+"""
+LLM 响应缓存 (Content-addressed LLM Response Cache)
+
+按 provider / model / base_url / 凭据摘要 / prompt / 图片字节 / 采样参数 计算 SHA-256 作为键，
+缓存模型的原始文本输出：
+- 内存层：有界 LRU，命中即返回
+- 磁盘层：按总字节数限额的 JSON 文件，服务重启后仍可命中
+- 只缓存调用方校验通过的输出（AIVisionService.commit_response_cache），
+  命中后校验失败的条目由 invalidate() 删除
+- 磁盘写入与删除走后台线程（写回队列，与 session_persister 相同的模式）：put() / invalidate()
+  只更新内存并排队，不在调用方所在的事件循环线程里做文件 IO；队列中尚未落盘的条目 get() 仍可命中
+
+相同输入（模板示例、刷新页面后重跑、CI 冒烟测试）不再重复一次几十秒的往返。
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# 写回队列中表示"待删除"的墓碑
+_TOMBSTONE = object()
+
+
+class LLMResponseCache:
+    """内存 LRU + 磁盘限额的两级响应缓存"""
+
+    def __init__(
+        self,
+        max_entries: int = 256,
+        ttl_seconds: float = 86400.0,
+        disk_path: Optional[str] = "data/llm_cache",
+        disk_max_bytes: int = 256 * 1024 * 1024,
+        clock: Callable[[], float] = time.time,
+    ):
+        """
+        初始化缓存
+
+        Args:
+            max_entries: 内存层最多缓存的条目数
+            ttl_seconds: 条目有效期（秒），<=0 表示永不过期
+            disk_path: 磁盘层目录，为 None 时仅使用内存层
+            disk_max_bytes: 磁盘层总字节数上限，超出后淘汰最久未使用的文件
+            clock: 墙上时钟（磁盘条目跨进程有效，不能用单调时钟；测试时可注入假时钟）
+        """
+        self._max_entries = max(1, max_entries)
+        self._ttl = ttl_seconds
+        self._disk_path = Path(disk_path) if disk_path else None
+        self._disk_max_bytes = disk_max_bytes
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        # {key: {"text": str, "created_at": float, "endpoint": str}}
+        self._memory: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        # 磁盘索引 {key: size_bytes}，按访问时间排序（首次使用时扫描目录构建）
+        self._disk_index: Optional["OrderedDict[str, int]"] = None
+        self._disk_bytes = 0
+        # 磁盘写回队列 {key: 条目 | _TOMBSTONE}，按入队顺序由后台线程处理
+        self._pending: "OrderedDict[str, Any]" = OrderedDict()
+        self._inflight: Optional[Tuple[str, Any]] = None  # 后台线程正在处理的 (key, 条目 | _TOMBSTONE)
+        self._writer: Optional[threading.Thread] = None
+        self._disk_errors = 0
+
+        self._hits_memory = 0
+        self._hits_disk = 0
+        self._misses = 0
+        self._stores = 0
+        self._expired = 0
+        self._bytes_saved = 0
+
+    @staticmethod
+    def make_key(
+        endpoint: str,
+        provider: str,
+        model_name: str,
+        prompt: str,
+        base_url: Optional[str] = None,
+        image_data: Optional[bytes] = None,
+        params: Optional[Dict[str, Any]] = None,
+        credential: str = "",
+    ) -> str:
+        """
+        计算内容寻址的缓存键
+
+        Args:
+            credential: 调用凭据的摘要（不同凭据的输出互不共享），不要传入明文 API key
+
+        Returns:
+            SHA-256 十六进制摘要
+        """
+        digest = hashlib.sha256()
+        header = json.dumps(
+            {
+                "endpoint": endpoint,
+                "provider": (provider or "").lower(),
+                "model": model_name or "",
+                "base_url": (base_url or "").rstrip("/"),
+                "credential": credential or "",
+                "params": params or {},
+            },
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        digest.update(header.encode("utf-8"))
+        digest.update(b"\x00prompt\x00")
+        digest.update((prompt or "").encode("utf-8"))
+        if image_data:
+            digest.update(b"\x00image\x00")
+            digest.update(image_data)
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        读取缓存（内存层未命中时回落到磁盘层并回填内存）
+
+        Returns:
+            缓存的原始文本；未命中或已过期时返回 None
+        """
+        now = self._clock()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if self._is_expired(entry, now):
+                    self._memory.pop(key, None)
+                    self._expired += 1
+                else:
+                    self._memory.move_to_end(key)
+                    self._hits_memory += 1
+                    self._bytes_saved += len(entry["text"].encode("utf-8"))
+                    return entry["text"]
+            pending = self._queued_locked(key)
+            if isinstance(pending, dict) and not self._is_expired(pending, now):
+                # 已被挤出内存层、尚未落盘的条目
+                self._hits_disk += 1
+                self._bytes_saved += len(pending["text"].encode("utf-8"))
+                self._remember_locked(key, pending)
+                return pending["text"]
+            if pending is _TOMBSTONE:
+                self._misses += 1
+                return None
+
+        entry = self._read_disk(key, now)
+        with self._lock:
+            if entry is None:
+                self._misses += 1
+                return None
+            self._hits_disk += 1
+            self._bytes_saved += len(entry["text"].encode("utf-8"))
+            self._remember_locked(key, entry)
+            return entry["text"]
+
+    def put(self, key: str, text: str, endpoint: str = ""):
+        """写入缓存（空文本不缓存；磁盘层由后台线程异步写入）"""
+        if not text:
+            return
+        entry = {"text": text, "created_at": self._clock(), "endpoint": endpoint}
+        with self._cond:
+            self._remember_locked(key, entry)
+            self._stores += 1
+            if self._disk_enabled():
+                self._enqueue_locked(key, entry)
+
+    def invalidate(self, key: str) -> bool:
+        """
+        删除单个条目（内存层与磁盘层）
+
+        Returns:
+            条目是否存在
+        """
+        with self._cond:
+            removed = self._memory.pop(key, None) is not None
+            if self._disk_path is None:
+                return removed
+            if isinstance(self._queued_locked(key), dict):
+                removed = True
+            if self._disk_index is not None and key in self._disk_index:
+                # 先从索引摘除（之后的 get 不再读这个文件），文件由后台线程删除
+                self._disk_bytes -= self._disk_index.pop(key)
+                removed = True
+            # 无条件排队删除：可能有一次写入正在进行
+            self._enqueue_locked(key, _TOMBSTONE)
+        return removed
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        等待写回队列中的磁盘写入 / 删除全部完成（测试与应用关闭时调用）
+
+        Returns:
+            是否在超时前完成
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending and self._inflight is None, timeout)
+
+    def clear(self):
+        """清空内存层与磁盘层"""
+        self.flush()
+        with self._lock:
+            self._memory.clear()
+            keys = list(self._load_disk_index_locked().keys())
+            for key in keys:
+                self._remove_disk_locked(key)
+
+    def get_stats(self) -> dict:
+        """获取缓存统计信息（命中率、节省字节数等）"""
+        with self._lock:
+            hits = self._hits_memory + self._hits_disk
+            lookups = hits + self._misses
+            return {
+                "memory_entries": len(self._memory),
+                "max_entries": self._max_entries,
+                "disk_entries": len(self._disk_index) if self._disk_index is not None else None,
+                "disk_bytes": self._disk_bytes,
+                "disk_max_bytes": self._disk_max_bytes,
+                "ttl_seconds": self._ttl,
+                "hits": hits,
+                "hits_memory": self._hits_memory,
+                "hits_disk": self._hits_disk,
+                "misses": self._misses,
+                "stores": self._stores,
+                "expired": self._expired,
+                "disk_pending": len(self._pending) + (1 if self._inflight is not None else 0),
+                "disk_errors": self._disk_errors,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "bytes_saved": self._bytes_saved,
+            }
+
+    # ==================== 私有方法 ====================
+
+    def _disk_enabled(self) -> bool:
+        return self._disk_path is not None and self._disk_max_bytes > 0
+
+    def _enqueue_locked(self, key: str, value: Any):
+        self._pending[key] = value
+        self._pending.move_to_end(key)
+        if self._writer is None or not self._writer.is_alive():
+            self._writer = threading.Thread(target=self._run_writer, name="llm-cache-writer", daemon=True)
+            self._writer.start()
+        self._cond.notify_all()
+
+    def _queued_locked(self, key: str) -> Any:
+        """写回队列中该键最新的待处理值（含正在处理的那一项），没有时返回 None"""
+        if key in self._pending:
+            return self._pending[key]
+        if self._inflight is not None and self._inflight[0] == key:
+            return self._inflight[1]
+        return None
+
+    def _run_writer(self):
+        while True:
+            with self._cond:
+                if not self._pending:
+                    # 队列清空后线程退出，下次入队时重新启动
+                    self._writer = None
+                    self._cond.notify_all()
+                    return
+                key, value = self._pending.popitem(last=False)
+                self._inflight = (key, value)
+
+            try:
+                if value is _TOMBSTONE:
+                    with self._lock:
+                        self._remove_disk_locked(key)
+                else:
+                    self._write_disk(key, value)
+            except Exception as e:
+                with self._lock:
+                    self._disk_errors += 1
+                logger.warning(f"LLM cache disk update failed for {key[:12]}: {e}")
+            finally:
+                with self._cond:
+                    self._inflight = None
+                    self._cond.notify_all()
+
+    def _is_expired(self, entry: Dict[str, Any], now: float) -> bool:
+        return self._ttl > 0 and now - entry.get("created_at", 0) > self._ttl
+
+    def _remember_locked(self, key: str, entry: Dict[str, Any]):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._max_entries:
+            self._memory.popitem(last=False)
+
+    def _disk_file(self, key: str) -> Path:
+        return self._disk_path / key[:2] / f"{key}.json"
+
+    def _load_disk_index_locked(self) -> "OrderedDict[str, int]":
+        if self._disk_index is not None:
+            return self._disk_index
+
+        index: "OrderedDict[str, int]" = OrderedDict()
+        total = 0
+        if self._disk_path is not None and self._disk_path.exists():
+            files = []
+            for file in self._disk_path.glob("*/*.json"):
+                try:
+                    stat = file.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, file.stem, stat.st_size))
+            for _, key, size in sorted(files):
+                index[key] = size
+                total += size
+        self._disk_index = index
+        self._disk_bytes = total
+        return index
+
+    def _read_disk(self, key: str, now: float) -> Optional[Dict[str, Any]]:
+        if self._disk_path is None:
+            return None
+        with self._lock:
+            index = self._load_disk_index_locked()
+            if key not in index:
+                return None
+            file = self._disk_file(key)
+        try:
+            with open(file, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.debug(f"LLM cache disk read failed for {key[:12]}: {e}")
+            with self._lock:
+                self._remove_disk_locked(key)
+            return None
+
+        with self._lock:
+            if self._is_expired(entry, now) or not entry.get("text"):
+                self._expired += 1
+                self._remove_disk_locked(key)
+                return None
+            if key in index:
+                index.move_to_end(key)
+        return entry
+
+    def _write_disk(self, key: str, entry: Dict[str, Any]):
+        if self._disk_path is None or self._disk_max_bytes <= 0:
+            return
+        data = json.dumps(entry, ensure_ascii=False).encode("utf-8")
+        if len(data) > self._disk_max_bytes:
+            return
+
+        file = self._disk_file(key)
+        tmp_file = file.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            file.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp_file, "wb") as f:
+                f.write(data)
+            # 原子替换，避免并发读到半个文件
+            os.replace(tmp_file, file)
+        except OSError as e:
+            logger.warning(f"LLM cache disk write failed for {key[:12]}: {e}")
+            with self._lock:
+                self._disk_errors += 1
+            try:
+                tmp_file.unlink()
+            except OSError:
+                pass
+            return
+
+        with self._lock:
+            index = self._load_disk_index_locked()
+            self._disk_bytes -= index.pop(key, 0)
+            index[key] = len(data)
+            self._disk_bytes += len(data)
+            while self._disk_bytes > self._disk_max_bytes and index:
+                oldest = next(iter(index))
+                self._remove_disk_locked(oldest)
+
+    def _remove_disk_locked(self, key: str):
+        index = self._load_disk_index_locked()
+        self._disk_bytes -= index.pop(key, 0)
+        try:
+            self._disk_file(key).unlink()
+        except OSError:
+            pass
+
+
+# ==================== 全局实例 ====================
+
+_cache: Optional[LLMResponseCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> LLMResponseCache:
+    """
+    获取全局 LLM 响应缓存（单例模式）
+
+    Returns:
+        LLMResponseCache 实例
+    """
+    global _cache
+
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = LLMResponseCache(
+                    max_entries=settings.LLM_CACHE_MEMORY_ENTRIES,
+                    ttl_seconds=settings.LLM_CACHE_TTL_SECONDS,
+                    disk_path=settings.LLM_CACHE_DISK_PATH or None,
+                    disk_max_bytes=settings.LLM_CACHE_DISK_MAX_BYTES,
+                )
+
+    return _cache
+
+
+def reset_response_cache():
+    """重置全局 LLM 响应缓存（主要用于测试）"""
+    global _cache
+    if _cache is not None:
+        _cache.flush(timeout=5.0)
+    _cache = None
+
+
+def is_cache_enabled(endpoint: str) -> bool:
+    """检查某个入口是否启用缓存（全局开关 + 按入口关闭）"""
+    return settings.LLM_CACHE_ENABLED and endpoint not in settings.LLM_CACHE_DISABLED_ENDPOINTS
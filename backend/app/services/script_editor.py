@@ -6,13 +6,13 @@ Author: Claude Code
 Date: 2026-01-22
 """
 
-import json
 import uuid
 from pathlib import Path
 from datetime import datetime
 from typing import Optional, List, Literal
 from difflib import SequenceMatcher
 
+from app.core.serialization import read_json_file, write_json_file
 from app.models.schemas import (
     ScriptContent,
     ScriptMetadata,
@@ -67,7 +67,7 @@ class ScriptEditorService:
         current_version = 0
         created_at = None
         if draft_file.exists():
-            existing_data = json.loads(draft_file.read_text(encoding='utf-8'))
+            existing_data = read_json_file(draft_file)
             current_version = existing_data.get("version", 0)
             created_at = existing_data.get("metadata", {}).get("created_at")
 
@@ -93,10 +93,7 @@ class ScriptEditorService:
         }
 
         # 写入文件
-        draft_file.write_text(
-            json.dumps(draft_data, ensure_ascii=False, indent=2),
-            encoding='utf-8'
-        )
+        write_json_file(draft_file, draft_data)
 
         return SaveDraftResponse(
             script_id=script_id,
@@ -121,7 +118,7 @@ class ScriptEditorService:
             return None
 
         try:
-            draft_data = json.loads(draft_file.read_text(encoding='utf-8'))
+            draft_data = read_json_file(draft_file)
             return ScriptDraft.parse_obj(draft_data)
         except Exception as e:
             print(f"Error loading draft {script_id}: {e}")
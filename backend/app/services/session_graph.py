@@ -0,0 +1,96 @@
+"""
+会话画布模型缓存 (Session Graph Cache)
+
+会话管理器以 model_dump 字典保存画布；增量生成、会话读取接口每次都要 [Node(**n) for n in nodes]
+重新校验整张画布，保存时又对每个节点 model_dump 一次。大画布下这一来一回占据了主要 CPU。
+
+设计：
+- SessionGraph 是一个会话版本的画布：已校验的 Node / Edge 模型与对应的字典，两组列表一一对应
+- 新版本按元素对象身份复用上一版本：
+  * from_models()：保存时只对上一版本中没有的模型 model_dump（未修改的节点仍是同一个对象）
+  * from_dicts()：读取时只校验上一版本中没有的字典（CanvasPatch 只替换被改动的元素）
+  因此一次编辑只重新校验 / 序列化被改动的元素
+- 缓存的模型在多个请求之间共享，约定为只读：调用方需要修改时先 model_copy 再改（写时复制），
+  不能原地修改字段，否则缓存中的字典与模型不再一致
+"""
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from pydantic import TypeAdapter
+
+from app.models.schemas import Edge, Node
+
+_NODE_LIST = TypeAdapter(List[Node])
+_EDGE_LIST = TypeAdapter(List[Edge])
+
+
+class SessionGraph:
+    """一个会话版本的画布（只读模型 + 对应的 model_dump 字典）"""
+
+    __slots__ = ("nodes", "edges", "node_dicts", "edge_dicts", "rebuilt")
+
+    def __init__(
+        self,
+        nodes: List[Node],
+        edges: List[Edge],
+        node_dicts: List[Dict[str, Any]],
+        edge_dicts: List[Dict[str, Any]],
+        rebuilt: int = 0
+    ):
+        self.nodes = nodes
+        self.edges = edges
+        self.node_dicts = node_dicts
+        self.edge_dicts = edge_dicts
+        self.rebuilt = rebuilt  # 构建时重新校验 / 序列化的元素数（其余复用上一版本）
+
+    @classmethod
+    def from_models(cls, nodes: Sequence[Node], edges: Sequence[Edge],
+                    previous: Optional["SessionGraph"] = None) -> "SessionGraph":
+        """由模型构建（保存路径）：只对上一版本中没有的模型 model_dump"""
+        node_dicts, node_rebuilt = _dump(nodes, previous.nodes if previous else (), previous.node_dicts if previous else ())
+        edge_dicts, edge_rebuilt = _dump(edges, previous.edges if previous else (), previous.edge_dicts if previous else ())
+        return cls(list(nodes), list(edges), node_dicts, edge_dicts, node_rebuilt + edge_rebuilt)
+
+    @classmethod
+    def from_dicts(cls, node_dicts: List[Dict[str, Any]], edge_dicts: List[Dict[str, Any]],
+                   previous: Optional["SessionGraph"] = None) -> "SessionGraph":
+        """由字典构建（读取路径）：只校验上一版本中没有的字典"""
+        nodes, node_rebuilt = _hydrate(
+            node_dicts, previous.node_dicts if previous else (), previous.nodes if previous else (), _NODE_LIST
+        )
+        edges, edge_rebuilt = _hydrate(
+            edge_dicts, previous.edge_dicts if previous else (), previous.edges if previous else (), _EDGE_LIST
+        )
+        return cls(nodes, edges, node_dicts, edge_dicts, node_rebuilt + edge_rebuilt)
+
+    def matches(self, node_dicts: List[Dict[str, Any]], edge_dicts: List[Dict[str, Any]]) -> bool:
+        """是否为这组字典构建（会话版本未变）"""
+        return self.node_dicts is node_dicts and self.edge_dicts is edge_dicts
+
+
+# ==================== 私有方法 ====================
+
+def _dump(models: Sequence[Any], previous_models: Sequence[Any],
+          previous_dicts: Sequence[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], int]:
+    known = {id(model): data for model, data in zip(previous_models, previous_dicts)}
+    dicts = []
+    rebuilt = 0
+    for model in models:
+        data = known.get(id(model))
+        if data is None:
+            data = model.model_dump()
+            rebuilt += 1
+        dicts.append(data)
+    return dicts, rebuilt
+
+
+def _hydrate(dicts: List[Dict[str, Any]], previous_dicts: Sequence[Dict[str, Any]],
+             previous_models: Sequence[Any], adapter: TypeAdapter) -> Tuple[List[Any], int]:
+    known = {id(data): model for data, model in zip(previous_dicts, previous_models)}
+    models = [known.get(id(data)) for data in dicts]
+    missing = [position for position, model in enumerate(models) if model is None]
+    if missing:
+        # 缺失的元素一次批量校验（TypeAdapter 比逐个 Node(**n) 快）
+        for position, model in zip(missing, adapter.validate_python([dicts[position] for position in missing])):
+            models[position] = model
+    return models, len(missing)
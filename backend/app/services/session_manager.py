@@ -2,29 +2,90 @@
 画布会话管理器 (Canvas Session Manager)
 
 提供内存存储 + 可选文件持久化的会话管理功能，用于增量生成流程图时保存画布状态。
+
+设计：
+- 文件持久化默认走 SessionWriteBehind：保存只标记脏会话，后台线程合并后原子落盘，
+  不在请求线程中序列化 / 写文件；关闭时 close() 刷盘
+- 大小检查按抽样估算编码后的字节数，大画布不再为检查完整序列化一次
+- 内存层是按会话数与字节数双重限制的 LRU（OrderedDict），超出时淘汰最久未访问的会话到文件层；
+  访问文件层的会话时透明恢复到内存
+- 每次访问都会刷新 timestamp 并移到 LRU 尾部，因此 LRU 顺序即过期顺序：
+  cleanup_expired() 只从头部取过期会话，遇到第一个未过期的即停止，不扫描全部会话
+- run_session_sweeper() 由应用 lifespan 启动，定期分批清理过期会话
+- 持久层可插拔（SessionStore）：默认每会话一个 JSON 文件；多 worker 部署使用 SQLite WAL 共享存储，
+  此时内存层只是读穿缓存：访问时按存储中的版本号校验，发现其他 worker 写入了更新版本就重新加载；
+  存储拒绝的写入（其他 worker 已先写入同一版本）经回调记录，下次访问时丢弃内存副本并重新加载；
+  内存中过期的会话只移出内存，存储中的过期会话由存储按最后访问时间分批清理——
+  读取会话时按 TTL 的 1/10 节流更新存储中的访问时间，只读不写的会话不会被其他 worker 清理
+- patch_session() 按版本号做乐观并发：在缓存的 CanvasIndex 上应用编辑操作，
+  校验与大小计算只涉及被改动的元素，版本号 +1；基准版本不一致时抛出 SessionVersionConflict。
+  共享存储时内存中的版本号不足以判断冲突：补丁结果在应答前通过 compare_and_save 同步写入
+  （以补丁前的版本为条件），其他 worker 已写入新版本时丢弃内存副本并抛出 SessionVersionConflict；
+  已同步写入的版本不再交给写回队列；create_or_update_session() 传入 expected_version 时
+  （保存基于某个版本生成的结果）走同样的校验与同步写入
+- get_session_graph() 返回缓存的已校验 Node / Edge 模型（SessionGraph），不在每次读取时重新校验；
+  保存 / 补丁按对象身份复用上一版本的模型与字典，只重新校验 / 序列化被改动的元素
+- 会话数 / 节点数 / 边数 / 字节数 / 时间戳总和维护为运行计数，get_session_stats() 为 O(1)
 """
 
-import json
-import os
+import asyncio
 import logging
+import threading
 import uuid
-from typing import Dict, List, Optional
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime, timedelta
-from pathlib import Path
 
+from app.core.config import settings
+from app.core.serialization import json_size
 from app.models.schemas import Node, Edge
+from app.services.canvas_patch import CanvasIndex, CanvasPatch
+from app.services.session_graph import SessionGraph
+from app.services.session_persister import SessionWriteBehind
+from app.services.session_snapshot import available_compressions, migrate_json_sessions
+from app.services.session_store import FileSessionStore, SessionStore, create_session_store
 
 logger = logging.getLogger(__name__)
 
+# 文件存储的会话目录
+SESSION_PERSIST_PATH = "data/canvas_sessions"
+
+# 会话大小上限
+MAX_SESSION_BYTES = 5 * 1024 * 1024  # 5MB
+
+# 大小估算时首尾各抽样的节点 / 边数量（不超过 2 倍时精确计算）
+_SIZE_SAMPLE = 32
+
+# 读取会话时更新存储访问时间的最小间隔（占 TTL 的比例）
+_TOUCH_INTERVAL_RATIO = 0.1
+
+
+class SessionVersionConflict(Exception):
+    """补丁的基准版本与会话当前版本不一致（其他客户端已写入新版本）"""
+
+    def __init__(self, session_id: str, expected_version: int, current_version: int):
+        super().__init__(
+            f"Session {session_id} is at version {current_version}, patch is based on version {expected_version}"
+        )
+        self.session_id = session_id
+        self.expected_version = expected_version
+        self.current_version = current_version
+
 
 class CanvasSessionManager:
-    """画布会话管理器（内存存储 + 文件持久化）"""
+    """画布会话管理器（内存 LRU + 文件持久化）"""
 
     def __init__(
         self,
         ttl_minutes: int = 60,
         persist_path: str = "data/canvas_sessions",
-        enable_persistence: bool = True
+        enable_persistence: bool = True,
+        write_behind: bool = True,
+        flush_interval_seconds: float = 0.5,
+        max_dirty: int = 256,
+        max_sessions: int = 1000,
+        max_bytes: int = 256 * 1024 * 1024,
+        store: Optional[SessionStore] = None
     ):
         """
         初始化会话管理器
@@ -33,33 +94,84 @@ class CanvasSessionManager:
             ttl_minutes: 会话过期时间（分钟），默认 60 分钟
             persist_path: 持久化文件存储路径，默认 "data/canvas_sessions"
             enable_persistence: 是否启用文件持久化，默认 True
+            write_behind: 是否后台合并写盘（False 时每次保存同步写盘）
+            flush_interval_seconds: 后台写盘的合并窗口（秒）
+            max_dirty: 待落盘会话数上限
+            max_sessions: 内存中保留的会话数上限
+            max_bytes: 内存中会话的估算总字节数上限
+            store: 持久层，默认为 persist_path 下的 JSON 文件存储（enable_persistence=False 时忽略）
         """
-        self._sessions: Dict[str, dict] = {}  # {session_id: {nodes, edges, timestamp, ...}}
+        # {session_id: {nodes, edges, timestamp, ...}}，按最近访问排序（尾部最新）
+        self._sessions: "OrderedDict[str, dict]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._indexes: Dict[str, CanvasIndex] = {}  # 打过补丁的会话的 id 索引（会话被替换 / 移出内存时失效）
+        self._graphs: Dict[str, SessionGraph] = {}  # 已校验的模型（版本变化后在下次读取时增量重建）
+        self._touched_at: Dict[str, datetime] = {}  # 最近一次写入存储访问时间的时刻
+        self._stored_versions: Dict[str, int] = {}  # 已同步写入共享存储的版本（写回时跳过）
+        self._lock = threading.RLock()
         self._ttl = timedelta(minutes=ttl_minutes)
-        self._persist_path = persist_path
+        self._touch_interval = self._ttl * _TOUCH_INTERVAL_RATIO
         self._enable_persistence = enable_persistence
+        self._store: Optional[SessionStore] = None
+        if enable_persistence:
+            self._store = store if store is not None else FileSessionStore(persist_path)
+        # 被存储拒绝的写入 {session_id: 版本号}；回调可能来自写盘线程，用独立的锁，下次访问时处理
+        self._stale_writes: Dict[str, int] = {}
+        self._stale_lock = threading.Lock()
+        if self._store is not None and self._store.shared:
+            self._store.set_stale_write_listener(self._on_stale_write)
+        self._max_sessions = max(max_sessions, 1)
+        self._max_bytes = max_bytes
+        self._persister: Optional[SessionWriteBehind] = None
+        if enable_persistence and write_behind:
+            self._persister = SessionWriteBehind(
+                self._store,
+                self._persisted_snapshot,
+                flush_interval_seconds=flush_interval_seconds,
+                max_dirty=max_dirty,
+            )
+
+        # 运行计数（get_session_stats 不遍历会话）
+        self._total_nodes = 0
+        self._total_edges = 0
+        self._total_bytes = 0
+        self._timestamp_total = 0.0
+        self._evictions = 0
+        self._expirations = 0
+        self._restores = 0
+        self._graph_hits = 0
+        self._graph_builds = 0
+        self._graph_rebuilt_elements = 0
 
         logger.info(
             f"CanvasSessionManager initialized: ttl={ttl_minutes}min, "
-            f"persistence={enable_persistence}, path={persist_path}"
+            f"persistence={enable_persistence}, store={self._store.name if self._store else None}, "
+            f"write_behind={self._persister is not None}, path={persist_path}, "
+            f"max_sessions={self._max_sessions}, max_bytes={max_bytes}"
         )
 
     def create_or_update_session(
         self,
         session_id: Optional[str],
         nodes: List[Node],
-        edges: List[Edge]
+        edges: List[Edge],
+        expected_version: Optional[int] = None
     ) -> str:
         """
         创建或更新会话
 
         Args:
             session_id: 会话 ID，如果为 None 则创建新会话
-            nodes: 节点列表
+            nodes: 节点列表（保存后作为缓存模型共享，调用方不应再原地修改）
             edges: 边列表
+            expected_version: 结果所基于的版本号（如生成前加载画布时的版本），None 表示不校验；
+                校验方式与 patch_session 相同（共享存储时通过 compare_and_save 同步写入）
 
         Returns:
             会话 ID（新创建或更新的）
+
+        Raises:
+            SessionVersionConflict: expected_version 与当前版本不一致
         """
         # 生成新会话 ID
         if not session_id:
@@ -68,35 +180,51 @@ class CanvasSessionManager:
         else:
             logger.info(f"Updating existing session: {session_id}")
 
-        # 构建会话数据
-        session_data = {
-            "nodes": [n.model_dump() for n in nodes],
-            "edges": [e.model_dump() for e in edges],
-            "timestamp": datetime.now(),
-            "node_count": len(nodes),
-            "edge_count": len(edges),
-            "created_at": self._sessions.get(session_id, {}).get("created_at", datetime.now())
-        }
+        # 上一版本中未改动的模型（同一对象）直接复用其字典，不重新 model_dump
+        graph = SessionGraph.from_models(nodes, edges, self._graphs.get(session_id))
+        node_dicts = graph.node_dicts
+        edge_dicts = graph.edge_dicts
 
         # 检查会话大小（防止超大画布）
-        session_size = len(json.dumps(session_data, default=str))
-        max_size = 5 * 1024 * 1024  # 5MB
-
-        if session_size > max_size:
-            logger.error(
-                f"Session too large: {session_size / 1024 / 1024:.1f}MB > 5MB "
-                f"(nodes={len(nodes)}, edges={len(edges)})"
-            )
-            raise ValueError(
-                f"Session too large ({session_size / 1024 / 1024:.1f}MB > 5MB). "
-                "Please clear canvas or reduce node count."
-            )
-
-        # 存储到内存
-        self._sessions[session_id] = session_data
-
-        # 持久化到文件（可选）
-        if self._enable_persistence:
+        session_size = self._estimate_session_size(node_dicts, edge_dicts)
+        self._check_session_size(session_size, len(nodes), len(edges))
+
+        with self._lock:
+            # 已淘汰到文件层（或由其他 worker 更新）的会话先恢复，保证版本号 / 创建时间连续
+            if session_id not in self._sessions:
+                self._restore_session(session_id)
+            else:
+                self._revalidate(session_id)
+
+            # 构建会话数据（每次更新版本号 +1，供增量响应 / 乐观并发校验使用）
+            previous = self._sessions.get(session_id, {})
+            current_version = previous.get("version", 0)
+            if expected_version is not None and expected_version != current_version:
+                raise SessionVersionConflict(session_id, expected_version, current_version)
+            session_data = {
+                "nodes": node_dicts,
+                "edges": edge_dicts,
+                "timestamp": datetime.now(),
+                "node_count": len(nodes),
+                "edge_count": len(edges),
+                "created_at": previous.get("created_at", datetime.now()),
+                "version": current_version + 1
+            }
+            committed = expected_version is not None and self._store is not None and self._store.shared
+            if committed:
+                self._commit_patch(session_id, session_data, current_version, expected_version)
+
+            # 存储到内存；先标记脏再淘汰，被淘汰的脏会话会把快照交给写回队列
+            self._insert(session_id, session_data, session_size)
+            self._graphs[session_id] = graph
+            if committed:
+                self._stored_versions[session_id] = session_data["version"]
+            elif self._persister is not None:
+                self._persister.mark_dirty(session_id)
+            self._enforce_limits()
+
+        # 持久化到文件（可选，默认已交给后台线程合并写盘）
+        if not committed and self._persister is None and self._enable_persistence:
             try:
                 self._persist_session(session_id)
             except Exception as e:
@@ -119,33 +247,34 @@ class CanvasSessionManager:
         Returns:
             会话数据字典，如果会话不存在或已过期则返回 None
         """
-        # 先从内存查找
-        if session_id not in self._sessions:
-            # 尝试从文件恢复
-            if self._enable_persistence:
-                try:
-                    self._load_session(session_id)
-                except Exception as e:
-                    logger.warning(f"Failed to load session {session_id} from file: {e}")
-
-        session = self._sessions.get(session_id)
-
-        # 会话不存在
-        if not session:
-            logger.warning(f"Session not found: {session_id}")
-            return None
-
-        # 检查是否过期
-        age = datetime.now() - session["timestamp"]
-        if age > self._ttl:
-            logger.warning(
-                f"Session expired: {session_id} (age={age.total_seconds() / 60:.1f}min > {self._ttl.total_seconds() / 60}min)"
-            )
-            self.delete_session(session_id)
-            return None
-
-        # 更新访问时间
-        session["timestamp"] = datetime.now()
+        with self._lock:
+            # 先从内存查找，未命中时尝试从文件层恢复
+            if session_id not in self._sessions:
+                self._restore_session(session_id)
+            else:
+                self._revalidate(session_id)
+
+            session = self._sessions.get(session_id)
+
+            # 会话不存在
+            if not session:
+                logger.warning(f"Session not found: {session_id}")
+                return None
+
+            # 检查是否过期
+            age = datetime.now() - session["timestamp"]
+            if age > self._ttl:
+                logger.warning(
+                    f"Session expired: {session_id} (age={age.total_seconds() / 60:.1f}min > {self._ttl.total_seconds() / 60}min)"
+                )
+                self._expirations += 1
+                self._expire(session_id)
+                return None
+
+            # 更新访问时间（移到 LRU 尾部）
+            self._touch(session_id, session)
+            self._touch_store(session_id, session["timestamp"])
+            self._enforce_limits()
 
         logger.info(
             f"Session retrieved: {session_id} ({session['node_count']} nodes, "
@@ -154,26 +283,150 @@ class CanvasSessionManager:
 
         return session
 
-    def delete_session(self, session_id: str) -> bool:
+    def get_session_graph(self, session_id: str) -> Optional[Tuple[dict, SessionGraph]]:
         """
-        删除会话
+        获取会话数据及其已校验的 Node / Edge 模型
+
+        模型按会话版本缓存：版本未变时直接返回；版本变化后只校验被改动的元素。
+        返回的模型在请求之间共享，调用方需要修改时先 model_copy。
 
         Args:
             session_id: 会话 ID
 
         Returns:
-            是否成功删除
+            (会话数据字典, SessionGraph)，会话不存在或已过期时返回 None
         """
-        # 从内存删除
-        existed = session_id in self._sessions
-        self._sessions.pop(session_id, None)
+        with self._lock:
+            session = self.get_session(session_id)
+            if session is None:
+                return None
+
+            graph = self._graphs.get(session_id)
+            if graph is not None and graph.matches(session["nodes"], session["edges"]):
+                self._graph_hits += 1
+                return session, graph
+
+            graph = SessionGraph.from_dicts(session["nodes"], session["edges"], previous=graph)
+            self._graphs[session_id] = graph
+            self._graph_builds += 1
+            self._graph_rebuilt_elements += graph.rebuilt
+
+        logger.debug(
+            f"Session graph built: {session_id} ({graph.rebuilt} of "
+            f"{len(graph.nodes) + len(graph.edges)} elements validated)"
+        )
+
+        return session, graph
+
+    def patch_session(
+        self,
+        session_id: str,
+        ops: List[dict],
+        expected_version: Optional[int]
+    ) -> Optional[dict]:
+        """
+        在会话上应用编辑操作（乐观并发）
+
+        Args:
+            session_id: 会话 ID
+            ops: 画布操作列表（格式见 app.services.canvas_patch）
+            expected_version: 客户端所基于的版本号，None 表示不校验
+
+        Returns:
+            更新后的会话数据，会话不存在或已过期时返回 None
 
-        # 删除持久化文件
-        if self._enable_persistence:
+        Raises:
+            SessionVersionConflict: expected_version 与当前版本不一致（共享存储时以存储中的版本为准）
+            GraphOpError: 操作无效（整个补丁不生效）
+            ValueError: 应用后会话超过大小上限
+        """
+        with self._lock:
+            session = self.get_session(session_id)
+            if session is None:
+                return None
+
+            current_version = session.get("version", 1)
+            if expected_version is not None and expected_version != current_version:
+                raise SessionVersionConflict(session_id, expected_version, current_version)
+
+            index = self._indexes.get(session_id)
+            if index is None:
+                index = CanvasIndex(session["nodes"], session["edges"])
+            patch = CanvasPatch(session["nodes"], session["edges"], index)
+            try:
+                patch.apply_all(ops)
+                session_size = self._sizes.get(session_id, 0) + patch.size_delta
+                self._check_session_size(session_size, len(patch.nodes), len(patch.edges))
+            except ValueError:
+                # GraphOpError / 超过大小上限：索引可能已部分更新，下次补丁重建
+                self._indexes.pop(session_id, None)
+                raise
+
+            session_data = {
+                "nodes": patch.nodes,
+                "edges": patch.edges,
+                "timestamp": datetime.now(),
+                "node_count": len(patch.nodes),
+                "edge_count": len(patch.edges),
+                "created_at": session["created_at"],
+                "version": current_version + 1
+            }
+            shared = self._store is not None and self._store.shared
+            if shared:
+                self._commit_patch(session_id, session_data, current_version, expected_version)
+
+            previous_graph = self._graphs.get(session_id)
+            self._insert(session_id, session_data, session_size)
+            self._indexes[session_id] = index
+            if previous_graph is not None:
+                # 保留上一版本的模型：下次读取时只校验补丁替换的元素
+                self._graphs[session_id] = previous_graph
+            if shared:
+                self._stored_versions[session_id] = session_data["version"]
+            elif self._persister is not None:
+                self._persister.mark_dirty(session_id)
+            self._enforce_limits()
+
+        if not shared and self._persister is None and self._enable_persistence:
             try:
-                self._delete_persisted_session(session_id)
+                self._persist_session(session_id)
             except Exception as e:
-                logger.warning(f"Failed to delete persisted session {session_id}: {e}")
+                logger.warning(f"Failed to persist session {session_id}: {e}")
+
+        logger.info(
+            f"Session patched: {session_id} v{current_version} -> v{current_version + 1} "
+            f"({len(ops)} ops, {len(patch.nodes)} nodes, {len(patch.edges)} edges)"
+        )
+
+        return session_data
+
+    def delete_session(self, session_id: str) -> bool:
+        """
+        删除会话（内存与文件层）
+
+        Args:
+            session_id: 会话 ID
+
+        Returns:
+            是否成功删除
+        """
+        with self._lock:
+            # 从内存删除；已淘汰到文件层的会话同样视为存在
+            existed = self._discard(session_id) is not None
+            if not existed and self._store is not None:
+                existed = (
+                    (self._persister is not None and self._persister.pending_snapshot(session_id) is not None)
+                    or self._store.exists(session_id)
+                )
+
+            # 删除持久化数据
+            if self._persister is not None:
+                self._persister.mark_deleted(session_id)
+            elif self._store is not None:
+                try:
+                    self._delete_persisted_session(session_id)
+                except Exception as e:
+                    logger.warning(f"Failed to delete persisted session {session_id}: {e}")
 
         if existed:
             logger.info(f"Session deleted: {session_id}")
@@ -182,47 +435,106 @@ class CanvasSessionManager:
 
         return existed
 
-    def cleanup_expired(self) -> int:
+    def cleanup_expired(self, max_batch: Optional[int] = None) -> int:
         """
-        清理所有过期会话（定期任务）
+        清理过期会话（由 run_session_sweeper 定期调用）
+
+        LRU 顺序即过期顺序：只从头部取过期会话，遇到第一个未过期的会话即停止。
+        存储后端支持时同时按索引清理存储中的过期会话（最后访问时间早于 TTL）。
+
+        Args:
+            max_batch: 本次内存 / 存储各自最多清理的会话数（None 表示不限）
 
         Returns:
-            清理的会话数量
+            清理的会话数量（内存 + 存储）
         """
-        now = datetime.now()
-        expired_ids = [
-            sid for sid, sess in self._sessions.items()
-            if now - sess["timestamp"] > self._ttl
-        ]
-
-        for sid in expired_ids:
-            self.delete_session(sid)
+        with self._lock:
+            cutoff = datetime.now() - self._ttl
+            expired_ids = []
+            for sid, sess in self._sessions.items():
+                if sess["timestamp"] >= cutoff or (max_batch is not None and len(expired_ids) >= max_batch):
+                    break
+                expired_ids.append(sid)
+
+            for sid in expired_ids:
+                self._expire(sid)
+            self._expirations += len(expired_ids)
+
+        store_expired = 0
+        if self._store is not None:
+            try:
+                store_expired = self._store.delete_expired(cutoff, max_batch if max_batch is not None else 1000)
+            except Exception as e:
+                logger.warning(f"Failed to expire sessions in {self._store.name} store: {e}")
 
         if expired_ids:
             logger.info(f"Cleaned up {len(expired_ids)} expired sessions: {expired_ids}")
+        if store_expired:
+            logger.info(f"Cleaned up {store_expired} expired sessions from {self._store.name} store")
+
+        return len(expired_ids) + store_expired
 
-        return len(expired_ids)
+    def get_session_version(self, session_id: str) -> Optional[int]:
+        """获取会话当前版本号（不刷新访问时间），会话不在内存中时返回 None"""
+        session = self._sessions.get(session_id)
+        return session.get("version", 1) if session else None
 
     def get_session_count(self) -> int:
-        """获取当前会话总数"""
+        """获取当前内存中的会话总数"""
         return len(self._sessions)
 
     def get_session_stats(self) -> dict:
-        """获取会话统计信息"""
-        now = datetime.now()
-        total = len(self._sessions)
-        total_nodes = sum(s["node_count"] for s in self._sessions.values())
-        total_edges = sum(s["edge_count"] for s in self._sessions.values())
-        avg_age_minutes = sum((now - s["timestamp"]).total_seconds() / 60 for s in self._sessions.values()) / max(total, 1)
-
-        return {
-            "total_sessions": total,
-            "total_nodes": total_nodes,
-            "total_edges": total_edges,
-            "avg_age_minutes": avg_age_minutes,
-            "ttl_minutes": self._ttl.total_seconds() / 60,
-            "persistence_enabled": self._enable_persistence
-        }
+        """获取会话统计信息（运行计数，O(1)）"""
+        with self._lock:
+            total = len(self._sessions)
+            avg_age_minutes = (
+                (datetime.now().timestamp() - self._timestamp_total / total) / 60 if total else 0.0
+            )
+
+            return {
+                "total_sessions": total,
+                "total_nodes": self._total_nodes,
+                "total_edges": self._total_edges,
+                "avg_age_minutes": avg_age_minutes,
+                "ttl_minutes": self._ttl.total_seconds() / 60,
+                "persistence_enabled": self._enable_persistence,
+                "total_bytes": self._total_bytes,
+                "max_sessions": self._max_sessions,
+                "max_bytes": self._max_bytes,
+                "evictions": self._evictions,
+                "expirations": self._expirations,
+                "restores": self._restores,
+                "graph_cache_hits": self._graph_hits,
+                "graph_cache_builds": self._graph_builds,
+                "graph_rebuilt_elements": self._graph_rebuilt_elements
+            }
+
+    def get_persistence_stats(self) -> dict:
+        """获取后台写盘统计（队列深度、刷盘耗时等），未启用时只返回开关状态"""
+        store_stats = self._store.get_stats() if self._store is not None else None
+        if self._persister is None:
+            return {"write_behind": False, "persistence_enabled": self._enable_persistence, "store": store_stats}
+        return {"write_behind": True, **self._persister.get_stats(), "store": store_stats}
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        等待所有待落盘会话写入文件
+
+        Returns:
+            是否在超时前完成（未启用后台写盘时总是 True）
+        """
+        if self._persister is None:
+            return True
+        return self._persister.flush(timeout)
+
+    def close(self, timeout: Optional[float] = 5.0):
+        """刷盘、停止后台写盘线程并释放存储连接（应用关闭时调用）"""
+        if self._persister is not None:
+            self._persister.close(timeout)
+            # 关闭后的保存退回同步写盘
+            self._persister = None
+        if self._store is not None:
+            self._store.close()
 
     # ==================== 私有方法 ====================
 
@@ -230,57 +542,225 @@ class CanvasSessionManager:
         """生成唯一的会话 ID"""
         return f"canvas-{uuid.uuid4().hex[:16]}"
 
-    def _persist_session(self, session_id: str):
-        """持久化会话到文件"""
-        if not self._enable_persistence:
+    def _insert(self, session_id: str, session_data: dict, size: int):
+        """放入内存（替换同 id 的旧会话）并更新运行计数"""
+        self._discard(session_id)
+        self._sessions[session_id] = session_data
+        self._sizes[session_id] = size
+        self._total_nodes += session_data["node_count"]
+        self._total_edges += session_data["edge_count"]
+        self._total_bytes += size
+        self._timestamp_total += session_data["timestamp"].timestamp()
+
+    def _discard(self, session_id: str) -> Optional[dict]:
+        """从内存移除并更新运行计数，返回被移除的会话"""
+        session = self._sessions.pop(session_id, None)
+        if session is None:
+            return None
+        self._total_nodes -= session["node_count"]
+        self._total_edges -= session["edge_count"]
+        self._total_bytes -= self._sizes.pop(session_id, 0)
+        self._timestamp_total -= session["timestamp"].timestamp()
+        self._indexes.pop(session_id, None)
+        self._graphs.pop(session_id, None)
+        self._touched_at.pop(session_id, None)
+        self._stored_versions.pop(session_id, None)
+        return session
+
+    def _touch(self, session_id: str, session: dict):
+        """刷新访问时间并移到 LRU 尾部"""
+        now = datetime.now()
+        self._timestamp_total += now.timestamp() - session["timestamp"].timestamp()
+        session["timestamp"] = now
+        self._sessions.move_to_end(session_id)
+
+    def _commit_patch(self, session_id: str, session_data: dict, base_version: int,
+                      expected_version: Optional[int]):
+        """共享存储：以补丁前的版本为条件同步写入，其他 worker 已写入新版本时抛出 SessionVersionConflict"""
+        snapshot = self._snapshot_of(session_data)
+        if self._store.compare_and_save(session_id, snapshot, base_version):
+            logger.debug(f"Session patch committed to {self._store.name} store: {session_id} v{session_data['version']}")
+            return
+        try:
+            stored_version = self._store.get_version(session_id)
+        except Exception as e:
+            logger.warning(f"Failed to check stored version of session {session_id}: {e}")
+            stored_version = None
+        # 内存副本已落后于存储，下次访问时重新加载
+        self._discard(session_id)
+        raise SessionVersionConflict(
+            session_id,
+            expected_version if expected_version is not None else base_version,
+            stored_version if stored_version is not None else base_version,
+        )
+
+    def _touch_store(self, session_id: str, now: datetime):
+        """共享存储：节流更新存储中的最后访问时间（存储按该时间清理过期会话）"""
+        if self._store is None or not self._store.shared:
+            return
+        touched_at = self._touched_at.get(session_id)
+        if touched_at is not None and now - touched_at < self._touch_interval:
+            return
+        try:
+            self._store.touch(session_id, now)
+        except Exception as e:
+            logger.warning(f"Failed to record access time of session {session_id}: {e}")
+            return
+        self._touched_at[session_id] = now
+
+    def _on_stale_write(self, session_id: str, version: int):
+        """存储拒绝了某个版本的写入（可能在写盘线程中调用，不获取会话锁）"""
+        with self._stale_lock:
+            self._stale_writes[session_id] = max(version, self._stale_writes.get(session_id, 0))
+
+    def _enforce_limits(self):
+        """超出会话数 / 字节数上限时从 LRU 头部淘汰（至少保留最近访问的一个会话）"""
+        while len(self._sessions) > 1 and (
+            len(self._sessions) > self._max_sessions or self._total_bytes > self._max_bytes
+        ):
+            self._evict(next(iter(self._sessions)))
+
+    def _evict(self, session_id: str):
+        """淘汰到文件层：尚未落盘的会话把快照交给写回队列，未启用持久化时直接丢弃"""
+        if self._store is None:
+            logger.warning(f"Session evicted without persistence (data dropped): {session_id}")
+        self._drop_from_memory(session_id)
+        self._evictions += 1
+        logger.debug(f"Session evicted from memory: {session_id}")
+
+    def _expire(self, session_id: str):
+        """过期：共享存储中的会话可能已被其他 worker 更新，只移出内存（由存储按 TTL 清理）"""
+        if self._store is not None and self._store.shared:
+            self._drop_from_memory(session_id)
+        else:
+            self.delete_session(session_id)
+
+    def _drop_from_memory(self, session_id: str):
+        if self._persister is not None:
+            snapshot = self._persisted_snapshot(session_id)
+            if snapshot is not None:
+                self._persister.mark_evicted(session_id, snapshot)
+        self._discard(session_id)
+
+    def _revalidate(self, session_id: str):
+        """
+        共享存储：其他 worker 写入了更高版本，或本 worker 的同版本写入被存储拒绝时，
+        丢弃内存副本并重新加载
+        """
+        if self._store is None or not self._store.shared:
+            return
+        with self._stale_lock:
+            rejected_version = self._stale_writes.pop(session_id, None)
+        try:
+            stored_version = self._store.get_version(session_id)
+        except Exception as e:
+            logger.warning(f"Failed to check stored version of session {session_id}: {e}")
+            return
+        version = self._sessions[session_id].get("version", 1)
+        if stored_version is None:
+            return
+        if stored_version > version or (rejected_version is not None and rejected_version >= version):
+            logger.info(f"Session {session_id} updated by another worker (v{stored_version}), reloading")
+            self._discard(session_id)
+            self._restore_session(session_id)
+
+    def _restore_session(self, session_id: str):
+        """从持久层恢复会话到内存（已删除但尚未从存储移除的会话不恢复）"""
+        if self._store is None:
+            return
+        if self._persister is not None and self._persister.is_pending_delete(session_id):
             return
+        try:
+            self._load_session(session_id)
+        except Exception as e:
+            logger.warning(f"Failed to load session {session_id} from file: {e}")
+
+    def _check_session_size(self, session_size: int, node_count: int, edge_count: int):
+        """超过会话大小上限时抛出 ValueError"""
+        if session_size > MAX_SESSION_BYTES:
+            logger.error(
+                f"Session too large: {session_size / 1024 / 1024:.1f}MB > 5MB "
+                f"(nodes={node_count}, edges={edge_count})"
+            )
+            raise ValueError(
+                f"Session too large ({session_size / 1024 / 1024:.1f}MB > 5MB). "
+                "Please clear canvas or reduce node count."
+            )
+
+    def _estimate_session_size(self, node_dicts: List[dict], edge_dicts: List[dict]) -> int:
+        """
+        估算会话编码后的字节数
 
-        # 确保目录存在
-        Path(self._persist_path).mkdir(parents=True, exist_ok=True)
+        节点 / 边数量不超过 2 * _SIZE_SAMPLE 时精确计算；否则只编码首尾各 _SIZE_SAMPLE 个，
+        按平均大小外推（画布元素大小相近，误差远小于 5MB 上限的判断粒度）。
+        """
+        def estimate(items: List[dict]) -> int:
+            if len(items) <= 2 * _SIZE_SAMPLE:
+                return json_size(items)
+            sample = items[:_SIZE_SAMPLE] + items[-_SIZE_SAMPLE:]
+            return json_size(sample) * len(items) // len(sample)
+
+        return estimate(node_dicts) + estimate(edge_dicts)
+
+    def _persisted_snapshot(self, session_id: str) -> Optional[dict]:
+        """
+        会话的可持久化快照（datetime 转为字符串）
 
-        session_file = os.path.join(self._persist_path, f"{session_id}.json")
-        session_data = self._sessions[session_id].copy()
+        会话已不在内存中，或当前版本已由补丁同步写入共享存储时返回 None
+        """
+        session = self._sessions.get(session_id)
+        if session is None or self._stored_versions.get(session_id) == session.get("version"):
+            return None
+        return self._snapshot_of(session)
 
-        # 将 datetime 转换为字符串
+    @staticmethod
+    def _snapshot_of(session: dict) -> dict:
+        session_data = session.copy()
         session_data["timestamp"] = session_data["timestamp"].isoformat()
         session_data["created_at"] = session_data["created_at"].isoformat()
+        return session_data
 
-        with open(session_file, "w", encoding="utf-8") as f:
-            json.dump(session_data, f, ensure_ascii=False, indent=2)
-
-        logger.debug(f"Session persisted to file: {session_file}")
+    def _persist_session(self, session_id: str):
+        """同步持久化会话（未启用后台写盘时使用）"""
+        if self._store is None:
+            return
 
-    def _load_session(self, session_id: str):
-        """从文件加载会话"""
-        if not self._enable_persistence:
+        session_data = self._persisted_snapshot(session_id)
+        if session_data is None:
             return
 
-        session_file = os.path.join(self._persist_path, f"{session_id}.json")
+        self._store.save(session_id, session_data)
 
-        if not os.path.exists(session_file):
+        logger.debug(f"Session persisted to {self._store.name} store: {session_id}")
+
+    def _load_session(self, session_id: str):
+        """从持久层加载会话（优先使用写回队列中尚未落盘的快照）"""
+        if self._store is None:
             return
 
-        with open(session_file, "r", encoding="utf-8") as f:
-            session_data = json.load(f)
+        pending = self._persister.pending_snapshot(session_id) if self._persister is not None else None
+        session_data = dict(pending) if pending is not None else self._store.load(session_id)
+        if session_data is None:
+            return
 
         # 将字符串转换回 datetime
         session_data["timestamp"] = datetime.fromisoformat(session_data["timestamp"])
         session_data["created_at"] = datetime.fromisoformat(session_data["created_at"])
+        session_data.setdefault("version", 1)
 
-        self._sessions[session_id] = session_data
+        size = self._estimate_session_size(session_data["nodes"], session_data["edges"])
+        self._insert(session_id, session_data, size)
+        self._restores += 1
 
-        logger.debug(f"Session loaded from file: {session_file}")
+        logger.debug(f"Session loaded from {self._store.name} store: {session_id}")
 
     def _delete_persisted_session(self, session_id: str):
-        """删除持久化文件"""
-        if not self._enable_persistence:
+        """删除持久化数据"""
+        if self._store is None:
             return
 
-        session_file = os.path.join(self._persist_path, f"{session_id}.json")
-
-        if os.path.exists(session_file):
-            os.remove(session_file)
-            logger.debug(f"Persisted session file deleted: {session_file}")
+        if self._store.delete(session_id):
+            logger.debug(f"Persisted session deleted from {self._store.name} store: {session_id}")
 
 
 # ==================== 全局实例 ====================
@@ -300,14 +780,67 @@ def get_session_manager() -> CanvasSessionManager:
     if _session_manager is None:
         _session_manager = CanvasSessionManager(
             ttl_minutes=60,  # 1 小时过期
-            persist_path="data/canvas_sessions",
-            enable_persistence=True  # 启用文件持久化
+            persist_path=SESSION_PERSIST_PATH,
+            enable_persistence=True,  # 启用文件持久化
+            write_behind=settings.SESSION_WRITE_BEHIND_ENABLED,
+            flush_interval_seconds=settings.SESSION_PERSIST_FLUSH_INTERVAL_SECONDS,
+            max_dirty=settings.SESSION_PERSIST_MAX_DIRTY,
+            max_sessions=settings.SESSION_CACHE_MAX_SESSIONS,
+            max_bytes=settings.SESSION_CACHE_MAX_BYTES,
+            store=create_session_store(
+                settings.SESSION_STORE_BACKEND,
+                persist_path=SESSION_PERSIST_PATH,
+                sqlite_path=settings.SESSION_SQLITE_PATH,
+                snapshot_format=settings.SESSION_SNAPSHOT_FORMAT,
+                compression=settings.SESSION_SNAPSHOT_COMPRESSION
+            )
         )
 
     return _session_manager
 
 
+async def run_session_sweeper(interval_seconds: float, batch_size: int = 200):
+    """
+    定期清理过期会话（由应用 lifespan 启动，取消任务即停止）
+
+    每轮最多清理 batch_size 个；一批清满说明还有积压，让出事件循环后立即继续下一批。
+    """
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            while get_session_manager().cleanup_expired(max_batch=batch_size) >= batch_size:
+                await asyncio.sleep(0)
+        except Exception as e:
+            logger.warning(f"Session sweep failed: {e}")
+
+
+def migrate_session_snapshots(persist_path: str = SESSION_PERSIST_PATH) -> Optional[Dict[str, int]]:
+    """
+    把文件存储中的旧 JSON 会话批量转换为二进制快照（由应用 lifespan 在开始服务前调用）
+
+    只在文件存储 + binary 快照格式下执行；迁移与请求并发时可能用旧内容覆盖新保存的快照，
+    因此必须在处理请求之前完成。
+
+    Returns:
+        迁移统计（converted / skipped / failed），未执行时返回 None
+    """
+    if settings.SESSION_STORE_BACKEND != "file" or settings.SESSION_SNAPSHOT_FORMAT != "binary":
+        return None
+    compression = settings.SESSION_SNAPSHOT_COMPRESSION
+    if compression not in available_compressions():
+        compression = "zlib"
+    return migrate_json_sessions(persist_path, compression)
+
+
+def shutdown_session_manager(timeout: Optional[float] = 5.0):
+    """应用关闭时刷盘并停止后台写盘线程（全局实例未创建时不做任何事）"""
+    if _session_manager is not None:
+        _session_manager.close(timeout)
+
+
 def reset_session_manager():
     """重置全局会话管理器（主要用于测试）"""
     global _session_manager
+    if _session_manager is not None:
+        _session_manager.close()
     _session_manager = None
@@ -0,0 +1,259 @@
+"""
+会话写回持久化 (Write-behind Session Persister)
+
+旧实现在 create_or_update_session 中同步写盘：每次保存都在请求所在的事件循环线程里
+把整个会话 indent=2 序列化并重写文件，画布频繁保存时阻塞事件循环。
+
+设计：
+- 后台线程写盘：调用方只把会话 id 标记为脏（O(1)），首次标记后等待 flush_interval 再统一刷盘
+- 合并：刷盘窗口内同一会话的多次更新只写一次；写入的是刷盘时刻的最新快照（通过 snapshot 回调获取）
+- 写入交给 SessionStore：一批快照一次 save_many（SQLite 为单个事务，文件存储为临时文件 + os.replace 原子写入）；
+  批量写入失败时逐个重试，单个会话的错误不影响其他会话
+- 脏集合有上限：达到 max_dirty 时立即触发刷盘，调用方等待集合回落（背压，内存有界）
+- 删除以墓碑形式排队，与写入在同一线程按顺序执行，避免延迟写入"复活"已删除的会话
+- 被移出内存的脏会话以快照形式排队（mark_evicted），落盘前可通过 pending_snapshot() 取回
+- flush() / close() 供测试与应用关闭时同步落盘；get_stats() 暴露队列深度与刷盘耗时
+"""
+
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.services.session_store import SessionStore
+
+logger = logging.getLogger(__name__)
+
+# 脏集合中表示"待删除"的墓碑
+_TOMBSTONE = object()
+
+
+class SessionWriteBehind:
+    """按会话合并、后台原子落盘的写回队列"""
+
+    def __init__(
+        self,
+        store: SessionStore,
+        snapshot: Callable[[str], Optional[Dict[str, Any]]],
+        flush_interval_seconds: float = 0.5,
+        max_dirty: int = 256,
+    ):
+        """
+        Args:
+            store: 会话存储后端
+            snapshot: 刷盘时获取会话可持久化快照的回调，会话已不存在时返回 None
+            flush_interval_seconds: 首次标记脏到刷盘的等待时间（合并窗口）
+            max_dirty: 脏集合上限，达到后立即刷盘并对调用方施加背压
+        """
+        self._store = store
+        self._snapshot = snapshot
+        self._flush_interval = max(flush_interval_seconds, 0.0)
+        self._max_dirty = max(max_dirty, 1)
+
+        self._cond = threading.Condition()
+        self._dirty: Dict[str, Any] = {}    # {session_id: True | _TOMBSTONE | 快照}，按首次标记顺序
+        self._first_dirty_at: Optional[float] = None
+        self._flush_requested = False
+        self._inflight: Dict[str, Any] = {}  # 正在写入的批次（计入队列深度）
+        self._generation = 0                # 已完成的刷盘批次数
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+
+        self._marks = 0
+        self._coalesced = 0
+        self._writes = 0
+        self._deletes = 0
+        self._errors = 0
+        self._bytes_written = 0
+        self._backpressure_waits = 0
+        self._flush_total_seconds = 0.0
+        self._flush_max_seconds = 0.0
+        self._last_flush_seconds = 0.0
+
+    def mark_dirty(self, session_id: str):
+        """标记会话需要落盘（同一窗口内多次标记只写一次）"""
+        self._enqueue(session_id, True)
+
+    def mark_deleted(self, session_id: str):
+        """标记会话文件需要删除（覆盖尚未写入的更新）"""
+        self._enqueue(session_id, _TOMBSTONE)
+
+    def mark_evicted(self, session_id: str, snapshot: Dict[str, Any]):
+        """
+        会话已移出内存：若仍待落盘（含正在写入的批次），改为保存其快照直到写入文件
+
+        须在会话从内存移除之前调用。
+        """
+        with self._cond:
+            if self._dirty.get(session_id) is True or self._inflight.get(session_id) is True:
+                self._dirty[session_id] = snapshot
+                if self._first_dirty_at is None:
+                    self._first_dirty_at = time.monotonic()
+                self._cond.notify_all()
+
+    def pending_snapshot(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """已移出内存、尚未落盘的会话快照（比文件内容更新），没有时返回 None"""
+        with self._cond:
+            for pending in (self._dirty, self._inflight):
+                value = pending.get(session_id)
+                if isinstance(value, dict):
+                    return value
+            return None
+
+    def is_pending_delete(self, session_id: str) -> bool:
+        """会话是否已删除但文件尚未移除（此时不应从文件恢复）"""
+        with self._cond:
+            return self._dirty.get(session_id) is _TOMBSTONE
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        立即刷盘并等待当前所有脏会话写完
+
+        Returns:
+            是否在超时前完成
+        """
+        with self._cond:
+            if not self._dirty and not self._inflight:
+                return True
+            target = self._generation + (2 if self._inflight else 1)
+            self._flush_requested = True
+            self._ensure_thread_locked()
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: self._generation >= target or self._closed, timeout)
+
+    def close(self, timeout: Optional[float] = 5.0):
+        """刷盘并停止后台线程（应用关闭时调用）"""
+        self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._cond:
+            flushes = self._generation
+            return {
+                "queue_depth": len(self._dirty) + len(self._inflight),
+                "max_dirty": self._max_dirty,
+                "flush_interval_seconds": self._flush_interval,
+                "marks": self._marks,
+                "coalesced": self._coalesced,
+                "writes": self._writes,
+                "deletes": self._deletes,
+                "errors": self._errors,
+                "bytes_written": self._bytes_written,
+                "backpressure_waits": self._backpressure_waits,
+                "flushes": flushes,
+                "last_flush_ms": round(self._last_flush_seconds * 1000, 2),
+                "avg_flush_ms": round(self._flush_total_seconds / flushes * 1000, 2) if flushes else 0.0,
+                "max_flush_ms": round(self._flush_max_seconds * 1000, 2),
+            }
+
+    # ==================== 私有方法 ====================
+
+    def _enqueue(self, session_id: str, value: Any):
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("session persister is closed")
+            self._marks += 1
+            if session_id in self._dirty:
+                self._coalesced += 1
+            elif len(self._dirty) >= self._max_dirty:
+                # 背压：立即刷盘，等待脏集合回落后再加入
+                self._backpressure_waits += 1
+                self._flush_requested = True
+                self._ensure_thread_locked()
+                self._cond.notify_all()
+                self._cond.wait_for(lambda: len(self._dirty) < self._max_dirty or self._closed)
+            self._dirty[session_id] = value
+            if self._first_dirty_at is None:
+                self._first_dirty_at = time.monotonic()
+            self._ensure_thread_locked()
+            self._cond.notify_all()
+
+    def _ensure_thread_locked(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="session-write-behind", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._dirty:
+                        due = self._first_dirty_at + self._flush_interval
+                        remaining = due - time.monotonic()
+                        if self._flush_requested or self._closed or remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    elif self._closed:
+                        return
+                    else:
+                        self._cond.wait()
+                batch = self._dirty
+                self._dirty = {}
+                self._first_dirty_at = None
+                self._flush_requested = False
+                self._inflight = batch
+                # 背压中的调用方可以继续加入
+                self._cond.notify_all()
+
+            started = time.perf_counter()
+            self._write_batch(batch)
+            elapsed = time.perf_counter() - started
+
+            with self._cond:
+                self._inflight = {}
+                self._generation += 1
+                self._last_flush_seconds = elapsed
+                self._flush_total_seconds += elapsed
+                self._flush_max_seconds = max(self._flush_max_seconds, elapsed)
+                self._cond.notify_all()
+
+    def _write_batch(self, batch: Dict[str, Any]):
+        saves: List[Tuple[str, Dict[str, Any]]] = []
+        for session_id, value in batch.items():
+            if value is _TOMBSTONE:
+                self._delete_one(session_id)
+                continue
+            try:
+                payload = value if isinstance(value, dict) else self._snapshot(session_id)
+            except Exception as e:
+                self._record_error(session_id, e)
+                continue
+            if payload is not None:
+                saves.append((session_id, payload))
+
+        try:
+            written = self._store.save_many(saves)
+        except Exception as e:
+            logger.warning(f"Batch persist of {len(saves)} sessions failed, retrying one by one: {e}")
+            written = 0
+            for session_id, payload in list(saves):
+                try:
+                    written += self._store.save(session_id, payload)
+                except Exception as item_error:
+                    saves.remove((session_id, payload))
+                    self._record_error(session_id, item_error)
+
+        with self._cond:
+            self._writes += len(saves)
+            self._bytes_written += written
+        logger.debug(f"Persisted {len(saves)} sessions ({written} bytes)")
+
+    def _delete_one(self, session_id: str):
+        try:
+            self._store.delete(session_id)
+        except Exception as e:
+            self._record_error(session_id, e)
+            return
+        with self._cond:
+            self._deletes += 1
+        logger.debug(f"Persisted session deleted: {session_id}")
+
+    def _record_error(self, session_id: str, error: Exception):
+        with self._cond:
+            self._errors += 1
+        logger.warning(f"Failed to persist session {session_id}: {error}")
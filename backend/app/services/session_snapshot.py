@@ -0,0 +1,355 @@
+"""
+画布会话二进制快照 (Compact Binary Session Snapshot)
+
+会话文件原本是完整 model_dump 的 JSON：每个节点都重复 "position" / "data" / "shape": null 等键名，
+冷启动加载要先 json 解析整个文件、再由调用方逐个 Node(**n) 校验。
+
+格式（小端）：
+    header:  magic b"CSNP" | 格式版本 u8 | 压缩算法 u8 | 正文解压后长度 u32
+    body:    meta 长度 u32 | meta JSON | x float64[n] | y float64[n]
+meta JSON 按列存储：
+    session: 会话字段（timestamp / created_at / version / node_count ...）
+    nodes:   ids 列；type / label / shape / iconType / color 为字典编码列（取值表 + 下标数组）
+    edges:   ids 列；source / target 为端点表下标（端点表 = 节点 ids + 未知端点）；label 为字典编码列
+    raw:     结构不标准的节点 / 边（多出或缺少字段）按下标原样保存，解码时覆盖
+
+设计：
+- 压缩可选：zstd（安装了 zstandard 时）/ zlib / none，写在 header 中，解码与写入时的配置无关
+- 格式版本写在 header，不认识的版本抛出 SnapshotFormatError，不会误读
+- decode_snapshot() 只解出列数据；CanvasSnapshot 在首次访问时才构建节点 / 边字典（只读会话字段时不构建）
+- 加载时不再逐个 Node(**n)：存储层只还原字典，Node / Edge 模型由会话管理器在首次 get_session_graph()
+  时经 SessionGraph 整列校验（TypeAdapter 一次调用），之后按版本缓存
+- is_snapshot() 按 magic 区分二进制快照与旧 JSON，存储层据此兼容旧数据；
+  migrate_json_sessions() 把目录中的旧 JSON 会话文件批量转换为快照（应用启动时由 lifespan 调用）
+"""
+
+import logging
+import struct
+import zlib
+from array import array
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.core.serialization import json_dumps_bytes, json_loads, read_json_file, write_bytes_file
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"CSNP"
+FORMAT_VERSION = 1
+SNAPSHOT_SUFFIX = ".snap"
+
+_HEADER = struct.Struct("<4sBBI")
+_META_LENGTH = struct.Struct("<I")
+_CODECS = {"none": 0, "zlib": 1, "zstd": 2}
+_CODEC_NAMES = {code: name for name, code in _CODECS.items()}
+
+_NODE_KEYS = {"id", "type", "position", "data"}
+_POSITION_KEYS = {"x", "y"}
+_DATA_COLUMNS = ("label", "shape", "iconType", "color")
+_EDGE_KEYS = {"id", "source", "target", "label"}
+
+
+class SnapshotFormatError(ValueError):
+    """数据不是可识别的会话快照（magic / 格式版本 / 压缩算法不支持）"""
+
+
+class CanvasSnapshot:
+    """解码后的会话快照（列数据），节点 / 边在首次访问时才构建"""
+
+    def __init__(self, meta: Dict[str, Any], xs: array, ys: array):
+        self._meta = meta
+        self._xs = xs
+        self._ys = ys
+        self._nodes: Optional[List[Dict[str, Any]]] = None
+        self._edges: Optional[List[Dict[str, Any]]] = None
+
+    @property
+    def session_fields(self) -> Dict[str, Any]:
+        """会话字段（不含 nodes / edges），不触发节点构建"""
+        return dict(self._meta["session"])
+
+    @property
+    def node_count(self) -> int:
+        return len(self._meta["nodes"]["ids"])
+
+    @property
+    def edge_count(self) -> int:
+        return len(self._meta["edges"]["ids"])
+
+    @property
+    def nodes(self) -> List[Dict[str, Any]]:
+        """节点字典（与 model_dump 结构一致）"""
+        if self._nodes is None:
+            self._nodes = self._build_nodes()
+        return self._nodes
+
+    @property
+    def edges(self) -> List[Dict[str, Any]]:
+        """边字典（与 model_dump 结构一致）"""
+        if self._edges is None:
+            self._edges = self._build_edges()
+        return self._edges
+
+    def to_session(self) -> Dict[str, Any]:
+        """还原为持久化快照字典（会话字段 + nodes / edges）"""
+        return {**self.session_fields, "nodes": self.nodes, "edges": self.edges}
+
+    # ==================== 私有方法 ====================
+
+    def _build_nodes(self) -> List[Dict[str, Any]]:
+        columns = self._meta["nodes"]
+        data_columns = [_dict_decode(columns[key]) for key in _DATA_COLUMNS]
+        nodes = [
+            {
+                "id": node_id,
+                "type": node_type,
+                "position": {"x": x, "y": y},
+                "data": dict(zip(_DATA_COLUMNS, data)),
+            }
+            for node_id, node_type, x, y, data in zip(
+                columns["ids"], _dict_decode(columns["type"]), self._xs, self._ys, zip(*data_columns)
+            )
+        ]
+        for position, node in columns.get("raw", {}).items():
+            nodes[int(position)] = node
+        return nodes
+
+    def _build_edges(self) -> List[Dict[str, Any]]:
+        columns = self._meta["edges"]
+        ends = self._meta["nodes"]["ids"] + columns.get("extra_ends", [])
+        edges = [
+            {"id": edge_id, "source": ends[source], "target": ends[target], "label": label}
+            for edge_id, source, target, label in zip(
+                columns["ids"], columns["source"], columns["target"], _dict_decode(columns["label"])
+            )
+        ]
+        for position, edge in columns.get("raw", {}).items():
+            edges[int(position)] = edge
+        return edges
+
+
+def available_compressions() -> Tuple[str, ...]:
+    """当前环境可用的压缩算法"""
+    return tuple(name for name in _CODECS if name != "zstd" or zstandard is not None)
+
+
+def is_snapshot(data: bytes) -> bool:
+    """数据是否为二进制快照（否则视为旧 JSON）"""
+    return data[:len(MAGIC)] == MAGIC
+
+
+def encode_snapshot(session: Dict[str, Any], compression: str = "zlib", level: Optional[int] = None) -> bytes:
+    """
+    把会话持久化快照（nodes / edges 为 model_dump 字典）编码为二进制快照
+
+    Args:
+        session: 会话快照字典（datetime 已转为字符串）
+        compression: "zstd" / "zlib" / "none"，zstd 不可用时回退 zlib
+        level: 压缩级别（None 使用算法默认值）
+    """
+    if compression not in _CODECS:
+        raise ValueError(f"Unknown snapshot compression {compression!r}")
+    if compression == "zstd" and zstandard is None:
+        compression = "zlib"
+
+    nodes = session.get("nodes", [])
+    edges = session.get("edges", [])
+    node_columns, xs, ys = _encode_nodes(nodes)
+    meta = {
+        "session": {key: value for key, value in session.items() if key not in ("nodes", "edges")},
+        "nodes": node_columns,
+        "edges": _encode_edges(edges, node_columns["ids"]),
+    }
+    meta_bytes = json_dumps_bytes(meta)
+    body = b"".join((_META_LENGTH.pack(len(meta_bytes)), meta_bytes, _le_bytes(xs), _le_bytes(ys)))
+
+    if compression == "zstd":
+        payload = zstandard.ZstdCompressor(level=level if level is not None else 3).compress(body)
+    elif compression == "zlib":
+        payload = zlib.compress(body, level if level is not None else 6)
+    else:
+        payload = body
+    return _HEADER.pack(MAGIC, FORMAT_VERSION, _CODECS[compression], len(body)) + payload
+
+
+def decode_snapshot(data: bytes) -> CanvasSnapshot:
+    """
+    解码二进制快照（只解出列数据，节点 / 边在访问时构建）
+
+    Raises:
+        SnapshotFormatError: magic / 格式版本 / 压缩算法不支持
+    """
+    if len(data) < _HEADER.size or not is_snapshot(data):
+        raise SnapshotFormatError("not a canvas session snapshot")
+    _, version, codec, body_length = _HEADER.unpack_from(data)
+    if version != FORMAT_VERSION:
+        raise SnapshotFormatError(f"unsupported snapshot format version {version}")
+
+    payload = memoryview(data)[_HEADER.size:]
+    codec_name = _CODEC_NAMES.get(codec)
+    if codec_name == "zstd":
+        if zstandard is None:
+            raise SnapshotFormatError("snapshot is zstd-compressed but zstandard is not installed")
+        body = zstandard.ZstdDecompressor().decompress(payload, max_output_size=body_length)
+    elif codec_name == "zlib":
+        body = zlib.decompress(payload)
+    elif codec_name == "none":
+        body = bytes(payload)
+    else:
+        raise SnapshotFormatError(f"unsupported snapshot compression {codec}")
+
+    (meta_length,) = _META_LENGTH.unpack_from(body)
+    meta_end = _META_LENGTH.size + meta_length
+    meta = json_loads(body[_META_LENGTH.size:meta_end])
+    node_count = len(meta["nodes"]["ids"])
+    xs = _le_array(body[meta_end:meta_end + 8 * node_count])
+    ys = _le_array(body[meta_end + 8 * node_count:meta_end + 16 * node_count])
+    return CanvasSnapshot(meta, xs, ys)
+
+
+def load_session_bytes(data: bytes) -> Dict[str, Any]:
+    """读取会话快照字典：二进制快照或旧 JSON 均可"""
+    if is_snapshot(data):
+        return decode_snapshot(data).to_session()
+    if data.startswith(b"\xef\xbb\xbf"):
+        data = data[3:]
+    return json_loads(data)
+
+
+def migrate_json_sessions(persist_path: str, compression: str = "zlib") -> Dict[str, int]:
+    """
+    把目录中的旧 JSON 会话文件转换为二进制快照（原子写入快照后删除 JSON）
+
+    已存在同名快照时只删除 JSON（快照更新）。
+
+    Returns:
+        {"converted": n, "skipped": n, "failed": n}
+    """
+    result = {"converted": 0, "skipped": 0, "failed": 0}
+    for json_file in sorted(Path(persist_path).glob("*.json")):
+        snapshot_file = json_file.with_suffix(SNAPSHOT_SUFFIX)
+        try:
+            if snapshot_file.exists():
+                result["skipped"] += 1
+            else:
+                write_bytes_file(snapshot_file, encode_snapshot(read_json_file(json_file), compression))
+                result["converted"] += 1
+            json_file.unlink()
+        except Exception as e:
+            result["failed"] += 1
+            logger.warning(f"Failed to migrate session file {json_file}: {e}")
+    if any(result.values()):
+        logger.info(f"Session snapshot migration in {persist_path}: {result}")
+    return result
+
+
+# ==================== 私有方法 ====================
+
+def _encode_nodes(nodes: List[Dict[str, Any]]) -> Tuple[Dict[str, Any], array, array]:
+    ids: List[str] = []
+    types: List[Any] = []
+    data_values: Dict[str, List[Any]] = {key: [] for key in _DATA_COLUMNS}
+    xs = array("d")
+    ys = array("d")
+    raw: Dict[str, Any] = {}
+
+    for position, node in enumerate(nodes):
+        ids.append(node.get("id"))
+        if _is_standard_node(node):
+            types.append(node["type"])
+            xs.append(node["position"]["x"])
+            ys.append(node["position"]["y"])
+            for key in _DATA_COLUMNS:
+                data_values[key].append(node["data"][key])
+        else:
+            raw[str(position)] = node
+            types.append(None)
+            xs.append(0.0)
+            ys.append(0.0)
+            for key in _DATA_COLUMNS:
+                data_values[key].append(None)
+
+    columns: Dict[str, Any] = {"ids": ids, "type": _dict_encode(types)}
+    columns.update({key: _dict_encode(values) for key, values in data_values.items()})
+    if raw:
+        columns["raw"] = raw
+    return columns, xs, ys
+
+
+def _encode_edges(edges: List[Dict[str, Any]], node_ids: List[str]) -> Dict[str, Any]:
+    end_index = {node_id: position for position, node_id in enumerate(node_ids)}
+    extra_ends: List[str] = []
+
+    def end(value: Any) -> int:
+        if value not in end_index:
+            end_index[value] = len(node_ids) + len(extra_ends)
+            extra_ends.append(value)
+        return end_index[value]
+
+    ids: List[Any] = []
+    sources: List[int] = []
+    targets: List[int] = []
+    labels: List[Any] = []
+    raw: Dict[str, Any] = {}
+    for position, edge in enumerate(edges):
+        ids.append(edge.get("id"))
+        if edge.keys() == _EDGE_KEYS and isinstance(edge["source"], str) and isinstance(edge["target"], str):
+            sources.append(end(edge["source"]))
+            targets.append(end(edge["target"]))
+            labels.append(edge["label"])
+        else:
+            raw[str(position)] = edge
+            sources.append(0)
+            targets.append(0)
+            labels.append(None)
+
+    columns: Dict[str, Any] = {"ids": ids, "source": sources, "target": targets, "label": _dict_encode(labels)}
+    if extra_ends:
+        columns["extra_ends"] = extra_ends
+    if raw:
+        columns["raw"] = raw
+    return columns
+
+
+def _is_standard_node(node: Dict[str, Any]) -> bool:
+    position = node.get("position")
+    data = node.get("data")
+    return (
+        node.keys() == _NODE_KEYS
+        and isinstance(position, dict) and position.keys() == _POSITION_KEYS
+        and isinstance(position["x"], (int, float)) and isinstance(position["y"], (int, float))
+        and isinstance(data, dict) and data.keys() == set(_DATA_COLUMNS)
+    )
+
+
+def _dict_encode(values: List[Any]) -> Dict[str, List[Any]]:
+    """字典编码：取值表（按首次出现顺序）+ 每行的下标"""
+    table: Dict[Any, int] = {}
+    index = [table.setdefault(value, len(table)) for value in values]
+    return {"values": list(table), "index": index}
+
+
+def _dict_decode(column: Dict[str, List[Any]]) -> List[Any]:
+    values = column["values"]
+    return [values[position] for position in column["index"]]
+
+
+def _le_bytes(values: array) -> bytes:
+    if array("H", [1]).tobytes() != b"\x01\x00":
+        values = array("d", values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _le_array(data: bytes) -> array:
+    values = array("d")
+    values.frombytes(data)
+    if array("H", [1]).tobytes() != b"\x01\x00":
+        values.byteswap()
+    return values
+
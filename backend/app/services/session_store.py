@@ -0,0 +1,444 @@
+"""
+画布会话存储后端 (Canvas Session Store)
+
+CanvasSessionManager 的持久层。旧实现固定为"每会话一个 JSON 文件"：多 worker 部署时，
+worker A 保存的会话要等文件写出后 worker B 才能看到，并发写同一文件互相覆盖。
+
+设计：
+- SessionStore 为存储接口：load / save_many / compare_and_save / delete / get_version / touch /
+  delete_expired，存的是会话的可持久化快照（datetime 已转为 ISO 字符串，带 version）
+- FileSessionStore：每会话一个文件（单进程默认，原子写入）
+- 快照编码由 snapshot_format 决定：binary 为 session_snapshot 的列式二进制快照，json 为旧格式；
+  读取时按内容识别两种格式，旧 JSON 会话在下次保存时被替换为新格式（渐进迁移）
+- SQLiteSessionStore：SQLite WAL 模式，多进程共享同一个数据库文件
+  * WAL：读不阻塞写、写不阻塞读，多个 worker 并发读
+  * save_many 在一个事务内批量 upsert（ON CONFLICT），只接受版本号高于已存版本的写入，
+    避免延迟的写回覆盖其他 worker 的新版本；两个 worker 从同一版本各自 +1 时后写入的被拒绝，
+    被拒绝的写入通过 stale write 回调通知会话管理器（由其丢弃内存副本、重新加载）
+  * compare_and_save 按基准版本号做条件写入（UPDATE ... WHERE version = 基准版本），
+    补丁在应答前同步提交，两个 worker 基于同一版本的补丁只有一个成功
+  * accessed_at 列记录最后访问时间（保存或 touch），带索引：delete_expired 按索引分批删除
+    最后访问早于 TTL 的会话，不扫全表，也不会清理其他 worker 频繁读取但未保存的会话
+  * 每个线程一个连接（sqlite3 连接不能跨线程共享），busy_timeout 等待写锁
+- shared 属性表示存储是否被多个进程共享：共享时内存层只作为读穿缓存，访问时按版本号校验
+- create_session_store() 按配置创建后端
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.core.serialization import json_dumps_bytes, write_bytes_file
+from app.services.session_snapshot import (
+    SNAPSHOT_SUFFIX,
+    available_compressions,
+    encode_snapshot,
+    load_session_bytes,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class SessionStore(ABC):
+    """会话持久层接口（快照字典：nodes / edges / timestamp / created_at / version ...）"""
+
+    name = "base"
+    # 是否被多个进程共享（共享时内存层需要按版本号校验）
+    shared = False
+    # 写入因版本号不高于已存版本被拒绝时的回调 (session_id, 被拒绝的版本号)
+    _stale_write_listener: Optional[Callable[[str, int], None]] = None
+
+    @abstractmethod
+    def load(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """读取会话快照，不存在时返回 None"""
+
+    @abstractmethod
+    def save_many(self, items: List[Tuple[str, Dict[str, Any]]]) -> int:
+        """
+        批量写入会话快照
+
+        Returns:
+            写入的字节数
+        """
+
+    @abstractmethod
+    def delete(self, session_id: str) -> bool:
+        """删除会话，返回是否存在"""
+
+    def save(self, session_id: str, snapshot: Dict[str, Any]) -> int:
+        """写入单个会话快照"""
+        return self.save_many([(session_id, snapshot)])
+
+    def compare_and_save(self, session_id: str, snapshot: Dict[str, Any], expected_version: int) -> bool:
+        """
+        仅当已存版本等于 expected_version（或会话尚未落盘）时写入快照
+
+        默认实现先读后写，只适用于单进程存储；共享存储需要在一个事务内完成。
+
+        Returns:
+            是否写入（False 表示其他 worker 已写入了不同的版本）
+        """
+        stored_version = self.get_version(session_id)
+        if stored_version is not None and stored_version != expected_version:
+            return False
+        self.save(session_id, snapshot)
+        return True
+
+    def exists(self, session_id: str) -> bool:
+        return self.get_version(session_id) is not None
+
+    def get_version(self, session_id: str) -> Optional[int]:
+        """已存会话的版本号，不存在时返回 None"""
+        snapshot = self.load(session_id)
+        return snapshot.get("version", 1) if snapshot else None
+
+    def touch(self, session_id: str, accessed_at: datetime):
+        """记录会话的最后访问时间（供 delete_expired 判断过期）；默认不支持"""
+
+    def delete_expired(self, cutoff: datetime, limit: int = 200) -> int:
+        """删除最后访问时间早于 cutoff 的会话（最多 limit 个），返回删除数量；默认不支持"""
+        return 0
+
+    def set_stale_write_listener(self, listener: Optional[Callable[[str, int], None]]):
+        """
+        注册被拒绝写入的回调
+
+        回调可能在后台写盘线程中调用，不应阻塞或获取调用方可能持有的锁。
+        """
+        self._stale_write_listener = listener
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"backend": self.name, "shared": self.shared}
+
+    def close(self):
+        """释放连接等资源"""
+
+
+class _SnapshotCodec:
+    """快照编码（binary / json），解码时按内容自动识别"""
+
+    def __init__(self, snapshot_format: str = "json", compression: str = "zlib"):
+        if snapshot_format not in ("binary", "json"):
+            logger.warning(f"Unknown session snapshot format {snapshot_format!r}, falling back to json")
+            snapshot_format = "json"
+        if compression not in ("zstd", "zlib", "none"):
+            logger.warning(f"Unknown session snapshot compression {compression!r}, falling back to zlib")
+            compression = "zlib"
+        elif compression not in available_compressions():
+            logger.info("zstandard is not installed, session snapshots use zlib")
+            compression = "zlib"
+        self.snapshot_format = snapshot_format
+        self.compression = compression
+
+    def encode(self, snapshot: Dict[str, Any]) -> bytes:
+        if self.snapshot_format == "binary":
+            return encode_snapshot(snapshot, self.compression)
+        return json_dumps_bytes(snapshot)
+
+    @staticmethod
+    def decode(data: bytes) -> Dict[str, Any]:
+        return load_session_bytes(data)
+
+
+class FileSessionStore(SessionStore):
+    """每个会话一个文件（{id}.snap 二进制快照或 {id}.json，原子写入，单进程使用）"""
+
+    name = "file"
+
+    def __init__(self, persist_path: str = "data/canvas_sessions", snapshot_format: str = "json",
+                 compression: str = "zlib"):
+        """
+        Args:
+            persist_path: 会话文件目录
+            snapshot_format: "binary" 或 "json"（写入格式；两种格式都可读取）
+            compression: 二进制快照的压缩算法（zstd / zlib / none）
+        """
+        self._persist_path = persist_path
+        self._codec = _SnapshotCodec(snapshot_format, compression)
+        self._suffix = SNAPSHOT_SUFFIX if self._codec.snapshot_format == "binary" else ".json"
+        self._legacy_suffix = ".json" if self._suffix == SNAPSHOT_SUFFIX else SNAPSHOT_SUFFIX
+
+    def load(self, session_id: str) -> Optional[Dict[str, Any]]:
+        for suffix in (self._suffix, self._legacy_suffix):
+            session_file = self._session_file(session_id, suffix)
+            if os.path.exists(session_file):
+                return self._codec.decode(Path(session_file).read_bytes())
+        return None
+
+    def save_many(self, items: List[Tuple[str, Dict[str, Any]]]) -> int:
+        if not items:
+            return 0
+        Path(self._persist_path).mkdir(parents=True, exist_ok=True)
+        written = 0
+        for session_id, snapshot in items:
+            written += write_bytes_file(self._session_file(session_id), self._codec.encode(snapshot))
+            # 新格式写入成功后删除旧格式文件（渐进迁移）
+            legacy_file = self._session_file(session_id, self._legacy_suffix)
+            if os.path.exists(legacy_file):
+                os.remove(legacy_file)
+        return written
+
+    def delete(self, session_id: str) -> bool:
+        existed = False
+        for suffix in (self._suffix, self._legacy_suffix):
+            session_file = self._session_file(session_id, suffix)
+            if os.path.exists(session_file):
+                os.remove(session_file)
+                existed = True
+        return existed
+
+    def exists(self, session_id: str) -> bool:
+        return any(
+            os.path.exists(self._session_file(session_id, suffix)) for suffix in (self._suffix, self._legacy_suffix)
+        )
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **super().get_stats(),
+            "path": self._persist_path,
+            "snapshot_format": self._codec.snapshot_format,
+            "compression": self._codec.compression,
+        }
+
+    # ==================== 私有方法 ====================
+
+    def _session_file(self, session_id: str, suffix: Optional[str] = None) -> str:
+        return os.path.join(self._persist_path, f"{session_id}{suffix or self._suffix}")
+
+
+class SQLiteSessionStore(SessionStore):
+    """SQLite WAL 存储（多进程共享，事务化 upsert，索引化过期清理）"""
+
+    name = "sqlite"
+    shared = True
+
+    _SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS canvas_sessions (
+            session_id TEXT PRIMARY KEY,
+            version INTEGER NOT NULL,
+            updated_at REAL NOT NULL,
+            node_count INTEGER NOT NULL DEFAULT 0,
+            edge_count INTEGER NOT NULL DEFAULT 0,
+            payload BLOB NOT NULL,
+            accessed_at REAL NOT NULL DEFAULT 0
+        )
+        """,
+    )
+    _INDEXES = (
+        "CREATE INDEX IF NOT EXISTS idx_canvas_sessions_accessed_at ON canvas_sessions (accessed_at)",
+    )
+
+    _UPSERT = """
+        INSERT INTO canvas_sessions (session_id, version, updated_at, node_count, edge_count, payload, accessed_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (session_id) DO UPDATE SET
+            version = excluded.version,
+            updated_at = excluded.updated_at,
+            node_count = excluded.node_count,
+            edge_count = excluded.edge_count,
+            payload = excluded.payload,
+            accessed_at = MAX(excluded.accessed_at, canvas_sessions.accessed_at)
+        WHERE excluded.version > canvas_sessions.version
+    """
+
+    _COMPARE_AND_UPDATE = """
+        UPDATE canvas_sessions SET
+            version = ?,
+            updated_at = ?,
+            node_count = ?,
+            edge_count = ?,
+            payload = ?,
+            accessed_at = MAX(accessed_at, ?)
+        WHERE session_id = ? AND version = ?
+    """
+
+    def __init__(self, db_path: str = "data/canvas_sessions.db", busy_timeout_ms: int = 5000,
+                 snapshot_format: str = "json", compression: str = "zlib"):
+        """
+        Args:
+            db_path: 数据库文件路径（多个 worker 指向同一文件）
+            busy_timeout_ms: 等待其他连接释放写锁的时间
+            snapshot_format: payload 编码，"binary" 或 "json"（两种格式都可读取）
+            compression: 二进制快照的压缩算法（zstd / zlib / none）
+        """
+        self._db_path = db_path
+        self._codec = _SnapshotCodec(snapshot_format, compression)
+        self._busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        self._stale_writes = 0
+
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        with self._transaction() as conn:
+            for statement in self._SCHEMA:
+                conn.execute(statement)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(canvas_sessions)")}
+            if "accessed_at" not in columns:
+                # 旧版本建的表：补上访问时间列，以最后保存时间为初值
+                conn.execute("ALTER TABLE canvas_sessions ADD COLUMN accessed_at REAL NOT NULL DEFAULT 0")
+                conn.execute("UPDATE canvas_sessions SET accessed_at = updated_at")
+            for statement in self._INDEXES:
+                conn.execute(statement)
+
+    def load(self, session_id: str) -> Optional[Dict[str, Any]]:
+        row = self._connection().execute(
+            "SELECT payload, accessed_at FROM canvas_sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if not row:
+            return None
+        snapshot = self._codec.decode(row[0])
+        # 其他 worker 读取时只更新了 accessed_at：快照中的 timestamp（最后访问时间）取两者较新者
+        timestamp = snapshot.get("timestamp")
+        if isinstance(timestamp, str) and row[1] > datetime.fromisoformat(timestamp).timestamp():
+            snapshot["timestamp"] = datetime.fromtimestamp(row[1]).isoformat()
+        return snapshot
+
+    def save_many(self, items: List[Tuple[str, Dict[str, Any]]]) -> int:
+        if not items:
+            return 0
+        rows = [self._row(session_id, snapshot) for session_id, snapshot in items]
+        rejected: List[Tuple[str, int]] = []
+        with self._transaction() as conn:
+            for row in rows:
+                if conn.execute(self._UPSERT, row).rowcount == 0:
+                    rejected.append((row[0], row[1]))
+            self._stale_writes += len(rejected)
+
+        listener = self._stale_write_listener
+        for session_id, version in rejected:
+            logger.warning(f"Stale write rejected: session {session_id} v{version} is not newer than the stored version")
+            if listener is not None:
+                listener(session_id, version)
+        return sum(len(row[5]) for row in rows)
+
+    def compare_and_save(self, session_id: str, snapshot: Dict[str, Any], expected_version: int) -> bool:
+        row = self._row(session_id, snapshot)
+        with self._transaction() as conn:
+            updated = conn.execute(self._COMPARE_AND_UPDATE, (*row[1:], session_id, expected_version)).rowcount
+            if updated:
+                return True
+            if conn.execute("SELECT 1 FROM canvas_sessions WHERE session_id = ?", (session_id,)).fetchone():
+                return False
+            # 会话还在写回队列中、尚未落盘：直接插入
+            conn.execute(self._UPSERT, row)
+        return True
+
+    def delete(self, session_id: str) -> bool:
+        with self._transaction() as conn:
+            return conn.execute("DELETE FROM canvas_sessions WHERE session_id = ?", (session_id,)).rowcount > 0
+
+    def get_version(self, session_id: str) -> Optional[int]:
+        row = self._connection().execute(
+            "SELECT version FROM canvas_sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def touch(self, session_id: str, accessed_at: datetime):
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE canvas_sessions SET accessed_at = MAX(accessed_at, ?) WHERE session_id = ?",
+                (accessed_at.timestamp(), session_id),
+            )
+
+    def delete_expired(self, cutoff: datetime, limit: int = 200) -> int:
+        with self._transaction() as conn:
+            return conn.execute(
+                """
+                DELETE FROM canvas_sessions WHERE session_id IN (
+                    SELECT session_id FROM canvas_sessions WHERE accessed_at < ? ORDER BY accessed_at LIMIT ?
+                )
+                """,
+                (cutoff.timestamp(), limit),
+            ).rowcount
+
+    def get_stats(self) -> Dict[str, Any]:
+        count = self._connection().execute("SELECT COUNT(*) FROM canvas_sessions").fetchone()[0]
+        return {
+            **super().get_stats(),
+            "path": self._db_path,
+            "sessions": count,
+            "stale_writes": self._stale_writes,
+            "snapshot_format": self._codec.snapshot_format,
+        }
+
+    def close(self):
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.ProgrammingError:
+                # 其他线程创建的连接只能由该线程关闭，进程退出时释放
+                pass
+        self._local = threading.local()
+
+    # ==================== 私有方法 ====================
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._db_path, timeout=self._busy_timeout_ms / 1000, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA busy_timeout={int(self._busy_timeout_ms)}")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _transaction(self):
+        return _ImmediateTransaction(self._connection())
+
+    def _row(self, session_id: str, snapshot: Dict[str, Any]) -> tuple:
+        timestamp = snapshot.get("timestamp")
+        updated_at = datetime.fromisoformat(timestamp).timestamp() if isinstance(timestamp, str) else datetime.now().timestamp()
+        return (
+            session_id,
+            snapshot.get("version", 1),
+            updated_at,
+            snapshot.get("node_count", 0),
+            snapshot.get("edge_count", 0),
+            self._codec.encode(snapshot),
+            updated_at,
+        )
+
+
+class _ImmediateTransaction:
+    """BEGIN IMMEDIATE ... COMMIT / ROLLBACK（立即获取写锁，避免读升级写时的死锁）"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self._conn = conn
+
+    def __enter__(self) -> sqlite3.Connection:
+        self._conn.execute("BEGIN IMMEDIATE")
+        return self._conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self._conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+def create_session_store(backend: str, persist_path: str, sqlite_path: str, snapshot_format: str = "json",
+                         compression: str = "zlib") -> SessionStore:
+    """
+    按名称创建存储后端
+
+    Args:
+        backend: "file" 或 "sqlite"
+        persist_path: 文件存储目录
+        sqlite_path: SQLite 数据库文件路径
+        snapshot_format: 快照编码，"binary" 或 "json"
+        compression: 二进制快照的压缩算法（zstd / zlib / none）
+    """
+    if backend == "sqlite":
+        return SQLiteSessionStore(sqlite_path, snapshot_format=snapshot_format, compression=compression)
+    if backend != "file":
+        logger.warning(f"Unknown session store backend {backend!r}, falling back to file")
+    return FileSessionStore(persist_path, snapshot_format=snapshot_format, compression=compression)
@@ -0,0 +1,245 @@
+"""
+单飞请求合并 (Single-flight Request Coalescing)
+
+多个客户端同时提交完全相同的生成请求（团队演示、双击重试）时，原先每个请求都单独调用上游。
+响应缓存只能让“之后”的请求命中，无法合并“同时在途”的请求。
+
+设计：
+- 以响应缓存的内容寻址键（provider / model / prompt / 图片 / 采样参数）为 key
+- 非流式：第一个请求（leader）发起上游调用，其余请求（follower）等待同一结果；
+  follower 拿到的是结果的深拷贝，调用方各自修改互不影响
+- 流式：leader 的上游流由后台任务泵入共享缓冲区，follower 加入时先回放已输出的前缀，
+  再跟随新 token；上游异常会传给所有订阅者
+- 上游调用在独立任务中执行：单个调用方取消（断开、首 token 超时）不影响其他订阅者，
+  所有订阅者都离开时才取消上游调用
+- key 按事件循环隔离（Future / Task 不能跨事件循环共享）
+"""
+
+import asyncio
+import copy
+import logging
+import threading
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    """一次在途的非流式调用"""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class _StreamFlight:
+    """一次在途的流式调用：共享 token 缓冲区 + 订阅者计数"""
+
+    def __init__(self):
+        self.tokens: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.changed = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class SingleFlight:
+    """合并相同 key 的并发调用"""
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._flights: Dict[str, _Flight] = {}
+        self._streams: Dict[str, _StreamFlight] = {}
+        self._leaders = 0
+        self._followers = 0
+        self._stream_leaders = 0
+        self._stream_followers = 0
+
+    async def do(self, key: Optional[str], factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        执行（或加入）一次非流式调用
+
+        Args:
+            key: 合并键；为 None 或未启用时直接执行
+            factory: 发起上游调用的协程工厂，只有 leader 会调用
+
+        Returns:
+            调用结果（follower 得到深拷贝）
+        """
+        if not self.enabled or not key:
+            return await factory()
+
+        scoped_key = _loop_scoped(key)
+        with self._lock:
+            flight = self._flights.get(scoped_key)
+            leader = flight is None
+            if leader:
+                flight = _Flight(asyncio.ensure_future(factory()))
+                self._flights[scoped_key] = flight
+                flight.task.add_done_callback(lambda _: self._forget(self._flights, scoped_key, flight))
+                self._leaders += 1
+            else:
+                self._followers += 1
+            flight.waiters += 1
+
+        if not leader:
+            logger.info("[SINGLE-FLIGHT] Joined in-flight call %s", key[:12])
+        try:
+            result = await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            # 调用方被取消：最后一个等待者离开时才取消上游调用
+            self._leave(flight)
+            raise
+        except BaseException:
+            with self._lock:
+                flight.waiters -= 1
+            raise
+        with self._lock:
+            flight.waiters -= 1
+        return result if leader else copy.deepcopy(result)
+
+    async def stream(
+        self,
+        key: Optional[str],
+        factory: Callable[[], AsyncIterator[str]],
+    ) -> AsyncIterator[str]:
+        """
+        订阅（或发起）一次流式调用
+
+        Args:
+            key: 合并键；为 None 或未启用时直接转发 factory() 的输出
+            factory: 返回上游 token 流的工厂，只有 leader 会调用
+
+        Yields:
+            token（follower 先收到已输出的前缀）
+        """
+        if not self.enabled or not key:
+            async for token in factory():
+                yield token
+            return
+
+        scoped_key = _loop_scoped(key)
+        with self._lock:
+            flight = self._streams.get(scoped_key)
+            if flight is None:
+                flight = _StreamFlight()
+                self._streams[scoped_key] = flight
+                flight.task = asyncio.ensure_future(self._pump(scoped_key, flight, factory))
+                self._stream_leaders += 1
+            else:
+                self._stream_followers += 1
+                logger.info(
+                    "[SINGLE-FLIGHT] Joined in-flight stream %s, replaying %s tokens",
+                    key[:12],
+                    len(flight.tokens),
+                )
+            flight.subscribers += 1
+
+        position = 0
+        try:
+            while True:
+                while position < len(flight.tokens):
+                    token = flight.tokens[position]
+                    position += 1
+                    yield token
+                if flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                await flight.changed.wait()
+        finally:
+            with self._lock:
+                flight.subscribers -= 1
+                abandoned = flight.subscribers == 0 and not flight.done
+            if abandoned and flight.task is not None:
+                # 所有订阅者都已离开：取消上游调用，释放连接与并发名额
+                flight.task.cancel()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "inflight_calls": len(self._flights),
+                "inflight_streams": len(self._streams),
+                "leaders": self._leaders,
+                "coalesced": self._followers,
+                "stream_leaders": self._stream_leaders,
+                "stream_coalesced": self._stream_followers,
+            }
+
+    # ==================== 私有方法 ====================
+
+    async def _pump(self, scoped_key: str, flight: _StreamFlight, factory: Callable[[], AsyncIterator[str]]):
+        upstream = factory()
+        try:
+            async for token in upstream:
+                flight.tokens.append(token)
+                flight.notify()
+        except asyncio.CancelledError:
+            flight.error = RuntimeError("Upstream stream cancelled")
+            raise
+        except Exception as error:
+            flight.error = error
+        finally:
+            flight.done = True
+            self._forget(self._streams, scoped_key, flight)
+            flight.notify()
+            aclose = getattr(upstream, "aclose", None)
+            if aclose is not None:
+                try:
+                    await aclose()
+                except Exception:
+                    pass
+
+    def _leave(self, flight: _Flight):
+        with self._lock:
+            flight.waiters -= 1
+            abandoned = flight.waiters == 0
+        if abandoned and not flight.task.done():
+            flight.task.cancel()
+
+    def _forget(self, flights: Dict[str, Any], scoped_key: str, flight: Any):
+        with self._lock:
+            if flights.get(scoped_key) is flight:
+                del flights[scoped_key]
+
+
+def _loop_scoped(key: str) -> str:
+    return f"{id(asyncio.get_running_loop())}:{key}"
+
+
+# ==================== 全局实例 ====================
+
+_single_flight: Optional[SingleFlight] = None
+_single_flight_lock = threading.Lock()
+
+
+def get_single_flight() -> SingleFlight:
+    """
+    获取全局单飞合并器（单例模式）
+
+    Returns:
+        SingleFlight 实例
+    """
+    global _single_flight
+
+    if _single_flight is None:
+        with _single_flight_lock:
+            if _single_flight is None:
+                _single_flight = SingleFlight(enabled=settings.SINGLE_FLIGHT_ENABLED)
+
+    return _single_flight
+
+
+def reset_single_flight():
+    """重置全局单飞合并器（主要用于测试）"""
+    global _single_flight
+    _single_flight = None
@@ -0,0 +1,215 @@
+"""
+流式 JSON 增量解析器 (Incremental JSON Array Parser)
+
+LLM 流式输出的 JSON 是逐 token 到达的，SSE 接口需要在对象闭合的瞬间推送
+PARTIAL_NODE / PARTIAL_EDGE / PARTIAL_ELEMENT 等事件。旧实现在每次触发时
+从头重扫整个 accumulated 缓冲区，长输出下是 O(n²)。
+
+本模块的解析器在 chunk 之间保留词法状态（字符串/转义/容器栈），每个字符只扫描一次，
+某个被关注的数组键（nodes / edges / layers / items / elements ...）下的对象闭合时，
+立即产出且只产出一次。
+"""
+
+import json
+import logging
+import re
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# 字符串外只关心结构字符；字符串内只关心引号和转义
+_STRUCTURAL_CHARS = re.compile(r'[{}\[\]":,]')
+_STRING_SPECIAL_CHARS = re.compile(r'["\\]')
+
+# 已扫描且不再需要的前缀超过该长度时才裁剪，避免频繁切片
+_COMPACT_THRESHOLD = 4096
+
+
+class ArrayObjectEvent(NamedTuple):
+    """被关注数组中一个已闭合的对象"""
+    key: str
+    index: int
+    value: Dict[str, Any]
+
+
+class _Container:
+    __slots__ = ("is_object", "key", "start", "capturing", "expect_key", "pending_key", "object_count")
+
+    def __init__(self, is_object: bool, key: Optional[str], start: int, capturing: bool):
+        self.is_object = is_object
+        self.key = key                  # 该容器在父对象中的键名
+        self.start = start              # 起始 "{"/"[" 在缓冲区中的偏移
+        self.capturing = capturing      # 是否为被关注数组的直接对象元素（闭合时需要原文）
+        self.expect_key = is_object     # 对象中下一个字符串是否为键
+        self.pending_key: Optional[str] = None
+        self.object_count = 0           # 数组中已出现的对象元素个数
+
+
+class IncrementalJSONArrayParser:
+    """跨 chunk 保持状态的 JSON 数组对象提取器"""
+
+    def __init__(self, array_keys: Iterable[str]):
+        """
+        初始化解析器
+
+        Args:
+            array_keys: 需要提取对象的数组键名，任意嵌套深度均生效
+                        （如 layers[].items[] 中的 items）
+        """
+        self._array_keys = frozenset(array_keys)
+        # 只保留尚未闭合的被关注对象所需的文本，已完成部分会被裁剪
+        self._buffer = ""
+        self._consumed = 0
+        self._pos = 0
+        self._stack: List[_Container] = []
+        self._in_string = False
+        self._string_start = -1
+        self._escape_pending = False
+        self._emitted = 0
+        self._skipped = 0
+
+    @property
+    def consumed_chars(self) -> int:
+        """目前为止收到的字符总数"""
+        return self._consumed + len(self._buffer)
+
+    @property
+    def emitted_count(self) -> int:
+        return self._emitted
+
+    def feed(self, chunk: str) -> List[ArrayObjectEvent]:
+        """
+        追加一段流式文本，返回本次新闭合的对象（按文档顺序）
+
+        Args:
+            chunk: 新到达的文本片段
+
+        Returns:
+            ArrayObjectEvent 列表；无新对象时为空列表
+        """
+        if not chunk:
+            return []
+
+        self._buffer += chunk
+        events: List[ArrayObjectEvent] = []
+        buffer = self._buffer
+        end = len(buffer)
+        pos = self._pos
+
+        while pos < end:
+            if self._in_string:
+                if self._escape_pending:
+                    self._escape_pending = False
+                    pos += 1
+                    continue
+                match = _STRING_SPECIAL_CHARS.search(buffer, pos)
+                if match is None:
+                    pos = end
+                    break
+                pos = match.start()
+                if buffer[pos] == "\\":
+                    self._escape_pending = True
+                    pos += 1
+                    continue
+                self._close_string(pos)
+                pos += 1
+                continue
+
+            match = _STRUCTURAL_CHARS.search(buffer, pos)
+            if match is None:
+                pos = end
+                break
+            pos = match.start()
+            char = buffer[pos]
+            top = self._stack[-1] if self._stack else None
+
+            if char == '"':
+                # 顶层之外的文本（如 markdown 说明、代码块标记）不参与解析
+                if top is not None:
+                    self._in_string = True
+                    self._string_start = pos
+            elif char == "{" or char == "[":
+                key = None
+                capturing = False
+                if top is not None:
+                    if top.is_object:
+                        key = top.pending_key
+                        top.pending_key = None
+                    elif char == "{":
+                        top.object_count += 1
+                        capturing = top.key in self._array_keys
+                self._stack.append(_Container(char == "{", key, pos, capturing))
+            elif char == "}" or char == "]":
+                if top is not None and top.is_object == (char == "}"):
+                    self._stack.pop()
+                    if char == "}":
+                        event = self._build_event(top, pos)
+                        if event is not None:
+                            events.append(event)
+                    parent = self._stack[-1] if self._stack else None
+                    if parent is not None and parent.is_object:
+                        parent.pending_key = None
+            elif char == ",":
+                if top is not None and top.is_object:
+                    top.expect_key = True
+                    top.pending_key = None
+            # ":" 不需要处理：键名在字符串闭合时已记录
+            pos += 1
+
+        self._pos = pos
+        self._compact()
+        return events
+
+    def get_stats(self) -> dict:
+        """解析器统计信息（调试用）"""
+        return {
+            "chars": self.consumed_chars,
+            "buffered": len(self._buffer),
+            "depth": len(self._stack),
+            "emitted": self._emitted,
+            "skipped": self._skipped,
+        }
+
+    # ==================== 私有方法 ====================
+
+    def _compact(self):
+        """裁剪已扫描且不再被引用的前缀，保证追加 chunk 的开销与总长度无关"""
+        keep_from = self._pos
+        for container in self._stack:
+            if container.capturing:
+                keep_from = min(keep_from, container.start)
+                break
+        if self._in_string:
+            keep_from = min(keep_from, self._string_start)
+        if keep_from < _COMPACT_THRESHOLD:
+            return
+
+        self._buffer = self._buffer[keep_from:]
+        self._consumed += keep_from
+        self._pos -= keep_from
+        self._string_start -= keep_from
+        for container in self._stack:
+            container.start -= keep_from
+
+    def _close_string(self, pos: int):
+        self._in_string = False
+        top = self._stack[-1] if self._stack else None
+        if top is not None and top.is_object and top.expect_key:
+            top.pending_key = self._buffer[self._string_start + 1:pos]
+            top.expect_key = False
+
+    def _build_event(self, container: _Container, end: int) -> Optional[ArrayObjectEvent]:
+        if not container.capturing:
+            return None
+        parent = self._stack[-1]
+
+        snippet = self._buffer[container.start:end + 1]
+        try:
+            value = json.loads(snippet)
+        except json.JSONDecodeError:
+            # 对象内部有语法问题（注释、尾逗号等），交给最终的容错解析处理
+            self._skipped += 1
+            return None
+
+        self._emitted += 1
+        return ArrayObjectEvent(parent.key, parent.object_count - 1, value)
@@ -0,0 +1,410 @@
+"""
+视觉识别结果缓存 (Perceptual-hash Vision Result Cache)
+
+用户经常把同一张架构图截图重新上传（重新截取、另存为 JPEG、缩放过），
+字节级的 LLM 响应缓存无法命中，每次都是一次完整的多模态调用。
+
+本模块在同一命名空间（入口 + provider/model + prompt 变体）内查找已有结果：
+- 默认只接受字节完全相同的图片（SHA-256）
+- 开启近似匹配（max_distance > 0）时，先按裁边后的 dHash 汉明距离找候选，
+  再用裁边后缩放到固定尺寸的灰度缩略图逐格比对；9x8 的 dHash 看不到文字，
+  只改了标签的同构图哈希几乎相同，必须由第二步拒绝
+- 内存层：有界 LRU，命中直接返回 ImageAnalysisResponse / 图结构
+- 磁盘层：每条一个 JSON 文件，服务重启后重新加载；写盘在线程池中完成，不阻塞事件循环
+"""
+
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, NamedTuple, Optional, Tuple
+
+from app.core.config import settings
+
+try:
+    from PIL import Image, ImageChops
+except ImportError:
+    Image = None
+    ImageChops = None
+
+logger = logging.getLogger(__name__)
+
+# dHash 边长：8 -> 64 位哈希
+_DHASH_SIZE = 8
+# 计算哈希前先缩到该尺寸以内，大截图的解码/裁边开销与原图分辨率无关
+_HASH_WORK_SIZE = 512
+# 与左上角背景色的灰度差超过该值才算内容（用于裁掉截图四周的留白）
+_BORDER_TOLERANCE = 16
+# 宽高比相差超过该比例的图片不视为近似重复
+_MAX_ASPECT_DRIFT = 0.1
+# 内容比对缩略图边长：在原始分辨率上裁边后缩放到 16x16
+_DETAIL_SIZE = 16
+# 内容比对的裁边阈值（高于 _BORDER_TOLERANCE，避免 JPEG 振铃把边界外扩）
+_DETAIL_BORDER_TOLERANCE = 48
+# 内容比对允许的最大单格灰度差：重新另存/缩放/补边 <= 16，只改标签的同构图 >= 60
+_MAX_DETAIL_DIFF = 24
+
+
+class ImageFingerprint(NamedTuple):
+    """图片指纹：精确字节摘要 + 感知哈希 + 内容比对缩略图（hex）"""
+    sha256: str
+    dhash: Optional[int]
+    aspect: float
+    detail: Optional[str] = None
+
+
+class VisionCacheSlot(NamedTuple):
+    """一次查询对应的写入位置（未命中时用于回写结果）"""
+    fingerprint: ImageFingerprint
+    namespace: str
+
+
+def compute_fingerprint(image_data: bytes) -> ImageFingerprint:
+    """
+    计算图片指纹（CPU 密集，异步代码中应通过 asyncio.to_thread 调用）
+
+    无法解码时 dhash 为 None，只能按字节精确命中。
+    """
+    sha = hashlib.sha256(image_data).hexdigest()
+    if Image is None:
+        return ImageFingerprint(sha, None, 0.0)
+
+    try:
+        image = Image.open(io.BytesIO(image_data))
+        image.draft("L", (_HASH_WORK_SIZE, _HASH_WORK_SIZE))
+        gray = image.convert("L")
+    except Exception as e:
+        logger.debug(f"[VISION CACHE] Cannot decode image for perceptual hash: {e}")
+        return ImageFingerprint(sha, None, 0.0)
+
+    # 内容比对缩略图在缩小前的分辨率上裁边，缩小后的边界有亚像素偏移
+    detail = _trim_border(gray, _DETAIL_BORDER_TOLERANCE)
+    detail = detail.resize((_DETAIL_SIZE, _DETAIL_SIZE), Image.BOX).tobytes().hex()
+
+    gray.thumbnail((_HASH_WORK_SIZE, _HASH_WORK_SIZE), Image.BILINEAR)
+
+    # 裁掉与背景色一致的边框：只裁留白的重新截图可以精确命中
+    gray = _trim_border(gray, _BORDER_TOLERANCE)
+
+    width, height = gray.size
+    pixels = gray.resize((_DHASH_SIZE + 1, _DHASH_SIZE), Image.LANCZOS).tobytes()
+    value = 0
+    for row in range(_DHASH_SIZE):
+        offset = row * (_DHASH_SIZE + 1)
+        for col in range(_DHASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return ImageFingerprint(sha, value, round(width / max(height, 1), 4), detail)
+
+
+def _trim_border(gray: "Image.Image", tolerance: int) -> "Image.Image":
+    """裁掉与左上角背景色一致的边框"""
+    background = Image.new("L", gray.size, gray.getpixel((0, 0)))
+    mask = ImageChops.difference(gray, background).point(lambda p: 255 if p > tolerance else 0)
+    box = mask.getbbox()
+    return gray.crop(box) if box else gray
+
+
+def _detail_matches(a: Optional[str], b: Optional[str]) -> bool:
+    """内容比对：两张缩略图逐格灰度差都不超过阈值（缺少缩略图时不接受近似匹配）"""
+    if not a or not b or len(a) != len(b):
+        return False
+    return max(abs(x - y) for x, y in zip(bytes.fromhex(a), bytes.fromhex(b))) <= _MAX_DETAIL_DIFF
+
+
+class VisionResultCache:
+    """按感知哈希近似匹配的视觉识别结果缓存"""
+
+    def __init__(
+        self,
+        max_entries: int = 512,
+        max_distance: int = 0,
+        ttl_seconds: float = 7 * 86400.0,
+        disk_path: Optional[str] = "data/vision_cache",
+        clock: Callable[[], float] = time.time,
+    ):
+        """
+        初始化缓存
+
+        Args:
+            max_entries: 最多缓存的结果数（内存与磁盘共用该上限）
+            max_distance: 近似匹配的最大汉明距离（0-64），0 表示只接受字节完全相同的图片
+            ttl_seconds: 条目有效期（秒），<=0 表示永不过期
+            disk_path: 磁盘目录，为 None 时仅使用内存
+            clock: 墙上时钟（测试时可注入假时钟）
+        """
+        self._max_entries = max(1, max_entries)
+        self._max_distance = max(0, max_distance)
+        self._ttl = ttl_seconds
+        self._disk_path = Path(disk_path) if disk_path else None
+        self._clock = clock
+        self._lock = threading.Lock()
+        # {entry_id: {"namespace", "sha256", "dhash", "aspect", "detail", "value", "created_at"}}
+        self._entries: Optional["OrderedDict[str, Dict[str, Any]]"] = None
+
+        self._hits_exact = 0
+        self._hits_near = 0
+        self._misses = 0
+        self._stores = 0
+        self._expired = 0
+
+    @staticmethod
+    def make_namespace(endpoint: str, provider: str, model_name: Optional[str], base_url: Optional[str] = None, **variant) -> str:
+        """
+        计算命名空间：只有入口、模型与 prompt 变体都相同的结果才能互相复用
+
+        Args:
+            endpoint: 入口名（architecture / flowchart / excalidraw / reactflow）
+            variant: prompt 变体（fast_mode、preserve_layout、analyze_bottlenecks、附加指令等）
+        """
+        return json.dumps(
+            {
+                "endpoint": endpoint,
+                "provider": (provider or "").lower(),
+                "model": model_name or "",
+                "base_url": (base_url or "").rstrip("/"),
+                "variant": variant,
+            },
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+
+    def get(self, fingerprint: ImageFingerprint, namespace: str) -> Optional[Any]:
+        """
+        查找结果：先按字节精确匹配，再（开启近似匹配时）在同一命名空间内
+        找汉明距离最小、且内容比对通过的近似图片
+
+        Returns:
+            缓存的结果（JSON 可序列化对象）；未命中返回 None
+        """
+        now = self._clock()
+        with self._lock:
+            entries = self._load_locked()
+            exact_id = self._entry_id(namespace, fingerprint.sha256)
+            entry = entries.get(exact_id)
+            if entry is not None and self._is_expired(entry, now):
+                self._drop_locked(exact_id)
+                self._expired += 1
+                entry = None
+            if entry is not None:
+                entries.move_to_end(exact_id)
+                self._hits_exact += 1
+                return entry["value"]
+
+            best_id, best_distance = self._nearest_locked(fingerprint, namespace, now)
+            if best_id is None:
+                self._misses += 1
+                return None
+            entries.move_to_end(best_id)
+            self._hits_near += 1
+            logger.info(f"[VISION CACHE] Near-duplicate hit (distance={best_distance})")
+            return entries[best_id]["value"]
+
+    def put(self, fingerprint: ImageFingerprint, namespace: str, value: Any):
+        """写入结果（内存 + 磁盘），超出上限时淘汰最久未使用的条目"""
+        entry_id = self._entry_id(namespace, fingerprint.sha256)
+        entry = {
+            "namespace": namespace,
+            "sha256": fingerprint.sha256,
+            "dhash": fingerprint.dhash,
+            "aspect": fingerprint.aspect,
+            "detail": fingerprint.detail,
+            "value": value,
+            "created_at": self._clock(),
+        }
+        with self._lock:
+            entries = self._load_locked()
+            entries[entry_id] = entry
+            entries.move_to_end(entry_id)
+            self._stores += 1
+            while len(entries) > self._max_entries:
+                oldest = next(iter(entries))
+                self._drop_locked(oldest)
+        self._write_disk(entry_id, entry)
+
+    def clear(self):
+        """清空内存与磁盘"""
+        with self._lock:
+            entries = self._load_locked()
+            for entry_id in list(entries.keys()):
+                self._drop_locked(entry_id)
+
+    def get_stats(self) -> dict:
+        """获取缓存统计信息（精确/近似命中次数与命中率）"""
+        with self._lock:
+            hits = self._hits_exact + self._hits_near
+            lookups = hits + self._misses
+            return {
+                "entries": len(self._entries) if self._entries is not None else None,
+                "max_entries": self._max_entries,
+                "max_distance": self._max_distance,
+                "ttl_seconds": self._ttl,
+                "hits": hits,
+                "hits_exact": self._hits_exact,
+                "hits_near": self._hits_near,
+                "misses": self._misses,
+                "stores": self._stores,
+                "expired": self._expired,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            }
+
+    # ==================== 私有方法 ====================
+
+    @staticmethod
+    def _entry_id(namespace: str, sha256: str) -> str:
+        return hashlib.sha256(f"{namespace}\x00{sha256}".encode("utf-8")).hexdigest()
+
+    def _is_expired(self, entry: Dict[str, Any], now: float) -> bool:
+        return self._ttl > 0 and now - entry.get("created_at", 0) > self._ttl
+
+    def _nearest_locked(self, fingerprint: ImageFingerprint, namespace: str, now: float) -> Tuple[Optional[str], int]:
+        if self._max_distance <= 0 or fingerprint.dhash is None:
+            return None, -1
+
+        best_id, best_distance = None, self._max_distance + 1
+        expired_ids = []
+        for entry_id, entry in self._entries.items():
+            if entry["namespace"] != namespace or entry.get("dhash") is None:
+                continue
+            if self._is_expired(entry, now):
+                expired_ids.append(entry_id)
+                continue
+            aspect = entry.get("aspect") or 0.0
+            if fingerprint.aspect and aspect and abs(aspect - fingerprint.aspect) > _MAX_ASPECT_DRIFT * aspect:
+                continue
+            distance = (entry["dhash"] ^ fingerprint.dhash).bit_count()
+            if distance < best_distance and _detail_matches(entry.get("detail"), fingerprint.detail):
+                best_id, best_distance = entry_id, distance
+
+        for entry_id in expired_ids:
+            self._drop_locked(entry_id)
+            self._expired += 1
+        return best_id, best_distance
+
+    def _load_locked(self) -> "OrderedDict[str, Dict[str, Any]]":
+        if self._entries is not None:
+            return self._entries
+
+        loaded = []
+        if self._disk_path is not None and self._disk_path.exists():
+            for file in self._disk_path.glob("*.json"):
+                try:
+                    with open(file, "r", encoding="utf-8") as f:
+                        entry = json.load(f)
+                    loaded.append((entry.get("created_at", 0), file.stem, entry))
+                except (OSError, ValueError) as e:
+                    logger.debug(f"[VISION CACHE] Dropping unreadable entry {file.name}: {e}")
+                    self._unlink(file)
+
+        self._entries = OrderedDict()
+        for _, entry_id, entry in sorted(loaded, key=lambda item: item[0]):
+            self._entries[entry_id] = entry
+        while len(self._entries) > self._max_entries:
+            self._drop_locked(next(iter(self._entries)))
+        if loaded:
+            logger.info(f"[VISION CACHE] Loaded {len(self._entries)} entries from {self._disk_path}")
+        return self._entries
+
+    def _drop_locked(self, entry_id: str):
+        self._entries.pop(entry_id, None)
+        if self._disk_path is not None:
+            self._unlink(self._disk_path / f"{entry_id}.json")
+
+    def _write_disk(self, entry_id: str, entry: Dict[str, Any]):
+        if self._disk_path is None:
+            return
+        file = self._disk_path / f"{entry_id}.json"
+        tmp_file = file.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            self._disk_path.mkdir(parents=True, exist_ok=True)
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False)
+            # 原子替换，避免并发读到半个文件
+            os.replace(tmp_file, file)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"[VISION CACHE] Disk write failed for {entry_id[:12]}: {e}")
+            self._unlink(tmp_file)
+            return
+
+        with self._lock:
+            # 写盘期间该条目可能已被淘汰
+            if self._entries is not None and entry_id not in self._entries:
+                self._unlink(file)
+
+    @staticmethod
+    def _unlink(file: Path):
+        try:
+            file.unlink()
+        except OSError:
+            pass
+
+
+# ==================== 全局实例 ====================
+
+_cache: Optional[VisionResultCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_vision_result_cache() -> VisionResultCache:
+    """
+    获取全局视觉识别结果缓存（单例模式）
+
+    Returns:
+        VisionResultCache 实例
+    """
+    global _cache
+
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = VisionResultCache(
+                    max_entries=settings.VISION_CACHE_MAX_ENTRIES,
+                    max_distance=settings.VISION_CACHE_MAX_DISTANCE,
+                    ttl_seconds=settings.VISION_CACHE_TTL_SECONDS,
+                    disk_path=settings.VISION_CACHE_DISK_PATH or None,
+                )
+
+    return _cache
+
+
+def reset_vision_result_cache():
+    """重置全局视觉识别结果缓存（主要用于测试）"""
+    global _cache
+    _cache = None
+
+
+async def lookup_vision_result(
+    endpoint: str,
+    image_data: bytes,
+    provider: str,
+    model_name: Optional[str],
+    base_url: Optional[str] = None,
+    **variant,
+) -> Tuple[Optional[VisionCacheSlot], Optional[Any]]:
+    """
+    查询视觉识别结果缓存
+
+    Returns:
+        (slot, value)：命中时 value 为缓存结果；未命中时用 slot 调用 store_vision_result 回写。
+        缓存关闭时返回 (None, None)。
+    """
+    if not settings.VISION_CACHE_ENABLED or not image_data:
+        return None, None
+
+    cache = get_vision_result_cache()
+    fingerprint = await asyncio.to_thread(compute_fingerprint, image_data)
+    namespace = cache.make_namespace(endpoint, provider, model_name, base_url, **variant)
+    slot = VisionCacheSlot(fingerprint, namespace)
+    return slot, await asyncio.to_thread(cache.get, fingerprint, namespace)
+
+
+async def store_vision_result(slot: Optional[VisionCacheSlot], value: Any):
+    """回写视觉识别结果（slot 为 None 时忽略；写盘在线程池中执行）"""
+    if slot is None:
+        return
+    await asyncio.to_thread(get_vision_result_cache().put, slot.fingerprint, slot.namespace, value)
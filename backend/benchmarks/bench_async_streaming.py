@@ -0,0 +1,210 @@
+"""
+Benchmark: thread+queue 桥接流式 vs 原生异步流式
+
+对比旧实现（同步 SDK 流跑在默认线程池里，每个 token 再 run_in_executor(q.get) 一次）
+与 AIVisionService.generate_with_stream 的原生 AsyncOpenAI 路径在单个 worker 内能承载的并发流数量。
+上游用 httpx.MockTransport 模拟：固定首 token 延迟 + 固定 token 速率。
+
+同时在压测期间探测一次 loop.run_in_executor(None, ...) 的排队延迟，代表同进程里其它
+依赖线程池的请求（文件解析、同步 SDK 调用等）被拖慢的程度。
+
+Usage:
+    cd backend
+    python benchmarks/bench_async_streaming.py
+    python benchmarks/bench_async_streaming.py --concurrency 10 40 100 --tokens 50 --workers 32
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import queue
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+from openai import AsyncOpenAI, OpenAI
+
+from app.services.ai_vision import create_vision_service
+
+BASE_URL = "https://bench.invalid/v1"
+
+
+def _chunk_line(index: int) -> bytes:
+    chunk = {
+        "id": "bench",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": "bench-model",
+        "choices": [{"index": 0, "delta": {"content": f"tok{index} "}}],
+    }
+    return f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+
+
+def build_sync_client(tokens: int, first_token_delay: float, token_interval: float) -> OpenAI:
+    def body():
+        time.sleep(first_token_delay)
+        for i in range(tokens):
+            yield _chunk_line(i)
+            time.sleep(token_interval)
+        yield b"data: [DONE]\n\n"
+
+    def handler(request):
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=body())
+
+    return OpenAI(
+        api_key="bench",
+        base_url=BASE_URL,
+        max_retries=0,
+        http_client=httpx.Client(transport=httpx.MockTransport(handler)),
+    )
+
+
+def build_async_client(tokens: int, first_token_delay: float, token_interval: float) -> AsyncOpenAI:
+    async def body():
+        await asyncio.sleep(first_token_delay)
+        for i in range(tokens):
+            yield _chunk_line(i)
+            await asyncio.sleep(token_interval)
+        yield b"data: [DONE]\n\n"
+
+    async def handler(request):
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=body())
+
+    return AsyncOpenAI(
+        api_key="bench",
+        base_url=BASE_URL,
+        max_retries=0,
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+    )
+
+
+async def legacy_thread_bridge_stream(client: OpenAI, prompt: str):
+    """旧版 generate_with_stream 的 thread+queue 桥接逻辑（原样复刻用于对比）"""
+    q = queue.Queue()
+
+    def _openai_stream():
+        try:
+            stream = client.chat.completions.create(
+                model="bench-model",
+                messages=[{"role": "user", "content": prompt}],
+                stream=True,
+            )
+            for chunk in stream:
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    q.put(("data", delta))
+            q.put(("done", None))
+        except Exception as e:
+            q.put(("error", e))
+
+    loop = asyncio.get_event_loop()
+    loop.run_in_executor(None, _openai_stream)
+
+    while True:
+        msg_type, data = await loop.run_in_executor(None, q.get)
+        if msg_type == "error":
+            raise data
+        elif msg_type == "done":
+            break
+        else:
+            yield data
+
+
+async def _probe_executor_latency(delay: float) -> float:
+    await asyncio.sleep(delay)
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    await loop.run_in_executor(None, lambda: None)
+    return time.perf_counter() - started
+
+
+async def run_case(mode: str, concurrency: int, args) -> dict:
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    loop.set_default_executor(executor)
+
+    if mode == "thread-bridge":
+        client = build_sync_client(args.tokens, args.first_token_delay, args.token_interval)
+
+        def make_stream():
+            return legacy_thread_bridge_stream(client, "bench")
+    else:
+        client = build_async_client(args.tokens, args.first_token_delay, args.token_interval)
+        service = create_vision_service("custom", api_key="bench", base_url=BASE_URL, model_name="bench-model")
+        service._get_async_openai_client = lambda: client
+
+        def make_stream():
+            return service.generate_with_stream("bench")
+
+    async def one_stream():
+        started = time.perf_counter()
+        first = None
+        count = 0
+        async for _ in make_stream():
+            if first is None:
+                first = time.perf_counter() - started
+            count += 1
+        return first, time.perf_counter() - started, count
+
+    # 预热：排除 SDK 首次调用的平台探测等一次性开销
+    await one_stream()
+
+    ideal = args.first_token_delay + args.tokens * args.token_interval
+    probe = asyncio.create_task(_probe_executor_latency(ideal / 2))
+    started = time.perf_counter()
+    results = await asyncio.gather(*(one_stream() for _ in range(concurrency)))
+    wall = time.perf_counter() - started
+    probe_latency = await probe
+    executor.shutdown(wait=True)
+
+    ttfts = sorted(r[0] for r in results if r[0] is not None)
+    durations = sorted(r[1] for r in results)
+    return {
+        "mode": mode,
+        "concurrency": concurrency,
+        "wall_s": round(wall, 3),
+        "ideal_stream_s": round(ideal, 3),
+        "p50_ttft_s": round(ttfts[len(ttfts) // 2], 3),
+        "max_ttft_s": round(ttfts[-1], 3),
+        "p50_stream_s": round(durations[len(durations) // 2], 3),
+        "streams_per_s": round(concurrency / wall, 2),
+        "executor_probe_s": round(probe_latency, 3),
+        "tokens_ok": all(r[2] == args.tokens for r in results),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Streams-per-worker benchmark for generate_with_stream")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 40, 100])
+    parser.add_argument("--tokens", type=int, default=40)
+    parser.add_argument("--first-token-delay", type=float, default=0.2)
+    parser.add_argument("--token-interval", type=float, default=0.02)
+    parser.add_argument("--workers", type=int, default=min(32, (os.cpu_count() or 1) + 4),
+                        help="default executor size (asyncio default: min(32, cpu+4))")
+    parser.add_argument("--json", help="optional path to write the JSON report")
+    args = parser.parse_args()
+
+    rows = []
+    for concurrency in args.concurrency:
+        for mode in ("thread-bridge", "native-async"):
+            row = asyncio.run(run_case(mode, concurrency, args))
+            rows.append(row)
+            print(
+                f"{mode:14s} n={concurrency:<4d} wall={row['wall_s']:>7.3f}s "
+                f"p50_ttft={row['p50_ttft_s']:.3f}s max_ttft={row['max_ttft_s']:.3f}s "
+                f"streams/s={row['streams_per_s']:>7.2f} executor_probe={row['executor_probe_s']:.3f}s "
+                f"ok={row['tokens_ok']}"
+            )
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"workers": args.workers, "results": rows}, f, indent=2)
+        print(f"Report written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
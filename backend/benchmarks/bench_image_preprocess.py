@@ -0,0 +1,134 @@
+"""
+Benchmark: 原图直传 vs ImagePreprocessor 预处理后上传
+
+对示例流程图截图（tests/ 下的真实截图 + 按分辨率生成的架构图截图）分别统计：
+- 原始字节数 / 预处理后字节数 / base64 载荷节省
+- 预处理耗时（首次）与复用耗时（failover 第二次尝试命中缓存）
+- 按给定上行带宽估算的上传耗时变化（旧实现每次尝试都重新 base64 原图）
+
+Usage:
+    cd backend
+    python benchmarks/bench_image_preprocess.py
+    python benchmarks/bench_image_preprocess.py --profile claude --uplink-mbps 5 --attempts 3
+    python benchmarks/bench_image_preprocess.py --images path/to/a.png path/to/b.jpg
+"""
+
+import argparse
+import base64
+import io
+import os
+import sys
+import time
+from typing import List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw
+
+from app.services.image_preprocessor import ImagePreprocessor
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_SCREENSHOT = os.path.join(BACKEND_DIR, "tests", "8d8c58ed11c145efbd76c954b4fe6233.png")
+
+DEFAULT_MAX_EDGES = {"claude": 1568, "openai": 2048, "gemini": 3072, "siliconflow": 2048}
+
+
+def render_diagram(width: int, height: int, fmt: str) -> bytes:
+    """生成类似架构图截图的图片：分层色块 + 连线 + 文字 + 轻微渐变背景"""
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    for y in range(0, height, 4):
+        shade = 250 - int(8 * y / height)
+        draw.line([0, y, width, y], fill=(shade, shade, 255))
+
+    columns, rows = 6, 4
+    box_w, box_h = width // (columns * 2), height // (rows * 3)
+    for row in range(rows):
+        for col in range(columns):
+            x = int((col * 2 + 0.5) * box_w)
+            y = int((row * 3 + 1) * box_h)
+            draw.rounded_rectangle([x, y, x + box_w, y + box_h], radius=12, outline="#1e3a8a", fill="#dbeafe", width=3)
+            draw.text((x + 10, y + 10), f"Service {row}-{col}", fill="black")
+            if col < columns - 1:
+                draw.line([x + box_w, y + box_h // 2, x + 2 * box_w, y + box_h // 2], fill="#334155", width=3)
+
+    buffer = io.BytesIO()
+    if fmt == "JPEG":
+        image.save(buffer, format="JPEG", quality=95)
+    else:
+        image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def load_samples(paths: List[str]) -> List[Tuple[str, bytes]]:
+    samples = []
+    for path in paths:
+        with open(path, "rb") as f:
+            samples.append((os.path.basename(path), f.read()))
+    if samples:
+        return samples
+
+    if os.path.exists(SAMPLE_SCREENSHOT):
+        with open(SAMPLE_SCREENSHOT, "rb") as f:
+            samples.append(("sample_screenshot.png", f.read()))
+    for width, height, fmt in [(1920, 1080, "PNG"), (2880, 1800, "PNG"), (3840, 2160, "PNG"), (3840, 2160, "JPEG")]:
+        samples.append((f"diagram_{width}x{height}.{fmt.lower()}", render_diagram(width, height, fmt)))
+    return samples
+
+
+def legacy_payload(image_data: bytes, attempts: int) -> Tuple[int, float]:
+    """旧实现：每次尝试都对原图 base64，返回 (单次载荷字节数, 总编码耗时)"""
+    start = time.perf_counter()
+    for _ in range(attempts):
+        encoded = base64.b64encode(image_data).decode("utf-8")
+    return len(encoded), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Vision image preprocessing benchmark")
+    parser.add_argument("--images", nargs="*", default=[], help="image files (default: bundled + generated samples)")
+    parser.add_argument("--profile", default="claude", choices=sorted(DEFAULT_MAX_EDGES))
+    parser.add_argument("--quality", type=int, default=85)
+    parser.add_argument("--uplink-mbps", type=float, default=10.0, help="assumed client->provider upload bandwidth")
+    parser.add_argument("--attempts", type=int, default=2, help="vision attempts per request (failover)")
+    args = parser.parse_args()
+
+    bytes_per_second = args.uplink_mbps * 1_000_000 / 8
+    print(f"profile={args.profile} max_edge={DEFAULT_MAX_EDGES[args.profile]} quality={args.quality} "
+          f"uplink={args.uplink_mbps}Mbps attempts={args.attempts}")
+    print(f"{'image':<28} {'orig_kb':>8} {'new_kb':>7} {'b64_saved':>9} {'size':>11} "
+          f"{'prep_ms':>8} {'reuse_ms':>8} {'legacy_ms':>10} {'new_ms':>8}")
+
+    total_before = total_after = 0
+    for name, image_data in load_samples(args.images):
+        preprocessor = ImagePreprocessor(max_edges=DEFAULT_MAX_EDGES, jpeg_quality=args.quality)
+
+        legacy_b64_len, legacy_encode_s = legacy_payload(image_data, args.attempts)
+        legacy_ms = (legacy_encode_s + args.attempts * legacy_b64_len / bytes_per_second) * 1000
+
+        start = time.perf_counter()
+        prepared = preprocessor.prepare(image_data, args.profile)
+        new_b64_len = len(prepared.b64)
+        prep_s = time.perf_counter() - start
+
+        reuse_start = time.perf_counter()
+        for _ in range(args.attempts - 1):
+            preprocessor.prepare(image_data, args.profile).b64
+        reuse_s = time.perf_counter() - reuse_start
+
+        new_ms = (prep_s + reuse_s + args.attempts * new_b64_len / bytes_per_second) * 1000
+        total_before += legacy_b64_len
+        total_after += new_b64_len
+
+        print(
+            f"{name:<28} {len(image_data) / 1024:>8.0f} {len(prepared.data) / 1024:>7.0f} "
+            f"{1 - new_b64_len / legacy_b64_len:>8.0%} {f'{prepared.width}x{prepared.height}':>11} "
+            f"{prep_s * 1000:>8.1f} {reuse_s * 1000:>8.2f} {legacy_ms:>10.0f} {new_ms:>8.0f}"
+        )
+
+    print(f"total base64 payload: {total_before / 1024:.0f} KB -> {total_after / 1024:.0f} KB "
+          f"({1 - total_after / max(total_before, 1):.0%} saved per attempt)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Benchmark: 增量 Prompt 中现有画布的编码体积（旧 json.dumps(model_dump(), indent=2) vs 紧凑编码）
+
+画布由 ChatGeneratorService._mock_* 示例图复制放大到指定节点数（保留 iconType / color 等样式字段）。
+对每个画布规模统计：
+- legacy:         旧实现嵌入的 JSON（indent=2，完整 model_dump）
+- legacy_compact: 同样的 JSON 去掉缩进（单独衡量 pretty-print 的开销）
+- codec:          GraphCodec 紧凑编码（短 id / 量化坐标 / 类型字典 / 邻接表）
+- codec_no_pos:   紧凑编码且不输出坐标
+以及完整增量 Prompt 的 token 数（全量画布 / 经 _scope_incremental_graph 裁剪为相关 k 跳子图）、
+编码耗时与紧凑编码的往返校验。
+
+安装了 tiktoken 时使用 cl100k_base 计数，否则使用近似分词（英文按 4 字符 / 数字按 3 位 / 汉字按 1 字计一个 token）。
+
+Usage:
+    cd backend
+    python benchmarks/bench_prompt_encoding.py
+    python benchmarks/bench_prompt_encoding.py --nodes 10 50 150 500 --encoding o200k_base
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import time
+from typing import Callable, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.models.schemas import ChatGenerationRequest, Edge, Node
+from app.services.chat_generator import ChatGeneratorService
+from app.services.graph_codec import GraphCodec
+
+_APPROX_TOKEN = re.compile(r"[A-Za-z]+|\d{1,3}|[\u4e00-\u9fff]|\s+|[^\sA-Za-z\d\u4e00-\u9fff]")
+
+
+def build_canvas(node_count: int) -> Tuple[List[Node], List[Edge]]:
+    """复制 _mock_* 示例图直到达到目标节点数，副本之间串一条边"""
+    service = ChatGeneratorService()
+    templates = [
+        service._mock_microservice_architecture(),
+        service._mock_high_concurrency(),
+        service._mock_oom_investigation(),
+        service._mock_architecture_overview(),
+    ]
+    nodes: List[Node] = []
+    edges: List[Edge] = []
+    copy_index = 0
+    while len(nodes) < node_count:
+        template = templates[copy_index % len(templates)]
+        offset_y = copy_index * 400
+        for node in template["nodes"][:node_count - len(nodes)]:
+            node = json.loads(json.dumps(node))
+            node["id"] = f"{node['id']}-{copy_index}"
+            node["position"]["y"] += offset_y
+            nodes.append(Node(**node))
+        known = {node.id for node in nodes}
+        for edge in template["edges"]:
+            source, target = f"{edge['source']}-{copy_index}", f"{edge['target']}-{copy_index}"
+            if source in known and target in known:
+                edges.append(Edge(id=f"{edge['id']}-{copy_index}", source=source, target=target, label=edge.get("label")))
+        if copy_index:
+            edges.append(Edge(id=f"link-{copy_index}", source=nodes[0].id, target=f"{template['nodes'][0]['id']}-{copy_index}"))
+        copy_index += 1
+    return nodes, edges
+
+
+def make_counter(encoding_name: str) -> Tuple[str, Callable[[str], int]]:
+    try:
+        import tiktoken
+    except ImportError:
+        return "approx", lambda text: sum(
+            (len(token) + 3) // 4 if token[0].isalpha() else 1 for token in _APPROX_TOKEN.findall(text)
+        )
+    encoding = tiktoken.get_encoding(encoding_name)
+    return encoding_name, lambda text: len(encoding.encode(text))
+
+
+def best_of(repeat: int, fn: Callable[[], object]) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Incremental prompt graph encoding size benchmark")
+    parser.add_argument("--nodes", type=int, nargs="+", default=[10, 50, 150, 500])
+    parser.add_argument("--encoding", default="cl100k_base", help="tiktoken encoding name (if installed)")
+    parser.add_argument("--repeat", type=int, default=5, help="best-of repeats for encode timing")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    tokenizer, count_tokens = make_counter(args.encoding)
+    service = ChatGeneratorService()
+    request = ChatGenerationRequest(user_input="在订单服务前面加一层 Redis 缓存", incremental_mode=True)
+
+    print(f"Tokenizer: {tokenizer}")
+    print(
+        f"{'nodes':>6s} {'edges':>6s} | {'legacy':>8s} {'no-indent':>9s} {'codec':>8s} {'no-pos':>8s} "
+        f"{'ratio':>6s} | {'prompt':>8s} {'scoped':>8s} {'legacy ms':>9s} {'codec ms':>8s} round-trip"
+    )
+    for node_count in args.nodes:
+        nodes, edges = build_canvas(node_count)
+        graph = {"nodes": [n.model_dump() for n in nodes], "edges": [e.model_dump() for e in edges]}
+        legacy = json.dumps(graph, ensure_ascii=False, indent=2)
+        legacy_compact = json.dumps(graph, ensure_ascii=False, separators=(",", ":"))
+        codec = GraphCodec(nodes, edges)
+        compact = codec.encode()
+        no_positions = GraphCodec(nodes, edges, position_grid=None).encode()
+        prompt = service._build_incremental_prompt(request, nodes, edges, codec)
+        scoped_nodes, scoped_edges, omitted_summary = service._scope_incremental_graph(request.user_input, nodes, edges)
+        scoped_prompt = service._build_incremental_prompt(
+            request, nodes, edges, GraphCodec(scoped_nodes, scoped_edges), omitted_summary
+        )
+
+        decoded_nodes, decoded_edges = codec.decode(compact)
+        round_trip = (
+            [(n.id, n.type, n.data.label) for n in decoded_nodes] == [(n.id, n.type, n.data.label) for n in nodes]
+            # 邻接表按源节点分组，边的顺序会变
+            and sorted((e.source, e.target, e.label or "") for e in decoded_edges)
+            == sorted((e.source, e.target, e.label or "") for e in edges)
+        )
+
+        legacy_tokens = count_tokens(legacy)
+        codec_tokens = count_tokens(compact)
+        legacy_ms = best_of(args.repeat, lambda: json.dumps(
+            {"nodes": [n.model_dump() for n in nodes], "edges": [e.model_dump() for e in edges]},
+            ensure_ascii=False, indent=2,
+        )) * 1000
+        codec_ms = best_of(args.repeat, lambda: GraphCodec(nodes, edges).encode()) * 1000
+        print(
+            f"{len(nodes):>6d} {len(edges):>6d} | {legacy_tokens:>8d} {count_tokens(legacy_compact):>9d} "
+            f"{codec_tokens:>8d} {count_tokens(no_positions):>8d} x{legacy_tokens / codec_tokens:>5.1f} | "
+            f"{count_tokens(prompt):>8d} {count_tokens(scoped_prompt):>8d} {legacy_ms:>9.2f} {codec_ms:>8.2f} {'ok' if round_trip else 'MISMATCH'}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Benchmark: RAG fallback 检索（逐块重扫 vs BM25 倒排索引）
+
+合成中英混合的架构文档分块（每块约 --chunk-words 个英文词 + 若干中文短语），对每个语料规模比较：
+- linear: 旧实现，每次查询对全部分块正则分词、构建 Counter、余弦 + 覆盖率打分，再全量排序
+- bm25:   BM25Index，上传时建索引，查询只遍历查询词的 postings，heapq 取 top-k
+另外测量索引构建（整库重建，对应启动加载）、单个分块增量添加与删除的耗时。
+linear 在大语料下很慢，超过 --linear-max-chunks 的规模跳过。
+
+Usage:
+    cd backend
+    python benchmarks/bench_rag_fallback.py
+    python benchmarks/bench_rag_fallback.py --chunks 1000 10000 100000 --queries 50 --top-k 5
+"""
+
+import argparse
+import logging
+import math
+import os
+import random
+import sys
+import time
+from collections import Counter
+from typing import Any, Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.lexical_index import BM25Index, tokenize
+
+_TERMS = [
+    "gateway", "authentication", "cache", "redis", "database", "replica", "shard", "queue", "kafka",
+    "consumer", "producer", "latency", "throughput", "service", "mesh", "sidecar", "circuit", "breaker",
+    "retry", "timeout", "load", "balancer", "kubernetes", "pod", "deployment", "rollback", "canary",
+    "metrics", "tracing", "logging", "alert", "storage", "object", "bucket", "cdn", "edge", "token",
+    "session", "oauth", "rate", "limit", "index", "partition", "consistency", "availability", "backup",
+]
+_PHRASES = ["网关鉴权", "缓存穿透", "数据库分片", "消息队列", "服务熔断", "限流降级", "读写分离", "灰度发布"]
+_QUERIES = [
+    "how to configure gateway authentication",
+    "redis cache replica consistency",
+    "kafka consumer latency and retry",
+    "服务熔断 circuit breaker timeout",
+    "数据库分片 shard partition",
+    "canary deployment rollback",
+]
+
+
+def build_corpus(chunk_count: int, words_per_chunk: int, seed: int = 7) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    # Zipf 分布的词频：少数常用词出现在大量分块中，接近真实文档
+    weights = [1 / (rank + 1) for rank in range(len(_TERMS))]
+    chunks = []
+    for i in range(chunk_count):
+        words = rng.choices(_TERMS, weights=weights, k=words_per_chunk)
+        phrase = rng.choice(_PHRASES)
+        chunks.append({
+            "chunk_id": f"doc-{i // 20}_{i % 20}",
+            "document_id": f"doc-{i // 20}",
+            "content": f"Section {i}: {' '.join(words)}. {phrase}。",
+        })
+    return chunks
+
+
+def legacy_score(query: str, content: str) -> float:
+    q_tokens = tokenize(query)
+    d_tokens = tokenize(content)
+    if not q_tokens or not d_tokens:
+        return 0.0
+    a, b = Counter(q_tokens), Counter(d_tokens)
+    numerator = sum(a[t] * b[t] for t in set(a) & set(b))
+    cosine = numerator / (math.sqrt(sum(v * v for v in a.values())) * math.sqrt(sum(v * v for v in b.values())))
+    coverage = len(set(q_tokens) & set(d_tokens)) / max(len(set(q_tokens)), 1)
+    return 0.7 * cosine + 0.3 * coverage
+
+
+def legacy_search(chunks: List[Dict[str, Any]], query: str, top_k: int) -> List[Tuple[float, Dict[str, Any]]]:
+    ranked = []
+    for chunk in chunks:
+        score = legacy_score(query, chunk["content"])
+        if score > 0:
+            ranked.append((score, chunk))
+    ranked.sort(key=lambda x: x[0], reverse=True)
+    return ranked[:top_k]
+
+
+def time_queries(search, queries: List[str]) -> float:
+    started = time.perf_counter()
+    for query in queries:
+        search(query)
+    return (time.perf_counter() - started) * 1000 / len(queries)
+
+
+def run(chunk_count: int, args) -> Dict[str, float]:
+    chunks = build_corpus(chunk_count, args.chunk_words)
+    queries = [_QUERIES[i % len(_QUERIES)] for i in range(args.queries)]
+    result: Dict[str, float] = {}
+
+    started = time.perf_counter()
+    index = BM25Index()
+    for chunk in chunks:
+        index.add(chunk["chunk_id"], chunk["content"], chunk)
+    result["build_ms"] = (time.perf_counter() - started) * 1000
+
+    result["bm25_ms"] = time_queries(lambda query: index.search(query, args.top_k), queries)
+    if chunk_count <= args.linear_max_chunks:
+        linear_queries = queries[:max(1, min(len(queries), args.linear_queries))]
+        result["linear_ms"] = time_queries(lambda query: legacy_search(chunks, query, args.top_k), linear_queries)
+
+    extra = build_corpus(args.queries, args.chunk_words, seed=11)
+    started = time.perf_counter()
+    for chunk in extra:
+        index.add(f"extra-{chunk['chunk_id']}", chunk["content"], chunk)
+    result["add_us"] = (time.perf_counter() - started) * 1e6 / len(extra)
+    started = time.perf_counter()
+    for chunk in extra:
+        index.remove(f"extra-{chunk['chunk_id']}")
+    result["remove_us"] = (time.perf_counter() - started) * 1e6 / len(extra)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG fallback lexical search benchmark")
+    parser.add_argument("--chunks", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--chunk-words", type=int, default=80, help="English words per synthetic chunk")
+    parser.add_argument("--queries", type=int, default=60)
+    parser.add_argument("--linear-queries", type=int, default=6, help="queries timed for the linear scan")
+    parser.add_argument("--linear-max-chunks", type=int, default=100000)
+    parser.add_argument("--top-k", type=int, default=5)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    print(f"{'chunks':>8s} | {'build ms':>9s} {'add us':>7s} {'remove us':>9s} | "
+          f"{'linear ms/q':>11s} {'bm25 ms/q':>9s} {'speedup':>8s}")
+    for chunk_count in args.chunks:
+        result = run(chunk_count, args)
+        linear = result.get("linear_ms")
+        linear_text = f"{linear:>11.2f}" if linear is not None else f"{'-':>11s}"
+        speedup = f"{linear / result['bm25_ms']:>7.0f}x" if linear is not None else f"{'-':>8s}"
+        print(
+            f"{chunk_count:>8d} | {result['build_ms']:>9.0f} {result['add_us']:>7.1f} {result['remove_us']:>9.1f} | "
+            f"{linear_text} {result['bm25_ms']:>9.2f} {speedup}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Benchmark: stdlib json vs app.core.serialization（orjson / msgspec 可用时）
+
+场景：
+- canvas_persist:  5K 节点大画布的会话持久化（旧：json.dumps(indent=2, ensure_ascii=False)）
+- canvas_size:     会话大小检查（旧：len(json.dumps(session_data, default=str))）
+- canvas_load:     会话 / RAG 索引文件解码（旧：json.loads）
+- sse_session:     长 SSE 会话中逐帧编码 [PARTIAL_NODE] / [PARTIAL_ELEMENT]
+                   （旧：f"data: [PARTIAL_NODE] {json.dumps(payload, ensure_ascii=False)}\\n\\n"）
+
+输出每个场景的耗时、吞吐（MB/s 或 frames/s）与加速比。
+
+Usage:
+    cd backend
+    python benchmarks/bench_serialization.py
+    python benchmarks/bench_serialization.py --nodes 5000 20000 --frames 20000 --repeat 5
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.core import serialization
+from app.core.serialization import json_dumps, json_dumps_bytes, json_loads, json_size
+
+
+def build_session(node_count: int) -> Dict[str, Any]:
+    """与 CanvasSessionManager 内存结构一致的大画布会话"""
+    nodes = [
+        {
+            "id": f"node-{i}",
+            "type": ["api", "service", "database", "cache", "queue"][i % 5],
+            "position": {"x": 180.0 * (i % 40), "y": 140.0 * (i // 40)},
+            "data": {"label": f"服务 {i} / Service {i}", "shape": "rectangle", "iconType": None, "color": "#2563eb"},
+        }
+        for i in range(node_count)
+    ]
+    edges = [
+        {"id": f"e-{i}", "source": f"node-{i - 1}", "target": f"node-{i}", "label": "calls" if i % 3 else None}
+        for i in range(1, node_count)
+    ]
+    return {
+        "nodes": nodes,
+        "edges": edges,
+        "timestamp": datetime.now(),
+        "node_count": len(nodes),
+        "edge_count": len(edges),
+        "created_at": datetime.now(),
+    }
+
+
+def best_of(repeat: int, fn: Callable[[], Any]) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def report(name: str, size: int, legacy: float, fast: float, unit: str, amount: float):
+    print(
+        f"{name:15s} n={size:<6d} stdlib={legacy * 1000:>8.2f}ms ({amount / legacy:>10.1f} {unit}) "
+        f"{serialization.BACKEND}={fast * 1000:>8.2f}ms ({amount / fast:>10.1f} {unit}) x{legacy / fast:.1f}"
+    )
+
+
+def run_canvas(node_count: int, repeat: int):
+    session = build_session(node_count)
+    persisted = dict(session, timestamp=session["timestamp"].isoformat(), created_at=session["created_at"].isoformat())
+    encoded = json.dumps(persisted, ensure_ascii=False, indent=2)
+    megabytes = len(encoded.encode("utf-8")) / 1024 / 1024
+
+    legacy = best_of(repeat, lambda: json.dumps(persisted, ensure_ascii=False, indent=2).encode("utf-8"))
+    fast = best_of(repeat, lambda: json_dumps_bytes(persisted, indent=True))
+    report("canvas_persist", node_count, legacy, fast, "MB/s", megabytes)
+
+    legacy = best_of(repeat, lambda: len(json.dumps(session, default=str)))
+    fast = best_of(repeat, lambda: json_size(session))
+    report("canvas_size", node_count, legacy, fast, "MB/s", megabytes)
+
+    raw = encoded.encode("utf-8")
+    legacy = best_of(repeat, lambda: json.loads(raw.decode("utf-8")))
+    fast = best_of(repeat, lambda: json_loads(raw))
+    report("canvas_load", node_count, legacy, fast, "MB/s", megabytes)
+
+
+def run_sse(frame_count: int, repeat: int):
+    payloads: List[Dict[str, Any]] = []
+    for i in range(frame_count):
+        if i % 2:
+            payloads.append({
+                "id": f"el-{i}", "type": "rectangle", "x": i * 1.5, "y": i * 0.5, "width": 180, "height": 72,
+                "strokeColor": "#1e3a8a", "backgroundColor": "#dbeafe", "text": f"组件 {i}",
+            })
+        else:
+            payloads.append({
+                "id": f"node-{i}", "type": "service", "position": {"x": i * 10, "y": 0},
+                "data": {"label": f"服务 {i}", "shape": "task"}, "index": i,
+            })
+
+    def legacy():
+        for payload in payloads:
+            f"data: [PARTIAL_NODE] {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    def fast():
+        for payload in payloads:
+            f"data: [PARTIAL_NODE] {json_dumps(payload)}\n\n"
+
+    report("sse_session", frame_count, best_of(repeat, legacy), best_of(repeat, fast), "frames/s", frame_count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serialization throughput benchmark")
+    parser.add_argument("--nodes", type=int, nargs="+", default=[5000])
+    parser.add_argument("--frames", type=int, nargs="+", default=[10000])
+    parser.add_argument("--repeat", type=int, default=5, help="best-of repeats per measurement")
+    args = parser.parse_args()
+
+    print(f"Serialization backend: {serialization.BACKEND}")
+    for node_count in args.nodes:
+        run_canvas(node_count, args.repeat)
+    for frame_count in args.frames:
+        run_sse(frame_count, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Benchmark: 会话快照格式的磁盘大小与加载时间（旧 JSON vs 二进制快照）
+
+对每个画布规模比较：
+- json-indent:  旧格式（indent=2 的完整 model_dump），json.load + 逐个 Node(**n) / Edge(**e) 校验
+- json-compact: 紧凑 JSON（FileSessionStore json 格式），json_loads + Node(**n) / Edge(**e)
+- snap-<codec>: 二进制快照（none / zlib / zstd），分别测量
+    * meta:  只解码（会话字段、节点数可用，不构建节点）
+    * dicts: 解码 + 构建节点 / 边字典（会话管理器加载的路径）
+    * models: 解码 + SessionGraph.from_dicts()（首次 get_session_graph 构建模型的路径）
+加载时间取 --repeat 次中的最小值，包含读文件。
+
+Usage:
+    cd backend
+    python benchmarks/bench_session_snapshot.py
+    python benchmarks/bench_session_snapshot.py --nodes 1000 10000 --repeat 5
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_session_store import build_snapshot
+from app.core.serialization import json_loads, write_bytes_file, write_json_file
+from app.models.schemas import Edge, Node
+from app.services.session_graph import SessionGraph
+from app.services.session_snapshot import available_compressions, decode_snapshot, encode_snapshot
+
+
+def best_ms(fn: Callable[[], object], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def load_json_validated(path: Path, loads: Callable[[bytes], Dict]) -> None:
+    session = loads(path.read_bytes())
+    [Node(**node) for node in session["nodes"]]
+    [Edge(**edge) for edge in session["edges"]]
+
+
+def run(node_count: int, directory: str, repeat: int) -> List[Dict[str, object]]:
+    snapshot = build_snapshot(node_count)
+    rows: List[Dict[str, object]] = []
+
+    indent_file = Path(directory, f"indent-{node_count}.json")
+    with open(indent_file, "w", encoding="utf-8") as f:
+        json.dump(snapshot, f, ensure_ascii=False, indent=2)
+    rows.append({
+        "format": "json-indent",
+        "bytes": indent_file.stat().st_size,
+        "encode": best_ms(lambda: json.dumps(snapshot, ensure_ascii=False, indent=2), repeat),
+        "load": best_ms(lambda: load_json_validated(indent_file, json.loads), repeat),
+    })
+
+    compact_file = Path(directory, f"compact-{node_count}.json")
+    write_json_file(compact_file, snapshot, indent=False)
+    rows.append({
+        "format": "json-compact",
+        "bytes": compact_file.stat().st_size,
+        "encode": best_ms(lambda: write_json_file(compact_file, snapshot, indent=False), repeat),
+        "load": best_ms(lambda: load_json_validated(compact_file, json_loads), repeat),
+    })
+
+    for codec in available_compressions():
+        snap_file = Path(directory, f"{codec}-{node_count}.snap")
+        write_bytes_file(snap_file, encode_snapshot(snapshot, codec))
+        rows.append({
+            "format": f"snap-{codec}",
+            "bytes": snap_file.stat().st_size,
+            "encode": best_ms(lambda: encode_snapshot(snapshot, codec), repeat),
+            "meta": best_ms(lambda: decode_snapshot(snap_file.read_bytes()).node_count, repeat),
+            "load": best_ms(lambda: decode_snapshot(snap_file.read_bytes()).to_session(), repeat),
+            "models": best_ms(lambda: _load_models(snap_file), repeat),
+        })
+    return rows
+
+
+def _load_models(path: Path) -> None:
+    snapshot = decode_snapshot(path.read_bytes())
+    SessionGraph.from_dicts(snapshot.nodes, snapshot.edges)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Canvas session snapshot size / load time benchmark")
+    parser.add_argument("--nodes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    directory = tempfile.mkdtemp(prefix="bench-snapshot-")
+    try:
+        for node_count in args.nodes:
+            rows = run(node_count, directory, args.repeat)
+            baseline = rows[0]["bytes"]
+            print(f"\n{node_count} nodes / {node_count - 1} edges")
+            print(f"{'format':>13s} | {'size KB':>8s} {'ratio':>6s} | {'encode ms':>9s} {'meta ms':>8s} "
+                  f"{'load ms':>8s} {'models ms':>9s}")
+            for row in rows:
+                meta = f"{row['meta']:>8.2f}" if "meta" in row else f"{'-':>8s}"
+                models = f"{row['models']:>9.2f}" if "models" in row else f"{row['load']:>9.2f}"
+                print(
+                    f"{row['format']:>13s} | {row['bytes'] / 1024:>8.1f} {baseline / row['bytes']:>5.1f}x | "
+                    f"{row['encode']:>9.2f} {meta} {row['load']:>8.2f} {models}"
+                )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Benchmark: 会话存储后端的多进程保存 / 加载吞吐（file vs sqlite）
+
+模拟 uvicorn 多 worker：启动 W 个进程共享同一个存储（同一目录 / 同一数据库文件），
+在屏障处同时开始：
+- save:  每个 worker 逐个保存自己的 N 个会话（每次一个事务，对应同步写盘或写回队列的单会话批次）
+- batch: 每个 worker 以 --batch 个会话为一批 save_many（对应写回队列一次刷盘）
+- load:  每个 worker 随机加载全部 worker 保存的会话（跨进程可见性 + 并发读）
+吞吐 = 全部 worker 的操作数 / 从最早开始到最晚结束的墙钟时间。
+
+会话快照与 CanvasSessionManager 持久化的结构一致（nodes / edges / timestamp / version ...）。
+
+Usage:
+    cd backend
+    python benchmarks/bench_session_store.py
+    python benchmarks/bench_session_store.py --workers 1 2 4 8 --sessions 500 --nodes 100
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.core.serialization import json_size
+from app.services.session_store import create_session_store
+
+
+def build_snapshot(node_count: int, version: int = 1) -> Dict[str, Any]:
+    now = datetime.now().isoformat()
+    nodes = [
+        {
+            "id": f"node-{i}",
+            "type": ["api", "service", "database", "cache", "queue"][i % 5],
+            "position": {"x": 180.0 * (i % 20), "y": 140.0 * (i // 20)},
+            "data": {"label": f"服务 {i} / Service {i}", "shape": "rectangle", "iconType": None, "color": "#2563eb"},
+        }
+        for i in range(node_count)
+    ]
+    edges = [
+        {"id": f"e-{i}", "source": f"node-{i - 1}", "target": f"node-{i}", "label": "calls" if i % 3 else None}
+        for i in range(1, node_count)
+    ]
+    return {
+        "nodes": nodes,
+        "edges": edges,
+        "timestamp": now,
+        "node_count": len(nodes),
+        "edge_count": len(edges),
+        "created_at": now,
+        "version": version,
+    }
+
+
+def worker(backend: str, directory: str, worker_id: int, worker_count: int, args, barrier, results):
+    logging.disable(logging.INFO)
+    store = create_session_store(backend, directory, os.path.join(directory, "sessions.db"))
+    snapshot = build_snapshot(args.nodes)
+    own_ids = [f"canvas-w{worker_id}-{i}" for i in range(args.sessions)]
+    timings: Dict[str, Tuple[float, float]] = {}
+
+    barrier.wait()
+    started = time.time()
+    for session_id in own_ids:
+        store.save(session_id, snapshot)
+    timings["save"] = (started, time.time())
+
+    barrier.wait()
+    started = time.time()
+    batch_snapshot = dict(snapshot, version=2)
+    for offset in range(0, len(own_ids), args.batch):
+        store.save_many([(session_id, batch_snapshot) for session_id in own_ids[offset:offset + args.batch]])
+    timings["batch"] = (started, time.time())
+
+    barrier.wait()
+    rng = random.Random(worker_id)
+    all_ids = [f"canvas-w{w}-{i}" for w in range(worker_count) for i in range(args.sessions)]
+    missing = 0
+    started = time.time()
+    for session_id in rng.choices(all_ids, k=args.sessions):
+        if store.load(session_id) is None:
+            missing += 1
+    timings["load"] = (started, time.time())
+
+    store.close()
+    results.put((timings, missing))
+
+
+def run(backend: str, worker_count: int, args) -> Dict[str, float]:
+    directory = tempfile.mkdtemp(prefix=f"bench-sessions-{backend}-")
+    try:
+        # 先在主进程建表，避免多个 worker 同时初始化
+        create_session_store(backend, directory, os.path.join(directory, "sessions.db")).close()
+        barrier = multiprocessing.Barrier(worker_count)
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=worker, args=(backend, directory, w, worker_count, args, barrier, results))
+            for w in range(worker_count)
+        ]
+        for process in processes:
+            process.start()
+        collected: List[Tuple[Dict[str, Tuple[float, float]], int]] = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    throughput = {}
+    for phase in ("save", "batch", "load"):
+        begin = min(timings[phase][0] for timings, _ in collected)
+        end = max(timings[phase][1] for timings, _ in collected)
+        throughput[phase] = worker_count * args.sessions / max(end - begin, 1e-9)
+    throughput["missing"] = sum(missing for _, missing in collected)
+    return throughput
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-process canvas session store throughput benchmark")
+    parser.add_argument("--backends", nargs="+", default=["file", "sqlite"], choices=["file", "sqlite"])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--sessions", type=int, default=300, help="sessions saved / loaded per worker")
+    parser.add_argument("--nodes", type=int, default=50, help="nodes per session")
+    parser.add_argument("--batch", type=int, default=32, help="sessions per save_many batch")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    payload_kb = json_size(build_snapshot(args.nodes)) / 1024
+    print(f"Sessions per worker: {args.sessions}, nodes per session: {args.nodes} (~{payload_kb:.0f}KB)")
+    print(f"{'backend':>8s} {'workers':>7s} | {'save/s':>9s} {'batch/s':>9s} {'load/s':>9s} missing")
+    for backend in args.backends:
+        for worker_count in args.workers:
+            result = run(backend, worker_count, args)
+            print(
+                f"{backend:>8s} {worker_count:>7d} | {result['save']:>9.0f} {result['batch']:>9.0f} "
+                f"{result['load']:>9.0f} {result['missing']:>7.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,431 @@
+"""
+Benchmark: SSE 流式接口负载测试
+
+以 N 个并发客户端驱动以下流式接口，解析 SSE 事件并统计延迟分位数：
+- chat:              POST /api/chat-generator/generate-stream        ([TOKEN] / [PARTIAL_NODE] / [RESULT])
+- excalidraw:        POST /api/excalidraw/generate-stream            ([TOKEN] / [PARTIAL_ELEMENT] / [RESULT])
+- vision-flowchart:  POST /api/vision/analyze-flowchart-stream-v2    (JSON 事件 progress / complete)
+- vision-excalidraw: POST /api/vision/generate-excalidraw-stream     (JSON 事件 element / complete)
+- script:            POST /api/export/script-stream                  (JSON 事件 TOKEN / COMPLETE)
+
+统计项（p50 / p90 / p99 / max）：
+- ttfb:           请求发出到收到首个响应字节
+- first_partial:  请求发出到首个增量对象（[PARTIAL_NODE] / [PARTIAL_ELEMENT] / element 事件）
+- event_gap:      相邻 SSE 事件的间隔
+- total:          整个流的耗时
+- loop_lag:       压测期间服务端事件循环的调度延迟（定时器超时量，反映同步阻塞调用）
+以及每个 worker 的吞吐 streams/s。
+
+默认在当前进程内用 uvicorn 启动 app（与客户端同一事件循环，才能测到服务端的 loop lag），
+上游使用 benchmarks/fake_llm_server.py（独立线程 + 独立事件循环，不干扰被测循环）；
+也可用 --base-url 压测已部署的服务、用 --upstream-base-url 指向任意 OpenAI 兼容上游。
+
+进程内模式默认关闭响应缓存 / 视觉缓存 / 单飞合并，并给每个请求的 prompt 加序号，
+保证每个流都真实走到上游；需要测缓存命中场景时加 --keep-caches。
+
+结果以 JSON 写出（--json），可用 --baseline 与上一版本的报告对比分位数变化。
+
+Usage:
+    cd backend
+    python benchmarks/bench_sse_load.py
+    python benchmarks/bench_sse_load.py --scenarios chat excalidraw --concurrency 10 50 --requests 2
+    python benchmarks/bench_sse_load.py --fake-first-token-ms 800 --fake-tps 60 --fake-rate-429 0.05
+    python benchmarks/bench_sse_load.py --model claude-fake --json reports/sse.json --baseline reports/sse-prev.json
+    python benchmarks/bench_sse_load.py --base-url http://127.0.0.1:8000 --upstream-base-url http://127.0.0.1:9100/v1 --workers 4
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+import uvicorn
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_SCREENSHOT = os.path.join(BACKEND_DIR, "tests", "8d8c58ed11c145efbd76c954b4fe6233.png")
+
+SCENARIOS = ["chat", "excalidraw", "vision-flowchart", "vision-excalidraw", "script"]
+PARTIAL_TAGS = {"PARTIAL_NODE", "PARTIAL_ELEMENT", "element"}
+RESULT_TAGS = {"RESULT", "complete", "COMPLETE"}
+ERROR_TAGS = {"ERROR", "error"}
+
+
+@dataclass
+class StreamSample:
+    """单个流的测量结果"""
+
+    ok: bool = False
+    status: int = 0
+    ttfb: Optional[float] = None
+    first_partial: Optional[float] = None
+    total: float = 0.0
+    gaps: List[float] = field(default_factory=list)
+    counts: Dict[str, int] = field(default_factory=dict)
+    error: Optional[str] = None
+
+
+def parse_event(payload: str) -> str:
+    """
+    提取 SSE data 负载的事件类型
+
+    文本协议 "[TAG] ..." 返回 TAG；JSON 协议 {"type": ...} 返回 type；否则返回 "data"
+    """
+    if payload.startswith("["):
+        end = payload.find("]")
+        if end > 1:
+            return payload[1:end]
+    if payload.startswith("{"):
+        try:
+            return str(json.loads(payload).get("type") or "data")
+        except (ValueError, AttributeError):
+            pass
+    return "data"
+
+
+def percentiles(values: List[float]) -> Optional[Dict[str, float]]:
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def pick(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 1)
+
+    return {"p50_ms": pick(0.5), "p90_ms": pick(0.9), "p99_ms": pick(0.99), "max_ms": round(ordered[-1] * 1000, 1)}
+
+
+def build_request(scenario: str, index: int, args) -> Dict[str, Any]:
+    """构造各场景的请求（method / path / params / json）"""
+    suffix = "" if args.keep_caches else f" #{index}"
+    upstream = {
+        "provider": "custom",
+        "api_key": args.api_key,
+        "base_url": args.upstream_base_url,
+        "model_name": args.model,
+    }
+    if scenario == "chat":
+        body = {"user_input": f"设计一个电商秒杀系统的微服务架构{suffix}", "diagram_type": "flow", **upstream}
+        return {"path": "/api/chat-generator/generate-stream", "json": body}
+    if scenario == "excalidraw":
+        body = {"prompt": f"Draw a microservice architecture with gateway, services and databases{suffix}", **upstream}
+        return {"path": "/api/excalidraw/generate-stream", "json": body}
+    if scenario in ("vision-flowchart", "vision-excalidraw"):
+        body = {"image_data": args.image_b64, "prompt": f"benchmark{suffix}", **upstream}
+        path = (
+            "/api/vision/analyze-flowchart-stream-v2"
+            if scenario == "vision-flowchart"
+            else "/api/vision/generate-excalidraw-stream"
+        )
+        return {"path": path, "json": body}
+    if scenario == "script":
+        nodes = [
+            {"id": f"n{i}", "type": "default", "position": {"x": i * 200, "y": 0}, "data": {"label": f"Service {i}{suffix}"}}
+            for i in range(6)
+        ]
+        edges = [{"id": f"e{i}", "source": f"n{i}", "target": f"n{i + 1}"} for i in range(5)]
+        return {
+            "path": "/api/export/script-stream",
+            "params": upstream,
+            "json": {"nodes": nodes, "edges": edges, "duration": "30s"},
+        }
+    raise ValueError(f"Unknown scenario: {scenario}")
+
+
+async def run_stream(client: httpx.AsyncClient, request: Dict[str, Any]) -> StreamSample:
+    sample = StreamSample()
+    started = time.perf_counter()
+    last_event = None
+    buffer = ""
+    try:
+        async with client.stream("POST", request["path"], params=request.get("params"), json=request["json"]) as response:
+            sample.status = response.status_code
+            async for chunk in response.aiter_text():
+                now = time.perf_counter()
+                if sample.ttfb is None:
+                    sample.ttfb = now - started
+                buffer += chunk
+                while "\n\n" in buffer:
+                    block, buffer = buffer.split("\n\n", 1)
+                    payload = "\n".join(
+                        line[5:].lstrip() for line in block.splitlines() if line.startswith("data:")
+                    )
+                    if not payload:
+                        continue
+                    tag = parse_event(payload)
+                    sample.counts[tag] = sample.counts.get(tag, 0) + 1
+                    if last_event is not None:
+                        sample.gaps.append(now - last_event)
+                    last_event = now
+                    if tag in PARTIAL_TAGS and sample.first_partial is None:
+                        sample.first_partial = now - started
+                    if tag in RESULT_TAGS:
+                        sample.ok = True
+                    if tag in ERROR_TAGS and sample.error is None:
+                        sample.error = payload[:200]
+    except Exception as error:
+        sample.error = f"{type(error).__name__}: {error}"[:200]
+    sample.total = time.perf_counter() - started
+    sample.ok = sample.ok and sample.status == 200 and sample.error is None
+    return sample
+
+
+async def sample_loop_lag(interval: float, stop: asyncio.Event, lags: List[float]):
+    """定时器超时量即为事件循环被阻塞 / 排队的时间"""
+    while not stop.is_set():
+        expected = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, time.perf_counter() - expected))
+
+
+async def run_scenario(base_url: str, scenario: str, concurrency: int, args) -> Dict[str, Any]:
+    limits = httpx.Limits(max_connections=concurrency + 8, max_keepalive_connections=concurrency + 8)
+    timeout = httpx.Timeout(args.timeout, connect=10.0)
+    counter = iter(range(1_000_000))
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout) as client:
+        # 预热：排除首次导入 / SDK 初始化等一次性开销
+        await run_stream(client, build_request(scenario, next(counter), args))
+
+        lags: List[float] = []
+        stop = asyncio.Event()
+        lag_task = asyncio.create_task(sample_loop_lag(args.lag_interval, stop, lags))
+
+        async def one_client() -> List[StreamSample]:
+            return [
+                await run_stream(client, build_request(scenario, next(counter), args))
+                for _ in range(args.requests)
+            ]
+
+        started = time.perf_counter()
+        batches = await asyncio.gather(*(one_client() for _ in range(concurrency)))
+        wall = time.perf_counter() - started
+        stop.set()
+        await lag_task
+
+    samples = [sample for batch in batches for sample in batch]
+    ok = [sample for sample in samples if sample.ok]
+    events: Dict[str, int] = {}
+    for sample in samples:
+        for tag, count in sample.counts.items():
+            events[tag] = events.get(tag, 0) + count
+    errors = sorted({sample.error for sample in samples if sample.error})
+
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "streams": len(samples),
+        "ok": len(ok),
+        "wall_s": round(wall, 3),
+        "streams_per_s": round(len(ok) / wall, 2) if wall else 0.0,
+        "streams_per_s_per_worker": round(len(ok) / wall / args.workers, 2) if wall else 0.0,
+        "ttfb": percentiles([s.ttfb for s in samples if s.ttfb is not None]),
+        "first_partial": percentiles([s.first_partial for s in samples if s.first_partial is not None]),
+        "event_gap": percentiles([gap for s in samples for gap in s.gaps]),
+        "total": percentiles([s.total for s in samples]),
+        "loop_lag": percentiles(lags) if args.base_url is None else None,
+        "events": events,
+        "errors": errors[:5],
+    }
+
+
+# ==================== 进程内服务 ====================
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_fake_upstream(args) -> uvicorn.Server:
+    """在独立线程中启动 fake LLM 上游"""
+    from benchmarks.fake_llm_server import FakeLLMConfig, create_app
+
+    config = FakeLLMConfig(
+        first_token_ms=args.fake_first_token_ms,
+        tokens_per_second=args.fake_tps,
+        rate_429=args.fake_rate_429,
+        rate_503=args.fake_rate_503,
+        retry_after_seconds=0.5,
+        seed=args.seed,
+    )
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(create_app(config), host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.02)
+    args.upstream_base_url = f"http://127.0.0.1:{port}/v1"
+    return server
+
+
+def configure_app(args):
+    from app.core.config import settings
+
+    if not args.keep_caches:
+        settings.LLM_CACHE_ENABLED = False
+        settings.VISION_CACHE_ENABLED = False
+        settings.SINGLE_FLIGHT_ENABLED = False
+
+
+async def run_all(args) -> List[Dict[str, Any]]:
+    server = None
+    base_url = args.base_url
+    if base_url is None:
+        configure_app(args)
+        from app.main import app
+
+        port = _free_port()
+        server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+        serve_task = asyncio.create_task(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.02)
+        base_url = f"http://127.0.0.1:{port}"
+
+    rows = []
+    try:
+        for scenario in args.scenarios:
+            for concurrency in args.concurrency:
+                row = await run_scenario(base_url, scenario, concurrency, args)
+                rows.append(row)
+                print(format_row(row))
+    finally:
+        if server is not None:
+            server.should_exit = True
+            await serve_task
+    return rows
+
+
+# ==================== 报告 ====================
+
+def format_row(row: Dict[str, Any]) -> str:
+    def p(metric: str, key: str = "p50_ms") -> str:
+        value = (row.get(metric) or {}).get(key)
+        return f"{value:>8.1f}" if value is not None else "       -"
+
+    return (
+        f"{row['scenario']:18s} n={row['concurrency']:<4d} ok={row['ok']}/{row['streams']} "
+        f"ttfb p50={p('ttfb')} p99={p('ttfb', 'p99_ms')} "
+        f"partial p50={p('first_partial')} gap p99={p('event_gap', 'p99_ms')} "
+        f"total p50={p('total')} lag p99={p('loop_lag', 'p99_ms')} "
+        f"streams/s/worker={row['streams_per_s_per_worker']:.2f}"
+    )
+
+
+def compare_with_baseline(rows: List[Dict[str, Any]], baseline_path: str):
+    """打印与基线报告的 p50 / p99 差异（正数表示变慢）"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {(r["scenario"], r["concurrency"]): r for r in json.load(f).get("results", [])}
+
+    print(f"\nDelta vs {baseline_path} (ms, + = slower):")
+    for row in rows:
+        previous = baseline.get((row["scenario"], row["concurrency"]))
+        if not previous:
+            continue
+        parts = []
+        for metric in ("ttfb", "first_partial", "event_gap", "total", "loop_lag"):
+            current, old = row.get(metric), previous.get(metric)
+            if current and old:
+                parts.append(
+                    f"{metric} p50 {current['p50_ms'] - old['p50_ms']:+.1f} p99 {current['p99_ms'] - old['p99_ms']:+.1f}"
+                )
+        throughput = row["streams_per_s_per_worker"] - previous.get("streams_per_s_per_worker", 0.0)
+        print(f"{row['scenario']:18s} n={row['concurrency']:<4d} {' | '.join(parts)} | streams/s/worker {throughput:+.2f}")
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SSE load test for streaming endpoints")
+    parser.add_argument("--scenarios", nargs="+", default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 50])
+    parser.add_argument("--requests", type=int, default=1, help="streams per client (sequential)")
+    parser.add_argument("--base-url", help="target a running deployment instead of an in-process server")
+    parser.add_argument("--workers", type=int, default=1, help="server worker processes (for streams/s/worker)")
+    parser.add_argument("--upstream-base-url", help="OpenAI-compatible upstream (default: in-process fake server)")
+    parser.add_argument("--api-key", default="bench")
+    parser.add_argument("--model", default="fake-gpt", help="model name; names containing 'claude' use the Anthropic format")
+    parser.add_argument("--image", default=SAMPLE_SCREENSHOT, help="screenshot for the vision scenarios")
+    parser.add_argument("--keep-caches", action="store_true", help="keep response/vision caches and single-flight enabled")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--lag-interval", type=float, default=0.01)
+    parser.add_argument("--fake-first-token-ms", type=float, default=300.0)
+    parser.add_argument("--fake-tps", type=float, default=200.0)
+    parser.add_argument("--fake-rate-429", type=float, default=0.0)
+    parser.add_argument("--fake-rate-503", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", help="optional path to write the JSON report")
+    parser.add_argument("--baseline", help="previous JSON report to diff against")
+    parser.add_argument("--verbose", action="store_true", help="keep the app's INFO logs")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        # 每个流都会打多条 INFO 日志，压测时屏蔽以免日志 I/O 影响测量
+        logging.disable(logging.INFO)
+
+    with open(args.image, "rb") as f:
+        args.image_b64 = "data:image/png;base64," + base64.b64encode(f.read()).decode("ascii")
+
+    fake_server = None
+    if args.upstream_base_url is None:
+        fake_server = start_fake_upstream(args)
+        print(f"Fake upstream: {args.upstream_base_url} "
+              f"(first_token={args.fake_first_token_ms}ms tps={args.fake_tps})")
+
+    try:
+        rows = asyncio.run(run_all(args))
+    finally:
+        if fake_server is not None:
+            fake_server.should_exit = True
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git_revision": _git_revision(),
+            "python": platform.python_version(),
+            "target": args.base_url or "in-process",
+            "upstream": args.upstream_base_url if fake_server is None else "fake_llm_server",
+            "model": args.model,
+            "workers": args.workers,
+            "requests_per_client": args.requests,
+            "keep_caches": args.keep_caches,
+            "fake": None if fake_server is None else {
+                "first_token_ms": args.fake_first_token_ms,
+                "tps": args.fake_tps,
+                "rate_429": args.fake_rate_429,
+                "rate_503": args.fake_rate_503,
+            },
+        },
+        "results": rows,
+    }
+
+    if args.baseline:
+        compare_with_baseline(rows, args.baseline)
+    if args.json:
+        directory = os.path.dirname(os.path.abspath(args.json))
+        os.makedirs(directory, exist_ok=True)
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\nReport written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
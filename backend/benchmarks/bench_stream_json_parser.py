@@ -0,0 +1,173 @@
+"""
+Benchmark: 全量重扫 _extract_array_objects vs IncrementalJSONArrayParser
+
+模拟 SSE 流式场景：按小 token 逐段到达的 flowchart JSON（nodes + edges），
+旧实现在每个含 "}" 的 token（或每 96 字符）触发时对 accumulated 全量重扫 nodes 与 edges，
+新实现每个 token 只扫描新增部分。
+
+Usage:
+    cd backend
+    python benchmarks/bench_stream_json_parser.py
+    python benchmarks/bench_stream_json_parser.py --sizes 10000 50000 200000 --token-chars 4
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.stream_json_parser import IncrementalJSONArrayParser
+
+
+def legacy_extract_array_objects(payload: str, array_key: str) -> List[Dict[str, Any]]:
+    """旧版 api/chat_generator.py::_extract_array_objects（原样复刻用于对比）"""
+    key_token = f"\"{array_key}\""
+    key_pos = payload.find(key_token)
+    if key_pos < 0:
+        return []
+
+    colon_pos = payload.find(":", key_pos + len(key_token))
+    if colon_pos < 0:
+        return []
+
+    array_start = payload.find("[", colon_pos)
+    if array_start < 0:
+        return []
+
+    results: List[Dict[str, Any]] = []
+    in_string = False
+    escaped = False
+    array_depth = 0
+    object_depth = 0
+    object_start = -1
+
+    for idx in range(array_start, len(payload)):
+        char = payload[idx]
+
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == "\"":
+                in_string = False
+            continue
+
+        if char == "\"":
+            in_string = True
+            continue
+
+        if char == "[":
+            array_depth += 1
+            continue
+
+        if char == "]":
+            array_depth -= 1
+            if array_depth <= 0 and object_depth == 0:
+                break
+            continue
+
+        if char == "{":
+            if array_depth >= 1:
+                if object_depth == 0:
+                    object_start = idx
+                object_depth += 1
+            continue
+
+        if char == "}" and object_depth > 0:
+            object_depth -= 1
+            if object_depth == 0 and object_start != -1:
+                snippet = payload[object_start:idx + 1]
+                try:
+                    parsed = json.loads(snippet)
+                    if isinstance(parsed, dict):
+                        results.append(parsed)
+                except json.JSONDecodeError:
+                    pass
+                object_start = -1
+
+    return results
+
+
+def build_payload(target_chars: int) -> str:
+    nodes = []
+    edges = []
+    index = 0
+    while True:
+        nodes.append({
+            "id": f"node-{index}",
+            "type": "service",
+            "position": {"x": 120 * (index % 8), "y": 160 * (index // 8)},
+            "data": {"label": f"Service {index} {{v{index}}}", "shape": "task"},
+        })
+        if index:
+            edges.append({"id": f"e-{index}", "source": f"node-{index - 1}", "target": f"node-{index}", "label": "calls"})
+        index += 1
+        payload = json.dumps({"nodes": nodes, "edges": edges}, ensure_ascii=False)
+        if len(payload) >= target_chars:
+            return payload
+
+
+def tokenize(payload: str, token_chars: int) -> List[str]:
+    return [payload[i:i + token_chars] for i in range(0, len(payload), token_chars)]
+
+
+def run_legacy(tokens: List[str], parse_interval_chars: int = 96) -> tuple:
+    accumulated = ""
+    chars_since_parse = 0
+    seen = set()
+    for token in tokens:
+        accumulated += token
+        chars_since_parse += len(token)
+        if "}" in token or chars_since_parse >= parse_interval_chars:
+            chars_since_parse = 0
+            for key in ("nodes", "edges"):
+                for obj in legacy_extract_array_objects(accumulated, key):
+                    seen.add((key, obj.get("id")))
+    return len(seen)
+
+
+def run_incremental(tokens: List[str]) -> tuple:
+    parser = IncrementalJSONArrayParser(("nodes", "edges"))
+    emitted = 0
+    for token in tokens:
+        emitted += len(parser.feed(token))
+    return emitted
+
+
+def measure(fn, tokens, repeat: int) -> tuple:
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn(tokens)
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Incremental JSON parser micro-benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 50_000, 200_000])
+    parser.add_argument("--token-chars", type=int, default=4, help="average chars per streamed token")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'chars':>8} {'tokens':>7} {'objects':>8} {'legacy_s':>10} {'incremental_s':>14} {'speedup':>8}")
+    for size in args.sizes:
+        payload = build_payload(size)
+        tokens = tokenize(payload, args.token_chars)
+        legacy_s, legacy_count = measure(run_legacy, tokens, 1 if size > 100_000 else args.repeat)
+        incr_s, incr_count = measure(run_incremental, tokens, args.repeat)
+        assert legacy_count == incr_count, (legacy_count, incr_count)
+        print(
+            f"{len(payload):>8} {len(tokens):>7} {incr_count:>8} "
+            f"{legacy_s:>10.3f} {incr_s:>14.4f} {legacy_s / incr_s:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+"""
+本地替身 LLM 服务 (Fake LLM Server for perf testing)
+
+压测流式接口不能一直打付费 provider。该服务在本机模拟上游：
+- POST /v1/chat/completions：OpenAI 格式，支持 stream=true（SSE chunk + [DONE]）与非流式
+- POST /v1/messages：Anthropic 格式，支持 stream=true（message_start / content_block_delta /
+  message_delta / message_stop 事件）与非流式
+
+AIVisionService 以 provider=custom 指向它即可（base_url=http://127.0.0.1:9100/v1；
+模型名包含 "claude" 时走 Anthropic 路径，其余走 OpenAI 兼容路径）。
+
+可配置项：
+- 首 token 延迟（含抖动）与输出速率（tokens/s）
+- 错误注入：429（带 Retry-After）/ 503 / 超时（挂起不响应）/ 截断（finish_reason=length）
+- 返回内容：ChatGeneratorService._mock_* 的示例图（Excalidraw 请求返回由同一图转换的 elements）
+
+运行期可通过 POST /_fake/config 调整参数、GET /_fake/stats 查看请求计数；
+单个请求可用 X-Fake-Error: 429|503|timeout|truncate 强制注入错误（便于测试 failover）。
+
+Usage:
+    cd backend
+    python benchmarks/fake_llm_server.py
+    python benchmarks/fake_llm_server.py --port 9100 --first-token-ms 800 --tps 60 --rate-429 0.05
+    python benchmarks/fake_llm_server.py --rate-503 0.02 --rate-timeout 0.01 --rate-truncate 0.05 --seed 7
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from dataclasses import asdict, dataclass, fields
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from app.services.chat_generator import ChatGeneratorService
+
+
+@dataclass
+class FakeLLMConfig:
+    """替身服务的行为参数"""
+
+    first_token_ms: float = 500.0        # 首 token 延迟
+    first_token_jitter_ms: float = 0.0   # 首 token 延迟的均匀抖动幅度
+    tokens_per_second: float = 80.0      # 输出速率，<=0 表示不限速
+    chars_per_token: int = 4             # 每个 token 的字符数（也是流式分片大小）
+    rate_429: float = 0.0                # 429 概率
+    rate_503: float = 0.0                # 503 概率
+    rate_timeout: float = 0.0            # 挂起不响应的概率
+    rate_truncate: float = 0.0           # 输出一半后以 finish_reason=length 结束的概率
+    retry_after_seconds: float = 1.0     # 429 响应的 Retry-After
+    hang_seconds: float = 600.0          # 超时注入时挂起的时长
+    payload: str = "auto"                # auto / microservice / high_concurrency / oom / architecture
+    seed: Optional[int] = None
+
+    def update(self, values: Dict[str, Any]):
+        names = {item.name for item in fields(self)}
+        for key, value in values.items():
+            if key in names:
+                setattr(self, key, value)
+
+
+_PAYLOAD_BUILDERS = {
+    "microservice": "_mock_microservice_architecture",
+    "high_concurrency": "_mock_high_concurrency",
+    "oom": "_mock_oom_investigation",
+    "architecture": "_mock_architecture_overview",
+}
+
+
+def load_canned_graphs() -> Dict[str, Dict[str, Any]]:
+    """从 ChatGeneratorService 的 _mock_* 方法生成示例图"""
+    service = ChatGeneratorService()
+    graphs = {}
+    for name, method in _PAYLOAD_BUILDERS.items():
+        result = getattr(service, method)()
+        graphs[name] = {
+            "nodes": result.get("nodes", []),
+            "edges": result.get("edges", []),
+            "mermaid_code": result.get("mermaid_code", ""),
+        }
+    return graphs
+
+
+def graph_to_excalidraw(graph: Dict[str, Any]) -> Dict[str, Any]:
+    """把示例图转换为 Excalidraw elements（矩形 + 箭头），用于 Excalidraw 流式压测"""
+    elements: List[Dict[str, Any]] = []
+    boxes: Dict[str, Dict[str, float]] = {}
+
+    def base(element_id: str, element_type: str, x: float, y: float, width: float, height: float) -> Dict[str, Any]:
+        return {
+            "id": element_id, "type": element_type, "x": x, "y": y, "width": width, "height": height,
+            "angle": 0, "strokeColor": "#1e3a8a", "backgroundColor": "#dbeafe", "fillStyle": "solid",
+            "strokeWidth": 2, "strokeStyle": "solid", "roughness": 0, "opacity": 100, "groupIds": [],
+            "boundElements": [], "seed": len(elements) + 1, "version": 1, "versionNonce": len(elements) + 1,
+            "isDeleted": False,
+        }
+
+    for node in graph["nodes"]:
+        position = node.get("position") or {}
+        x, y = float(position.get("x", 0)), float(position.get("y", 0))
+        boxes[node["id"]] = {"x": x, "y": y}
+        elements.append(base(f"s-{node['id']}", "rectangle", x, y, 180, 72))
+    for edge in graph["edges"]:
+        source, target = boxes.get(edge.get("source")), boxes.get(edge.get("target"))
+        if not source or not target:
+            continue
+        arrow = base(f"a-{edge.get('id')}", "arrow", source["x"] + 180, source["y"] + 36,
+                     target["x"] - source["x"] - 180, target["y"] - source["y"])
+        arrow["points"] = [[0, 0], [arrow["width"], arrow["height"]]]
+        arrow["endArrowhead"] = "arrow"
+        elements.append(arrow)
+    for node in graph["nodes"]:
+        box = boxes[node["id"]]
+        label = base(f"t-{node['id']}", "text", box["x"] + 12, box["y"] + 24, 156, 24)
+        label.update({"text": (node.get("data") or {}).get("label", node["id"]), "fontSize": 16, "textAlign": "center"})
+        elements.append(label)
+    return {"elements": elements, "appState": {}, "files": {}}
+
+
+class FakeLLMServer:
+    """请求处理逻辑（与 FastAPI 路由解耦，便于单测直接驱动）"""
+
+    def __init__(self, config: Optional[FakeLLMConfig] = None):
+        self.config = config or FakeLLMConfig()
+        self.graphs = load_canned_graphs()
+        self.random = random.Random(self.config.seed)
+        self.stats: Dict[str, int] = {
+            "requests": 0, "streams": 0, "completed": 0,
+            "injected_429": 0, "injected_503": 0, "injected_timeout": 0, "injected_truncate": 0,
+        }
+
+    def pick_payload(self, prompt: str) -> str:
+        """按 prompt 选择示例内容：Excalidraw 请求返回 elements，其余按 prompt 哈希轮换示例图"""
+        name = self.config.payload
+        if name not in self.graphs:
+            names = sorted(self.graphs)
+            name = names[sum(prompt.encode("utf-8")) % len(names)]
+        graph = self.graphs[name]
+        if "excalidraw" in prompt.lower():
+            return json.dumps(graph_to_excalidraw(graph), ensure_ascii=False, separators=(",", ":"))
+        return json.dumps(graph, ensure_ascii=False, separators=(",", ":"))
+
+    def pick_fault(self, forced: Optional[str]) -> Optional[str]:
+        """决定本次请求注入的错误类型"""
+        if forced:
+            return forced.strip().lower()
+        roll = self.random.random()
+        for fault, rate in (
+            ("429", self.config.rate_429),
+            ("503", self.config.rate_503),
+            ("timeout", self.config.rate_timeout),
+            ("truncate", self.config.rate_truncate),
+        ):
+            if roll < rate:
+                return fault
+            roll -= rate
+        return None
+
+    def split_tokens(self, text: str, max_tokens: Optional[int], truncate: bool) -> tuple:
+        """按 chars_per_token 切分输出；超过 max_tokens 或注入截断时返回 (前缀分片, True)"""
+        size = max(1, self.config.chars_per_token)
+        chunks = [text[i:i + size] for i in range(0, len(text), size)]
+        limit = len(chunks)
+        if truncate:
+            limit = max(1, limit // 2)
+        if max_tokens:
+            limit = min(limit, max(1, int(max_tokens)))
+        return chunks[:limit], limit < len(chunks)
+
+    async def wait_first_token(self):
+        jitter = self.config.first_token_jitter_ms
+        delay = self.config.first_token_ms + (self.random.uniform(-jitter, jitter) if jitter else 0.0)
+        await asyncio.sleep(max(0.0, delay) / 1000.0)
+
+    async def paced(self, chunks: List[str]) -> AsyncIterator[str]:
+        """按 tokens_per_second 节奏输出（按时间表补偿，避免逐个 sleep 的累积误差）"""
+        started = time.perf_counter()
+        tps = self.config.tokens_per_second
+        for index, chunk in enumerate(chunks):
+            if tps > 0:
+                delay = started + index / tps - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            yield chunk
+
+    async def prepare(self, fault: Optional[str], api: str) -> Optional[JSONResponse]:
+        """注入 429 / 503 / 超时；返回需要直接响应的错误，None 表示正常生成"""
+        self.stats["requests"] += 1
+        if fault == "timeout":
+            self.stats["injected_timeout"] += 1
+            await asyncio.sleep(self.config.hang_seconds)
+            return error_response(api, 504, "timeout", "Injected upstream timeout")
+        if fault == "429":
+            self.stats["injected_429"] += 1
+            response = error_response(api, 429, "rate_limit_error", "Injected rate limit: too many requests")
+            response.headers["retry-after"] = f"{self.config.retry_after_seconds:g}"
+            return response
+        if fault == "503":
+            self.stats["injected_503"] += 1
+            return error_response(api, 503, "overloaded_error", "Injected 503 service unavailable")
+        return None
+
+
+def error_response(api: str, status_code: int, error_type: str, message: str) -> JSONResponse:
+    if api == "anthropic":
+        body = {"type": "error", "error": {"type": error_type, "message": message}}
+    else:
+        body = {"error": {"message": message, "type": error_type, "code": error_type}}
+    return JSONResponse(status_code=status_code, content=body)
+
+
+def extract_prompt(messages: List[Dict[str, Any]]) -> str:
+    """拼接消息中的文本部分（忽略图片）"""
+    parts = []
+    for message in messages or []:
+        content = message.get("content")
+        if isinstance(content, str):
+            parts.append(content)
+        elif isinstance(content, list):
+            parts.extend(item.get("text", "") for item in content if isinstance(item, dict))
+    return "\n".join(parts)
+
+
+def _sse(data: Dict[str, Any], event: Optional[str] = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def create_app(config: Optional[FakeLLMConfig] = None) -> FastAPI:
+    """创建替身 LLM 服务"""
+    server = FakeLLMServer(config)
+    app = FastAPI(title="Fake LLM Server")
+    app.state.fake = server
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        model = body.get("model") or "fake-model"
+        fault = server.pick_fault(request.headers.get("x-fake-error"))
+        error = await server.prepare(fault, "openai")
+        if error is not None:
+            return error
+
+        text = server.pick_payload(extract_prompt(body.get("messages")))
+        chunks, truncated = server.split_tokens(text, body.get("max_tokens"), fault == "truncate")
+        finish_reason = "length" if truncated else "stop"
+        if fault == "truncate":
+            server.stats["injected_truncate"] += 1
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+
+        if not body.get("stream"):
+            await server.wait_first_token()
+            async for _ in server.paced(chunks):
+                pass
+            server.stats["completed"] += 1
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(chunks)},
+                    "finish_reason": finish_reason,
+                }],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(chunks), "total_tokens": len(chunks)},
+            }
+
+        def chunk(delta: Dict[str, Any], reason: Optional[str] = None) -> str:
+            return _sse({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": reason}],
+            })
+
+        async def events():
+            server.stats["streams"] += 1
+            await server.wait_first_token()
+            yield chunk({"role": "assistant", "content": ""})
+            async for piece in server.paced(chunks):
+                yield chunk({"content": piece})
+            yield chunk({}, finish_reason)
+            yield "data: [DONE]\n\n"
+            server.stats["completed"] += 1
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.post("/v1/messages")
+    async def messages(request: Request):
+        body = await request.json()
+        model = body.get("model") or "claude-fake"
+        fault = server.pick_fault(request.headers.get("x-fake-error"))
+        error = await server.prepare(fault, "anthropic")
+        if error is not None:
+            return error
+
+        text = server.pick_payload(extract_prompt(body.get("messages")))
+        chunks, truncated = server.split_tokens(text, body.get("max_tokens"), fault == "truncate")
+        stop_reason = "max_tokens" if truncated else "end_turn"
+        if fault == "truncate":
+            server.stats["injected_truncate"] += 1
+        message_id = f"msg_{uuid.uuid4().hex[:12]}"
+
+        if not body.get("stream"):
+            await server.wait_first_token()
+            async for _ in server.paced(chunks):
+                pass
+            server.stats["completed"] += 1
+            return {
+                "id": message_id,
+                "type": "message",
+                "role": "assistant",
+                "model": model,
+                "content": [{"type": "text", "text": "".join(chunks)}],
+                "stop_reason": stop_reason,
+                "stop_sequence": None,
+                "usage": {"input_tokens": 0, "output_tokens": len(chunks)},
+            }
+
+        async def events():
+            server.stats["streams"] += 1
+            yield _sse({
+                "type": "message_start",
+                "message": {
+                    "id": message_id, "type": "message", "role": "assistant", "model": model,
+                    "content": [], "stop_reason": None, "stop_sequence": None,
+                    "usage": {"input_tokens": 0, "output_tokens": 1},
+                },
+            }, "message_start")
+            await server.wait_first_token()
+            yield _sse({"type": "content_block_start", "index": 0,
+                        "content_block": {"type": "text", "text": ""}}, "content_block_start")
+            yield _sse({"type": "ping"}, "ping")
+            async for piece in server.paced(chunks):
+                yield _sse({"type": "content_block_delta", "index": 0,
+                            "delta": {"type": "text_delta", "text": piece}}, "content_block_delta")
+            yield _sse({"type": "content_block_stop", "index": 0}, "content_block_stop")
+            yield _sse({"type": "message_delta",
+                        "delta": {"stop_reason": stop_reason, "stop_sequence": None},
+                        "usage": {"output_tokens": len(chunks)}}, "message_delta")
+            yield _sse({"type": "message_stop"}, "message_stop")
+            server.stats["completed"] += 1
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.get("/v1/models")
+    async def list_models():
+        return {"object": "list", "data": [{"id": "fake-gpt", "object": "model"}, {"id": "claude-fake", "object": "model"}]}
+
+    @app.get("/_fake/stats")
+    async def fake_stats():
+        return {"config": asdict(server.config), "stats": dict(server.stats)}
+
+    @app.post("/_fake/config")
+    async def fake_config(request: Request):
+        server.config.update(await request.json())
+        if server.config.seed is not None:
+            server.random.seed(server.config.seed)
+        return {"config": asdict(server.config)}
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI/Anthropic-compatible LLM server for perf testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--first-token-ms", type=float, default=500.0)
+    parser.add_argument("--first-token-jitter-ms", type=float, default=0.0)
+    parser.add_argument("--tps", type=float, default=80.0, help="output tokens per second (<=0: unthrottled)")
+    parser.add_argument("--chars-per-token", type=int, default=4)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-503", type=float, default=0.0)
+    parser.add_argument("--rate-timeout", type=float, default=0.0)
+    parser.add_argument("--rate-truncate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--hang-seconds", type=float, default=600.0)
+    parser.add_argument("--payload", default="auto", choices=["auto", *sorted(_PAYLOAD_BUILDERS)])
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    config = FakeLLMConfig(
+        first_token_ms=args.first_token_ms,
+        first_token_jitter_ms=args.first_token_jitter_ms,
+        tokens_per_second=args.tps,
+        chars_per_token=args.chars_per_token,
+        rate_429=args.rate_429,
+        rate_503=args.rate_503,
+        rate_timeout=args.rate_timeout,
+        rate_truncate=args.rate_truncate,
+        retry_after_seconds=args.retry_after,
+        hang_seconds=args.hang_seconds,
+        payload=args.payload,
+        seed=args.seed,
+    )
+
+    import uvicorn
+
+    print(f"Fake LLM server on http://{args.host}:{args.port}/v1 "
+          f"(first_token={config.first_token_ms}ms tps={config.tokens_per_second})")
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+import pytest
+
+from app.services.concurrency_governor import reset_concurrency_governor
+from app.services.provider_health import reset_provider_health
+from app.services.single_flight import reset_single_flight
+
+
+@pytest.fixture(autouse=True)
+def isolated_provider_state():
+    """Provider health, concurrency limits and in-flight calls are process-global; keep tests isolated."""
+    reset_provider_health()
+    reset_concurrency_governor()
+    reset_single_flight()
+    yield
+    reset_provider_health()
+    reset_concurrency_governor()
+    reset_single_flight()
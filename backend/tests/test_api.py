@@ -34,6 +34,31 @@ def test_health_check():
     assert data["status"] == "healthy"
 
 
+def test_runtime_metrics():
+    """Metrics endpoint should expose LLM cache and client pool stats"""
+    response = client.get("/api/health/metrics")
+    assert response.status_code == 200
+    data = response.json()
+    assert "hit_rate" in data["llm_cache"]
+    assert "bytes_saved" in data["llm_cache"]
+    assert "size" in data["client_pool"]
+
+
+def test_provider_health_endpoint_hides_api_keys():
+    """Provider health endpoint should list breaker state without leaking keys"""
+    from app.services.provider_health import get_provider_health
+
+    get_provider_health().record_failure(
+        {"provider": "custom", "api_key": "sk-secret", "model_name": "m1"}, 429, "usage_limit_reached"
+    )
+    response = client.get("/api/health/providers")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["providers"][0]["state"] == "closed"
+    assert data["providers"][0]["last_error"] == "429:usage_limit_reached"
+    assert "sk-secret" not in response.text
+
+
 # ============================================================
 # Mermaid API Tests
 # ============================================================
@@ -307,6 +332,120 @@ def test_chat_generator_stream_architecture_layers_emit_partial_nodes(monkeypatc
     assert payload.index("[PARTIAL_NODE]") < payload.index("[LAYOUT_DATA]")
 
 
+def test_chat_generator_stream_ops_mode_applies_operations(monkeypatch):
+    """Incremental ops mode streams one [OP] per applied operation and updates the session."""
+    from app.api import chat_generator as cg_api
+    from app.models.schemas import Edge, Node
+    from app.services import chat_generator as cg
+    from app.services.session_manager import CanvasSessionManager
+
+    session_manager = CanvasSessionManager(enable_persistence=False)
+    session_id = session_manager.create_or_update_session(
+        None,
+        [
+            Node(id="api-1", type="api", position={"x": 0, "y": 0}, data={"label": "API Gateway"}),
+            Node(id="service-1", type="service", position={"x": 260, "y": 0}, data={"label": "Order Service"}),
+        ],
+        [Edge(id="e1", source="api-1", target="service-1")],
+    )
+    prompts = []
+
+    class DummyPresetsService:
+        def get_active_config(self, **kwargs):
+            return {"provider": "custom", "api_key": "k", "base_url": "https://example.invalid/v1", "model_name": "m"}
+
+    class DummyVisionService:
+        provider = "custom"
+        model_name = "mock-model"
+
+        async def generate_with_stream(self, prompt: str):
+            prompts.append(prompt)
+            chunks = [
+                '{"ops":[{"op":"add_node","id":"cache-1","type":"cache","label":"Redis","x":520,"y":0},',
+                '{"op":"add_edge","source":"n2","target":"cache-1","label":"read"},',
+                '{"op":"update_label","id":"n1","label":"Edge Gateway"},',
+                '{"op":"add_edge","source":"n9","target":"cache-1"},',
+                '{"op":"remove_edge","source":"n1","target":"n2"}]}',
+            ]
+            for item in chunks:
+                yield item
+
+    monkeypatch.setattr(cg_api, "get_model_presets_service", lambda: DummyPresetsService(), raising=True)
+    monkeypatch.setattr(cg_api, "create_vision_service", lambda **kwargs: DummyVisionService(), raising=True)
+    monkeypatch.setattr(cg_api, "get_session_manager", lambda: session_manager, raising=True)
+    monkeypatch.setattr(cg, "get_session_manager", lambda: session_manager, raising=True)
+
+    response = client.post(
+        "/api/chat-generator/generate-stream",
+        json={
+            "user_input": "add a cache behind the order service",
+            "provider": "custom",
+            "incremental_mode": True,
+            "session_id": session_id,
+            "incremental_output": "ops",
+        },
+    )
+
+    assert response.status_code == 200
+    payload = response.text
+    assert '"ops"' in prompts[0] and "n1|a|API Gateway" in prompts[0]
+    ops = [json.loads(line[len("data: [OP] "):]) for line in payload.splitlines() if line.startswith("data: [OP] ")]
+    assert [op["op"] for op in ops] == ["add_node", "add_edge", "update_label", "remove_edge"]
+    assert ops[1]["edge"]["source"] == "service-1"
+    assert "[OP_REJECTED]" in payload and "unknown node 'n9'" in payload
+    assert "ops_applied=4, ops_rejected=1" in payload
+    assert "[LAYOUT_DATA]" not in payload
+
+    session = session_manager.get_session(session_id)
+    assert [n["data"]["label"] for n in session["nodes"]] == ["Edge Gateway", "Order Service", "Redis"]
+    assert [(e["source"], e["target"]) for e in session["edges"]] == [("service-1", "cache-1")]
+
+
+def test_canvas_session_patch_uses_etag_and_rejects_stale_writes(monkeypatch):
+    """PATCH applies ops against the If-Match version, bumps the ETag, and answers 409 / 422 / 428 without changing the session."""
+    from app.api import chat_generator as cg_api
+    from app.services.session_manager import CanvasSessionManager
+
+    session_manager = CanvasSessionManager(enable_persistence=False)
+    monkeypatch.setattr(cg_api, "get_session_manager", lambda: session_manager, raising=True)
+
+    saved = client.post(
+        "/api/chat-generator/session/save",
+        json={
+            "nodes": [
+                {"id": "api-1", "type": "api", "position": {"x": 0, "y": 0}, "data": {"label": "API Gateway"}},
+                {"id": "legacy-1", "type": "service", "position": {"x": 260, "y": 0}, "data": {"label": "Legacy"}},
+            ],
+            "edges": [{"id": "e1", "source": "api-1", "target": "legacy-1"}],
+        },
+    )
+    assert saved.status_code == 200 and saved.headers["etag"] == '"1"'
+    url = f"/api/chat-generator/session/{saved.json()['session_id']}"
+
+    ops = [
+        {"op": "update_node", "id": "api-1", "position": {"x": 40}},
+        {"op": "add_node", "node": {"id": "cache-1", "type": "cache", "position": {"x": 520, "y": 0}, "data": {"label": "Redis"}}},
+        {"op": "add_edge", "edge": {"id": "e2", "source": "api-1", "target": "cache-1"}},
+        {"op": "update_edge", "id": "e2", "label": "read"},
+        {"op": "remove_node", "id": "legacy-1"},
+    ]
+    patched = client.patch(url, json={"ops": ops}, headers={"If-Match": '"1"'})
+    assert patched.status_code == 200 and patched.headers["etag"] == '"2"'
+    assert patched.json()["applied"] == 5 and patched.json()["node_count"] == 2
+
+    stale = client.patch(url, json={"ops": [{"op": "remove_edge", "id": "e2"}]}, headers={"If-Match": '"1"'})
+    assert stale.status_code == 409 and stale.headers["etag"] == '"2"'
+    invalid = client.patch(url, json={"ops": [{"op": "remove_edge", "id": "e2"}, {"op": "remove_edge", "id": "e1"}], "base_version": 2})
+    assert invalid.status_code == 422 and "op 1" in invalid.json()["detail"]
+    assert client.patch(url, json={"ops": []}).status_code == 428
+
+    fetched = client.get(url)
+    assert fetched.headers["etag"] == '"2"'
+    session = fetched.json()["session"]
+    assert [(n["id"], n["position"]["x"]) for n in session["nodes"]] == [("api-1", 40.0), ("cache-1", 520.0)]
+    assert [(e["id"], e["label"]) for e in session["edges"]] == [("e2", "read")]
+
+
 def test_chat_generator_auto_failover_on_usage_limit(monkeypatch):
     """Non-stream chat generation should fail over to backup config when primary is rate-limited."""
     from app.services import chat_generator as cg_service
@@ -604,6 +743,36 @@ def test_vision_rejects_siliconflow_image():
     assert "text-only" in data["detail"]
 
 
+def test_vision_reactflow_reports_raw_response_for_incomplete_json(monkeypatch):
+    """A parsed response missing required fields fails cleanly with the raw model output"""
+    import base64
+    from app.api import vision as vision_api
+
+    raw = 'Format {nodes, edges}:\n{"nodes": [{"id": "a"}]}'
+
+    class FakeVisionService:
+        async def generate_with_vision(self, image_data, prompt):
+            return raw
+
+    monkeypatch.setattr(vision_api, "create_vision_service", lambda *args, **kwargs: FakeVisionService())
+
+    response = client.post(
+        "/api/vision/generate-reactflow",
+        json={
+            "image_data": base64.b64encode(b"incomplete-json-image").decode(),
+            "provider": "custom",
+            "api_key": "k",
+            "base_url": "https://example.invalid/v1",
+            "model_name": "m",
+        },
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["success"] is False
+    assert "missing" in data["message"]
+    assert data["raw_response"] == raw
+
+
 # ============================================================
 # RAG API Tests
 # ============================================================
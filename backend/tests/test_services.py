@@ -3,6 +3,7 @@ Service Layer Tests for SmartArchitect AI Backend
 Tests document parser, PPT exporter, Slidev exporter
 """
 
+import json
 import pytest
 import tempfile
 import os
@@ -71,6 +72,60 @@ def test_document_parser_chunking():
         os.unlink(temp_path)
 
 
+# ============================================================
+# RAG Fallback Index Tests
+# ============================================================
+
+def test_bm25_index_ranks_incrementally_and_removes():
+    """BM25 scores only matching chunks, prefers rarer terms, and forgets removed chunks"""
+    from app.services.lexical_index import BM25Index
+
+    index = BM25Index()
+    index.add("c1", "API gateway handles authentication and rate limiting", {"chunk_id": "c1"})
+    index.add("c2", "Redis cache sits in front of the database")
+    index.add("c3", "The gateway routes traffic to services. 网关负责鉴权")
+    assert index.search("no matching words", 5) == []
+
+    results = index.search("gateway authentication", 5)
+    assert [item for _, item in results] == [{"chunk_id": "c1"}, "c3"]
+    assert results[0][0] > results[1][0] > 0
+    assert [item for _, item in index.search("鉴权", 5)] == ["c3"]
+    assert len(index.search("gateway", 1)) == 1
+
+    assert index.remove("c1") and not index.remove("c1")
+    assert [item for _, item in index.search("authentication gateway", 5)] == ["c3"]
+    assert index.get_stats()["documents"] == 2 and "c1" not in index
+
+    # 超过一半槽位被删除后压缩，剩余文档仍可检索
+    index.remove("c2")
+    assert index.get_stats()["removed_slots"] == 0
+    assert [item for _, item in index.search("网关 gateway", 5)] == ["c3"]
+
+
+def test_rag_fallback_search_uses_index(tmp_path, monkeypatch):
+    """Fallback RAG indexes uploads incrementally, reloads the index from disk, and updates it on delete"""
+    import asyncio
+    from app.services import rag
+
+    markdown = tmp_path / "doc.md"
+    markdown.write_text("# Cache\n\nUse Redis as a read-through cache for the order service.", encoding="utf-8")
+    index_path = str(tmp_path / "rag_index.json")
+
+    monkeypatch.setattr(rag, "chromadb", None)
+    monkeypatch.setattr(rag, "SentenceTransformer", None)
+    service = rag.RAGService(fallback_index_path=index_path)
+    uploaded = asyncio.run(service.upload_document(str(markdown), "doc.md", "markdown"))
+    assert uploaded.success
+
+    found = asyncio.run(service.search_documents("redis cache", top_k=3))
+    assert found.chunks and "Redis" in found.chunks[0].content
+
+    reloaded = rag.RAGService(fallback_index_path=index_path)
+    assert reloaded.get_collection_stats()["lexical_index"]["documents"] == uploaded.chunks_created
+    asyncio.run(reloaded.delete_document(uploaded.document_id))
+    assert asyncio.run(reloaded.search_documents("redis cache")).chunks == []
+
+
 # ============================================================
 # PPT Exporter Tests
 # ============================================================
@@ -181,6 +236,1887 @@ def test_slidev_exporter_statistics():
     assert "3 total connections" in markdown or "3" in markdown
 
 
+# ============================================================
+# Provider Client Registry Tests
+# ============================================================
+
+class _FakeClient:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_client_registry_reuses_client_per_signature():
+    """Same (kind, signature) should return the same pooled client"""
+    from app.services.client_pool import ProviderClientRegistry
+
+    registry = ProviderClientRegistry(max_size=4, idle_seconds=60)
+    sig = ("custom", "key", "https://example.invalid/v1", "model")
+
+    first = registry.get_or_create("openai", sig, _FakeClient)
+    second = registry.get_or_create("openai", sig, _FakeClient)
+    other_kind = registry.get_or_create("anthropic", sig, _FakeClient)
+
+    assert first is second
+    assert other_kind is not first
+    stats = registry.get_stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+
+
+def test_client_registry_bounded_and_idle_eviction():
+    """Registry should stay bounded and close clients idle past the TTL"""
+    from app.services.client_pool import ProviderClientRegistry
+
+    now = [0.0]
+    registry = ProviderClientRegistry(max_size=2, idle_seconds=10, clock=lambda: now[0])
+
+    a = registry.get_or_create("openai", ("a",), _FakeClient)
+    registry.get_or_create("openai", ("b",), _FakeClient)
+    registry.get_or_create("openai", ("c",), _FakeClient)
+    assert registry.get_stats()["size"] == 2
+    # LRU eviction drops the reference without closing (may still be in use)
+    assert a.closed is False
+
+    now[0] = 11.0
+    d = registry.get_or_create("openai", ("d",), _FakeClient)
+    assert registry.get_stats()["size"] == 1
+    assert registry.get_or_create("openai", ("d",), _FakeClient) is d
+
+
+def test_client_registry_invalidate_signature():
+    """Invalidation should force a fresh client for the same signature"""
+    from app.services.client_pool import ProviderClientRegistry
+
+    registry = ProviderClientRegistry(max_size=4, idle_seconds=60)
+    sig = ("openai", "key", "", "gpt-4o-mini")
+    first = registry.get_or_create("openai", sig, _FakeClient)
+
+    assert registry.invalidate(sig) == 1
+    assert registry.get_or_create("openai", sig, _FakeClient) is not first
+
+
+def test_client_registry_closes_async_clients_on_their_loop():
+    """Retired async clients are closed on the owning loop once idle; dead loops just drop the coroutine"""
+    import asyncio
+    import threading
+
+    from app.services.client_pool import ProviderClientRegistry
+
+    class _FakeAsyncClient:
+        def __init__(self):
+            self.closed_on = None
+
+        async def aclose(self):
+            self.closed_on = asyncio.get_running_loop()
+
+    now = [0.0]
+    registry = ProviderClientRegistry(max_size=4, idle_seconds=10, clock=lambda: now[0])
+    loop = asyncio.new_event_loop()
+    worker = threading.Thread(target=loop.run_forever, daemon=True)
+    worker.start()
+    other_loop = asyncio.new_event_loop()
+    try:
+        sig = ("custom", "key", "https://example.invalid/v1", "model")
+        client = registry.get_or_create("httpx-async", sig, _FakeAsyncClient, loop=loop)
+        assert registry.get_or_create("httpx-async", sig, _FakeAsyncClient, loop=loop) is client
+        # Each loop gets its own client
+        assert registry.get_or_create("httpx-async", sig, _FakeAsyncClient, loop=other_loop) is not client
+
+        # Invalidated clients may still be streaming: kept until idle, then closed on their loop
+        assert registry.invalidate(sig) == 2
+        assert registry.get_stats()["retired"] == 2
+        assert client.closed_on is None
+
+        other_loop.close()
+        now[0] = 11.0
+        assert registry.evict_idle() == 2
+        asyncio.run_coroutine_threadsafe(asyncio.sleep(0), loop).result(timeout=5)
+        assert client.closed_on is loop
+        assert registry.get_stats()["retired"] == 0
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        worker.join(timeout=5)
+        loop.close()
+
+
+def test_vision_service_shares_pooled_sdk_client():
+    """create_vision_service should hand out the shared SDK client for identical configs"""
+    from app.services.ai_vision import create_vision_service
+    from app.services.client_pool import reset_client_registry
+
+    reset_client_registry()
+    try:
+        kwargs = dict(api_key="test-key", base_url="https://example.invalid/v1", model_name="mock-model")
+        first = create_vision_service("custom", **kwargs)
+        second = create_vision_service("custom", **kwargs)
+        other = create_vision_service("custom", api_key="other-key", base_url=kwargs["base_url"], model_name="mock-model")
+
+        assert first is not second
+        assert first.client is second.client
+        assert other.client is not first.client
+    finally:
+        reset_client_registry()
+
+
+def test_preset_update_invalidates_pooled_client_with_env_fallbacks(tmp_path):
+    """Preset edits evict the pooled client even when the vision service resolves base_url/api_key itself"""
+    from app.models.schemas import ModelPresetCreate, ModelPresetUpdate
+    from app.services.ai_vision import create_vision_service
+    from app.services.client_pool import get_client_registry, reset_client_registry
+    from app.services.model_presets import ModelPresetsService
+
+    reset_client_registry()
+    try:
+        presets = ModelPresetsService(config_file=str(tmp_path / "presets.json"))
+        preset = presets.create_preset(ModelPresetCreate(
+            name="openai-proxy", provider="openai", api_key="test-key",
+            model_name="gpt-4o-mini", base_url="https://proxy.invalid/v1",
+        ))
+        # The OpenAI client itself ignores base_url; the pool key must still match the preset
+        service = create_vision_service(
+            preset.provider, api_key=preset.api_key, base_url=preset.base_url, model_name=preset.model_name
+        )
+        assert service.client is not None
+        assert get_client_registry().get_stats()["size"] == 1
+
+        presets.update_preset(preset.id, ModelPresetUpdate(api_key="rotated-key"))
+        stats = get_client_registry().get_stats()
+        assert stats["size"] == 0
+        assert stats["retired"] == 1
+    finally:
+        reset_client_registry()
+
+
+# ============================================================
+# Native Async Streaming Tests
+# ============================================================
+
+def _sse_transport(lines, seen=None):
+    import httpx
+
+    async def handler(request):
+        if seen is not None:
+            seen.append(request)
+        body = "".join(f"{line}\n" for line in lines).encode("utf-8")
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=body)
+
+    return httpx.MockTransport(handler)
+
+
+@pytest.mark.asyncio
+async def test_generate_with_stream_uses_async_openai_client(monkeypatch):
+    """OpenAI-compatible streaming should run on the AsyncOpenAI client"""
+    import httpx
+    from openai import AsyncOpenAI
+    from app.core.config import settings
+    from app.services.ai_vision import create_vision_service
+
+    chunks = [
+        {"choices": [{"index": 0, "delta": {"content": "Hel"}}]},
+        {"choices": []},
+        {"choices": [{"index": 0, "delta": {"content": "lo"}}]},
+    ]
+    lines = []
+    for chunk in chunks:
+        chunk.update({"id": "c1", "object": "chat.completion.chunk", "created": 0, "model": "m"})
+        lines += [f"data: {json.dumps(chunk)}", ""]
+    lines += ["data: [DONE]", ""]
+
+    monkeypatch.setattr(settings, "LLM_CACHE_ENABLED", False)
+    service = create_vision_service("custom", api_key="k", base_url="https://example.invalid/v1", model_name="m")
+    client = AsyncOpenAI(
+        api_key="k",
+        base_url="https://example.invalid/v1",
+        http_client=httpx.AsyncClient(transport=_sse_transport(lines)),
+    )
+    monkeypatch.setattr(service, "_get_async_openai_client", lambda: client)
+
+    tokens = [token async for token in service.generate_with_stream("hi")]
+    assert tokens == ["Hel", "lo"]
+
+
+@pytest.mark.asyncio
+async def test_generate_with_vision_stream_raw_http_claude(monkeypatch):
+    """ikuncode.cc proxy path should parse Anthropic SSE via httpx.AsyncClient"""
+    import httpx
+    from app.core.config import settings
+    from app.services.ai_vision import create_vision_service
+
+    lines = [
+        "event: message_start",
+        'data: {"type": "message_start"}',
+        "",
+        "event: content_block_delta",
+        'data: {"type": "content_block_delta", "delta": {"type": "text_delta", "text": "{\\"a\\""}}',
+        "",
+        "event: content_block_delta",
+        'data: {"type": "content_block_delta", "delta": {"type": "text_delta", "text": ": 1}"}}',
+        "",
+        "event: message_stop",
+        'data: {"type": "message_stop"}',
+        "",
+    ]
+    seen = []
+    monkeypatch.setattr(settings, "LLM_CACHE_ENABLED", False)
+    service = create_vision_service(
+        "custom", api_key="k", base_url="https://api.ikuncode.cc/v1", model_name="claude-sonnet"
+    )
+    client = httpx.AsyncClient(transport=_sse_transport(lines, seen))
+    monkeypatch.setattr(service, "_get_async_raw_http_client", lambda: client)
+
+    tokens = [token async for token in service.generate_with_vision_stream(b"\x89PNG\r\n\x1a\nxx", "describe")]
+
+    assert "".join(tokens) == '{"a": 1}'
+    assert str(seen[0].url) == "https://api.ikuncode.cc/v1/messages"
+    payload = json.loads(seen[0].content)
+    assert payload["messages"][0]["content"][0]["source"]["media_type"] == "image/png"
+
+
+# ============================================================
+# LLM Response Cache Tests
+# ============================================================
+
+def test_response_cache_memory_disk_and_ttl(tmp_path):
+    """Entries survive a restart via the disk tier and expire after the TTL"""
+    from app.services.response_cache import LLMResponseCache
+
+    now = [1000.0]
+    key = LLMResponseCache.make_key("text", "custom", "m", "prompt", params={"temperature": 0.2})
+    assert key != LLMResponseCache.make_key("text", "custom", "m", "prompt", params={"temperature": 0.7})
+    assert key != LLMResponseCache.make_key("text", "custom", "m", "prompt", image_data=b"img")
+
+    cache = LLMResponseCache(max_entries=2, ttl_seconds=60, disk_path=str(tmp_path), clock=lambda: now[0])
+    assert cache.get(key) is None
+    cache.put(key, '{"nodes": []}', "text")
+    assert cache.get(key) == '{"nodes": []}'
+    assert cache.flush(timeout=5.0)
+
+    restarted = LLMResponseCache(max_entries=2, ttl_seconds=60, disk_path=str(tmp_path), clock=lambda: now[0])
+    assert restarted.get(key) == '{"nodes": []}'
+    stats = restarted.get_stats()
+    assert stats["hits_disk"] == 1
+    assert stats["bytes_saved"] == len('{"nodes": []}')
+
+    now[0] += 61
+    assert restarted.get(key) is None
+    assert restarted.get_stats()["disk_entries"] == 0
+
+
+def test_response_cache_disk_tier_is_size_bounded(tmp_path):
+    """Disk tier evicts the least recently used files past its byte budget"""
+    from app.services.response_cache import LLMResponseCache
+
+    cache = LLMResponseCache(max_entries=1, ttl_seconds=0, disk_path=str(tmp_path), disk_max_bytes=300)
+    for i in range(5):
+        cache.put(f"{i:02d}" + "k" * 62, "x" * 100, "stream")
+    assert cache.flush(timeout=5.0)
+
+    stats = cache.get_stats()
+    assert stats["disk_bytes"] <= 300
+    assert stats["disk_entries"] == len(list(tmp_path.glob("*/*.json")))
+    assert cache.get("04" + "k" * 62) == "x" * 100
+
+
+def test_response_cache_disk_writes_run_on_background_thread(tmp_path, monkeypatch):
+    """put() and invalidate() only queue disk IO; queued entries still hit and deletes are not resurrected"""
+    import threading
+    from app.services.response_cache import LLMResponseCache
+
+    cache = LLMResponseCache(max_entries=1, ttl_seconds=0, disk_path=str(tmp_path))
+    release = threading.Event()
+    writer_threads = []
+    original_write = cache._write_disk
+
+    def slow_write(key, entry):
+        writer_threads.append(threading.current_thread())
+        release.wait(5.0)
+        original_write(key, entry)
+
+    monkeypatch.setattr(cache, "_write_disk", slow_write)
+    cache.put("aa" + "k" * 62, "first", "text")
+    cache.put("bb" + "k" * 62, "second", "text")
+
+    # Returned before any file exists; the evicted-but-queued entry still hits
+    assert list(tmp_path.glob("*/*.json")) == []
+    assert cache.get_stats()["disk_pending"] == 2
+    assert cache.get("aa" + "k" * 62) == "first"
+
+    assert cache.invalidate("bb" + "k" * 62)
+    release.set()
+    assert cache.flush(timeout=5.0)
+
+    assert all(thread is not threading.current_thread() for thread in writer_threads)
+    assert [file.stem[:2] for file in tmp_path.glob("*/*.json")] == ["aa"]
+    assert cache.get_stats()["disk_pending"] == 0
+
+
+@pytest.mark.asyncio
+async def test_stream_cache_hit_replays_as_stream(monkeypatch, tmp_path):
+    """A completed stream is cached and replayed in chunks; opted-out endpoints bypass it"""
+    from app.core.config import settings
+    from app.services import ai_vision
+    from app.services.response_cache import LLMResponseCache
+
+    cache = LLMResponseCache(disk_path=str(tmp_path))
+    monkeypatch.setattr(ai_vision, "get_response_cache", lambda: cache)
+    monkeypatch.setattr(settings, "LLM_CACHE_REPLAY_CHUNK_CHARS", 4)
+
+    calls = []
+
+    async def fake_stream(prompt):
+        calls.append(prompt)
+        for token in ['{"no', 'des"', ': []}']:
+            yield token
+
+    service = ai_vision.create_vision_service("custom", api_key="k", base_url="https://example.invalid/v1", model_name="m")
+    monkeypatch.setattr(service, "_stream_text", fake_stream)
+
+    first = [token async for token in service.generate_with_stream("same prompt")]
+    # Nothing is cached until the caller has validated the output
+    assert cache.get_stats()["stores"] == 0
+    assert service.commit_response_cache() == 1
+    second = [token async for token in service.generate_with_stream("same prompt")]
+
+    assert "".join(first) == "".join(second) == '{"nodes": []}'
+    assert second == ['{"no', 'des"', ': []', '}']
+    assert len(calls) == 1
+    assert cache.get_stats()["hits"] == 1
+
+    monkeypatch.setattr(settings, "LLM_CACHE_DISABLED_ENDPOINTS_STR", "stream")
+    [token async for token in service.generate_with_stream("same prompt")]
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_response_cache_skips_truncated_and_rejected_output(monkeypatch, tmp_path):
+    """Truncated output is never staged; rejected hits are invalidated; keys include provider and credential"""
+    from app.services import ai_vision
+    from app.services.response_cache import LLMResponseCache
+
+    cache = LLMResponseCache(disk_path=str(tmp_path))
+    monkeypatch.setattr(ai_vision, "get_response_cache", lambda: cache)
+    kwargs = dict(base_url="https://example.invalid/v1", model_name="m")
+    service = ai_vision.create_vision_service("custom", api_key="k", **kwargs)
+
+    async def truncated_stream(prompt):
+        yield '{"nodes": ['
+        service._note_finish_reason("length")
+
+    monkeypatch.setattr(service, "_stream_text", truncated_stream)
+    [token async for token in service.generate_with_stream("cut off")]
+    assert service.commit_response_cache() == 0
+
+    calls = []
+
+    async def fake_custom_text(self, prompt):
+        calls.append((self.custom_api_key, prompt))
+        return {"nodes": [], "edges": []}
+
+    monkeypatch.setattr(ai_vision.AIVisionService, "_analyze_with_custom_text", fake_custom_text)
+    await service.analyze_text("p")
+    assert ai_vision.settle_response_cache(service, accepted=True) == 1
+    # A hit that fails validation is deleted so the retry goes upstream
+    await service.analyze_text("p")
+    assert ai_vision.settle_response_cache(service, accepted=False) == 1
+    await service.analyze_text("p")
+    assert len(calls) == 2
+
+    other_tenant = ai_vision.create_vision_service("custom", api_key="other", **kwargs)
+    assert other_tenant._response_cache_key("text", "p") != service._response_cache_key("text", "p")
+    assert service._response_cache_key("text", "p", provider="openai") != service._response_cache_key("text", "p")
+    assert ai_vision.settle_response_cache(None, accepted=False) == 0
+
+
+# ============================================================
+# Image Preprocessing Tests
+# ============================================================
+
+def _diagram_png(size=(3000, 1600), mode="RGB", exif=False):
+    import io
+    from PIL import Image, ImageDraw
+
+    image = Image.new(mode, size, "white")
+    draw = ImageDraw.Draw(image)
+    for i in range(8):
+        x = 100 + i * 350
+        draw.rectangle([x, 600, x + 250, 900], outline="black", fill="#dbeafe", width=4)
+        draw.line([x + 250, 750, x + 350, 750], fill="black", width=4)
+    buffer = io.BytesIO()
+    if exif:
+        image_exif = Image.Exif()
+        image_exif[0x010F] = "camera"
+        image.save(buffer, format="JPEG", quality=95, exif=image_exif)
+    else:
+        image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_image_preprocessor_downscales_and_reuses_result():
+    """Oversized screenshots are capped per profile and prepared only once"""
+    import base64
+    import io
+    from PIL import Image
+    from app.services.image_preprocessor import ImagePreprocessor
+
+    raw = _diagram_png()
+    preprocessor = ImagePreprocessor(max_edges={"claude": 1568, "openai": 2048})
+
+    prepared = preprocessor.prepare(raw, "claude")
+    assert prepared.resized
+    assert max(prepared.width, prepared.height) == 1568
+    assert len(prepared.data) < len(raw)
+    assert prepared.original_media_type == "image/png"
+    decoded = Image.open(io.BytesIO(prepared.data))
+    assert decoded.format.lower() == prepared.media_type.split("/")[1]
+    assert prepared.data_url == f"data:{prepared.media_type};base64,{base64.b64encode(prepared.data).decode()}"
+
+    assert preprocessor.prepare(raw, "claude") is prepared
+    assert preprocessor.prepare(raw, "openai").width == 2048
+    stats = preprocessor.get_stats()
+    assert stats["hits"] == 1 and stats["misses"] == 2
+
+
+def test_image_preprocessor_strips_metadata_and_passes_through_unknown():
+    """Re-encoding drops EXIF; undecodable bytes are sent unchanged with a sniffed type"""
+    import io
+    from PIL import Image
+    from app.services.image_preprocessor import ImagePreprocessor
+
+    preprocessor = ImagePreprocessor(max_edges={"openai": 1024})
+    prepared = preprocessor.prepare(_diagram_png(size=(2400, 1200), exif=True), "openai")
+    assert not Image.open(io.BytesIO(prepared.data)).getexif()
+
+    fake = b"\x89PNG\r\n\x1a\nxx"
+    passthrough = preprocessor.prepare(fake, "openai")
+    assert passthrough.data == fake
+    assert passthrough.media_type == "image/png"
+
+
+@pytest.mark.asyncio
+async def test_vision_service_sends_prepared_image(monkeypatch):
+    """Vision calls send the downscaled image with its real media type"""
+    from app.core.config import settings
+    from app.services import ai_vision
+    from app.services.image_preprocessor import ImagePreprocessor
+
+    monkeypatch.setattr(settings, "LLM_CACHE_ENABLED", False)
+    preprocessor = ImagePreprocessor(max_edges={"claude": 800})
+    monkeypatch.setattr(ai_vision, "get_image_preprocessor", lambda: preprocessor)
+
+    service = ai_vision.create_vision_service("custom", api_key="k", base_url="https://example.invalid/v1", model_name="claude-x")
+    assert service._image_profile() == "claude"
+
+    image = await service._prepare_image(_diagram_png())
+    assert max(image.width, image.height) == 800
+    assert image.media_type in ("image/png", "image/jpeg")
+    assert (await service._prepare_image(_diagram_png())) is image
+
+
+# ============================================================
+# Vision Result Cache Tests
+# ============================================================
+
+SAMPLE_SCREENSHOT = os.path.join(os.path.dirname(__file__), "8d8c58ed11c145efbd76c954b4fe6233.png")
+
+
+def _resave(image_data, fmt="JPEG", scale=1.0, pad=0):
+    import io
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(image_data)).convert("RGB")
+    if scale != 1.0:
+        image = image.resize((int(image.width * scale), int(image.height * scale)))
+    if pad:
+        padded = Image.new("RGB", (image.width + 2 * pad, image.height + 2 * pad), image.getpixel((0, 0)))
+        padded.paste(image, (pad, pad))
+        image = padded
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt, quality=70)
+    return buffer.getvalue()
+
+
+def _labeled_diagram(labels, size=(1200, 800)):
+    import io
+    from PIL import Image, ImageDraw, ImageFont
+
+    image = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default(size=22)
+    for i, label in enumerate(labels):
+        x = 80 + i * 380
+        draw.rectangle([x, 300, x + 260, 460], outline="black", fill="#dbeafe", width=3)
+        draw.text((x + 20, 370), label, fill="black", font=font)
+        if i < len(labels) - 1:
+            draw.line([x + 260, 380, x + 380, 380], fill="black", width=3)
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_vision_cache_matches_near_duplicate_screenshots(tmp_path):
+    """Re-saved, rescaled or re-padded screenshots hit; other diagrams and variants miss"""
+    from app.services.vision_result_cache import VisionResultCache, compute_fingerprint
+
+    with open(SAMPLE_SCREENSHOT, "rb") as f:
+        original = f.read()
+
+    cache = VisionResultCache(max_distance=6, disk_path=str(tmp_path))
+    namespace = cache.make_namespace("flowchart", "custom", "m", fast_mode=True, preserve_layout=True)
+    cache.put(compute_fingerprint(original), namespace, {"nodes": ["n1"]})
+
+    for variant in (_resave(original), _resave(original, scale=0.75), _resave(original, fmt="PNG", pad=40)):
+        assert cache.get(compute_fingerprint(variant), namespace) == {"nodes": ["n1"]}
+
+    other_variant = cache.make_namespace("flowchart", "custom", "m", fast_mode=False, preserve_layout=True)
+    assert cache.get(compute_fingerprint(original), other_variant) is None
+    assert cache.get(compute_fingerprint(_diagram_png(size=(1790, 1188))), namespace) is None
+
+    stats = cache.get_stats()
+    assert stats["hits_near"] == 3
+    assert stats["misses"] == 2
+    assert stats["hit_rate"] == 0.6
+
+
+def test_vision_cache_rejects_same_layout_with_different_labels(tmp_path):
+    """Diagrams that differ only in their labels never share a result; exact matching is the default"""
+    from app.services.vision_result_cache import VisionResultCache, compute_fingerprint
+
+    original = _labeled_diagram(["Web", "API", "MySQL"])
+    relabeled = _labeled_diagram(["Frontend", "Order Service", "PostgreSQL"])
+    original_print, relabeled_print = compute_fingerprint(original), compute_fingerprint(relabeled)
+    # dHash alone cannot tell them apart
+    assert (original_print.dhash ^ relabeled_print.dhash).bit_count() <= 6
+
+    cache = VisionResultCache(max_distance=6, disk_path=str(tmp_path))
+    cache.put(original_print, "ns", {"labels": "web"})
+    assert cache.get(relabeled_print, "ns") is None
+    assert cache.get(compute_fingerprint(_resave(original)), "ns") == {"labels": "web"}
+
+    exact_only = VisionResultCache(disk_path=None)
+    exact_only.put(original_print, "ns", {"labels": "web"})
+    assert exact_only.get(compute_fingerprint(_resave(original)), "ns") is None
+    assert exact_only.get(original_print, "ns") == {"labels": "web"}
+    assert exact_only.get_stats()["hits_near"] == 0
+
+
+def test_vision_cache_bounded_persisted_and_expiring(tmp_path):
+    """Entries survive a restart, are capped at max_entries and expire after the TTL"""
+    from app.services.vision_result_cache import ImageFingerprint, VisionResultCache
+
+    now = [1000.0]
+    cache = VisionResultCache(max_entries=2, ttl_seconds=60, disk_path=str(tmp_path), clock=lambda: now[0])
+    prints = [ImageFingerprint(f"sha{i}", (1 << (i * 16)) - 1, 1.5) for i in range(1, 4)]
+    for i, fingerprint in enumerate(prints):
+        cache.put(fingerprint, "ns", {"i": i})
+
+    assert len(list(tmp_path.glob("*.json"))) == 2
+    restarted = VisionResultCache(max_entries=2, ttl_seconds=60, disk_path=str(tmp_path), clock=lambda: now[0])
+    assert restarted.get(prints[0], "ns") is None
+    assert restarted.get(prints[2], "ns") == {"i": 2}
+
+    now[0] += 61
+    assert restarted.get(prints[2], "ns") is None
+    assert restarted.get_stats()["expired"] >= 1
+
+
+@pytest.mark.asyncio
+async def test_analyze_flowchart_reuses_cached_result(monkeypatch, tmp_path):
+    """A re-uploaded screenshot skips the multimodal call and returns the stored response"""
+    from app.services import ai_vision, vision_result_cache
+    from app.services.vision_result_cache import VisionResultCache
+
+    cache = VisionResultCache(max_distance=6, disk_path=str(tmp_path))
+    monkeypatch.setattr(vision_result_cache, "get_vision_result_cache", lambda: cache)
+
+    service = ai_vision.create_vision_service("custom", api_key="k", base_url="https://example.invalid/v1", model_name="m")
+    calls = []
+
+    async def fake_analyze(image_data, prompt, max_tokens=4096):
+        calls.append(len(image_data))
+        return service._build_response({
+            "nodes": [{"id": "a", "type": "default", "position": {"x": 0, "y": 0}, "data": {"label": "A"}}],
+            "edges": [],
+            "mermaid_code": "graph TD\nA",
+        })
+
+    monkeypatch.setattr(service, "_analyze_with_custom", fake_analyze)
+
+    with open(SAMPLE_SCREENSHOT, "rb") as f:
+        original = f.read()
+    first = await service.analyze_flowchart(original)
+    second = await service.analyze_flowchart(_resave(original))
+    await service.analyze_flowchart(original, fast_mode=False)
+
+    assert len(calls) == 2
+    assert second.model_dump() == first.model_dump()
+    assert cache.get_stats()["hits"] == 1
+
+
+# ============================================================
+# Hedged Failover Tests
+# ============================================================
+
+@pytest.mark.asyncio
+async def test_run_hedged_slow_primary_loses_to_hedge():
+    """A stalled primary is raced by the next candidate and cancelled when it loses"""
+    import asyncio
+    from app.services.hedged_failover import HedgeStats, run_hedged
+
+    stats = HedgeStats(max_inflight_hedges=4)
+    cancelled = []
+
+    async def attempt(index, name):
+        try:
+            await asyncio.sleep(5 if name == "primary" else 0.01)
+        except asyncio.CancelledError:
+            cancelled.append(name)
+            raise
+        return f"{name}-result"
+
+    hedged = []
+    index, result = await run_hedged(
+        ["primary", "backup", "third"], attempt, hedge_delay=0.05, stats=stats,
+        on_hedge=lambda i, name: hedged.append(name),
+    )
+
+    assert (index, result) == (1, "backup-result")
+    assert hedged == ["backup"]
+    assert cancelled == ["primary"]
+    snapshot = stats.get_stats()
+    assert snapshot["hedge_wins"] == 1
+    assert snapshot["inflight_hedges"] == 0
+    assert snapshot["providers"]["primary"]["losses"] == 1
+    assert snapshot["providers"]["backup"]["wins"] == 1
+    assert "third" not in snapshot["providers"]
+
+
+@pytest.mark.asyncio
+async def test_run_hedged_fails_over_sequentially_and_respects_cap():
+    """Failures move on immediately; with no hedge budget a slow candidate is simply awaited"""
+    import asyncio
+    from app.services.hedged_failover import HedgeExhaustedError, HedgeStats, run_hedged
+
+    stats = HedgeStats(max_inflight_hedges=0)
+    started = []
+
+    async def attempt(index, name):
+        started.append(name)
+        if name == "broken":
+            raise RuntimeError("429 usage_limit_reached")
+        await asyncio.sleep(0.1)
+        return name
+
+    errors = []
+    index, result = await run_hedged(
+        ["broken", "slow", "unused"], attempt, hedge_delay=0.01, stats=stats,
+        on_error=lambda i, name, error: errors.append(name),
+    )
+    assert (index, result) == (1, "slow")
+    assert started == ["broken", "slow"]
+    assert errors == ["broken"]
+    assert stats.get_stats()["hedges_capped"] == 1  # 每轮等待都会重试，同一请求只计一次
+
+    async def always_fail(index, name):
+        raise RuntimeError(f"{name} down")
+
+    with pytest.raises(HedgeExhaustedError) as exc_info:
+        await run_hedged(["a", "b"], always_fail, hedge_delay=None, stats=stats)
+    assert [i for i, _ in exc_info.value.errors] == [0, 1]
+
+
+# ============================================================
+# Provider Health Tests
+# ============================================================
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_circuit_breaker_opens_half_opens_and_backs_off():
+    """Breaker trips after consecutive failures, allows one probe, and doubles cooldown on probe failure"""
+    from app.services.provider_health import CircuitBreaker
+
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, open_seconds=10, max_open_seconds=25, clock=clock)
+
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow_request()
+
+    clock.now += 10
+    assert breaker.state == "half_open"
+    assert breaker.allow_request()
+    assert not breaker.allow_request()  # 探测名额已被占用
+
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert breaker.retry_after() == 20
+    clock.now += 20
+    breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.retry_after() == 25  # 封顶 max_open_seconds
+
+    clock.now += 25
+    assert breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "closed"  # 连续失败计数已清零
+
+
+def test_provider_health_orders_candidates_by_state_and_score():
+    """Tripped or error-prone configs sink; small latency differences keep preset order"""
+    from app.services.provider_health import ProviderHealthRegistry
+
+    clock = FakeClock()
+    registry = ProviderHealthRegistry(failure_threshold=2, open_seconds=30, clock=clock)
+    primary = {"provider": "openai", "api_key": "k1", "model_name": "gpt"}
+    backup = {"provider": "claude", "api_key": "k2", "model_name": "sonnet"}
+    third = {"provider": "gemini", "api_key": "k3", "model_name": "flash"}
+
+    registry.record_success(primary, latency_seconds=8.0)
+    registry.record_success(backup, latency_seconds=7.5)
+    assert registry.order_candidates([primary, backup, third]) == [primary, backup, third]
+
+    # 400 类请求错误不影响 provider 健康
+    registry.record_failure(primary, 400, "request_error")
+    assert registry.order_candidates([primary, backup]) == [primary, backup]
+
+    registry.record_failure(primary, 429, "usage_limit_reached")
+    assert registry.order_candidates([primary, backup]) == [backup, primary]
+
+    registry.record_failure(primary, 503, "upstream_unavailable")
+    assert registry.order_candidates([primary, third]) == [third, primary]
+    states = {item["config"].split("@")[0]: item for item in registry.get_states()}
+    assert states["openai/gpt"]["state"] == "open"
+    assert states["openai/gpt"]["last_error"] == "503:upstream_unavailable"
+
+    # 401 直接熔断
+    registry.record_failure(backup, 401, "authentication_failed")
+    assert registry.get_states()[-1]["state"] == "open"
+
+    clock.now += 30
+    registry.record_success(primary, first_token_seconds=0.5)
+    assert registry.order_candidates([backup, primary]) == [primary, backup]
+
+    registry.enabled = False
+    assert registry.order_candidates([backup, primary]) == [backup, primary]
+
+
+def test_provider_health_keeps_user_primary_first():
+    """The user's primary config stays first unless it is tripped or its probe is taken; only the tail is sorted"""
+    from app.services.provider_health import ProviderHealthRegistry
+
+    clock = FakeClock()
+    registry = ProviderHealthRegistry(failure_threshold=2, open_seconds=30, clock=clock)
+    primary = {"provider": "openai", "api_key": "k1", "model_name": "gpt"}
+    backup = {"provider": "claude", "api_key": "k2", "model_name": "sonnet"}
+    third = {"provider": "gemini", "api_key": "k3", "model_name": "flash"}
+
+    registry.record_success(backup, latency_seconds=0.5)
+    registry.record_success(third, latency_seconds=0.5)
+    registry.record_failure(backup, 429, "usage_limit_reached")
+    registry.record_failure(primary, 503, "upstream_unavailable")
+    # 主配置分数最低但未熔断：保持第一，只有后面的候选按健康度排序
+    assert registry.order_candidates([primary, backup, third], keep_primary=True) == [primary, third, backup]
+    assert registry.order_candidates([primary, backup, third])[0] is not primary
+
+    registry.record_failure(primary, 503, "upstream_unavailable")
+    assert registry.order_candidates([primary, backup, third], keep_primary=True) == [third, backup, primary]
+
+    # 冷却结束：探测在途时让位，探测成功后回到第一位
+    clock.now += 30
+    assert registry.order_candidates([primary, third], keep_primary=True) == [primary, third]
+    assert registry.begin_attempt(primary)
+    assert registry.order_candidates([primary, third], keep_primary=True) == [third, primary]
+    registry.record_success(primary, latency_seconds=9.0)
+    assert registry.order_candidates([primary, third], keep_primary=True) == [primary, third]
+
+
+def test_provider_health_claims_probe_only_when_attempt_starts():
+    """Ordering a half-open backup behind a healthy primary must not hold its probe slot"""
+    from app.services.provider_health import ProviderHealthRegistry
+
+    clock = FakeClock()
+    registry = ProviderHealthRegistry(failure_threshold=1, open_seconds=30, clock=clock)
+    primary = {"provider": "openai", "api_key": "k1", "model_name": "gpt"}
+    backup = {"provider": "claude", "api_key": "k2", "model_name": "sonnet"}
+
+    registry.record_success(primary, latency_seconds=1.0)
+    registry.record_failure(backup, 503, "upstream_unavailable")
+    clock.now += 30
+
+    # The primary serves every request; ordering alone never claims the backup's probe
+    for _ in range(3):
+        assert registry.order_candidates([primary, backup]) == [primary, backup]
+        assert registry.begin_attempt(primary)
+    assert registry.begin_attempt(backup)
+    # Probe in flight: a second attempt is not allowed and the backup sinks
+    assert not registry.begin_attempt(backup)
+    assert registry.order_candidates([backup, primary]) == [primary, backup]
+
+    registry.record_success(backup, latency_seconds=1.0)
+    assert all(item["state"] == "closed" for item in registry.get_states())
+    assert registry.begin_attempt(backup)
+
+
+# ============================================================
+# Concurrency Governor Tests
+# ============================================================
+
+@pytest.mark.asyncio
+async def test_concurrency_governor_queues_fifo_and_rejects_overflow():
+    """Requests over the limit wait in FIFO order; a full queue or queue timeout raises ProviderBusyError"""
+    import asyncio
+    from app.services.concurrency_governor import ConcurrencyGovernor, ProviderBusyError
+
+    governor = ConcurrencyGovernor(initial_limit=1, max_queue=2, queue_timeout=1.0)
+    order = []
+
+    async def worker(name, hold):
+        async with governor.slot("cfg") as ticket:
+            order.append((name, ticket.queue_depth))
+            await asyncio.sleep(hold)
+
+    first = asyncio.create_task(worker("a", 0.05))
+    await asyncio.sleep(0)
+    queued = [asyncio.create_task(worker(name, 0.01)) for name in ("b", "c")]
+    await asyncio.sleep(0)
+    assert governor.snapshot("cfg") == {"limit": 1, "in_flight": 1, "queued": 2, "cooldown_seconds": 0.0}
+
+    with pytest.raises(ProviderBusyError, match="rate limit"):
+        await governor.acquire("cfg")
+
+    await asyncio.gather(first, *queued)
+    assert order == [("a", 0), ("b", 1), ("c", 2)]
+    stats = governor.get_stats()["configs"]["cfg"]
+    assert stats["rejected"] == 1
+    assert stats["in_flight"] == 0
+    assert stats["max_wait_ms"] > 0
+
+    governor = ConcurrencyGovernor(initial_limit=1, queue_timeout=0.05)
+    await governor.acquire("cfg")
+    with pytest.raises(ProviderBusyError, match="waited"):
+        await governor.acquire("cfg")
+    assert governor.get_stats()["configs"]["cfg"]["timed_out"] == 1
+    assert governor.snapshot("cfg")["queued"] == 0
+
+
+@pytest.mark.asyncio
+async def test_concurrency_governor_aimd_and_retry_after():
+    """429 halves the limit once per interval and honours Retry-After; successes grow it back"""
+    import httpx
+    from app.services.concurrency_governor import ConcurrencyGovernor, rate_limit_info
+
+    request = httpx.Request("POST", "https://api.example.invalid/v1/chat/completions")
+    response = httpx.Response(429, headers={"retry-after": "0.2"}, request=request)
+    limited = httpx.HTTPStatusError("Too Many Requests", request=request, response=response)
+    assert rate_limit_info(limited) == (True, 0.2)
+    assert rate_limit_info(RuntimeError("upstream 503")) == (False, None)
+
+    governor = ConcurrencyGovernor(initial_limit=8, max_limit=8, decrease_interval=10.0)
+    for _ in range(2):
+        with pytest.raises(httpx.HTTPStatusError):
+            async with governor.slot("cfg"):
+                raise limited
+
+    stats = governor.get_stats()["configs"]["cfg"]
+    assert stats["limit"] == 4.0  # 同一窗口内的多个 429 只收缩一次
+    assert stats["rate_limited"] == 2
+    assert 0 < governor.snapshot("cfg")["cooldown_seconds"] <= 0.2
+
+    ticket = await governor.acquire("cfg")  # 冷却结束前排队等待
+    assert ticket.wait_seconds >= 0.1
+    governor.release("cfg", success=True)
+
+    for _ in range(8):
+        async with governor.slot("cfg"):
+            pass
+    assert governor.get_stats()["configs"]["cfg"]["limit"] > 5.0
+
+
+@pytest.mark.asyncio
+async def test_concurrency_governor_starts_at_max_limit():
+    """Without an explicit initial limit each config starts at max_limit; only an upstream 429 shrinks it"""
+    from app.services.concurrency_governor import ConcurrencyGovernor
+
+    governor = ConcurrencyGovernor(max_limit=6)
+    assert governor.snapshot("cfg")["limit"] == 6
+    assert governor.queue_timeout >= 240.0  # 名额在整个流期间被占用
+
+    tickets = [await governor.acquire("cfg") for _ in range(6)]
+    assert all(ticket.queue_depth == 0 for ticket in tickets)
+    for _ in tickets:
+        governor.release("cfg", success=True)
+    assert governor.get_stats()["configs"]["cfg"]["limit"] == 6.0
+
+
+@pytest.mark.asyncio
+async def test_concurrency_slot_held_until_cancelled_thread_returns():
+    """Cancelling a blocking SDK call (e.g. a losing hedge) keeps its slot until the thread returns"""
+    import asyncio
+    import threading
+    from app.services.concurrency_governor import ConcurrencyGovernor, run_blocking
+
+    governor = ConcurrencyGovernor(max_limit=1)
+    release_thread = threading.Event()
+
+    async def call():
+        async with governor.slot("cfg"):
+            return await run_blocking(release_thread.wait, 5)
+
+    task = asyncio.ensure_future(call())
+    await asyncio.sleep(0.05)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert governor.snapshot("cfg")["in_flight"] == 1
+
+    release_thread.set()
+    for _ in range(100):
+        if governor.snapshot("cfg")["in_flight"] == 0:
+            break
+        await asyncio.sleep(0.01)
+    assert governor.snapshot("cfg")["in_flight"] == 0
+    async with governor.slot("cfg"):
+        assert await run_blocking(lambda: "ok") == "ok"
+
+
+# ============================================================
+# Single-flight Coalescing Tests
+# ============================================================
+
+@pytest.mark.asyncio
+async def test_single_flight_coalesces_concurrent_text_calls(monkeypatch):
+    """Identical concurrent analyze_text calls share one upstream call; followers get independent copies"""
+    import asyncio
+    from app.core.config import settings
+    from app.services import single_flight
+    from app.services.ai_vision import AIVisionService, create_vision_service
+
+    monkeypatch.setattr(settings, "LLM_CACHE_ENABLED", False)
+    calls = []
+
+    async def fake_custom_text(self, prompt):
+        calls.append(prompt)
+        await asyncio.sleep(0.05)
+        return {"nodes": [{"id": "a"}], "edges": []}
+
+    monkeypatch.setattr(AIVisionService, "_analyze_with_custom_text", fake_custom_text)
+    services = [
+        create_vision_service("custom", api_key="k", base_url="https://example.invalid/v1", model_name="m")
+        for _ in range(3)
+    ]
+
+    results = await asyncio.gather(*(service.analyze_text("same prompt") for service in services))
+    assert calls == ["same prompt"]
+    assert all(result == {"nodes": [{"id": "a"}], "edges": []} for result in results)
+    results[1]["nodes"].append({"id": "b"})
+    assert len(results[0]["nodes"]) == 1
+
+    await asyncio.gather(services[0].analyze_text("one"), services[1].analyze_text("two"))
+    assert calls == ["same prompt", "one", "two"]
+    stats = single_flight.get_single_flight().get_stats()
+    assert stats["coalesced"] == 2
+    assert stats["inflight_calls"] == 0
+
+
+@pytest.mark.asyncio
+async def test_single_flight_stream_follower_replays_prefix(monkeypatch):
+    """A follower joining mid-stream gets the emitted prefix replayed, then the live tail"""
+    import asyncio
+    from app.core.config import settings
+    from app.services.ai_vision import AIVisionService, create_vision_service
+    from app.services.single_flight import get_single_flight
+
+    monkeypatch.setattr(settings, "LLM_CACHE_ENABLED", False)
+    upstream_calls = []
+    release_tail = asyncio.Event()
+
+    async def fake_stream_text(self, prompt):
+        upstream_calls.append(prompt)
+        yield "A"
+        yield "B"
+        await release_tail.wait()
+        yield "C"
+
+    monkeypatch.setattr(AIVisionService, "_stream_text", fake_stream_text)
+    leader = create_vision_service("custom", api_key="k", base_url="https://example.invalid/v1", model_name="m")
+    follower = create_vision_service("custom", api_key="k", base_url="https://example.invalid/v1", model_name="m")
+
+    leader_stream = leader.generate_with_stream("same prompt").__aiter__()
+    assert [await leader_stream.__anext__(), await leader_stream.__anext__()] == ["A", "B"]
+
+    follower_task = asyncio.create_task(
+        asyncio.wait_for(_collect(follower.generate_with_stream("same prompt")), timeout=2)
+    )
+    await asyncio.sleep(0.01)
+    release_tail.set()
+    leader_tail = [token async for token in leader_stream]
+
+    assert leader_tail == ["C"]
+    assert await follower_task == ["A", "B", "C"]
+    assert upstream_calls == ["same prompt"]
+    assert get_single_flight().get_stats()["stream_coalesced"] == 1
+
+
+async def _collect(stream):
+    return [token async for token in stream]
+
+
+# ============================================================
+# Incremental JSON Parser Tests
+# ============================================================
+
+def test_incremental_json_parser_emits_each_object_once():
+    """Objects under tracked array keys are emitted once, independent of chunking"""
+    from app.services.stream_json_parser import IncrementalJSONArrayParser
+
+    payload = (
+        'Sure! ```json\n{"layers": [{"name": "Edge \\"L1\\" {", "items": [{"id": "gw", "label": "}]"}]}],'
+        ' "nodes": [{"id": "n1", "data": {"label": "[x]"}}, {"id": "n2"}],'
+        ' "meta": {"nodes": "not-an-array"}, "edges": [{"source": "n1", "target": "n2"}]}\n```'
+    )
+    expected = [
+        ("items", 0, "gw"),
+        ("layers", 0, 'Edge "L1" {'),
+        ("nodes", 0, "n1"),
+        ("nodes", 1, "n2"),
+        ("edges", 0, "n1"),
+    ]
+
+    for size in (1, 3, 17, len(payload)):
+        parser = IncrementalJSONArrayParser(["layers", "items", "nodes", "edges"])
+        events = []
+        for i in range(0, len(payload), size):
+            events.extend(parser.feed(payload[i:i + size]))
+        summary = [
+            (e.key, e.index, e.value.get("id") or e.value.get("name") or e.value.get("source"))
+            for e in events
+        ]
+        assert summary == expected
+        assert parser.consumed_chars == len(payload)
+
+
+def test_incremental_json_parser_skips_invalid_objects():
+    """A malformed object is skipped without breaking later objects"""
+    from app.services.stream_json_parser import IncrementalJSONArrayParser
+
+    parser = IncrementalJSONArrayParser(["elements"])
+    events = parser.feed('{"elements": [{"id": "a",}, {"id": "b"}')
+    assert [e.value["id"] for e in events] == ["b"]
+    assert events[0].index == 1
+    assert parser.get_stats()["skipped"] == 1
+
+
+# ============================================================
+# JSON Recovery Tests
+# ============================================================
+
+JSON_RECOVERY_CORPUS = [
+    # (LLM 原始输出, 期望结果, 必须出现的修复类型)
+    (
+        '好的，下面是流程图：\n```json\n{"nodes": [{"id": "a"}], "edges": []}\n```\n如需调整请告诉我。',
+        {"nodes": [{"id": "a"}], "edges": []},
+        {"code_fence", "leading_text"},
+    ),
+    (
+        '{"nodes": [{"id": "a", "data": {"label": "It\'s done: see http://wiki"},},], "edges": [],}',
+        {"nodes": [{"id": "a", "data": {"label": "It's done: see http://wiki"}}], "edges": []},
+        {"trailing_comma"},
+    ),
+    (
+        '{"elements": [{"id": "r1", "type": "rectangle"}\n  {"id": "r2", "type": "arrow"}]}',
+        {"elements": [{"id": "r1", "type": "rectangle"}, {"id": "r2", "type": "arrow"}]},
+        {"missing_comma"},
+    ),
+    (
+        '{"nodes": [{"id": "a", "data": {"label": "API"}}, {"id": "b", "data": {"label": "Data',
+        {"nodes": [{"id": "a", "data": {"label": "API"}}, {"id": "b", "data": {"label": "Data"}}]},
+        {"closed_string", "closed_containers"},
+    ),
+    (
+        '{"nodes": [{"id": "a"}], "edges": [{"source": "a", "tar',
+        {"nodes": [{"id": "a"}], "edges": [{"source": "a"}]},
+        {"dropped_incomplete_member"},
+    ),
+    (
+        "{'nodes': [{id: 'a', visible: True}], /* note */ 'edges': None}",
+        {"nodes": [{"id": "a", "visible": True}], "edges": None},
+        {"single_quotes", "unquoted_key", "python_literal", "comment"},
+    ),
+    (
+        'Format {nodes, edges}:\n{"nodes": [{"id": "a"}], "edges": []}',
+        {"nodes": [{"id": "a"}], "edges": []},
+        {"leading_text"},
+    ),
+    (
+        'Use format {nodes, edges}:\n{"nodes": [{"id": 1}], "edges": [',
+        {"nodes": [{"id": 1}], "edges": []},
+        {"leading_text", "closed_containers"},
+    ),
+    (
+        'I will output {"type":"note"} then: {"nodes":[{"id":"a"}],"edges":[{"source":"a","target":"a"}],}',
+        {"nodes": [{"id": "a"}], "edges": [{"source": "a", "target": "a"}]},
+        {"leading_text", "trailing_comma"},
+    ),
+]
+
+
+@pytest.mark.parametrize("raw,expected,repairs", JSON_RECOVERY_CORPUS)
+def test_recover_json_corpus(raw, expected, repairs):
+    """Malformed LLM outputs are recovered in one pass and the repairs are reported"""
+    from app.services.json_recovery import recover_json
+
+    recovered = recover_json(raw)
+    assert recovered.value == expected
+    assert repairs <= set(recovered.repairs)
+
+
+def test_recover_json_call_sites():
+    """Valid JSON needs no repairs; every call site shares the parser and its failure mode"""
+    from app.services.ai_vision import create_vision_service
+    from app.services.chat_generator import ChatGeneratorService
+    from app.services.excalidraw_generator import ExcalidrawGeneratorService
+    from app.services.json_recovery import JSONRecoveryError, recover_json
+
+    assert recover_json('{"a": [1, {"b": "c"}]}').repairs == {}
+
+    truncated = '```json\n{"elements": [{"id": "a", "type": "text", "text": "user\'s'
+    assert ExcalidrawGeneratorService()._safe_json(truncated) == {
+        "elements": [{"id": "a", "type": "text", "text": "user's"}]
+    }
+    assert ExcalidrawGeneratorService()._safe_json("no json at all") is None
+
+    vision = create_vision_service("custom", api_key="k", base_url="https://example.invalid/v1", model_name="m")
+    assert vision._extract_json_from_response('Result: {"nodes": [],}', is_truncated=True) == {"nodes": []}
+    with pytest.raises(ValueError):
+        vision._extract_json_from_response("I cannot help with that.")
+
+    with pytest.raises(JSONRecoveryError):
+        ChatGeneratorService()._safe_json("")
+
+    # 说明文字里的花括号不能被“恢复”成空对象或垃圾键值
+    for prose in ("text { no json", "Use {} placeholders", "Format {nodes, edges}: none yet"):
+        with pytest.raises(JSONRecoveryError):
+            recover_json(prose)
+
+
+# ============================================================
+# Serialization Tests
+# ============================================================
+
+def test_serialization_matches_stdlib_layout(monkeypatch):
+    """Fast and stdlib backends produce the same bytes; unsupported values fall back to stdlib"""
+    from datetime import datetime
+    from app.core import serialization
+
+    payload = {"nodes": [{"id": "a", "data": {"label": "中文 \"q\"\n"}, "x": 1.5, "tags": [], "meta": {}}], "ok": None}
+    compact = serialization.json_dumps(payload)
+    pretty = serialization.json_dumps(payload, indent=True)
+    assert compact == json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+    assert pretty == json.dumps(payload, ensure_ascii=False, indent=2)
+    assert serialization.json_loads(compact.encode("utf-8")) == payload
+
+    stamp = datetime(2026, 1, 2, 3, 4, 5)
+    assert serialization.json_dumps({"t": stamp}, default=str) == '{"t":"2026-01-02 03:04:05"}'
+    assert serialization.json_dumps({1: 10 ** 30}) == '{"1":1000000000000000000000000000000}'
+
+    monkeypatch.setattr(serialization, "orjson", None)
+    monkeypatch.setattr(serialization, "msgspec", None)
+    monkeypatch.setattr(serialization, "BACKEND", "json")
+    assert serialization.json_dumps(payload) == compact
+    assert serialization.json_dumps(payload, indent=True) == pretty
+
+
+def test_session_persistence_round_trip(tmp_path):
+    """Sessions persisted through the serialization layer reload with datetimes restored"""
+    from app.services.session_manager import CanvasSessionManager
+
+    writer = CanvasSessionManager(persist_path=str(tmp_path), enable_persistence=True)
+    nodes = [Node(id="1", type="api", position=Position(x=0, y=0), data=NodeData(label="网关"))]
+    edges = [Edge(id="e1", source="1", target="1")]
+    session_id = writer.create_or_update_session(None, nodes, edges)
+    assert writer.flush(timeout=5)
+
+    persisted = json.loads((tmp_path / f"{session_id}.json").read_text(encoding="utf-8"))
+    assert persisted["nodes"][0]["data"]["label"] == "网关"
+
+    reader = CanvasSessionManager(persist_path=str(tmp_path), enable_persistence=True)
+    session = reader.get_session(session_id)
+    assert session["nodes"][0]["data"]["label"] == "网关"
+    assert session["created_at"] <= session["timestamp"]
+
+
+
+def test_session_write_behind_coalesces_and_writes_atomically(tmp_path):
+    """Rapid saves are coalesced into one atomic write of the latest state; deletes are not resurrected"""
+    from app.services.session_manager import CanvasSessionManager
+
+    manager = CanvasSessionManager(persist_path=str(tmp_path), flush_interval_seconds=60)
+    edges: list = []
+    session_id = None
+    for i in range(5):
+        nodes = [Node(id="1", type="api", position=Position(x=0, y=0), data=NodeData(label=f"v{i}"))]
+        session_id = manager.create_or_update_session(session_id, nodes, edges)
+
+    # 合并窗口内尚未落盘
+    assert not (tmp_path / f"{session_id}.json").exists()
+    stats = manager.get_persistence_stats()
+    assert stats["queue_depth"] == 1 and stats["coalesced"] == 4
+
+    assert manager.flush(timeout=5)
+    persisted = json.loads((tmp_path / f"{session_id}.json").read_text(encoding="utf-8"))
+    assert persisted["nodes"][0]["data"]["label"] == "v4"
+    assert persisted["version"] == 5
+    assert list(tmp_path.glob("*.tmp")) == []
+    stats = manager.get_persistence_stats()
+    assert stats["writes"] == 1 and stats["queue_depth"] == 0 and stats["flushes"] == 1
+
+    manager.delete_session(session_id)
+    assert manager.get_session(session_id) is None
+    manager.close()
+    assert not (tmp_path / f"{session_id}.json").exists()
+
+
+
+def test_session_lru_evicts_to_disk_and_sweeps_expired(tmp_path):
+    """The memory tier is bounded; evicted sessions reload from disk with their version, expiry stops at the first live session"""
+    from datetime import timedelta
+    from app.services.session_manager import CanvasSessionManager
+
+    manager = CanvasSessionManager(persist_path=str(tmp_path), flush_interval_seconds=60, max_sessions=2)
+    nodes = [Node(id="1", type="api", position=Position(x=0, y=0), data=NodeData(label="网关"))]
+    first = manager.create_or_update_session(None, nodes, [])
+    first = manager.create_or_update_session(first, nodes, [])
+    second = manager.create_or_update_session(None, nodes, [])
+    third = manager.create_or_update_session(None, nodes, [])
+
+    # first 被淘汰，尚未落盘时从写回队列的快照恢复
+    stats = manager.get_session_stats()
+    assert stats["total_sessions"] == 2 and stats["evictions"] == 1 and stats["total_nodes"] == 2
+    assert manager.get_session_version(first) is None
+    assert manager.get_session(first)["version"] == 2
+    assert manager.create_or_update_session(first, nodes, []) == first
+    assert manager.get_session_version(first) == 3
+    assert manager.get_session_count() == 2
+
+    # LRU 顺序为 [third, first]（second 已被淘汰）：third 过期，first 未过期，清理在此停止
+    assert list(manager._sessions) == [third, first]
+    manager._sessions[third]["timestamp"] -= timedelta(hours=2)
+    manager._timestamp_total -= timedelta(hours=2).total_seconds()
+    assert manager.cleanup_expired(max_batch=10) == 1
+    assert manager.get_session_stats()["total_sessions"] == 1
+    assert manager.get_session(second)["node_count"] == 1
+    manager.close()
+
+
+
+def test_sqlite_session_store_shared_between_workers(tmp_path):
+    """Two managers over one SQLite WAL store see each other's saves; stale writes never regress the version"""
+    from datetime import datetime, timedelta
+    from app.services.session_manager import CanvasSessionManager
+    from app.services.session_store import SQLiteSessionStore
+
+    db_path = str(tmp_path / "sessions.db")
+    worker_a = CanvasSessionManager(store=SQLiteSessionStore(db_path), flush_interval_seconds=60)
+    worker_b = CanvasSessionManager(store=SQLiteSessionStore(db_path), write_behind=False)
+    nodes = [Node(id="1", type="api", position=Position(x=0, y=0), data=NodeData(label="网关"))]
+
+    session_id = worker_a.create_or_update_session(None, nodes, [])
+    assert worker_b.get_session(session_id) is None
+    worker_a.flush(timeout=5)
+    assert worker_b.get_session(session_id)["version"] == 1
+
+    # worker B 写入新版本，worker A 的内存副本在访问时按版本号重新加载
+    renamed = [Node(id="1", type="api", position=Position(x=0, y=0), data=NodeData(label="API Gateway"))]
+    worker_b.create_or_update_session(session_id, renamed, [])
+    session = worker_a.get_session(session_id)
+    assert session["version"] == 2 and session["nodes"][0]["data"]["label"] == "API Gateway"
+
+    store = SQLiteSessionStore(db_path)
+    stale = dict(store.load(session_id), version=1)
+    store.save(session_id, stale)
+    store.save(session_id, dict(stale, version=2))  # 同版本的并发写入同样被拒绝
+    assert store.get_version(session_id) == 2
+    assert store.get_stats()["stale_writes"] == 2
+
+    assert store.delete_expired(datetime.now() - timedelta(hours=1)) == 0
+    assert store.delete_expired(datetime.now() + timedelta(hours=1)) == 1
+    assert store.load(session_id) is None
+    for closable in (store, worker_a, worker_b):
+        closable.close()
+
+
+def test_sqlite_session_store_reports_rejected_writes_and_tracks_access(tmp_path):
+    """A worker whose same-version write loses reloads the winner; reads keep the row from expiring"""
+    from datetime import datetime, timedelta
+    from app.services.session_manager import CanvasSessionManager
+    from app.services.session_store import SQLiteSessionStore
+
+    db_path = str(tmp_path / "sessions.db")
+    worker_a = CanvasSessionManager(store=SQLiteSessionStore(db_path), write_behind=False)
+    worker_b = CanvasSessionManager(store=SQLiteSessionStore(db_path), flush_interval_seconds=60)
+
+    def graph(label):
+        return [Node(id="1", type="api", position=Position(x=0, y=0), data=NodeData(label=label))]
+
+    session_id = worker_a.create_or_update_session(None, graph("v1"), [])
+    assert worker_b.get_session(session_id)["version"] == 1
+
+    # 两个 worker 都从 v1 保存为 v2：B 的写回晚于 A 落盘而被拒绝，B 下次访问时改用 A 的版本
+    worker_b.create_or_update_session(session_id, graph("from B"), [])
+    worker_a.create_or_update_session(session_id, graph("from A"), [])
+    worker_b.flush(timeout=5)
+    assert worker_b._stale_writes == {session_id: 2}
+    session = worker_b.get_session(session_id)
+    assert session["version"] == 2 and session["nodes"][0]["data"]["label"] == "from A"
+
+    # 只读访问更新存储中的访问时间：最后保存很久以前的会话不会被其他 worker 清理
+    store = SQLiteSessionStore(db_path)
+    old = (datetime.now() - timedelta(hours=2)).isoformat()
+    store.save(session_id, dict(store.load(session_id), version=3, timestamp=old))
+    assert store.delete_expired(datetime.now() - timedelta(hours=1)) == 0  # A / B 读取时已记录访问
+    store.touch(session_id, datetime.now() - timedelta(hours=3))  # 访问时间只前进不后退
+    worker_c = CanvasSessionManager(store=SQLiteSessionStore(db_path), write_behind=False)
+    assert worker_c.get_session(session_id)["version"] == 3
+    assert store.delete_expired(datetime.now() - timedelta(hours=1)) == 0
+    assert store.delete_expired(datetime.now() + timedelta(hours=1)) == 1
+    for closable in (store, worker_a, worker_b, worker_c):
+        closable.close()
+
+
+def test_sqlite_session_patch_commits_version_in_store_before_ack(tmp_path):
+    """On a shared store two patches based on the same version cannot both succeed, even across workers"""
+    import pytest
+    from app.services.session_manager import CanvasSessionManager, SessionVersionConflict
+    from app.services.session_store import SQLiteSessionStore
+
+    db_path = str(tmp_path / "sessions.db")
+    worker_a = CanvasSessionManager(store=SQLiteSessionStore(db_path), flush_interval_seconds=60)
+    worker_b = CanvasSessionManager(store=SQLiteSessionStore(db_path), flush_interval_seconds=60)
+    nodes = [Node(id="1", type="api", position=Position(x=0, y=0), data=NodeData(label="网关"))]
+
+    # 会话尚在 A 的写回队列中：补丁直接同步写入，之后的写回不会再覆盖
+    session_id = worker_a.create_or_update_session(None, nodes, [])
+    worker_a.patch_session(session_id, [{"op": "update_node", "id": "1", "position": {"x": 10}}], 1)
+    store = SQLiteSessionStore(db_path)
+    assert store.get_version(session_id) == 2
+    worker_a.flush(timeout=5)
+    assert store.get_stats()["stale_writes"] == 0 and worker_a._stale_writes == {}
+    assert worker_b.get_session(session_id)["version"] == 2
+
+    # B 的内存副本仍是 v2 时 A 已提交 v3：B 基于 v2 的补丁在存储中比较失败，不会被应答
+    worker_a.patch_session(session_id, [{"op": "update_node", "id": "1", "position": {"x": 20}}], 2)
+    revalidate = worker_b._revalidate
+    worker_b._revalidate = lambda sid: None  # 模拟版本校验与提交之间的竞争窗口
+    with pytest.raises(SessionVersionConflict) as conflict:
+        worker_b.patch_session(session_id, [{"op": "update_node", "id": "1", "position": {"x": 99}}], 2)
+    assert conflict.value.current_version == 3
+    worker_b._revalidate = revalidate
+
+    session = worker_b.get_session(session_id)
+    assert session["version"] == 3 and session["nodes"][0]["position"]["x"] == 20
+    assert store.load(session_id)["nodes"][0]["position"]["x"] == 20
+
+    # 基于旧版本生成的结果同样按版本提交，不覆盖其他 worker 的补丁
+    worker_a.patch_session(session_id, [{"op": "update_node", "id": "1", "position": {"x": 30}}], 3)
+    worker_b._revalidate = lambda sid: None
+    with pytest.raises(SessionVersionConflict):
+        worker_b.create_or_update_session(session_id, nodes, [], expected_version=3)
+    worker_b._revalidate = revalidate
+    assert store.load(session_id)["nodes"][0]["position"]["x"] == 30
+    worker_b.create_or_update_session(session_id, nodes, [], expected_version=4)
+    assert store.get_version(session_id) == 5
+    for closable in (store, worker_a, worker_b):
+        closable.close()
+
+
+def test_binary_session_snapshot_round_trip_and_migration(tmp_path, monkeypatch):
+    """Binary snapshots round-trip sessions, hydrate models through SessionGraph, and replace legacy JSON files"""
+    import pytest
+    from app.core.serialization import write_json_file
+    from app.services.session_graph import SessionGraph
+    from app.services.session_manager import CanvasSessionManager
+    from app.services.session_snapshot import (
+        FORMAT_VERSION, SnapshotFormatError, decode_snapshot, encode_snapshot, migrate_json_sessions,
+    )
+    from app.services.session_store import FileSessionStore
+
+    nodes = [
+        Node(id=f"n{i}", type="service", position=Position(x=i * 10.5, y=-i), data=NodeData(label=f"服务 {i}"))
+        for i in range(50)
+    ]
+    snapshot = {
+        "nodes": [node.model_dump() for node in nodes],
+        "edges": [{"id": "e1", "source": "n0", "target": "n1", "label": "calls"},
+                  {"id": "e2", "source": "n1", "target": "external", "label": None}],
+        "timestamp": "2024-01-01T00:00:00", "created_at": "2024-01-01T00:00:00", "version": 3,
+        "node_count": 50, "edge_count": 2,
+    }
+    for compression in ("none", "zlib"):
+        data = encode_snapshot(snapshot, compression)
+        assert data[:4] == b"CSNP" and data[4] == FORMAT_VERSION
+        decoded = decode_snapshot(data)
+        assert decoded.session_fields["version"] == 3 and decoded.node_count == 50
+        assert decoded.to_session() == snapshot
+        assert SessionGraph.from_dicts(decoded.nodes, decoded.edges).nodes[3] == nodes[3]
+    assert len(encode_snapshot(snapshot, "zlib")) < len(encode_snapshot(snapshot, "none"))
+    with pytest.raises(SnapshotFormatError):
+        decode_snapshot(b"CSNP\x63" + encode_snapshot(snapshot)[5:])
+
+    # 旧 JSON 会话可直接读取，保存后替换为 .snap
+    from datetime import datetime
+    now = datetime.now().isoformat()
+    write_json_file(tmp_path / "legacy.json", dict(snapshot, timestamp=now, created_at=now))
+    manager = CanvasSessionManager(
+        persist_path=str(tmp_path), store=FileSessionStore(str(tmp_path), snapshot_format="binary"), write_behind=False
+    )
+    assert manager.get_session("legacy")["node_count"] == 50
+    manager.create_or_update_session("legacy", nodes[:2], [])
+    assert not (tmp_path / "legacy.json").exists()
+    assert FileSessionStore(str(tmp_path), snapshot_format="binary").load("legacy")["node_count"] == 2
+    manager.close()
+
+    write_json_file(tmp_path / "old.json", snapshot)
+    assert migrate_json_sessions(str(tmp_path))["converted"] == 1
+    assert decode_snapshot((tmp_path / "old.snap").read_bytes()).to_session() == snapshot
+
+    # 启动迁移只在文件存储 + binary 格式下执行
+    from app.core.config import settings
+    from app.services.session_manager import migrate_session_snapshots
+
+    write_json_file(tmp_path / "startup.json", snapshot)
+    monkeypatch.setattr(settings, "SESSION_STORE_BACKEND", "sqlite")
+    assert migrate_session_snapshots(str(tmp_path)) is None
+    monkeypatch.setattr(settings, "SESSION_STORE_BACKEND", "file")
+    monkeypatch.setattr(settings, "SESSION_SNAPSHOT_FORMAT", "binary")
+    assert migrate_session_snapshots(str(tmp_path))["converted"] == 1
+    assert not (tmp_path / "startup.json").exists() and (tmp_path / "startup.snap").exists()
+
+
+def test_session_graph_cache_reuses_unchanged_elements():
+    """Validated models are cached per version; saves and patches only rebuild the elements that changed"""
+    from app.services.session_manager import CanvasSessionManager
+
+    manager = CanvasSessionManager(enable_persistence=False)
+    nodes = [Node(id=f"n{i}", type="api", position=Position(x=i, y=0), data=NodeData(label=f"N{i}")) for i in range(10)]
+    edges = [Edge(id=f"e{i}", source=f"n{i}", target=f"n{i + 1}") for i in range(9)]
+    session_id = manager.create_or_update_session(None, nodes, edges)
+
+    session, graph = manager.get_session_graph(session_id)
+    assert graph.nodes[3] is nodes[3] and graph.node_dicts is session["nodes"]
+    assert manager.get_session_graph(session_id)[1] is graph
+
+    # 保存时未改动的模型复用上一版本的字典
+    moved = nodes[0].model_copy(update={"position": Position(x=500, y=500)})
+    manager.create_or_update_session(session_id, [moved] + graph.nodes[1:], graph.edges)
+    session, saved = manager.get_session_graph(session_id)
+    assert saved.rebuilt == 1 and saved.node_dicts[5] is graph.node_dicts[5]
+    assert session["nodes"][0]["position"] == {"x": 500.0, "y": 500.0}
+
+    # 补丁后只校验被替换的元素
+    manager.patch_session(session_id, [{"op": "update_node", "id": "n2", "data": {"label": "Gateway"}}], None)
+    _, patched = manager.get_session_graph(session_id)
+    assert patched.rebuilt == 1 and patched.nodes[2].data.label == "Gateway"
+    assert patched.nodes[4] is saved.nodes[4] and saved.nodes[2].data.label == "N2"
+    stats = manager.get_session_stats()
+    assert stats["graph_cache_hits"] == 3 and stats["graph_cache_builds"] == 1 and stats["graph_rebuilt_elements"] == 1
+
+
+def test_incremental_merge_leaves_cached_session_nodes_untouched():
+    """Merging AI output copies nodes instead of mutating the shared, cached session models"""
+    from app.services.chat_generator import ChatGeneratorService
+
+    originals = [
+        Node(id="a", type="api", position=Position(x=0, y=0), data=NodeData(label="A", color="#111")),
+        Node(id="b", type="cache", position=Position(x=50, y=0), data=NodeData(label="B")),
+    ]
+    snapshot = [node.model_dump() for node in originals]
+    ai_nodes = [
+        Node(id="a", type="service", position=Position(x=900, y=900), data=NodeData(label="A2")),
+        Node(id="c", type="queue", position=Position(x=10, y=10), data=NodeData(label="C")),
+    ]
+
+    merged = ChatGeneratorService()._validate_incremental_result(originals, ai_nodes)
+    assert [node.model_dump() for node in originals] == snapshot
+    by_id = {node.id: node for node in merged}
+    assert by_id["a"].type == "api" and by_id["a"].data is originals[0].data
+    assert by_id["b"].id == "b" and by_id["c"].position.x == 270
+
+
+# ============================================================
+# Graph Codec Tests
+# ============================================================
+
+def test_graph_codec_round_trip_and_restores_ids():
+    """Compact encoding decodes back to the same graph; model output short ids map to original ids"""
+    from app.services.graph_codec import GraphCodec
+
+    nodes = [
+        Node(id="service-order", type="service", position=Position(x=963.4, y=198), data=NodeData(label="Order Service", shape="task")),
+        Node(id="db|main", type="database", position=Position(x=1220, y=200), data=NodeData(label='MySQL "主库" | rw')),
+        Node(id="svc-2", type="service", position=Position(x=0, y=0), data=NodeData(label="Auth: login, sso")),
+    ]
+    edges = [
+        Edge(id="e-a", source="service-order", target="db|main", label="SQL, 读写"),
+        Edge(id="e-b", source="service-order", target="svc-2"),
+    ]
+    codec = GraphCodec(nodes, edges)
+    text = codec.encode()
+    assert "s=service" in text and "d=database" in text
+    assert "n1>n2:\"SQL, 读写\",n3" in text
+    assert "service-order" not in text
+
+    decoded_nodes, decoded_edges = codec.decode(text)
+    assert [(n.id, n.type, n.data.label, n.data.shape) for n in decoded_nodes] == [
+        (n.id, n.type, n.data.label, n.data.shape) for n in nodes
+    ]
+    assert (decoded_nodes[0].position.x, decoded_nodes[0].position.y) == (960, 200)
+    assert [(e.source, e.target, e.label) for e in decoded_edges] == [(e.source, e.target, e.label) for e in edges]
+
+    no_positions = GraphCodec(nodes, edges, position_grid=None)
+    assert "pos" not in no_positions.encode()
+    assert no_positions.decode(no_positions.encode())[0][1].data.label == nodes[1].data.label
+
+    restored = codec.restore_ids({
+        "nodes": [{"id": "n1"}, {"id": "cache-1"}],
+        "edges": [{"id": "x", "source": "n1", "target": "cache-1"}, {"source": "cache-1", "target": "n2"}],
+    })
+    assert [n["id"] for n in restored["nodes"]] == ["service-order", "cache-1"]
+    assert [(e["source"], e["target"]) for e in restored["edges"]] == [
+        ("service-order", "cache-1"), ("cache-1", "db|main")
+    ]
+
+
+@pytest.mark.asyncio
+async def test_incremental_generation_uses_compact_prompt(monkeypatch):
+    """Incremental generation embeds the compact encoding and merges short-id output into the session"""
+    from app.models.schemas import ChatGenerationRequest
+    from app.services import chat_generator
+    from app.services.chat_generator import ChatGeneratorService
+    from app.services.session_manager import CanvasSessionManager
+
+    session_manager = CanvasSessionManager(enable_persistence=False)
+    existing_nodes = [
+        Node(id="api-1", type="api", position=Position(x=100, y=100), data=NodeData(label="API Gateway", color="#111")),
+        Node(id="service-1", type="service", position=Position(x=400, y=100), data=NodeData(label="Order Service")),
+    ]
+    session_id = session_manager.create_or_update_session(
+        None, existing_nodes, [Edge(id="e1", source="api-1", target="service-1")]
+    )
+
+    class FakePresets:
+        def get_active_config(self, **kwargs):
+            return {"provider": "custom", "api_key": "k", "model_name": "m"}
+
+        def get_failover_configs(self, **kwargs):
+            return []
+
+    prompts = []
+
+    async def fake_call(vision_service, prompt, provider):
+        prompts.append(prompt)
+        return {
+            "nodes": [
+                {"id": "n1", "type": "api", "position": {"x": 100, "y": 100}, "data": {"label": "API Gateway"}},
+                {"id": "cache-1", "type": "cache", "position": {"x": 700, "y": 100}, "data": {"label": "Redis"}},
+            ],
+            "edges": [{"id": "e9", "source": "n2", "target": "cache-1"}],
+        }
+
+    service = ChatGeneratorService()
+    monkeypatch.setattr(chat_generator, "get_session_manager", lambda: session_manager)
+    monkeypatch.setattr(chat_generator, "get_model_presets_service", lambda: FakePresets())
+    monkeypatch.setattr(chat_generator, "create_vision_service", lambda **kwargs: None)
+    monkeypatch.setattr(service, "_call_ai_text_generation", fake_call)
+
+    response = await service.generate_flowchart(
+        ChatGenerationRequest(user_input="add a cache", incremental_mode=True, session_id=session_id),
+        provider="custom",
+    )
+
+    assert "n1|a|API Gateway|100,100" in prompts[0]
+    assert "n1>n2" in prompts[0]
+    assert '"position"' not in prompts[0].split("User request:")[0]
+    assert [n.id for n in response.nodes] == ["api-1", "cache-1", "service-1"]
+    assert response.nodes[0].data.color == "#111"
+    assert {(e.source, e.target) for e in response.edges} == {("api-1", "service-1"), ("service-1", "cache-1")}
+    assert session_manager.get_session(session_id)["node_count"] == 3
+
+
+@pytest.mark.asyncio
+async def test_incremental_delta_response_requires_matching_base_version(monkeypatch):
+    """Delta mode returns only the changes when base_version matches, and the full graph otherwise"""
+    from app.models.schemas import ChatGenerationRequest
+    from app.services import chat_generator
+    from app.services.chat_generator import ChatGeneratorService
+    from app.services.session_manager import CanvasSessionManager
+
+    session_manager = CanvasSessionManager(enable_persistence=False)
+    session_id = session_manager.create_or_update_session(
+        None,
+        [
+            Node(id="api-1", type="api", position=Position(x=0, y=0), data=NodeData(label="Gateway")),
+            Node(id="db-1", type="database", position=Position(x=300, y=0), data=NodeData(label="MySQL")),
+        ],
+        [Edge(id="e0", source="api-1", target="db-1")],
+    )
+
+    class FakePresets:
+        def get_active_config(self, **kwargs):
+            return {"provider": "custom", "api_key": "k", "model_name": "m"}
+
+        def get_failover_configs(self, **kwargs):
+            return []
+
+    async def fake_call(vision_service, prompt, provider):
+        return {"ops": [
+            {"op": "add_node", "id": "cache-1", "type": "cache", "label": "Redis"},
+            {"op": "add_edge", "id": "e-new", "source": "n1", "target": "cache-1"},
+            {"op": "update_label", "id": "n2", "label": "PostgreSQL"},
+            {"op": "remove_edge", "source": "n1", "target": "n2"},
+        ]}
+
+    service = ChatGeneratorService()
+    monkeypatch.setattr(chat_generator, "get_session_manager", lambda: session_manager)
+    monkeypatch.setattr(chat_generator, "get_model_presets_service", lambda: FakePresets())
+    monkeypatch.setattr(chat_generator, "create_vision_service", lambda **kwargs: None)
+    monkeypatch.setattr(service, "_call_ai_text_generation", fake_call)
+
+    def make_request(base_version):
+        return ChatGenerationRequest(
+            user_input="add a cache", incremental_mode=True, session_id=session_id,
+            incremental_output="ops", response_mode="delta", base_version=base_version,
+        )
+
+    response = await service.generate_flowchart(make_request(1), provider="custom")
+    assert (response.base_version, response.session_version) == (1, 2)
+    assert response.nodes == [] and response.edges == []
+    assert [n.id for n in response.delta.added_nodes] == ["cache-1"]
+    assert [(n.id, n.data.label) for n in response.delta.modified_nodes] == [("db-1", "PostgreSQL")]
+    assert [e.id for e in response.delta.added_edges] == ["e-new"]
+    assert response.delta.removed_edge_ids == ["e0"] and response.delta.removed_node_ids == []
+
+    stale = await service.generate_flowchart(make_request(1), provider="custom")
+    assert stale.delta is None and stale.session_version == 3
+    assert len(stale.nodes) == 3 and "base_version does not match" in stale.message
+
+
+@pytest.mark.asyncio
+async def test_generation_result_never_overwrites_concurrent_patch(monkeypatch):
+    """A PATCH made during the model call survives: ops are replayed on top, merged graphs answer 409"""
+    from fastapi import HTTPException
+    from app.models.schemas import ChatGenerationRequest
+    from app.services import chat_generator
+    from app.services.chat_generator import ChatGeneratorService
+    from app.services.session_manager import CanvasSessionManager
+
+    session_manager = CanvasSessionManager(enable_persistence=False)
+    session_id = session_manager.create_or_update_session(
+        None,
+        [
+            Node(id="api-1", type="api", position=Position(x=0, y=0), data=NodeData(label="Gateway")),
+            Node(id="db-1", type="database", position=Position(x=300, y=0), data=NodeData(label="MySQL")),
+        ],
+        [Edge(id="e0", source="api-1", target="db-1")],
+    )
+
+    class FakePresets:
+        def get_active_config(self, **kwargs):
+            return {"provider": "custom", "api_key": "k", "model_name": "m"}
+
+        def get_failover_configs(self, **kwargs):
+            return []
+
+    async def fake_call(vision_service, prompt, provider):
+        version = session_manager.get_session_version(session_id)
+        session_manager.patch_session(
+            session_id, [{"op": "update_node", "id": "api-1", "data": {"label": f"Edited v{version}"}}], version
+        )
+        if '"ops"' in prompt:
+            return {"ops": [
+                {"op": "add_node", "id": "cache-1", "type": "cache", "label": "Redis"},
+                {"op": "add_edge", "source": "n1", "target": "cache-1"},
+            ]}
+        return {"nodes": [{"id": "n3", "type": "cache", "position": {"x": 600, "y": 0}, "data": {"label": "Redis"}}]}
+
+    service = ChatGeneratorService()
+    monkeypatch.setattr(chat_generator, "get_session_manager", lambda: session_manager)
+    monkeypatch.setattr(chat_generator, "get_model_presets_service", lambda: FakePresets())
+    monkeypatch.setattr(chat_generator, "create_vision_service", lambda **kwargs: None)
+    monkeypatch.setattr(service, "_call_ai_text_generation", fake_call)
+
+    response = await service.generate_flowchart(
+        ChatGenerationRequest(user_input="add a cache", incremental_mode=True, session_id=session_id,
+                              incremental_output="ops"),
+        provider="custom",
+    )
+    assert response.session_version == 3
+    session = session_manager.get_session(session_id)
+    assert [n["data"]["label"] for n in session["nodes"]] == ["Edited v1", "MySQL", "Redis"]
+    assert ("api-1", "cache-1") in [(e["source"], e["target"]) for e in session["edges"]]
+
+    with pytest.raises(HTTPException) as conflict:
+        await service.generate_flowchart(
+            ChatGenerationRequest(user_input="add a cache", incremental_mode=True, session_id=session_id),
+            provider="custom",
+        )
+    assert conflict.value.status_code == 409
+    session = session_manager.get_session(session_id)
+    assert session["version"] == 4 and session["nodes"][0]["data"]["label"] == "Edited v3"
+
+
+def test_incremental_scope_selects_relevant_k_hop_subgraph(monkeypatch):
+    """Large canvases send only the neighbourhood of request-relevant nodes plus a one-line summary"""
+    from app.core.config import settings
+    from app.models.schemas import ChatGenerationRequest
+    from app.services.chat_generator import ChatGeneratorService
+    from app.services.graph_codec import GraphCodec, k_hop_subgraph
+
+    monkeypatch.setattr(settings, "INCREMENTAL_SCOPE_MIN_NODES", 10)
+    monkeypatch.setattr(settings, "INCREMENTAL_SCOPE_HOPS", 1)
+    labels = [f"Worker {i}" for i in range(60)]
+    labels[30] = "Order Service"
+    labels[45] = "支付服务"
+    nodes = [
+        Node(id=f"node-{i}", type="service", position=Position(x=i * 200, y=0), data=NodeData(label=label))
+        for i, label in enumerate(labels)
+    ]
+    edges = [Edge(id=f"e{i}", source=f"node-{i}", target=f"node-{i + 1}") for i in range(59)]
+
+    sub_nodes, sub_edges = k_hop_subgraph(nodes, edges, ["node-30"], hops=2, max_nodes=4)
+    assert [n.id for n in sub_nodes] == ["node-28", "node-29", "node-30", "node-31"]
+    assert len(sub_edges) == 3
+
+    service = ChatGeneratorService()
+    scoped_nodes, scoped_edges, summary = service._scope_incremental_graph(
+        "add a cache in front of the order service, 并给支付服务加限流", nodes, edges
+    )
+    assert [n.id for n in scoped_nodes] == ["node-29", "node-30", "node-31", "node-44", "node-45", "node-46"]
+    assert len(scoped_edges) == 4
+    assert summary.startswith("Not shown (unchanged, keep as is): 54 more nodes (service: 54) and 55 more edges")
+
+    prompt = service._build_incremental_prompt(
+        ChatGenerationRequest(user_input="add a cache in front of the order service", incremental_mode=True),
+        nodes, edges, GraphCodec(scoped_nodes, scoped_edges), summary,
+    )
+    assert "Order Service" in prompt and "Worker 0" not in prompt
+    assert "nodes=60, edges=59" in prompt and "x >= 12080" in prompt
+
+    unmatched = service._scope_incremental_graph("add monitoring", nodes, edges)
+    assert unmatched == (nodes, edges, "")
+
+
+def test_graph_op_applier_validates_operations():
+    """Ops apply in order against a working copy; invalid ops are rejected without side effects"""
+    from app.services.graph_codec import GraphCodec
+    from app.services.graph_ops import GraphOpApplier, GraphOpError
+
+    nodes = [
+        Node(id="api-1", type="api", position=Position(x=0, y=100), data=NodeData(label="Gateway")),
+        Node(id="db-1", type="database", position=Position(x=400, y=100), data=NodeData(label="MySQL")),
+    ]
+    edges = [Edge(id="e0", source="api-1", target="db-1")]
+    applier = GraphOpApplier(nodes, edges, codec=GraphCodec(nodes, edges))
+
+    applied, rejected = applier.apply_all([
+        {"op": "add_node", "id": "cache-1", "type": "cache", "label": "Redis"},
+        {"op": "add_node", "id": "n1", "label": "Duplicate of api-1"},
+        {"op": "add_edge", "source": "n1", "target": "cache-1"},
+        {"op": "add_edge", "source": "n1", "target": "n2"},
+        {"op": "remove_edge", "source": "n1", "target": "n2"},
+        {"op": "delete_node", "id": "n2"},
+        "not an op",
+    ])
+    assert [item["op"] for item in applied] == ["add_node", "add_edge", "remove_edge"]
+    assert applied[0]["node"]["position"] == {"x": 680.0, "y": 100.0}
+    assert [item["reason"] for item in rejected] == [
+        "node 'api-1' already exists",
+        "edge 'api-1' -> 'db-1' already exists",
+        "unsupported op 'delete_node' (expected one of add_node, add_edge, update_label, remove_edge)",
+        "operation must be an object",
+    ]
+    assert [(e.source, e.target) for e in applier.edges] == [("api-1", "cache-1")]
+    assert [e.id for e in edges] == ["e0"] and len(nodes) == 2
+
+    with pytest.raises(GraphOpError):
+        applier.apply({"op": "update_label", "id": "n9", "label": "x"})
+    assert applier.apply({"op": "update_label", "id": "n2", "label": " PostgreSQL "})["label"] == "PostgreSQL"
+    assert applier.nodes[1].data.label == "PostgreSQL" and nodes[1].data.label == "MySQL"
+
+
+# ============================================================
+# Fake LLM Server Tests
+# ============================================================
+
+@pytest.mark.asyncio
+async def test_fake_llm_server_speaks_openai_and_anthropic_streams():
+    """The fake server is consumable by the real OpenAI / Anthropic SDK stream parsers"""
+    import httpx
+    from anthropic import AsyncAnthropic
+    from openai import AsyncOpenAI
+    from benchmarks.fake_llm_server import FakeLLMConfig, create_app
+
+    app = create_app(FakeLLMConfig(first_token_ms=0, tokens_per_second=0, payload="microservice"))
+    transport = httpx.ASGITransport(app=app)
+    messages = [{"role": "user", "content": "design a microservice"}]
+
+    async with httpx.AsyncClient(transport=transport) as http_client:
+        openai_client = AsyncOpenAI(api_key="k", base_url="http://fake/v1", http_client=http_client)
+        stream = await openai_client.chat.completions.create(model="fake-gpt", messages=messages, stream=True)
+        text, finish = "", None
+        async for chunk in stream:
+            text += chunk.choices[0].delta.content or ""
+            finish = chunk.choices[0].finish_reason or finish
+        assert finish == "stop"
+        assert len(json.loads(text)["nodes"]) > 0
+
+        anthropic_client = AsyncAnthropic(api_key="k", base_url="http://fake", http_client=http_client)
+        async with anthropic_client.messages.stream(model="claude-fake", max_tokens=8, messages=messages) as claude:
+            claude_text = "".join([token async for token in claude.text_stream])
+            final = await claude.get_final_message()
+        assert text.startswith(claude_text)
+        assert final.stop_reason == "max_tokens"
+
+
+@pytest.mark.asyncio
+async def test_fake_llm_server_injects_rate_limits_and_truncation():
+    """Forced 429 carries Retry-After; injected truncation ends with finish_reason=length"""
+    import httpx
+    from benchmarks.fake_llm_server import FakeLLMConfig, create_app
+
+    app = create_app(FakeLLMConfig(first_token_ms=0, tokens_per_second=0, retry_after_seconds=2))
+    body = {"model": "m", "messages": [{"role": "user", "content": "render excalidraw"}]}
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://fake") as client:
+        limited = await client.post("/v1/chat/completions", json=body, headers={"X-Fake-Error": "429"})
+        assert limited.status_code == 429
+        assert limited.headers["retry-after"] == "2"
+
+        complete = (await client.post("/v1/chat/completions", json=body)).json()["choices"][0]
+        assert complete["finish_reason"] == "stop"
+        assert "elements" in json.loads(complete["message"]["content"])
+
+        truncated = await client.post("/v1/chat/completions", json=body, headers={"X-Fake-Error": "truncate"})
+        choice = truncated.json()["choices"][0]
+        assert choice["finish_reason"] == "length"
+        assert complete["message"]["content"].startswith(choice["message"]["content"])
+
+        stats = (await client.get("/_fake/stats")).json()["stats"]
+        assert stats["injected_429"] == 1
+        assert stats["injected_truncate"] == 1
+
+
 # ============================================================
 # Integration Tests
 # ============================================================